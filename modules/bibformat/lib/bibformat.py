@@ -50,7 +50,8 @@ from invenio.config import \
      CFG_SITE_RECORD, \
      CFG_BIBFORMAT_DISABLE_I18N_FOR_CACHED_FORMATS
 from invenio.bibformat_config import \
-     CFG_BIBFORMAT_USE_OLD_BIBFORMAT
+     CFG_BIBFORMAT_USE_OLD_BIBFORMAT, \
+     CFG_BIBFORMAT_BATCH_SIZE
 from invenio.access_control_engine import acc_authorize_action
 import getopt
 import sys
@@ -100,7 +101,8 @@ def format_record(recID, of, ln=CFG_SITE_LANG, verbose=0, search_pattern=None,
     @return: formatted record
     @rtype: string
     """
-    from invenio.search_engine import record_exists
+    from invenio.search_engine import record_exists, \
+         get_prefetched_preformatted_record
     if search_pattern is None:
         search_pattern = []
 
@@ -128,7 +130,10 @@ def format_record(recID, of, ln=CFG_SITE_LANG, verbose=0, search_pattern=None,
         # always served from the same cache for any language.  Also,
         # do not fetch from DB when record has been deleted: we want
         # to return an "empty" record in that case
-        res = bibformat_dblayer.get_preformatted_record(recID, of)
+        try:
+            res = get_prefetched_preformatted_record(recID, of)
+        except KeyError:
+            res = bibformat_dblayer.get_preformatted_record(recID, of)
         if res is not None:
             # record 'recID' is formatted in 'of', so return it
             if verbose == 9:
@@ -170,7 +175,8 @@ def format_record(recID, of, ln=CFG_SITE_LANG, verbose=0, search_pattern=None,
                                               verbose=verbose,
                                               search_pattern=search_pattern,
                                               xml_record=xml_record,
-                                              user_info=user_info)
+                                              user_info=user_info,
+                                              use_cache=not on_the_fly)
         if of.lower() == 'xm':
             out = filter_hidden_fields(out, user_info)
         return out
@@ -293,6 +299,8 @@ def format_records(recIDs, of, ln=CFG_SITE_LANG, verbose=0, search_pattern=None,
     @type on_the_fly: boolean
     @rtype: string
     """
+    from invenio.search_engine import prefetch_records, \
+         clear_prefetched_records
     if req is not None:
         req.write(prologue)
 
@@ -306,53 +314,64 @@ def format_records(recIDs, of, ln=CFG_SITE_LANG, verbose=0, search_pattern=None,
 
     total_rec = len(recIDs)
     last_iteration = False
-    for i in range(total_rec):
-        if i == total_rec - 1:
-            last_iteration = True
-
-        #Print prefix
-        if record_prefix is not None:
-            if isinstance(record_prefix, str):
-                formatted_records += record_prefix
-                if req is not None:
-                    req.write(record_prefix)
-            else:
-                string_prefix = record_prefix(i)
-                formatted_records += string_prefix
-                if req is not None:
-                    req.write(string_prefix)
-
-        #Print formatted record
-        formatted_record = format_record(recIDs[i], of, ln, verbose, \
-                                         search_pattern, xml_records[i],\
-                                         user_info, on_the_fly)
-        formatted_records += formatted_record
-        if req is not None:
-            req.write(formatted_record)
-
-        #Print suffix
-        if record_suffix is not None:
-            if isinstance(record_suffix, str):
-                formatted_records += record_suffix
-                if req is not None:
-                    req.write(record_suffix)
-            else:
-                string_suffix = record_suffix(i)
-                formatted_records += string_suffix
-                if req is not None:
-                    req.write(string_suffix)
-
-        #Print separator if needed
-        if record_separator is not None and not last_iteration:
-            if isinstance(record_separator, str):
-                formatted_records += record_separator
-                if req is not None:
-                    req.write(record_separator)
-            else:
-                string_separator = record_separator(i)
-                formatted_records += string_separator
-                if req is not None:
-                    req.write(string_separator)
+    prefetched = []
+    try:
+        for i in range(total_rec):
+            if recIDs[i] is not None and i % CFG_BIBFORMAT_BATCH_SIZE == 0:
+                # load the next batch of records with a few queries:
+                clear_prefetched_records(prefetched)
+                if on_the_fly:
+                    prefetched = prefetch_records(recIDs[i:i + CFG_BIBFORMAT_BATCH_SIZE])
+                else:
+                    prefetched = prefetch_records(recIDs[i:i + CFG_BIBFORMAT_BATCH_SIZE], of, ln)
+            if i == total_rec - 1:
+                last_iteration = True
+
+            #Print prefix
+            if record_prefix is not None:
+                if isinstance(record_prefix, str):
+                    formatted_records += record_prefix
+                    if req is not None:
+                        req.write(record_prefix)
+                else:
+                    string_prefix = record_prefix(i)
+                    formatted_records += string_prefix
+                    if req is not None:
+                        req.write(string_prefix)
+
+            #Print formatted record
+            formatted_record = format_record(recIDs[i], of, ln, verbose, \
+                                             search_pattern, xml_records[i],\
+                                             user_info, on_the_fly)
+            formatted_records += formatted_record
+            if req is not None:
+                req.write(formatted_record)
+
+            #Print suffix
+            if record_suffix is not None:
+                if isinstance(record_suffix, str):
+                    formatted_records += record_suffix
+                    if req is not None:
+                        req.write(record_suffix)
+                else:
+                    string_suffix = record_suffix(i)
+                    formatted_records += string_suffix
+                    if req is not None:
+                        req.write(string_suffix)
+
+            #Print separator if needed
+            if record_separator is not None and not last_iteration:
+                if isinstance(record_separator, str):
+                    formatted_records += record_separator
+                    if req is not None:
+                        req.write(record_separator)
+                else:
+                    string_separator = record_separator(i)
+                    formatted_records += string_separator
+                    if req is not None:
+                        req.write(string_separator)
+    finally:
+        clear_prefetched_records(prefetched)
 
     if req is not None:
         req.write(epilogue)
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+BibFormat formatted records cache.
+
+Caches the outputs that bibformat_engine.format_record() formats on
+the fly, i.e. the outputs that are not precomputed by BibReformat in
+the bibfmt table.  Entries are keyed by record, output format,
+language, search pattern and user visibility class (see
+get_user_visibility_class()), and remember the `generation' at which
+they were formatted: the modification date of the record, the latest
+modification time of the format templates, output formats and format
+elements, and the current CFG_BIBFORMAT_CACHE_TTL period.  An entry
+whose generation differs from the current one is considered stale.
+
+The backends are the ones of the search results cache, see
+MemoryFormattedRecordsCache and DiskFormattedRecordsCache; use
+get_formatted_records_cache() to obtain the one configured via
+CFG_BIBFORMAT_CACHE_BACKEND.
+"""
+
+__revision__ = "$Id$"
+
+import os
+import time
+
+from invenio.config import \
+     CFG_CACHEDIR, \
+     CFG_BIBFORMAT_CACHE_BACKEND, \
+     CFG_BIBFORMAT_CACHE_SIZE, \
+     CFG_BIBFORMAT_CACHE_MAX_BYTES, \
+     CFG_BIBFORMAT_CACHE_TTL
+from invenio.bibformat_config import \
+     CFG_BIBFORMAT_TEMPLATES_PATH, \
+     CFG_BIBFORMAT_OUTPUTS_PATH, \
+     CFG_BIBFORMAT_ELEMENTS_PATH
+from invenio.dbquery import run_sql
+from invenio.search_engine_cache import \
+     MemorySearchResultsCache, \
+     DiskSearchResultsCache
+
+## how often (in seconds) do we look for modified format files?
+CFG_BIBFORMAT_CACHE_GENERATION_CHECK_INTERVAL = 5
+
+class MemoryFormattedRecordsCache(MemorySearchResultsCache):
+    """In-process least-recently-used cache of formatted records."""
+    def _get_size(self, formatted_record):
+        return len(formatted_record)
+
+class DiskFormattedRecordsCache(DiskSearchResultsCache):
+    """Cache of formatted records shared by the processes of the host."""
+    def _dump(self, formatted_record):
+        return formatted_record
+
+    def _load(self, dump):
+        if not isinstance(dump, str):
+            raise ValueError("corrupted formatted record")
+        return dump
+
+def get_formatted_records_cache():
+    """
+    Return formatted records cache backend as configured by
+    CFG_BIBFORMAT_CACHE_BACKEND ('memory' or 'disk'), or None if the
+    cache is disabled.
+    """
+    if CFG_BIBFORMAT_CACHE_BACKEND == 'disk':
+        return DiskFormattedRecordsCache(os.path.join(CFG_CACHEDIR, 'formatted_records'),
+                                         CFG_BIBFORMAT_CACHE_SIZE,
+                                         CFG_BIBFORMAT_CACHE_MAX_BYTES)
+    if CFG_BIBFORMAT_CACHE_BACKEND == 'memory':
+        return MemoryFormattedRecordsCache(CFG_BIBFORMAT_CACHE_SIZE,
+                                           CFG_BIBFORMAT_CACHE_MAX_BYTES)
+    return None
+
+_FORMAT_GENERATION = {'value': None, 'checked': 0}
+
+def get_format_generation(force=False):
+    """
+    Return the latest modification time of the format templates,
+    output formats and format elements.  The files are looked at no
+    more often than every CFG_BIBFORMAT_CACHE_GENERATION_CHECK_INTERVAL
+    seconds unless FORCE is set.
+    """
+    now = time.time()
+    if force or _FORMAT_GENERATION['value'] is None or \
+           now - _FORMAT_GENERATION['checked'] > CFG_BIBFORMAT_CACHE_GENERATION_CHECK_INTERVAL:
+        generation = 0
+        for dirname in (CFG_BIBFORMAT_TEMPLATES_PATH,
+                        CFG_BIBFORMAT_OUTPUTS_PATH,
+                        CFG_BIBFORMAT_ELEMENTS_PATH):
+            try:
+                filenames = os.listdir(dirname)
+                # catches added and removed files too:
+                generation = max(generation, os.stat(dirname).st_mtime)
+            except OSError:
+                continue
+            for filename in filenames:
+                try:
+                    generation = max(generation,
+                                     os.stat(os.path.join(dirname, filename)).st_mtime)
+                except OSError:
+                    continue
+        _FORMAT_GENERATION['value'] = int(generation)
+        _FORMAT_GENERATION['checked'] = now
+    return _FORMAT_GENERATION['value']
+
+def get_formatted_record_generation(recID):
+    """Return current generation of the formatted outputs of record
+    RECID (see the module docstring).  The modification date of the
+    record is taken from the records prefetched for the page being
+    formatted, if any."""
+    from invenio.search_engine import get_prefetched_modification_date
+    try:
+        modification_date = get_prefetched_modification_date(recID) or ''
+    except KeyError:
+        res = run_sql("SELECT DATE_FORMAT(modification_date, '%%Y-%%m-%%d %%H:%%i:%%s') FROM bibrec WHERE id=%s",
+                      (recID,))
+        if res:
+            modification_date = res[0][0]
+        else:
+            modification_date = ''
+    period = 0
+    if CFG_BIBFORMAT_CACHE_TTL:
+        period = int(time.time() / CFG_BIBFORMAT_CACHE_TTL)
+    return (modification_date, get_format_generation(), period)
+
+def get_user_visibility_class(user_info):
+    """
+    Return a string identifying the users who see the same formatted
+    outputs as the user described by USER_INFO: anonymous users
+    sharing the same restricted collections (e.g. granted by IP
+    address) are not told apart, whereas authenticated users each
+    have their own class, since format elements may check any of
+    their authorizations.
+    """
+    if not user_info:
+        return 'guest'
+    if str(user_info.get('guest', '1')) == '1':
+        collections = list(user_info.get('precached_permitted_restricted_collections', []))
+        collections.sort()
+        return 'guest:' + ','.join(collections)
+    return 'uid:%s' % user_info.get('uid', '')
+
+def get_formatted_record_cache_key(recID, of, ln, search_pattern, user_info):
+    """Return key of formatted output OF of record RECID in language
+    LN for SEARCH_PATTERN, as seen by the user of USER_INFO."""
+    return repr((int(recID), of.lower(), ln, tuple(search_pattern or []),
+                 get_user_visibility_class(user_info)))
+
+## formatted records cache (None if disabled):
+formatted_records_cache = get_formatted_records_cache()
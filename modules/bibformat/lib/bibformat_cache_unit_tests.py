@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for the formatted records cache."""
+
+__revision__ = "$Id$"
+
+import os
+import shutil
+import tempfile
+import time
+
+from invenio.testutils import InvenioTestCase
+
+from invenio import bibformat_cache
+from invenio.bibformat_cache import MemoryFormattedRecordsCache, \
+     DiskFormattedRecordsCache, get_user_visibility_class, \
+     get_formatted_record_cache_key, get_format_generation
+from invenio.testutils import make_test_suite, run_test_suite
+
+class TestFormattedRecordsCache(InvenioTestCase):
+    """Test formatted records cache backends and keys."""
+
+    def setUp(self):
+        """Create temporary cache directory."""
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove temporary cache directory."""
+        shutil.rmtree(self.dirname)
+
+    def test_memory_cache(self):
+        """bibformat cache - memory backend with byte limit"""
+        cache = MemoryFormattedRecordsCache(max_entries=10, max_bytes=10)
+        cache.set('a', '12345', 1)
+        cache.set('b', '', 1)
+        self.assertEqual(cache.get('a', 1), '12345')
+        self.assertEqual(cache.get('b', 1), '')
+        self.assertEqual(cache.get('a', 2), None)
+        cache.set('c', '123456', 1)
+        cache.set('d', '123456', 1)
+        self.assertEqual(cache.get('c', 1), None)
+        self.assertEqual(cache.get_stats()['bytes'], 6)
+
+    def test_disk_cache(self):
+        """bibformat cache - disk backend"""
+        cache = DiskFormattedRecordsCache(self.dirname)
+        cache.set('a', '<b>record</b>', ('2013-01-01 00:00:00', 1, 0))
+        self.assertEqual(cache.get('a', ('2013-01-01 00:00:00', 1, 0)), '<b>record</b>')
+        self.assertEqual(cache.get('a', ('2013-01-02 00:00:00', 1, 0)), None)
+        self.assertEqual(cache.get_stats()['hits'], 1)
+        self.assertEqual(cache.get_stats()['misses'], 1)
+
+    def test_visibility_classes(self):
+        """bibformat cache - user visibility classes"""
+        guest = {'guest': '1', 'uid': 3,
+                 'precached_permitted_restricted_collections': []}
+        other_guest = {'guest': '1', 'uid': 4,
+                       'precached_permitted_restricted_collections': []}
+        ip_guest = {'guest': '1', 'uid': 5,
+                    'precached_permitted_restricted_collections': ['Theses']}
+        user = {'guest': '0', 'uid': 6}
+        self.assertEqual(get_user_visibility_class(guest),
+                         get_user_visibility_class(other_guest))
+        self.assertNotEqual(get_user_visibility_class(guest),
+                            get_user_visibility_class(ip_guest))
+        self.assertNotEqual(get_user_visibility_class(guest),
+                            get_user_visibility_class(user))
+        self.assertEqual(get_formatted_record_cache_key(1, 'HD', 'en', None, guest),
+                         get_formatted_record_cache_key(1, 'hd', 'en', [], other_guest))
+        self.assertNotEqual(get_formatted_record_cache_key(1, 'hd', 'en', ['ellis'], guest),
+                            get_formatted_record_cache_key(1, 'hd', 'en', [], guest))
+
+    def test_format_generation(self):
+        """bibformat cache - format files modifications are noticed"""
+        saved_path = bibformat_cache.CFG_BIBFORMAT_TEMPLATES_PATH
+        bibformat_cache.CFG_BIBFORMAT_TEMPLATES_PATH = self.dirname
+        try:
+            template = os.path.join(self.dirname, 'Default_HTML_brief.bft')
+            open(template, 'w').write('<name>Default HTML brief</name>')
+            generation = get_format_generation(force=True)
+            future = time.time() + 10
+            os.utime(template, (future, future))
+            self.assertEqual(get_format_generation(), generation)
+            self.assertNotEqual(get_format_generation(force=True), generation)
+        finally:
+            bibformat_cache.CFG_BIBFORMAT_TEMPLATES_PATH = saved_path
+
+TEST_SUITE = make_test_suite(TestFormattedRecordsCache,)
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE)
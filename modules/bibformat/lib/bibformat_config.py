@@ -41,6 +41,14 @@ CFG_BIBFORMAT_OUTPUTS_PATH = "%s%sbibformat%soutput_formats" % (CFG_ETCDIR, os.s
 CFG_BIBFORMAT_FORMAT_TEMPLATE_EXTENSION = "bft"
 CFG_BIBFORMAT_FORMAT_OUTPUT_EXTENSION = "bfo"
 
+# Maximum number of records fetched by one query when records are
+# loaded in batches (e.g. for a page of search results)
+CFG_BIBFORMAT_BATCH_SIZE = 200
+
+# Number of records that BibReformat formats in one go (possibly in a
+# worker process) and then writes to the bibfmt table with one query
+CFG_BIBFORMAT_REFORMAT_CHUNK_SIZE = 100
+
 # Exceptions: errors
 class InvenioBibFormatError(Exception):
     """A generic error for BibFormat."""
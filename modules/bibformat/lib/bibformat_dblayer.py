@@ -28,6 +28,7 @@ import zlib
 import time
 
 from invenio.dbquery import run_sql
+from invenio.bibformat_config import CFG_BIBFORMAT_BATCH_SIZE
 from invenio.search_engine_utils import get_fieldvalues
 
 def localtime_to_utc(date, fmt="%Y-%m-%dT%H:%M:%SZ"):
@@ -471,6 +472,31 @@ def get_preformatted_record(recID, of, decompress=zlib.decompress):
     else:
         return None
 
+def get_preformatted_records(recIDs, of, decompress=zlib.decompress):
+    """
+    Returns the preformatted records with ids 'recIDs' and format 'of'
+
+    Batched version of L{get_preformatted_record}: records are fetched
+    with one query per CFG_BIBFORMAT_BATCH_SIZE records.
+
+    @param recIDs: the ids of the records to fetch
+    @param of: the output format code
+    @param decompress: the method used to decompress the preformatted record in database
+    @return: dictionary {recID: formatted record as String} of the records
+             formatted in 'of' (records not formatted in 'of' are missing)
+    """
+    run_on_slave = of not in ('xm', 'recstruct')
+    recIDs = list(recIDs)
+    out = {}
+    for i in range(0, len(recIDs), CFG_BIBFORMAT_BATCH_SIZE):
+        batch = recIDs[i:i + CFG_BIBFORMAT_BATCH_SIZE]
+        query = "SELECT id_bibrec, value FROM bibfmt WHERE id_bibrec IN (%s) AND format=%%s" % \
+                ",".join(["%s"] * len(batch))
+        res = run_sql(query, tuple(batch) + (of,), run_on_slave=run_on_slave)
+        for recID, value in res:
+            out[recID] = "%s" % decompress(value)
+    return out
+
 def get_preformatted_record_date(recID, of):
     """
     Returns the date of the last update of the cache for the considered
@@ -47,6 +47,7 @@ import inspect
 import traceback
 import zlib
 import cgi
+import time
 
 from invenio.config import \
      CFG_PATH_PHP, \
@@ -67,6 +68,7 @@ from invenio.messages import \
      wash_language, \
      gettext_set_language
 from invenio import bibformat_dblayer
+from invenio import bibformat_cache
 from invenio.bibformat_config import \
      CFG_BIBFORMAT_FORMAT_TEMPLATE_EXTENSION, \
      CFG_BIBFORMAT_FORMAT_OUTPUT_EXTENSION, \
@@ -95,6 +97,11 @@ if CFG_PATH_PHP: #Remove when call_old_bibformat is removed
 format_templates_cache = {}
 format_elements_cache = {}
 format_outputs_cache = {}
+# Compiled format templates, see get_compiled_format_template()
+format_templates_compiled_cache = {}
+
+# Time spent in each format element, collected by bf_profile() only
+element_profile = None
 
 html_field = '<!--HTML-->' # String indicating that field should be
                            # treated as HTML (and therefore no escaping of
@@ -291,7 +298,8 @@ def call_old_bibformat(recID, of="HD", on_the_fly=False, verbose=0):
         return out
 
 def format_record(recID, of, ln=CFG_SITE_LANG, verbose=0,
-                  search_pattern=None, xml_record=None, user_info=None):
+                  search_pattern=None, xml_record=None, user_info=None,
+                  use_cache=False):
     """
     Formats a record given output format. Main entry function of
     bibformat engine.
@@ -318,6 +326,7 @@ def format_record(recID, of, ln=CFG_SITE_LANG, verbose=0,
     @param search_pattern: list of strings representing the user request in web interface
     @param xml_record: an xml string representing the record to format
     @param user_info: the information of the user who will view the formatted page
+    @param use_cache: if True, serve (and store) the output from the formatted records cache
     @return: formatted record
     """
     if search_pattern is None:
@@ -328,6 +337,18 @@ def format_record(recID, of, ln=CFG_SITE_LANG, verbose=0,
     ln = wash_language(ln)
     _ = gettext_set_language(ln)
 
+    cache = bibformat_cache.formatted_records_cache
+    if not use_cache or cache is None or xml_record is not None or verbose:
+        cache = None
+    else:
+        cache_key = bibformat_cache.get_formatted_record_cache_key(recID, of, ln,
+                                                                   search_pattern,
+                                                                   user_info)
+        cache_generation = bibformat_cache.get_formatted_record_generation(recID)
+        cached_out = cache.get(cache_key, cache_generation)
+        if cached_out is not None:
+            return cached_out
+
     # Temporary workflow (during migration of formats):
     # Call new BibFormat
     # But if format not found for new BibFormat, then call old BibFormat
@@ -384,6 +405,9 @@ def format_record(recID, of, ln=CFG_SITE_LANG, verbose=0,
 
     out += out_
 
+    if cache is not None:
+        cache.set(cache_key, out, cache_generation)
+
     return out
 
 def decide_format_template(bfo, of):
@@ -458,6 +482,14 @@ def format_with_format_template(format_template_filename, bfo,
         translated_word = _(word)
         return translated_word
 
+    if format_template_code is None and verbose == 0 and \
+           format_template_filename is not None and \
+           format_template_filename.endswith("."+CFG_BIBFORMAT_FORMAT_TEMPLATE_EXTENSION):
+        # .bft, from the compiled template
+        compiled_template = get_compiled_format_template(format_template_filename,
+                                                         bfo.lang)
+        return eval_compiled_format_template(compiled_template, bfo, verbose)
+
     if format_template_code is not None:
         format_content = str(format_template_code)
     else:
@@ -489,6 +521,112 @@ def format_with_format_template(format_template_filename, bfo,
     return evaluated_format
 
 
+def compile_format_template(format_template, ln=CFG_SITE_LANG):
+    """
+    Compiles the code of a .bft format template for the given language.
+
+    Languages are filtered and texts translated once and for all, and
+    the template is split into a list of chunks that are either static
+    strings or tuples (element name, format element, parameters) for
+    the <BFE_ > tags, with the format element already loaded (None if
+    it could not be found) and its parameters already parsed.
+
+    @param format_template: the format template code
+    @param ln: the language to compile the template for
+    @return: the list of chunks, see L{eval_compiled_format_template}
+    """
+    _ = gettext_set_language(ln)
+
+    def translate(match):
+        """
+        Translate matching values
+        """
+        return _(match.group("word"))
+
+    filtered_format = filter_languages(format_template, ln)
+    localized_format = translation_pattern.sub(translate, filtered_format)
+
+    compiled_template = []
+    position = 0
+    for match in pattern_tag.finditer(localized_format):
+        if match.start() > position:
+            compiled_template.append(localized_format[position:match.start()])
+        position = match.end()
+        function_name = match.group("function_name")
+        params = {}
+        all_params = match.group('params')
+        if all_params is not None:
+            for param_match in pattern_function_params.finditer(all_params):
+                params[param_match.group('param')] = param_match.group('value')
+        try:
+            format_element = get_format_element(function_name)
+        except Exception:
+            format_element = None
+        compiled_template.append((function_name, format_element, params))
+    if position < len(localized_format):
+        compiled_template.append(localized_format[position:])
+    return compiled_template
+
+def get_compiled_format_template(filename, ln=CFG_SITE_LANG):
+    """
+    Returns the compiled format template of the given filename and
+    language (see L{compile_format_template}), compiling it again only
+    if the template file has been modified since.
+
+    @param filename: the filename of a .bft format template
+    @param ln: the language to compile the template for
+    @return: the list of chunks of the compiled template
+    """
+    path = "%s%s%s" % (CFG_BIBFORMAT_TEMPLATES_PATH, os.sep, filename)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        mtime = None
+    key = (path, ln, CFG_BIBFORMAT_ELEMENTS_IMPORT_PATH)
+    cached = format_templates_compiled_cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    compiled_template = compile_format_template(get_format_template(filename)['code'], ln)
+    format_templates_compiled_cache[key] = (mtime, compiled_template)
+    return compiled_template
+
+def eval_compiled_format_template(compiled_template, bfo, verbose=0):
+    """
+    Evaluates the format elements of a compiled format template (as
+    returned by L{compile_format_template}) and returns the formatted
+    text.
+
+    @param compiled_template: the list of chunks of the compiled template
+    @param bfo: the object containing parameters for the current formatting
+    @param verbose: the level of verbosity from 0 to 9 (O: silent,
+                    5: errors, 7: errors and warnings,
+                    9: errors and warnings, stop if error (debug mode ))
+    @return: formatted text
+    """
+    out = []
+    for chunk in compiled_template:
+        if type(chunk) is not tuple:
+            out.append(chunk)
+            continue
+        function_name, format_element, params = chunk
+        if format_element is None:
+            _ = gettext_set_language(bfo.lang)
+            try:
+                raise InvenioBibFormatError(_('Could not find format element named %s.') % function_name)
+            except InvenioBibFormatError:
+                register_exception(req=bfo.req)
+            continue
+        if element_profile is None:
+            (result, dummy) = eval_format_element(format_element, bfo, params, verbose)
+        else:
+            start = time.time()
+            (result, dummy) = eval_format_element(format_element, bfo, params, verbose)
+            stats = element_profile.setdefault(function_name.upper(), [0, 0.0])
+            stats[0] += 1
+            stats[1] += time.time() - start
+        out.append(result)
+    return ''.join(out)
+
 def eval_format_template_elements(format_template, bfo, verbose=0):
     """
     Evalutes the format elements of the given template and replace each element with its value.
@@ -1725,10 +1863,12 @@ def clear_caches():
 
     @return: None
     """
-    global format_templates_cache, format_elements_cache, format_outputs_cache
+    global format_templates_cache, format_elements_cache, format_outputs_cache, \
+           format_templates_compiled_cache
     format_templates_cache = {}
     format_elements_cache = {}
     format_outputs_cache = {}
+    format_templates_compiled_cache = {}
 
 class BibFormatObject:
     """
@@ -1817,13 +1957,14 @@ class BibFormatObject:
         Returns the record structure of this L{BibFormatObject} instance
 
         @return: the record structure as defined by BibRecord library
+            (possibly a compact one, see bibrecord.CompactRecord)
         """
         from invenio.search_engine import get_record
 
         # Create record if necessary
         if self.record is None:
             # on-the-fly creation if current output is xm
-            self.record = get_record(self.recID)
+            self.record = get_record(self.recID, compact=True)
 
         return self.record
 
@@ -2119,15 +2260,47 @@ def escape_field(value, mode=0):
     else:
         return value
 
-def bf_profile():
+def bf_profile(recIDs=None, of="HD", ln=CFG_SITE_LANG, sample_size=50):
     """
-    Runs a benchmark
-
-    @return: None
+    Runs a benchmark: formats a sample of records and prints the time
+    spent in each format element, the remainder being spent in
+    choosing and rendering templates and in fetching records.
+
+    @param recIDs: the records to format (default: the first 'sample_size' records)
+    @param of: the output format to use
+    @param ln: the language to use
+    @param sample_size: the number of records to format if 'recIDs' is not given
+    @return: dictionary {element name: [number of calls, total time]}
     """
-    for i in range(1, 51):
-        format_record(i, "HD", ln=CFG_SITE_LANG, verbose=9, search_pattern=[])
-    return
+    global element_profile
+    if recIDs is None:
+        recIDs = [row[0] for row in run_sql("SELECT id FROM bibrec ORDER BY id LIMIT %s",
+                                            (sample_size,))]
+    element_profile = {}
+    start = time.time()
+    try:
+        for recID in recIDs:
+            format_record(recID, of, ln=ln, search_pattern=[])
+    finally:
+        profile_data = element_profile
+        element_profile = None
+    total_time = time.time() - start
+
+    print "Formatted %d records in %s (%s) in %.3f s (%.2f ms/record)" % \
+          (len(recIDs), of, ln, total_time, 1000 * total_time / max(len(recIDs), 1))
+    print "%-40s %8s %10s %10s %6s" % ('element', 'calls', 'total(ms)', 'avg(ms)', '%')
+    elements_time = 0.0
+    items = profile_data.items()
+    items.sort(key=lambda item: item[1][1], reverse=True)
+    for name, (calls, element_time) in items:
+        elements_time += element_time
+        print "%-40s %8d %10.2f %10.3f %6.1f" % \
+              (name, calls, 1000 * element_time, 1000 * element_time / calls,
+               100 * element_time / max(total_time, 0.000001))
+    print "%-40s %8s %10.2f %10s %6.1f" % \
+          ('(templates, records and other)', '', 1000 * (total_time - elements_time), '',
+           100 * (total_time - elements_time) / max(total_time, 0.000001))
+    return profile_data
 
 if __name__ == "__main__":
     import profile
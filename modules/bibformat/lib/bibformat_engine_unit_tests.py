@@ -27,6 +27,7 @@ __revision__ = "$Id$"
 from invenio.testutils import InvenioTestCase
 import os
 import sys
+import time
 
 from invenio import bibformat
 from invenio import bibformat_engine
@@ -794,6 +795,34 @@ class FormatTest(InvenioTestCase):
 
         self.assertEqual(result,'''<h1>hi</h1> this is my template\ntest<bfe_non_existing_element must disappear/><test_1  non prefixed element must stay as any normal tag/>tfrgarbage\n<br/>test me!&lt;b&gt;ok&lt;/b&gt;a default valueeditor\n<br/>test me!<b>ok</b>a default valueeditor\n<br/>test me!&lt;b&gt;ok&lt;/b&gt;a default valueeditor\n99999''')
 
+    def test_compiled_format_template(self):
+        """ bibformat - compiled templates give same output and follow file changes"""
+        bibformat_engine.CFG_BIBFORMAT_OUTPUTS_PATH = self.old_outputs_path
+        template = bibformat_engine.get_format_template("Test3.bft")
+        result = bibformat_engine.format_with_format_template(format_template_filename = "Test3.bft",
+                                                              bfo=self.bfo_1,
+                                                              verbose=0)
+        expected = bibformat_engine.format_with_format_template(format_template_filename = None,
+                                                                bfo=self.bfo_1,
+                                                                verbose=0,
+                                                                format_template_code=template['code'])
+        self.assertEqual(result, expected)
+
+        path = CFG_BIBFORMAT_TEMPLATES_PATH + os.sep + "Test_compiled.bft"
+        try:
+            open(path, 'w').write('<name>Test compiled</name>first')
+            result = bibformat_engine.format_with_format_template("Test_compiled.bft",
+                                                                  bfo=self.bfo_1)
+            self.assertEqual(result, 'first')
+            open(path, 'w').write('<name>Test compiled</name>second')
+            future = time.time() + 10
+            os.utime(path, (future, future))
+            result = bibformat_engine.format_with_format_template("Test_compiled.bft",
+                                                                  bfo=self.bfo_1)
+            self.assertEqual(result, 'second')
+        finally:
+            os.remove(path)
+
 
 class MarcFilteringTest(InvenioTestCase):
     """ bibformat - MARC tag filtering tests"""
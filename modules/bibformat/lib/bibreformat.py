@@ -25,7 +25,7 @@ __revision__ = "$Id$"
 import sys
 
 try:
-    from invenio.dbquery import run_sql
+    from invenio.dbquery import run_sql, run_sql_many
     from invenio.config import \
          CFG_SITE_URL,\
          CFG_TMPDIR,\
@@ -37,12 +37,13 @@ try:
     from invenio.bibrank_citation_searcher import get_cited_by
     from invenio.bibrank_citation_indexer import get_bibrankmethod_lastupdate
     from invenio.bibformat import format_record
-    from invenio.bibformat_config import CFG_BIBFORMAT_USE_OLD_BIBFORMAT
+    from invenio.bibformat_config import CFG_BIBFORMAT_USE_OLD_BIBFORMAT, \
+         CFG_BIBFORMAT_REFORMAT_CHUNK_SIZE
     from invenio.shellutils import split_cli_ids_arg
     from invenio.bibtask import task_init, write_message, task_set_option, \
             task_get_option, task_update_progress, task_has_option, \
             task_low_level_submission, task_sleep_now_if_required, \
-            task_get_task_param
+            task_init_worker_process
     import os
     import time
     import zlib
@@ -72,7 +73,7 @@ def store_last_updated(format, update_date):
 ### run the bibreformat task bibsched scheduled
 ###
 
-def bibreformat_task(fmt, sql, sql_queries, cds_query, process_format, process, recids):
+def bibreformat_task(fmt, sql, sql_queries, cds_query, process_format, process, recids, parallel=1):
     """
     BibReformat main task
 
@@ -83,6 +84,7 @@ def bibreformat_task(fmt, sql, sql_queries, cds_query, process_format, process,
     @param process_format:
     @param process:
     @param recids: a list of record IDs to reformat
+    @param parallel: the number of processes formatting the records
     @return: None
     """
     write_message("Processing format %s" % fmt)
@@ -168,7 +170,8 @@ def bibreformat_task(fmt, sql, sql_queries, cds_query, process_format, process,
                                                                          fmt)
         else:
             (total_rec_1, tbibformat_1, tbibupload_1) = iterate_over_new(recIDs,
-                                                                         fmt)
+                                                                         fmt,
+                                                                         parallel)
         total_rec += total_rec_1
         tbibformat += tbibformat_1
         tbibupload += tbibupload_1
@@ -182,7 +185,8 @@ def bibreformat_task(fmt, sql, sql_queries, cds_query, process_format, process,
                                                                          fmt)
         else:
             (total_rec_2, tbibformat_2, tbibupload_2) = iterate_over_new(without_format,
-                                                                         fmt)
+                                                                         fmt,
+                                                                         parallel)
         total_rec += total_rec_2
         tbibformat += tbibformat_2
         tbibupload += tbibupload_2
@@ -257,38 +261,120 @@ def without_fmt(queries, chunk_size=2000):
 ### Bibreformat all selected records (using new python bibformat)
 ### (see iterate_over_old further down)
 
-def iterate_over_new(list, fmt):
+def format_records_chunk(recIDs, fmt):
+    """
+    Format a chunk of records
+
+    @param recIDs: the list of record IDs to format
+    @param fmt: the output format to use
+    @return: tuple (list of bibfmt rows (id_bibrec, format, last_updated,
+             compressed value), time taken to format, id of the process
+             that formatted the records)
+    """
+    rows = []
+    t1 = time.time()
+    for recID in recIDs:
+        # Time at which the record was formatted
+        start_date = time.strftime('%Y-%m-%d %H:%M:%S')
+        formatted_record = zlib.compress(format_record(recID, fmt, on_the_fly=True))
+        rows.append((recID, fmt, start_date, formatted_record))
+    return (rows, time.time() - t1, os.getpid())
+
+
+def _format_records_chunk_in_worker(args):
+    """
+    Format a chunk of records in a worker process of
+    iter_formatted_chunks_in_parallel()
+
+    @param args: tuple (list of record IDs, output format)
+    """
+    return format_records_chunk(args[0], args[1])
+
+
+def iter_formatted_chunks_in_parallel(chunks, fmt, parallel):
+    """
+    Yield the formatted chunks of records, in order, as formatted by
+    PARALLEL worker processes that work at most 2*PARALLEL chunks ahead
+    of the consumer.
+
+    @param chunks: list of lists of record IDs
+    @param fmt: the output format to use
+    @param parallel: the number of worker processes
+    @return: iterator over format_records_chunk() results
+    """
+    from multiprocessing import Pool
+    pool = Pool(parallel, task_init_worker_process)
+    done = False
+    try:
+        pending = []
+        next_chunk = 0
+        for dummy_chunk in chunks:
+            while next_chunk < len(chunks) and len(pending) < 2 * parallel:
+                pending.append(pool.apply_async(_format_records_chunk_in_worker,
+                                                ((chunks[next_chunk], fmt),)))
+                next_chunk += 1
+            yield pending.pop(0).get()
+        done = True
+    finally:
+        if done:
+            pool.close()
+            pool.join()
+        else:
+            pool.terminate()
+
+
+def iterate_over_new(list, fmt, parallel=1):
     """
     Iterate over list of IDs
 
+    Records are formatted by chunks of CFG_BIBFORMAT_REFORMAT_CHUNK_SIZE,
+    by PARALLEL worker processes if PARALLEL is greater than 1, and
+    each chunk is written to the bibfmt table with one query by this
+    process.
+
     @param list: the list of record IDs to format
     @param fmt: the output format to use
+    @param parallel: the number of processes formatting the records
     @return: tuple (total number of records, time taken to format, time taken to insert)
     """
-    global total_rec
-
-    formatted_records = ''      # (string-)List of formatted record of an iteration
-    tbibformat  = 0     # time taken up by external call
-    tbibupload  = 0     # time taken up by external call
-    start_date = task_get_task_param('task_starting_time') # Time at which the record was formatted
+    tbibformat  = 0     # time taken up by formatting
+    tbibupload  = 0     # time taken up by writing to bibfmt
+
+    recIDs = [recID for recID in list]
+    chunks = [recIDs[i:i + CFG_BIBFORMAT_REFORMAT_CHUNK_SIZE]
+              for i in xrange(0, len(recIDs), CFG_BIBFORMAT_REFORMAT_CHUNK_SIZE)]
+    if parallel > 1 and len(chunks) > 1:
+        write_message("Formatting records with %d processes" % parallel)
+        formatted_chunks = iter_formatted_chunks_in_parallel(chunks, fmt, parallel)
+    else:
+        formatted_chunks = (format_records_chunk(chunk, fmt) for chunk in chunks)
 
-    tot = len(list)
+    tot = len(recIDs)
     count = 0
-    for recID in list:
-        t1 = os.times()[4]
-        start_date = time.strftime('%Y-%m-%d %H:%M:%S')
-        formatted_record = zlib.compress(format_record(recID, fmt, on_the_fly=True))
-        run_sql('REPLACE LOW_PRIORITY INTO bibfmt (id_bibrec, format, last_updated, value) VALUES (%s, %s, %s, %s)',
-                (recID, fmt, start_date, formatted_record))
-        t2 = os.times()[4]
-        tbibformat += (t2 - t1)
-        count += 1
-        if (count % 100) == 0:
-            write_message("   ... formatted %s records out of %s" % (count, tot))
-            task_update_progress('Formatted %s out of %s' % (count, tot))
-            task_sleep_now_if_required(can_stop_too=True)
-    if (tot % 100) != 0:
-        write_message("   ... formatted %s records out of %s" % (count, tot))
+    t0 = time.time()
+    workers = {} # process id -> [formatted records, time taken to format]
+    for rows, elapsed, pid in formatted_chunks:
+        t1 = time.time()
+        run_sql_many('REPLACE LOW_PRIORITY INTO bibfmt (id_bibrec, format, last_updated, value) VALUES (%s, %s, %s, %s)',
+                     rows)
+        tbibupload += time.time() - t1
+        tbibformat += elapsed
+        count += len(rows)
+        worker = workers.setdefault(pid, [0, 0.0])
+        worker[0] += len(rows)
+        worker[1] += elapsed
+        rate = count / max(time.time() - t0, 0.001)
+        write_message("   ... formatted %s records out of %s (%.1f rec/s)" % (count, tot, rate))
+        if len(workers) > 1:
+            pids = workers.keys()
+            pids.sort()
+            rates = ', '.join(["%.1f" % (workers[pid][0] / max(workers[pid][1], 0.001))
+                               for pid in pids])
+            task_update_progress('Formatted %s out of %s (%.1f rec/s; per worker: %s)' % \
+                                 (count, tot, rate, rates))
+        else:
+            task_update_progress('Formatted %s out of %s (%.1f rec/s)' % (count, tot, rate))
+        task_sleep_now_if_required(can_stop_too=True)
     return (tot, tbibformat, tbibupload)
 
 
@@ -488,7 +574,7 @@ def task_run_core():
 
     ### sql commands to be executed during the script run
     ###
-        bibreformat_task(fmt, sql, sql_queries, cds_query, task_has_option('without'), not task_has_option('noprocess'), recids)
+        bibreformat_task(fmt, sql, sql_queries, cds_query, task_has_option('without'), not task_has_option('noprocess'), recids, task_get_option('parallel', 1))
     return True
 
 
@@ -532,8 +618,11 @@ Examples:
   bibreformat -n -c 'Articles'   Show how many records are to be (re)formatted in 'Articles' collection.
 
   bibreformat -oHB -s1h          Format all new and modified records every hour, in HB.
+
+  bibreformat -a --parallel=4    Force reformatting all records (in HB) with 4 processes.
 """, help_specific_usage="""  -o,  --formats         \t Specify output format/s (default HB)
   -n,  --noprocess      \t Count records to be formatted (no processing done)
+  --parallel=N          \t Format records with N processes (default 1)
 Reformatting options:
   -a,  --all            \t Force reformatting all records
   -c,  --collection     \t Force reformatting records by collection
@@ -553,7 +642,8 @@ Pattern options:
                  "pattern=",
                  "format=",
                  "noprocess",
-                 "id="]),
+                 "id=",
+                 "parallel="]),
             task_submit_check_options_fnc=task_submit_check_options,
             task_submit_elaborate_specific_parameter_fnc=task_submit_elaborate_specific_parameter,
             task_run_fnc=task_run_core)
@@ -605,6 +695,13 @@ def task_submit_elaborate_specific_parameter(key, value, opts, args):
             task_set_option("format", value)
     elif key in ("-i", "--id"):
         task_set_option("recids", value)
+    elif key in ("--parallel",):
+        try:
+            task_set_option("parallel", int(value))
+        except ValueError:
+            raise StandardError("Number of parallel processes not valid")
+        if task_get_option("parallel") < 1:
+            raise StandardError("Number of parallel processes should be at least 1")
     else:
         return False
     return True
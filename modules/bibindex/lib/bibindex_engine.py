@@ -27,17 +27,21 @@ import re
 import sys
 import time
 import fnmatch
+import unicodedata
 from datetime import datetime
 from time import strptime
 
-from invenio.config import CFG_SOLR_URL
+from invenio.config import CFG_SOLR_URL, \
+     CFG_BIBINDEX_FLUSH_BATCH_SIZE
 from invenio.bibindex_engine_config import CFG_MAX_MYSQL_THREADS, \
      CFG_MYSQL_THREAD_TIMEOUT, \
      CFG_CHECK_MYSQL_THREADS, \
      CFG_BIBINDEX_COLUMN_VALUE_SEPARATOR, \
      CFG_BIBINDEX_INDEX_TABLE_TYPE, \
      CFG_BIBINDEX_ADDING_RECORDS_STARTED_STR, \
-     CFG_BIBINDEX_UPDATE_MESSAGE
+     CFG_BIBINDEX_UPDATE_MESSAGE, \
+     CFG_BIBINDEX_FLUSH_MAX_BYTES, \
+     CFG_BIBINDEX_FLUSH_RANGES_PER_QUERY
 from invenio.bibauthority_config import \
      CFG_BIBAUTHORITY_CONTROLLED_FIELDS_BIBLIOGRAPHIC, \
      CFG_BIBAUTHORITY_RECORD_CONTROL_NUMBER_FIELD
@@ -52,12 +56,13 @@ from invenio.search_engine import perform_request_search, \
      get_synonym_terms, \
      search_pattern, \
      search_unit_in_bibrec
-from invenio.dbquery import run_sql, DatabaseError, serialize_via_marshal, \
-     deserialize_via_marshal, wash_table_column_name
+from invenio.search_engine_date_index import get_recids_modified_between
+from invenio.dbquery import run_sql, run_sql_many, DatabaseError, \
+     serialize_via_marshal, deserialize_via_marshal, wash_table_column_name
 from invenio.bibindex_engine_washer import wash_index_term
 from invenio.bibtask import task_init, write_message, get_datetime, \
     task_set_option, task_get_option, task_get_task_param, \
-    task_update_progress, task_sleep_now_if_required
+    task_update_progress, task_sleep_now_if_required, task_init_worker_process
 from invenio.intbitset import intbitset
 from invenio.errorlib import register_exception
 from invenio.bibrankadminlib import get_def_name
@@ -102,6 +107,7 @@ nb_char_in_line = 50  # for verbose pretty printing
 chunksize = 1000 # default size of chunks that the records will be treated by
 base_process_size = 4500 # process base size
 _last_word_table = None
+_parallel_word_table = None # word table tokenized by --parallel worker processes
 
 
 _TOKENIZERS = load_tokenizers()
@@ -278,6 +284,45 @@ def init_temporary_reindex_tables(index_id, reindex_prefix="tmp_"):
                         ) ENGINE=MyISAM""" % (reindex_prefix, index_id))
 
 
+def get_sql_like_pattern_regexp(pattern):
+    """Return compiled regexp matching the same strings as the SQL
+    LIKE PATTERN (case-insensitively, as MySQL does)."""
+    regexp = ''
+    for char in pattern:
+        if char == '%':
+            regexp += '.*'
+        elif char == '_':
+            regexp += '.'
+        else:
+            regexp += re.escape(char)
+    return re.compile(regexp + '$', re.I | re.S)
+
+def get_term_collation_key(term):
+    """Return approximation of the key under which MySQL's
+    case-insensitive utf8 collations compare TERM: lowercased, without
+    accents and trailing spaces.  Used to spot terms that the database
+    would store in the same row."""
+    try:
+        term = term.decode('utf-8')
+    except (UnicodeError, AttributeError):
+        return term.lower().rstrip(' ')
+    term = u''.join([char for char in unicodedata.normalize('NFKD', term)
+                     if not unicodedata.combining(char)])
+    return term.lower().rstrip(' ')
+
+def run_sql_on_recID_ranges(query, ranges, verbose=9):
+    """Run QUERY over the list of recID RANGES ([[recID1, recID2],
+    ...]), several ranges per statement.  QUERY contains a single %s
+    standing for the `id_bibrec BETWEEN ... OR ...' condition."""
+    for i in range(0, len(ranges), CFG_BIBINDEX_FLUSH_RANGES_PER_QUERY):
+        groups = ranges[i:i + CFG_BIBINDEX_FLUSH_RANGES_PER_QUERY]
+        condition = " OR ".join(["id_bibrec BETWEEN %s AND %s"] * len(groups))
+        params = []
+        for group in groups:
+            params.extend((group[0], group[1]))
+        write_message(query % (condition % tuple(params)), verbose=verbose)
+        run_sql(query % condition, tuple(params))
+
 def remove_subfields(s):
     "Removes subfields from string, e.g. 'foo $$c bar' becomes 'foo bar'."
     return re_subfields.sub(' ', s)
@@ -585,6 +630,8 @@ class WordTable:
         self.index_id = index_id
         self.tablename = table_name_pattern % index_id
         self.virtual_tablename_pattern = table_name_pattern[table_name_pattern.find('idx'):-1]
+        # idxPHRASE tables have a non-unique key on term:
+        self.unique_terms = not self.virtual_tablename_pattern.startswith('idxPHRASE')
         self.humanname = get_def_name('%s' % (str(index_id),), "idxINDEX")[0][1]
         self.recIDs_in_mem = []
         self.fields_to_index = fields_to_index
@@ -604,6 +651,9 @@ class WordTable:
         self.wash_index_terms = wash_index_terms
         self.is_virtual = is_index_virtual(self.index_id)
         self.virtual_indexes = get_index_virtual_indexes(self.index_id)
+        # time spent fetching and tokenizing records, for progress reports:
+        self.time_fetching = 0.0
+        self.time_tokenizing = 0.0
 
         # tagToTokenizer mapping. It offers an indirection level necessary for
         # indexing fulltext.
@@ -641,6 +691,33 @@ class WordTable:
             out.append(row[0])
         return out
 
+    def get_fields_for_recID_range(self, tags, recID1, recID2):
+        """Returns dictionary {tag: [(recID, value), ...]} with the
+           values of the MARC-21 'tags' fields (SQL LIKE patterns as
+           for get_field()) of the records from 'recID1' to 'recID2'.
+           Runs one query per bibXXx table instead of one per record
+           and tag."""
+        out = {}
+        tags_by_table = {}
+        for tag in tags:
+            if not out.has_key(tag):
+                out[tag] = []
+                tags_by_table.setdefault(tag[0:2], []).append(tag)
+        for table_digits, table_tags in tags_by_table.items():
+            bibXXx = "bib" + table_digits + "x"
+            bibrec_bibXXx = "bibrec_" + bibXXx
+            query = """SELECT bb.id_bibrec, b.tag, b.value FROM %s AS b, %s AS bb
+                       WHERE bb.id_bibrec BETWEEN %%s AND %%s AND bb.id_bibxxx=b.id
+                       AND (%s)""" % (bibXXx, bibrec_bibXXx,
+                                      " OR ".join(["tag LIKE %s"] * len(table_tags)))
+            res = run_sql(query, (recID1, recID2) + tuple(table_tags))
+            tag_matchers = [(tag, get_sql_like_pattern_regexp(tag)) for tag in table_tags]
+            for recID, row_tag, value in res:
+                for tag, tag_matcher in tag_matchers:
+                    if tag_matcher.match(row_tag):
+                        out[tag].append((recID, value))
+        return out
+
     def clean(self):
         "Cleans the words table."
         self.value = {}
@@ -665,49 +742,45 @@ class WordTable:
             if ind_id != self.index_id:
                 tab_name = self.virtual_tablename_pattern % ind_id + "R"
             if mode == "normal":
-                for group in self.recIDs_in_mem:
-                    query = """UPDATE %s SET type='TEMPORARY' WHERE id_bibrec
-                    BETWEEN %%s AND %%s AND type='CURRENT'""" % tab_name
-                    write_message(query % (group[0], group[1]), verbose=9)
-                    run_sql(query, (group[0], group[1]))
+                run_sql_on_recID_ranges("""UPDATE %s SET type='TEMPORARY'
+                    WHERE (%%s) AND type='CURRENT'""" % tab_name, self.recIDs_in_mem)
 
-            nb_words_total = len(self.value)
+            words = self.value.keys()
+            nb_words_total = len(words)
             nb_words_report = int(nb_words_total / 10.0)
             nb_words_done = 0
-            for word in self.value.keys():
-                self.put_word_into_db(word, ind_id)
-                nb_words_done += 1
-                if nb_words_report != 0 and ((nb_words_done % nb_words_report) == 0):
-                    write_message('......processed %d/%d words' % (nb_words_done, nb_words_total))
+            nb_words_reported = 0
+            stats = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+            time_started = time.time()
+            for i in range(0, nb_words_total, CFG_BIBINDEX_FLUSH_BATCH_SIZE):
+                batch = words[i:i + CFG_BIBINDEX_FLUSH_BATCH_SIZE]
+                self.put_words_into_db(batch, ind_id, stats)
+                nb_words_done += len(batch)
+                if nb_words_report != 0 and nb_words_done - nb_words_reported >= nb_words_report:
+                    nb_words_reported = nb_words_done
+                    write_message('......processed %d/%d words (%.1f words/s)' % \
+                                  (nb_words_done, nb_words_total,
+                                   nb_words_done / max(time.time() - time_started, 0.001)))
                     percentage_display = get_percentage_completed(nb_words_done, nb_words_total)
                     task_update_progress("(%s:%s) flushed %d/%d words %s" % (tab_name, ind_name, nb_words_done, nb_words_total, percentage_display))
-            write_message('...updating %d words into %s ended' % \
-                          (nb_words_total, tab_name))
+            write_message('...updating %d words into %s ended (%d inserted, %d updated, %d deleted, %d unchanged in %.1f seconds)' % \
+                          (nb_words_total, tab_name, stats['inserted'], stats['updated'],
+                           stats['deleted'], stats['unchanged'], time.time() - time_started))
 
             write_message('...updating reverse table %s started' % tab_name)
             if mode == "normal":
-                for group in self.recIDs_in_mem:
-                    query = """UPDATE %s SET type='CURRENT' WHERE id_bibrec
-                    BETWEEN %%s AND %%s AND type='FUTURE'""" % tab_name
-                    write_message(query % (group[0], group[1]), verbose=9)
-                    run_sql(query, (group[0], group[1]))
-                    query = """DELETE FROM %s WHERE id_bibrec
-                    BETWEEN %%s AND %%s AND type='TEMPORARY'""" % tab_name
-                    write_message(query % (group[0], group[1]), verbose=9)
-                    run_sql(query, (group[0], group[1]))
-                    #if self.is_fulltext_index:
-                        #update_text_extraction_date(group[0], group[1])
+                run_sql_on_recID_ranges("""UPDATE %s SET type='CURRENT'
+                    WHERE (%%s) AND type='FUTURE'""" % tab_name, self.recIDs_in_mem)
+                run_sql_on_recID_ranges("""DELETE FROM %s
+                    WHERE (%%s) AND type='TEMPORARY'""" % tab_name, self.recIDs_in_mem)
+                #if self.is_fulltext_index:
+                    #update_text_extraction_date(group[0], group[1])
                 write_message('End of updating wordTable into %s' % tab_name, verbose=9)
             elif mode == "emergency":
-                for group in self.recIDs_in_mem:
-                    query = """UPDATE %s SET type='CURRENT' WHERE id_bibrec
-                    BETWEEN %%s AND %%s AND type='TEMPORARY'""" % tab_name
-                    write_message(query % (group[0], group[1]), verbose=9)
-                    run_sql(query, (group[0], group[1]))
-                    query = """DELETE FROM %s WHERE id_bibrec
-                    BETWEEN %%s AND %%s AND type='FUTURE'""" % tab_name
-                    write_message(query % (group[0], group[1]), verbose=9)
-                    run_sql(query, (group[0], group[1]))
+                run_sql_on_recID_ranges("""UPDATE %s SET type='CURRENT'
+                    WHERE (%%s) AND type='TEMPORARY'""" % tab_name, self.recIDs_in_mem)
+                run_sql_on_recID_ranges("""DELETE FROM %s
+                    WHERE (%%s) AND type='FUTURE'""" % tab_name, self.recIDs_in_mem)
                 write_message('End of emergency flushing wordTable into %s' % tab_name, verbose=9)
             write_message('...updating reverse table %s ended' % tab_name)
 
@@ -740,8 +813,110 @@ class WordTable:
         set.update_with_signs(self.value[word])
         return set != oldset
 
+    def put_words_into_db(self, words, index_id, stats=None):
+        """
+        Flush the list of WORDS to the database in bulk: their old
+        hitlists are read by one query, merged in memory and written
+        back by multi-row upserts.  Words that the database collation
+        may confuse with other terms, and all the words of idxPHRASE
+        tables, whose terms are not unique keys that the upserts could
+        update, are flushed one by one via put_word_into_db().  STATS, if given, is a dictionary whose
+        'inserted', 'updated', 'deleted' and 'unchanged' counters are
+        increased accordingly.
+        """
+        if stats is None:
+            stats = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+        if not words:
+            return stats
+        tab_name = self.tablename
+        if index_id != self.index_id:
+            tab_name = self.virtual_tablename_pattern % index_id + "F"
+        tab_name = wash_table_column_name(tab_name)
+        if not self.unique_terms:
+            for word in words:
+                stats[self.put_word_into_db(word, index_id)] += 1
+            return stats
+        old_hitlists = {}
+        res = run_sql("SELECT term, hitlist FROM %s WHERE term IN (%s)" % \
+                      (tab_name, ",".join(["%s"] * len(words))), tuple(words)) # kwalitee: disable=sql
+        for term, hitlist in res:
+            old_hitlists[term] = hitlist
+        # rows whose terms differ from the asked ones were matched by
+        # the collation, in which case the rows of the words without an
+        # exact match cannot be told.  Words that collate the same as
+        # another word of the batch or as another stored term share
+        # their row with it, which the upserts below would overwrite:
+        batch = dict.fromkeys(words)
+        matched_by_collation = [term for term in old_hitlists if term not in batch]
+        collation_keys = {}
+        for term in dict.fromkeys(words + old_hitlists.keys()):
+            key = get_term_collation_key(term)
+            collation_keys[key] = collation_keys.get(key, 0) + 1
+
+        serial_words = []
+        retried_words = []
+        upserts = []
+        deletes = []
+        for word in words:
+            if collation_keys[get_term_collation_key(word)] > 1:
+                serial_words.append(word)
+            elif word in old_hitlists:
+                hitlist = intbitset(old_hitlists[word])
+                if not self.merge_with_old_recIDs(word, hitlist):
+                    write_message("......... unchanged hitlist for ``%s''" % word, verbose=9)
+                    stats['unchanged'] += 1
+                elif hitlist:
+                    write_message("......... updating hitlist for ``%s''" % word, verbose=9)
+                    upserts.append((word, hitlist.fastdump()))
+                    stats['updated'] += 1
+                else:
+                    deletes.append(word)
+                    stats['deleted'] += 1
+            elif matched_by_collation:
+                serial_words.append(word)
+            else:
+                hitlist = intbitset()
+                hitlist.update_with_signs(self.value[word])
+                if hitlist: # never store empty words
+                    write_message("......... inserting hitlist for ``%s''" % word, verbose=9)
+                    upserts.append((word, hitlist.fastdump()))
+                    stats['inserted'] += 1
+                else:
+                    stats['unchanged'] += 1
+
+        query = """INSERT INTO %s (term, hitlist) VALUES (%%s, %%s)
+                   ON DUPLICATE KEY UPDATE hitlist=VALUES(hitlist)""" % tab_name # kwalitee: disable=sql
+        chunk = []
+        chunk_size = 0
+        for i in range(len(upserts) + 1):
+            if chunk and (i == len(upserts) or
+                          chunk_size + len(upserts[i][1]) > CFG_BIBINDEX_FLUSH_MAX_BYTES):
+                try:
+                    run_sql_many(query, chunk, limit=len(chunk))
+                except Exception, e:
+                    ## merging is idempotent, so the terms of a failed
+                    ## statement can be safely flushed one by one:
+                    write_message("......... bulk flush of %d terms into %s failed (%s), flushing them one by one" % \
+                                  (len(chunk), tab_name, e), verbose=2)
+                    retried_words.extend([word for word, dummy_hitlist in chunk])
+                chunk = []
+                chunk_size = 0
+            if i < len(upserts):
+                chunk.append(upserts[i])
+                chunk_size += len(upserts[i][1])
+        if deletes:
+            run_sql("DELETE FROM %s WHERE term IN (%s)" % \
+                    (tab_name, ",".join(["%s"] * len(deletes))), tuple(deletes)) # kwalitee: disable=sql
+        for word in retried_words: # already counted
+            self.put_word_into_db(word, index_id)
+        for word in serial_words:
+            stats[self.put_word_into_db(word, index_id)] += 1
+        return stats
+
     def put_word_into_db(self, word, index_id):
-        """Flush a single word to the database and delete it from memory"""
+        """Flush a single word to the database and delete it from memory.
+        Return what was done: 'inserted', 'updated', 'deleted' or
+        'unchanged'."""
         tab_name = self.tablename
         if index_id != self.index_id:
             tab_name = self.virtual_tablename_pattern % index_id + "F"
@@ -750,15 +925,17 @@ class WordTable:
             if not self.merge_with_old_recIDs(word, set):
                 # nothing to update:
                 write_message("......... unchanged hitlist for ``%s''" % word, verbose=9)
-                pass
+                outcome = 'unchanged'
             else:
                 # yes there were some new words:
                 write_message("......... updating hitlist for ``%s''" % word, verbose=9)
+                outcome = 'updated'
                 run_sql("UPDATE %s SET hitlist=%%s WHERE term=%%s" % wash_table_column_name(tab_name), (set.fastdump(), word)) # kwalitee: disable=sql
 
         else: # the word is new, will create new set:
             write_message("......... inserting hitlist for ``%s''" % word, verbose=9)
             set = intbitset(self.value[word].keys())
+            outcome = 'inserted'
             try:
                 run_sql("INSERT INTO %s (term, hitlist) VALUES (%%s, %%s)" % wash_table_column_name(tab_name), (word, set.fastdump())) # kwalitee: disable=sql
             except Exception, e:
@@ -768,7 +945,8 @@ class WordTable:
 
         if not set: # never store empty words
             run_sql("DELETE FROM %s WHERE term=%%s" % wash_table_column_name(tab_name), (word,)) # kwalitee: disable=sql
-
+            outcome = 'deleted'
+        return outcome
 
     def display(self):
         "Displays the word table."
@@ -804,10 +982,70 @@ class WordTable:
             write_message("The word '%s' does not exist in the word file."\
                               % word)
 
-    def add_recIDs(self, recIDs, opt_flush):
+    def get_recID_chunks(self, recIDs, opt_flush):
+        """Split the recIDs range list into the list of (low, high)
+        chunks treated at once by add_recIDs(): chunks contain at most
+        CHUNKSIZE records and do not cross flushes every OPT_FLUSH
+        records."""
+        chunks = []
+        flush_count = 0
+        for arange in recIDs:
+            i_low = arange[0]
+            chunksize_count = 0
+            while i_low <= arange[1]:
+                i_high = min(i_low + opt_flush - flush_count - 1, arange[1])
+                i_high = min(i_low + chunksize - chunksize_count - 1, i_high)
+                chunks.append((i_low, i_high))
+                flush_count = flush_count + i_high - i_low + 1
+                chunksize_count = chunksize_count + i_high - i_low + 1
+                if chunksize_count >= chunksize:
+                    chunksize_count = 0
+                if flush_count >= opt_flush:
+                    flush_count = 0
+                i_low = i_high + 1
+        return chunks
+
+    def iter_words_from_recID_chunks_in_parallel(self, chunks, parallel):
+        """Yield the word lists of the records of CHUNKS, in order, as
+        computed by PARALLEL worker processes that work at most
+        2*PARALLEL chunks ahead of the consumer.  The time the workers
+        spent fetching and tokenizing is added to the statistics of
+        this word table."""
+        global _parallel_word_table
+        from multiprocessing import Pool
+        # the workers are forked, hence they inherit this word table:
+        _parallel_word_table = self
+        pool = Pool(parallel, task_init_worker_process)
+        done = False
+        try:
+            pending = []
+            next_chunk = 0
+            for dummy_chunk in chunks:
+                while next_chunk < len(chunks) and len(pending) < 2 * parallel:
+                    pending.append(pool.apply_async(_get_words_from_recID_range_in_worker,
+                                                    (chunks[next_chunk],)))
+                    next_chunk += 1
+                wlist, time_fetching, time_tokenizing = pending.pop(0).get()
+                self.time_fetching += time_fetching
+                self.time_tokenizing += time_tokenizing
+                yield wlist
+            done = True
+        finally:
+            if done:
+                pool.close()
+                pool.join()
+            else:
+                pool.terminate()
+            _parallel_word_table = None
+
+    def add_recIDs(self, recIDs, opt_flush, parallel=1):
         """Fetches records which id in the recIDs range list and adds
         them to the wordTable.  The recIDs range list is of the form:
         [[i1_low,i1_high],[i2_low,i2_high], ..., [iN_low,iN_high]].
+
+        If PARALLEL is greater than 1, records are fetched and tokenized
+        by that many worker processes, while this process merges their
+        word lists and flushes them to the database.
         """
         if self.is_virtual:
             return
@@ -820,15 +1058,14 @@ class WordTable:
             records_to_go = records_to_go + arange[1] - arange[0] + 1
 
         time_started = time.time() # will measure profile time
-        for arange in recIDs:
-            i_low = arange[0]
-            chunksize_count = 0
-            while i_low <= arange[1]:
+        chunks = self.get_recID_chunks(recIDs, opt_flush)
+        wlists = None
+        if parallel > 1 and len(chunks) > 1:
+            write_message("%s tokenizing records with %d processes" % (self.tablename, parallel))
+            wlists = self.iter_words_from_recID_chunks_in_parallel(chunks, parallel)
+        try:
+            for i_low, i_high in chunks:
                 task_sleep_now_if_required()
-                # calculate chunk group of recIDs and treat it:
-                i_high = min(i_low + opt_flush - flush_count - 1, arange[1])
-                i_high = min(i_low + chunksize - chunksize_count - 1, i_high)
-
                 try:
                     self.chk_recID_range(i_low, i_high)
                 except StandardError:
@@ -843,14 +1080,14 @@ class WordTable:
                 percentage_display = get_percentage_completed(records_done, records_to_go)
                 task_update_progress("(%s:%s) adding recs %d-%d %s" % (self.tablename, self.humanname, i_low, i_high, percentage_display))
                 self.del_recID_range(i_low, i_high)
-                just_processed = self.add_recID_range(i_low, i_high)
+                if wlists is not None:
+                    just_processed = self.add_recID_range(i_low, i_high, wlists.next())
+                else:
+                    just_processed = self.add_recID_range(i_low, i_high)
                 flush_count = flush_count + i_high - i_low + 1
-                chunksize_count = chunksize_count + i_high - i_low + 1
                 records_done = records_done + just_processed
                 write_message(CFG_BIBINDEX_ADDING_RECORDS_STARTED_STR % \
                         (self.tablename, i_low, i_high))
-                if chunksize_count >= chunksize:
-                    chunksize_count = 0
                 # flush if necessary:
                 if flush_count >= opt_flush:
                     self.put_into_db()
@@ -860,18 +1097,61 @@ class WordTable:
                     write_message("%s backing up" % (self.tablename))
                     flush_count = 0
                     self.log_progress(time_started, records_done, records_to_go)
-                # iterate:
-                i_low = i_high + 1
+        finally:
+            if wlists is not None:
+                # stops the worker processes
+                wlists.close()
         if flush_count > 0:
             self.put_into_db()
             if self.index_name == 'fulltext' and CFG_SOLR_URL:
                 solr_commit()
             self.log_progress(time_started, records_done, records_to_go)
 
-    def add_recID_range(self, recID1, recID2):
-        """Add records from RECID1 to RECID2."""
-        wlist = {}
+    def add_recID_range(self, recID1, recID2, wlist=None):
+        """Add records from RECID1 to RECID2.  WLIST, if given, is the
+        result of get_words_from_recID_range() for these records."""
         self.recIDs_in_mem.append([recID1, recID2])
+        if wlist is None:
+            wlist = self.get_words_from_recID_range(recID1, recID2)
+        recIDs = wlist.keys()
+
+        self.index_virtual_indexes_reversed(wlist, recID1, recID2)
+
+        if len(wlist) == 0: return 0
+        # put words into reverse index table with FUTURE status:
+        for recID in recIDs:
+            run_sql("INSERT INTO %sR (id_bibrec,termlist,type) VALUES (%%s,%%s,'FUTURE')" % wash_table_column_name(self.tablename[:-1]), (recID, serialize_via_marshal(wlist[recID]))) # kwalitee: disable=sql
+            # ... and, for new records, enter the CURRENT status as empty:
+            try:
+                run_sql("INSERT INTO %sR (id_bibrec,termlist,type) VALUES (%%s,%%s,'CURRENT')" % wash_table_column_name(self.tablename[:-1]), (recID, serialize_via_marshal([]))) # kwalitee: disable=sql
+            except DatabaseError:
+                # okay, it's an already existing record, no problem
+                pass
+
+        # put words into memory word list:
+        put = self.put
+        for recID in recIDs:
+            for w in wlist[recID]:
+                put(recID, w, 1)
+        return len(recIDs)
+
+    def get_words_from_recID_range(self, recID1, recID2):
+        """Fetch and tokenize records from RECID1 to RECID2 and return
+        dictionary {recID: list of words}.  Only reads from the
+        database, so that it can be run by worker processes."""
+        wlist = {}
+        time_started = time.time()
+        # fetch at once the values of the whole range for all the tags
+        # needed here, including the deletion flag:
+        if len(self.fields_to_index) == 0 or \
+               self.index_name in ('authorcount', 'journal'):
+            prefetched_fields = self.get_fields_for_recID_range(["980__c"], recID1, recID2)
+        else:
+            prefetched_fields = self.get_fields_for_recID_range(list(self.fields_to_index) + ["980__c"],
+                                                                recID1, recID2)
+        deleted_recIDs = intbitset([recID for recID, value in prefetched_fields["980__c"]
+                                    if value == "DELETED"])
+        time_fetched = time.time()
         # special case of author indexes where we also add author
         # canonical IDs:
         if self.index_name in ('author', 'firstauthor', 'exactauthor', 'exactfirstauthor'):
@@ -904,7 +1184,8 @@ class WordTable:
         else:
             for tag in self.fields_to_index:
                 tokenizing_function = self.tag_to_words_fnc_map.get(tag, self.default_tokenizer_function)
-                phrases = self.get_phrases_for_tokenizing(tag, recID1, recID2)
+                phrases = self.get_phrases_for_tokenizing(tag, recID1, recID2,
+                                                          prefetched_fields[tag])
                 for row in sorted(phrases):
                     recID, phrase = row
                     if not wlist.has_key(recID):
@@ -916,7 +1197,7 @@ class WordTable:
         # lookup index-time synonyms:
         synonym_kbrs = get_all_synonym_knowledge_bases()
         if synonym_kbrs.has_key(self.index_name):
-            if len(wlist) == 0: return 0
+            if len(wlist) == 0: return wlist
             recIDs = wlist.keys()
             for recID in recIDs:
                 for word in wlist[recID]:
@@ -932,45 +1213,37 @@ class WordTable:
         recIDs = wlist.keys()
         for recID in recIDs:
             # was this record marked as deleted?
-            if "DELETED" in self.get_field(recID, "980__c"):
+            if recID in deleted_recIDs:
                 wlist[recID] = []
                 write_message("... record %d was declared deleted, removing its word list" % recID, verbose=9)
             write_message("... record %d, termlist: %s" % (recID, wlist[recID]), verbose=9)
+        time_tokenized = time.time()
+        self.time_fetching += time_fetched - time_started
+        self.time_tokenizing += time_tokenized - time_fetched
+        write_message("%s records #%d-#%d: %.2f seconds fetching fields, %.2f seconds tokenizing" % \
+                      (self.tablename, recID1, recID2, time_fetched - time_started,
+                       time_tokenized - time_fetched), verbose=3)
+        return wlist
 
-        self.index_virtual_indexes_reversed(wlist, recID1, recID2)
-
-        if len(wlist) == 0: return 0
-        # put words into reverse index table with FUTURE status:
-        for recID in recIDs:
-            run_sql("INSERT INTO %sR (id_bibrec,termlist,type) VALUES (%%s,%%s,'FUTURE')" % wash_table_column_name(self.tablename[:-1]), (recID, serialize_via_marshal(wlist[recID]))) # kwalitee: disable=sql
-            # ... and, for new records, enter the CURRENT status as empty:
-            try:
-                run_sql("INSERT INTO %sR (id_bibrec,termlist,type) VALUES (%%s,%%s,'CURRENT')" % wash_table_column_name(self.tablename[:-1]), (recID, serialize_via_marshal([]))) # kwalitee: disable=sql
-            except DatabaseError:
-                # okay, it's an already existing record, no problem
-                pass
 
-        # put words into memory word list:
-        put = self.put
-        for recID in recIDs:
-            for w in wlist[recID]:
-                put(recID, w, 1)
-        return len(recIDs)
-
-
-    def get_phrases_for_tokenizing(self, tag, first_recID, last_recID):
+    def get_phrases_for_tokenizing(self, tag, first_recID, last_recID, prefetched_phrases=None):
         """Gets phrases for later tokenization for a range of records and
            specific tag.
            @param tag: MARC tag
            @param first_recID: first recID from the range of recIDs to index
            @param last_recID: last recID from the range of recIDs to index
+           @param prefetched_phrases: (recID, value) pairs of the tag for
+               the range, if already fetched by get_fields_for_recID_range()
         """
-        bibXXx = "bib" + tag[0] + tag[1] + "x"
-        bibrec_bibXXx = "bibrec_" + bibXXx
-        query = """SELECT bb.id_bibrec,b.value FROM %s AS b, %s AS bb
-                   WHERE bb.id_bibrec BETWEEN %%s AND %%s
-                   AND bb.id_bibxxx=b.id AND tag LIKE %%s""" % (bibXXx, bibrec_bibXXx)
-        phrases = run_sql(query, (first_recID, last_recID, tag))
+        if prefetched_phrases is not None:
+            phrases = prefetched_phrases
+        else:
+            bibXXx = "bib" + tag[0] + tag[1] + "x"
+            bibrec_bibXXx = "bibrec_" + bibXXx
+            query = """SELECT bb.id_bibrec,b.value FROM %s AS b, %s AS bb
+                       WHERE bb.id_bibrec BETWEEN %%s AND %%s
+                       AND bb.id_bibxxx=b.id AND tag LIKE %%s""" % (bibXXx, bibrec_bibXXx)
+            phrases = run_sql(query, (first_recID, last_recID, tag))
         if tag == '8564_u':
             ## FIXME: Quick hack to be sure that hidden files are
             ## actually indexed.
@@ -1063,6 +1336,9 @@ class WordTable:
         if time_recs_per_min:
             write_message("Estimated runtime: %.1f minutes" % \
                     ((todo - done) / time_recs_per_min))
+        if self.time_fetching or self.time_tokenizing:
+            write_message("%.1f seconds were spent fetching fields and %.1f seconds tokenizing them" % \
+                    (self.time_fetching, self.time_tokenizing))
 
     def put(self, recID, word, sign):
         """Adds/deletes a word to the word list."""
@@ -1429,6 +1705,19 @@ class WordTable:
         return list(terms_main - set(left_in_other_indexes.keys())), left_in_other_indexes
 
 
+def _get_words_from_recID_range_in_worker(recid_range):
+    """Return the word list of the records of RECID_RANGE, a (low,
+    high) tuple, for the word table being indexed in parallel, together
+    with the time spent fetching and tokenizing them.  Runs in the
+    worker processes started by WordTable.add_recIDs()."""
+    wordtable = _parallel_word_table
+    time_fetching = wordtable.time_fetching
+    time_tokenizing = wordtable.time_tokenizing
+    wlist = wordtable.get_words_from_recID_range(recid_range[0], recid_range[1])
+    return (wlist,
+            wordtable.time_fetching - time_fetching,
+            wordtable.time_tokenizing - time_tokenizing)
+
 def main():
     """Main that construct all the bibtask."""
     task_init(authorization_action='runbibindex',
@@ -1452,6 +1741,7 @@ def main():
   -w, --windex=w1[,w2]\tword/phrase indexes to consider (all)
   -M, --maxmem=XXX\tmaximum memory usage in kB (no limit)
   -f, --flush=NNN\t\tfull consistent table flush after NNN records (10000)
+  --parallel=N\t\tfetch and tokenize records with N processes (1)
   --force\tforce indexing of all records for provided indexes
   -Z, --remove-dependent-index=w\tname of an index for removing from virtual index
 """,
@@ -1468,6 +1758,7 @@ def main():
                 "reindex",
                 "maxmem=",
                 "flush=",
+                "parallel=",
                 "force",
                 "remove-dependent-index="
             ]),
@@ -1522,6 +1813,10 @@ def task_submit_elaborate_specific_parameter(key, value, opts, args):
                 (base_process_size + 1000))
     elif key in ("-f", "--flush"):
         task_set_option("flush", int(value))
+    elif key in ("--parallel",):
+        task_set_option("parallel", int(value))
+        if task_get_option("parallel") < 1:
+            raise StandardError("Number of parallel processes should be at least 1")
     elif key in ("-o", "--force"):
         task_set_option("force", True)
     elif key in ("-Z", "--remove-dependent-index",):
@@ -1555,8 +1850,7 @@ def get_recIDs_by_date_bibliographic(dates, index_name, force_all=False):
         else:
             dates = (res[0][0], None)
     if dates[1] is None:
-        res = intbitset(run_sql("""SELECT b.id FROM bibrec AS b WHERE b.modification_date >= %s""",
-                                   (dates[0],)))
+        res = get_recids_modified_between(dates[0])
         if index_name == 'fulltext':
             res |= intbitset(run_sql("""SELECT id_bibrec FROM bibrec_bibdoc JOIN bibdoc ON id_bibdoc=id
                                         WHERE text_extraction_date <= modification_date AND
@@ -1564,8 +1858,7 @@ def get_recIDs_by_date_bibliographic(dates, index_name, force_all=False):
                                         AND status<>'DELETED'""",
                                         (dates[0],)))
     elif dates[0] is None:
-        res = intbitset(run_sql("""SELECT b.id FROM bibrec AS b WHERE b.modification_date <= %s""",
-                                   (dates[1],)))
+        res = get_recids_modified_between(untildate=dates[1])
         if index_name == 'fulltext':
             res |= intbitset(run_sql("""SELECT id_bibrec FROM bibrec_bibdoc JOIN bibdoc ON id_bibdoc=id
                                         WHERE text_extraction_date <= modification_date
@@ -1573,10 +1866,7 @@ def get_recIDs_by_date_bibliographic(dates, index_name, force_all=False):
                                         AND status<>'DELETED'""",
                                         (dates[1],)))
     else:
-        res = intbitset(run_sql("""SELECT b.id FROM bibrec AS b
-                                   WHERE b.modification_date >= %s AND
-                                   b.modification_date <= %s""",
-                                   (dates[0], dates[1])))
+        res = get_recids_modified_between(dates[0], dates[1])
         if index_name == 'fulltext':
             res |= intbitset(run_sql("""SELECT id_bibrec FROM bibrec_bibdoc JOIN bibdoc ON id_bibdoc=id
                                         WHERE text_extraction_date <= modification_date AND
@@ -1857,7 +2147,8 @@ def task_run_core():
                     raise StandardError(error_message)
             elif task_get_option("cmd") == "add":
                 final_recIDs = beautify_range_list(create_range_list(recIDs_for_index[index_name]))
-                wordTable.add_recIDs(final_recIDs, task_get_option("flush"))
+                wordTable.add_recIDs(final_recIDs, task_get_option("flush"),
+                                     task_get_option("parallel", 1))
                 task_sleep_now_if_required(can_stop_too=True)
             elif task_get_option("cmd") == "repair":
                 wordTable.repair(task_get_option("flush"))
@@ -1899,7 +2190,8 @@ def task_run_core():
                     raise StandardError(error_message)
             elif task_get_option("cmd") == "add":
                 final_recIDs = beautify_range_list(create_range_list(recIDs_for_index[index_name]))
-                wordTable.add_recIDs(final_recIDs, task_get_option("flush"))
+                wordTable.add_recIDs(final_recIDs, task_get_option("flush"),
+                                     task_get_option("parallel", 1))
                 task_sleep_now_if_required(can_stop_too=True)
             elif task_get_option("cmd") == "repair":
                 wordTable.repair(task_get_option("flush"))
@@ -1941,7 +2233,8 @@ def task_run_core():
                     raise StandardError(error_message)
             elif task_get_option("cmd") == "add":
                 final_recIDs = beautify_range_list(create_range_list(recIDs_for_index[index_name]))
-                wordTable.add_recIDs(final_recIDs, task_get_option("flush"))
+                wordTable.add_recIDs(final_recIDs, task_get_option("flush"),
+                                     task_get_option("parallel", 1))
                 if not task_get_option("id") and not task_get_option("collection"):
                     update_index_last_updated([index_name], task_get_task_param('task_starting_time'))
                 task_sleep_now_if_required(can_stop_too=True)
@@ -37,6 +37,14 @@ CFG_MAX_MYSQL_THREADS = 50 # how many threads (connections) we
 CFG_MYSQL_THREAD_TIMEOUT = 20 # we'll kill threads that were sleeping
                               # for more than X seconds
 
+## maximum size in bytes of the hitlists written by one multi-row
+## statement when flushing word tables (must stay well below MySQL's
+## max_allowed_packet, which is required to be at least 4M):
+CFG_BIBINDEX_FLUSH_MAX_BYTES = 1024 * 1024
+## number of recID ranges updated by one statement in the reverse
+## tables when flushing word tables:
+CFG_BIBINDEX_FLUSH_RANGES_PER_QUERY = 100
+
 
 
 CFG_BIBINDEX_SYNONYM_MATCH_TYPE = { 'None': '-None-',
@@ -49,6 +49,37 @@ class TestListSetOperations(InvenioTestCase):
 
 
 
+class TestSqlLikePatternRegexp(InvenioTestCase):
+    """Tests for matching MARC tags against SQL LIKE patterns."""
+
+    def test_like_pattern_wildcards(self):
+        """bibindex engine - SQL LIKE pattern wildcards"""
+        matcher = bibindex_engine.get_sql_like_pattern_regexp("100__%")
+        self.assert_(matcher.match("100__a"))
+        self.assert_(matcher.match("100abu"))
+        self.failIf(matcher.match("700__a"))
+
+    def test_like_pattern_exact_length(self):
+        """bibindex engine - SQL LIKE pattern without percent sign"""
+        matcher = bibindex_engine.get_sql_like_pattern_regexp("980__c")
+        self.assert_(matcher.match("980__C"))
+        self.failIf(matcher.match("980__a"))
+        self.failIf(matcher.match("980__cc"))
+
+
+class TestTermCollationKey(InvenioTestCase):
+    """Tests for spotting terms stored in the same database row."""
+
+    def test_collation_key_case_and_accents(self):
+        """bibindex engine - term collation key ignores case and accents"""
+        self.assertEqual(bibindex_engine.get_term_collation_key("Ellis"),
+                         bibindex_engine.get_term_collation_key("ellis"))
+        self.assertEqual(bibindex_engine.get_term_collation_key("\xc3\xa9lan "),
+                         bibindex_engine.get_term_collation_key("elan"))
+        self.assertNotEqual(bibindex_engine.get_term_collation_key("elan"),
+                            bibindex_engine.get_term_collation_key("ela"))
+
+
 class TestWashIndexTerm(InvenioTestCase):
     """Tests for washing index terms, useful for both searching and indexing."""
 
@@ -212,6 +243,8 @@ class TestGetAuthorFamilyNameWords(InvenioTestCase):
 
 
 TEST_SUITE = make_test_suite(TestListSetOperations,
+                             TestSqlLikePatternRegexp,
+                             TestTermCollationKey,
                              TestWashIndexTerm,
                              TestGetWordsFromPhrase,
                              TestGetPairsFromPhrase,
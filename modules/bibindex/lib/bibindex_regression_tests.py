@@ -1400,6 +1400,63 @@ class BibIndexVirtualIndexRemovalTest(InvenioTestCase):
         self.assertEqual(['151', '357','1985', 'Phys. Lett., B 151 (1985) 357', 'Phys. Lett., B'],
                          deserialize_via_marshal(res[0][0]))
 
+class BibIndexBulkFlushTest(InvenioTestCase):
+    """Tests flushing of word tables by batches of terms"""
+
+    _id = 41
+
+    def setUp(self):
+        create_virtual_index(self._id, [])
+        self.wordtable = WordTable("testindex", self._id, [], "idxWORD%02dF",
+                                   CFG_BIBINDEX_INDEX_TABLE_TYPE["Words"], {}, 50)
+
+    def tearDown(self):
+        remove_virtual_index(self._id)
+
+    def _get_hitlists(self):
+        """Return dictionary term -> list of recIDs of the test index."""
+        res = run_sql("SELECT term, hitlist FROM idxWORD%02dF" % self._id)
+        return dict([(term, intbitset(hitlist).tolist()) for term, hitlist in res])
+
+    def test_accent_variants_in_one_batch(self):
+        """bibindex - flushing accent variants of a term in one batch"""
+        self.wordtable.put(1, 'elan', 1)
+        self.wordtable.put(2, '\xc3\xa9lan', 1)
+        self.wordtable.put_words_into_db(['elan', '\xc3\xa9lan'], self._id)
+        self.assertEqual(self._get_hitlists().values(), [[1, 2]])
+        self.wordtable.put(3, 'elan', 1)
+        self.wordtable.put(1, '\xc3\xa9lan', -1)
+        self.wordtable.put_words_into_db(['elan', '\xc3\xa9lan'], self._id)
+        self.assertEqual(self._get_hitlists().values(), [[2, 3]])
+
+    def test_accent_variants_in_two_batches(self):
+        """bibindex - flushing accent variants of a term in two batches"""
+        self.wordtable.put(1, 'elan', 1)
+        self.wordtable.put_words_into_db(['elan'], self._id)
+        self.wordtable.clean()
+        self.wordtable.put(2, '\xc3\xa9lan', 1)
+        self.wordtable.put(3, 'elan', 1)
+        self.wordtable.put_words_into_db(['\xc3\xa9lan'], self._id)
+        self.wordtable.put_words_into_db(['elan'], self._id)
+        self.assertEqual(self._get_hitlists().values(), [[1, 2, 3]])
+
+    def test_reindexing_phrases(self):
+        """bibindex - reindexing phrases keeps one row per phrase"""
+        wordtable = WordTable("testindex", self._id, [], "idxPHRASE%02dF",
+                              CFG_BIBINDEX_INDEX_TABLE_TYPE["Phrases"], {}, 50)
+        wordtable.put(1, 'Ellis, J', 1)
+        wordtable.put(2, 'Ellis, J', 1)
+        wordtable.put(2, 'Higgs, P', 1)
+        wordtable.put_words_into_db(['Ellis, J', 'Higgs, P'], self._id)
+        wordtable.clean()
+        wordtable.put(1, 'Ellis, J', -1)
+        wordtable.put(3, 'Ellis, J', 1)
+        wordtable.put(2, 'Higgs, P', -1)
+        wordtable.put_words_into_db(['Ellis, J', 'Higgs, P'], self._id)
+        res = run_sql("SELECT term, hitlist FROM idxPHRASE%02dF" % self._id)
+        self.assertEqual([(term, intbitset(hitlist).tolist()) for term, hitlist in res],
+                         [('Ellis, J', [2, 3])])
+
 class BibIndexCLICallTest(InvenioTestCase):
     """Tests if calls to bibindex from CLI (bibsched deamon) are run correctly"""
 
@@ -1442,6 +1499,7 @@ TEST_SUITE = make_test_suite(BibIndexRemoveStopwordsTest,
                              BibIndexGlobalIndexContentTest,
                              BibIndexVirtualIndexAlsoChangesTest,
                              BibIndexVirtualIndexRemovalTest,
+                             BibIndexBulkFlushTest,
                              BibIndexCLICallTest)
 
 if __name__ == "__main__":
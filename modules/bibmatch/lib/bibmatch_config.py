@@ -50,3 +50,12 @@ CFG_BIBMATCH_VALIDATION_RESULT_MODES = ['normal', 'final', 'joker']
 ## CFG_BIBMATCH_VALIDATION_COMPARISON_MODES - list of supported parsing modes
 ## during record validation.
 CFG_BIBMATCH_VALIDATION_COMPARISON_MODES = ['strict', 'normal', 'lazy', 'ignored']
+
+## CFG_BIBMATCH_SEARCH_CACHE_SIZE - maximum number of search results
+## (matching queries and records fetched for validation) remembered
+## by each BibMatch process, see SearchResultsCache.
+CFG_BIBMATCH_SEARCH_CACHE_SIZE = 10000
+
+## CFG_BIBMATCH_PARALLEL_CHUNK_SIZE - number of records given at once to
+## each worker process when matching with --parallel.
+CFG_BIBMATCH_PARALLEL_CHUNK_SIZE = 50
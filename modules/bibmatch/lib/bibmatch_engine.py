@@ -31,7 +31,7 @@ import getopt
 import re
 import getpass
 from tempfile import mkstemp
-from time import sleep
+from time import sleep, time
 
 from invenio.config import CFG_SITE_SECURE_URL, CFG_BIBMATCH_FUZZY_WORDLIMITS, \
                            CFG_BIBMATCH_QUERY_TEMPLATES, \
@@ -41,10 +41,12 @@ from invenio.config import CFG_SITE_SECURE_URL, CFG_BIBMATCH_FUZZY_WORDLIMITS, \
                            CFG_SITE_RECORD, \
                            CFG_BIBMATCH_SEARCH_RESULT_MATCH_LIMIT
 from invenio.bibmatch_config import CFG_BIBMATCH_LOGGER, \
-                                    CFG_LOGFILE
+                                    CFG_LOGFILE, \
+                                    CFG_BIBMATCH_SEARCH_CACHE_SIZE, \
+                                    CFG_BIBMATCH_PARALLEL_CHUNK_SIZE
 from invenio.invenio_connector import InvenioConnector, \
                                       InvenioConnectorAuthError
-from invenio.bibrecord import create_records, \
+from invenio.bibrecord import create_records, create_record, iter_record_xmls, \
     record_get_field_values, record_xml_output, record_modify_controlfield, \
     record_has_field, record_add_field
 from invenio import bibconvert
@@ -100,6 +102,7 @@ def usage():
                            Note: Useful if you want to replace matched records using BibUpload.
  -z,  --clean              clean queries before searching
  --no-validation           do not perform post-match validation
+ --parallel=N              match the records in N processes (default 1)
  -h,  --help               print this help and exit
  -V,  --version            print version information and exit
 
@@ -617,11 +620,107 @@ def match_result_output(bibmatch_recid, recID_list, server_url, query, matchmode
                               % (query,))
     return "\n".join(result)
 
+class SearchResultsCache(object):
+    """
+    Wraps an InvenioConnector object, remembering the results of its
+    search_with_retry() calls: the same matching queries and the
+    MARCXML of the same candidate records, which are fetched for
+    validation, recur a lot over the records of a feed.  The other
+    methods are the ones of the wrapped object.
+    """
+
+    def __init__(self, server, size=CFG_BIBMATCH_SEARCH_CACHE_SIZE):
+        self.server = server
+        self.size = size
+        self.results = {}
+        self.searches = 0
+        self.hits = 0
+        # whether the last search was served from the cache, in which
+        # case there is no need to wait before the next query:
+        self.last_search_cached = False
+
+    def search_with_retry(self, sleeptime=3.0, retrycount=3, **params):
+        """
+        Returns the results of InvenioConnector.search_with_retry() for
+        PARAMS, searching only if they have not been searched already.
+        The returned results must not be modified.
+        """
+        self.searches += 1
+        key = repr(sorted(params.items()))
+        if key in self.results:
+            self.hits += 1
+            self.last_search_cached = True
+            return self.results[key]
+        self.last_search_cached = False
+        results = self.server.search_with_retry(sleeptime, retrycount, **params)
+        if len(self.results) >= self.size:
+            self.results.clear()
+        self.results[key] = results
+        return results
+
+    def __getattr__(self, name):
+        return getattr(self.server, name)
+
+## search results caches of the worker processes of match_records():
+_worker_servers = {}
+
+def _match_records_in_worker(args):
+    """
+    Match a chunk of records in a worker process of match_records().
+
+    @param args: tuple (list of (bibmatch_recid, record), (server_url,
+        user, password), dictionary of match_record() arguments)
+    @return: list of (match_record() result, number of searches,
+        number of searches served from cache)
+    """
+    records, server_args, match_args = args
+    server = _worker_servers.get(server_args)
+    if server is None:
+        server = _worker_servers[server_args] = \
+                 SearchResultsCache(InvenioConnector(server_args[0],
+                                                     user=server_args[1],
+                                                     password=server_args[2]))
+    out = []
+    for bibmatch_recid, record in records:
+        searches, hits = server.searches, server.hits
+        result = match_record(bibmatch_recid=bibmatch_recid, record=record,
+                              server=server, **match_args)
+        out.append((result, server.searches - searches, server.hits - hits))
+    return out
+
+def _iter_match_results_in_parallel(records, server_args, match_args, parallel):
+    """
+    Yield the match_record() results of RECORDS, in order, as matched
+    by PARALLEL worker processes that work at most 2*PARALLEL chunks
+    of CFG_BIBMATCH_PARALLEL_CHUNK_SIZE records ahead of the consumer.
+
+    @return: iterator over (match_record() result, number of searches,
+        number of searches served from cache)
+    """
+    from multiprocessing import Pool
+    chunks = []
+    for i in range(0, len(records), CFG_BIBMATCH_PARALLEL_CHUNK_SIZE):
+        chunks.append([(i + j + 1, record[0]) for j, record in
+                       enumerate(records[i:i + CFG_BIBMATCH_PARALLEL_CHUNK_SIZE])])
+    pool = Pool(parallel)
+    try:
+        pending = []
+        next_chunk = 0
+        for dummy_chunk in chunks:
+            while next_chunk < len(chunks) and len(pending) < 2 * parallel:
+                pending.append(pool.apply_async(_match_records_in_worker,
+                                                ((chunks[next_chunk], server_args, match_args),)))
+                next_chunk += 1
+            for result in pending.pop(0).get():
+                yield result
+    finally:
+        pool.terminate()
+
 def match_records(records, qrystrs=None, search_mode=None, operator="and", \
                   verbose=1, server_url=CFG_SITE_SECURE_URL, modify=0, \
                   sleeptime=CFG_BIBMATCH_LOCAL_SLEEPTIME, \
                   clean=False, collections=[], user="", password="", \
-                  fuzzy=True, validate=True, ascii_mode=False):
+                  fuzzy=True, validate=True, ascii_mode=False, parallel=1):
     """
     Match passed records with existing records on a local or remote Invenio
     installation. Returns which records are new (no match), which are matched,
@@ -677,6 +776,9 @@ def match_records(records, qrystrs=None, search_mode=None, operator="and", \
     @param ascii_mode: True to transform values to its ascii representation
     @type ascii_mode: bool
 
+    @param parallel: number of worker processes matching the records
+    @type parallel: int
+
     @rtype: list of lists
     @return an array of arrays of records, like this [newrecs,matchedrecs,
                                                       ambiguousrecs,fuzzyrecs]
@@ -695,6 +797,29 @@ def match_records(records, qrystrs=None, search_mode=None, operator="and", \
         CFG_BIBMATCH_LOGGER.info("-- BibMatch ending match with errors (AuthError) --")
         return [newrecs, matchedrecs, ambiguousrecs, fuzzyrecs]
 
+    # At least one (field, querystring) tuple is needed for default search query
+    if not qrystrs:
+        qrystrs = [("", "")]
+    match_args = dict(qrystrs=qrystrs,
+                      search_mode=search_mode,
+                      operator=operator,
+                      verbose=verbose,
+                      sleeptime=sleeptime,
+                      clean=clean,
+                      collections=collections,
+                      fuzzy=fuzzy,
+                      validate=validate,
+                      ascii_mode=ascii_mode)
+    if parallel > 1:
+        match_results = _iter_match_results_in_parallel(records, (server_url, user, password),
+                                                        match_args, parallel)
+    else:
+        server = SearchResultsCache(server)
+        match_results = None
+    nb_searches = 0
+    nb_cached_searches = 0
+    start_time = time()
+
     ## Go through each record and try to find matches using defined querystrings
     record_counter = 0
     for record in records:
@@ -702,23 +827,17 @@ def match_records(records, qrystrs=None, search_mode=None, operator="and", \
         if (verbose > 1):
             sys.stderr.write("\n Processing record: #%d .." % (record_counter,))
 
-        # At least one (field, querystring) tuple is needed for default search query
-        if not qrystrs:
-            qrystrs = [("", "")]
         CFG_BIBMATCH_LOGGER.info("Matching of record %d: Started" % (record_counter,))
-        [matched_results, ambiguous_results, fuzzy_results] = match_record(bibmatch_recid=record_counter,
-                                                                           record=record[0],
-                                                                           server=server,
-                                                                           qrystrs=qrystrs,
-                                                                           search_mode=search_mode,
-                                                                           operator=operator,
-                                                                           verbose=verbose,
-                                                                           sleeptime=sleeptime,
-                                                                           clean=clean,
-                                                                           collections=collections,
-                                                                           fuzzy=fuzzy,
-                                                                           validate=validate,
-                                                                           ascii_mode=ascii_mode)
+        if match_results is not None:
+            [matched_results, ambiguous_results, fuzzy_results], searches, cached_searches = \
+                match_results.next()
+            nb_searches += searches
+            nb_cached_searches += cached_searches
+        else:
+            [matched_results, ambiguous_results, fuzzy_results] = match_record(bibmatch_recid=record_counter,
+                                                                               record=record[0],
+                                                                               server=server,
+                                                                               **match_args)
 
         ## Evaluate final results for record
         # Add matched record iff number found is equal to one, otherwise return fuzzy,
@@ -779,6 +898,19 @@ def match_records(records, qrystrs=None, search_mode=None, operator="and", \
                 if (verbose > 1):
                     sys.stderr.write("Final result: new\n")
                 CFG_BIBMATCH_LOGGER.info("Matching of record %d: Completed as 'new'" % (record_counter,))
+    if match_results is None:
+        nb_searches = server.searches
+        nb_cached_searches = server.hits
+    elapsed = time() - start_time
+    CFG_BIBMATCH_LOGGER.info("-- BibMatch matched %d records in %.2f seconds (%.1f records/s), "
+                             "%d searches of which %d served from cache --" % \
+                             (len(records), elapsed, len(records) / max(elapsed, 0.001),
+                              nb_searches, nb_cached_searches))
+    if verbose > 1:
+        sys.stderr.write("\nBibMatch: matched %d records in %.2f seconds (%.1f records/s), "
+                         "%d searches of which %d served from cache\n" % \
+                         (len(records), elapsed, len(records) / max(elapsed, 0.001),
+                          nb_searches, nb_cached_searches))
     CFG_BIBMATCH_LOGGER.info("-- BibMatch ending match: New(%d), Matched(%d), Ambiguous(%d), Fuzzy(%d) --" % \
                              (len(newrecs), len(matchedrecs), len(ambiguousrecs), len(fuzzyrecs)))
     return [newrecs, matchedrecs, ambiguousrecs, fuzzyrecs]
@@ -873,7 +1005,8 @@ def match_record(bibmatch_recid, record, server, qrystrs=None, search_mode=None,
                                  % (str(error),))
             break
 
-        sleep(sleeptime)
+        if not getattr(server, 'last_search_cached', False):
+            sleep(sleeptime)
 
         ## Check results:
         if len(result_recids) > 0:
@@ -971,7 +1104,8 @@ def match_record(bibmatch_recid, record, server, qrystrs=None, search_mode=None,
                         else:
                             sys.stderr.write("\nSearching with values %s result=%s\n" %
                                          (search_params, current_resultset))
-                    sleep(sleeptime)
+                    if not getattr(server, 'last_search_cached', False):
+                        sleep(sleeptime)
                     if current_resultset == None:
                         continue
                     if current_resultset == [] and empty_results < CFG_BIBMATCH_FUZZY_EMPTY_RESULT_LIMIT:
@@ -1053,6 +1187,36 @@ def transform_input_to_marcxml(filename=None, file_input=""):
         sys.stdout = old_stdout
     return new_stdout.getvalue()
 
+def read_marcxml_records(filename):
+    """
+    Parses the MARCXML records of the file FILENAME one at a time,
+    instead of reading the whole file first, and tries again without
+    XML entities the records that cannot be parsed.
+
+    Returns the list of parsed records, like bibrecord.create_records().
+    """
+    records = []
+    for record_xml in iter_record_xmls(filename):
+        record = create_record(record_xml)
+        if record[1] == 0:
+            record = create_record(xml_entities_to_utf8(record_xml))
+        records.append(record)
+    return records
+
+def is_marcxml_file(filename):
+    """
+    Returns True if the file FILENAME looks like XML, i.e. if its first
+    non-whitespace character is '<'.
+    """
+    f = open(filename)
+    try:
+        for line in f:
+            if line.strip():
+                return line.strip().startswith('<')
+    finally:
+        f.close()
+    return False
+
 def bibrecs_has_errors(bibrecs):
     """
     Utility function to check a list of parsed BibRec objects, directly
@@ -1096,7 +1260,8 @@ def main():
                    "user=",
                    "no-fuzzy",
                    "no-validation",
-                   "ascii"
+                   "ascii",
+                   "parallel="
                  ])
 
     except getopt.GetoptError, e:
@@ -1124,6 +1289,7 @@ def main():
     validate = True                           # should matches be validate?
     fuzzy = True                              # Activate fuzzy-mode if no matches found for a record
     ascii_mode = False                        # Should values be turned into ascii mode
+    parallel = 1                              # number of matching processes
 
     for opt, opt_value in opts:
         if opt in ["-0", "--print-new"]:
@@ -1194,27 +1360,40 @@ def main():
             validate = False
         if opt == "--ascii":
             ascii_mode = True
+        if opt == "--parallel":
+            try:
+                parallel = int(opt_value)
+                if parallel < 1:
+                    raise ValueError
+            except ValueError:
+                sys.stderr.write("\nBibMatch: --parallel expects a positive number\n")
+                sys.exit(1)
 
     if verbose:
         sys.stderr.write("\nBibMatch: Parsing input file %s..." % (f_input,))
 
-    read_list = []
-    if not f_input:
-        for line_in in sys.stdin:
-            read_list.append(line_in)
+    if f_input and is_marcxml_file(f_input):
+        # MARCXML file: parse it record by record
+        records = read_marcxml_records(f_input)
+        file_read = None
     else:
-        f = open(f_input)
-        for line_in in f:
-            read_list.append(line_in)
-        f.close()
-    file_read = "".join(read_list)
+        read_list = []
+        if not f_input:
+            for line_in in sys.stdin:
+                read_list.append(line_in)
+        else:
+            f = open(f_input)
+            for line_in in f:
+                read_list.append(line_in)
+            f.close()
+        file_read = "".join(read_list)
 
-    # Detect input type
-    if not file_read.strip().startswith('<'):
-        # Not xml, assume type textmarc
-        file_read = transform_input_to_marcxml(f_input, file_read)
+        # Detect input type
+        if not file_read.strip().startswith('<'):
+            # Not xml, assume type textmarc
+            file_read = transform_input_to_marcxml(f_input, file_read)
 
-    records = create_records(file_read)
+        records = create_records(file_read)
 
     if len(records) == 0:
         if verbose:
@@ -1224,11 +1403,13 @@ def main():
     # Check for any parsing errors in records
     if bibrecs_has_errors(records):
         # Errors found. Let's try to remove any XML entities
-        if verbose > 8:
-            sys.stderr.write("\nBibMatch: Parsing error. Trying removal of XML entities..\n")
+        # (already done record by record for MARCXML files)
+        if file_read is not None:
+            if verbose > 8:
+                sys.stderr.write("\nBibMatch: Parsing error. Trying removal of XML entities..\n")
 
-        file_read = xml_entities_to_utf8(file_read)
-        records = create_records(file_read)
+            file_read = xml_entities_to_utf8(file_read)
+            records = create_records(file_read)
         if bibrecs_has_errors(records):
             # Still problems.. alert the user and exit
             if verbose:
@@ -1260,7 +1441,8 @@ def main():
                                   password=password,
                                   fuzzy=fuzzy,
                                   validate=validate,
-                                  ascii_mode=ascii_mode)
+                                  ascii_mode=ascii_mode,
+                                  parallel=parallel)
 
     # set the output according to print..
     # 0-newrecs 1-matchedrecs 2-ambiguousrecs 3-fuzzyrecs
@@ -23,7 +23,11 @@
 
 __revision__ = "$Id$"
 
-from invenio.config import CFG_SITE_RECORD
+import os
+import sys
+import time
+
+from invenio.config import CFG_SITE_RECORD, CFG_TMPDIR
 from invenio.testutils import make_test_suite, run_test_suite
 from invenio.bibrecord import create_records, record_has_field
 from invenio.bibmatch_engine import match_records, transform_input_to_marcxml, \
@@ -587,6 +591,16 @@ class BibMatchTest(InvenioTestCase):
                                                             verbose=0)
         self.assertEqual(1, len(fuzzyrecs))
 
+    def test_check_parallel(self):
+        """bibmatch - check matching in parallel processes"""
+        records = create_records(self.recxml1) + create_records(self.recxml2) + \
+                  create_records(self.recxml3) + create_records(self.recxml6)
+        sequential_results = match_records(records, verbose=0)
+        parallel_results = match_records(records, verbose=0, parallel=2)
+        self.assertEqual([len(recs) for recs in sequential_results],
+                         [len(recs) for recs in parallel_results])
+        self.assertEqual([1, 1, 1, 1], [len(recs) for recs in parallel_results])
+
     def test_check_remote(self):
         """bibmatch - check remote match (Invenio demo site)"""
         records = create_records(self.recxml6)
@@ -676,7 +690,28 @@ class BibMatchTest(InvenioTestCase):
                                                               verbose=0)
         self.assertEqual(1, len(nomatchrecs))
 
-TEST_SUITE = make_test_suite(BibMatchTest)
+class BibMatchBenchmarkTest(InvenioTestCase):
+    """Benchmark matching of the demo records."""
+
+    def test_benchmark_parallel(self):
+        """bibmatch - benchmark of sequential vs parallel matching of the demo records"""
+        records = create_records(open(os.path.join(CFG_TMPDIR, 'demobibdata.xml')).read())
+        timings = []
+        results = []
+        for parallel in (1, 2, 4):
+            t0 = time.time()
+            results.append([len(recs) for recs in
+                            match_records(records, verbose=0, parallel=parallel)])
+            timings.append((parallel, time.time() - t0))
+        sys.stderr.write("\nbibmatch benchmark over %d demo records:\n" % len(records))
+        for parallel, seconds in timings:
+            sys.stderr.write("  --parallel=%d: %.1f s (%.1f records/s)\n" % \
+                             (parallel, seconds, len(records) / max(seconds, 0.001)))
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+
+TEST_SUITE = make_test_suite(BibMatchTest,
+                             BibMatchBenchmarkTest)
 
 if __name__ == "__main__":
     run_test_suite(TEST_SUITE, warn_user=True)
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Compact, memory-mapped citation graphs.
+
+A citation dictionary {recid -> [recid, ...]} is stored on disk in
+compressed sparse row (CSR) form:
+
+    header:  magic (8 bytes), version (19 bytes, the last_updated value
+             of the dictionary in rnkCITATIONDATA), number of slots N
+             (uint32), number of edges E (uint32);
+    offsets: N + 1 uint32, the neighbours of recid R being stored at
+             positions offsets[R] to offsets[R+1] of the targets array;
+    targets: E uint32.
+
+The files live in CFG_CACHEDIR/citations and are mapped read-only in
+memory, so that all the processes of a host share the same pages and
+looking up the neighbours of a record costs O(degree) without any
+deserialization.  Files are replaced atomically, hence processes that
+still map an old version keep working until they reopen the new one.
+"""
+
+__revision__ = "$Id$"
+
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+
+try:
+    import fcntl
+    CFG_FCNTL_IMPORTABLE = True
+except ImportError:
+    CFG_FCNTL_IMPORTABLE = False
+
+try:
+    ## import optional module:
+    import numpy
+    CFG_NUMPY_IMPORTABLE = True
+except ImportError:
+    CFG_NUMPY_IMPORTABLE = False
+
+from invenio.config import CFG_CACHEDIR
+from invenio.intbitset import intbitset
+
+CFG_CITATION_GRAPH_DIR = os.path.join(CFG_CACHEDIR, 'citations')
+CFG_CITATION_GRAPH_MAGIC = 'INVCITG1'
+CFG_CITATION_GRAPH_VERSION_SIZE = 19
+_HEADER_FORMAT = '=%ds%dsII' % (len(CFG_CITATION_GRAPH_MAGIC),
+                                CFG_CITATION_GRAPH_VERSION_SIZE)
+_HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+_UINT32 = 'I'
+if array(_UINT32).itemsize != 4:
+    _UINT32 = 'L'
+
+class InvenioCitationGraphError(Exception):
+    """Error raised on missing or corrupted citation graph files."""
+    pass
+
+def get_citation_graph_path(name):
+    """Return path of the citation graph file of dictionary NAME."""
+    return os.path.join(CFG_CITATION_GRAPH_DIR, '%s.graph' % name)
+
+def _normalize_version(version):
+    """Return VERSION as a fixed size string."""
+    return str(version)[:CFG_CITATION_GRAPH_VERSION_SIZE].ljust(CFG_CITATION_GRAPH_VERSION_SIZE)
+
+def write_citation_graph(path, citation_dict, version):
+    """
+    Write CITATION_DICT ({recid -> list of recids}) in CSR form into
+    file PATH, tagging it with VERSION (e.g. the last_updated date of
+    the dictionary).  The file is replaced atomically.
+    """
+    if citation_dict:
+        nb_slots = max(citation_dict.keys()) + 1
+    else:
+        nb_slots = 0
+    offsets = array(_UINT32, [0]) * (nb_slots + 1)
+    targets = array(_UINT32)
+    recids = citation_dict.keys()
+    recids.sort()
+    previous_recid = -1
+    for recid in recids:
+        neighbours = citation_dict[recid]
+        if recid < 0 or not neighbours:
+            continue
+        # records without neighbours in between share the same offset:
+        for empty_recid in xrange(previous_recid + 1, recid):
+            offsets[empty_recid + 1] = len(targets)
+        targets.extend(neighbours)
+        offsets[recid + 1] = len(targets)
+        previous_recid = recid
+    for empty_recid in xrange(previous_recid + 1, nb_slots):
+        offsets[empty_recid + 1] = len(targets)
+
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='tmp_')
+    try:
+        tmpfile = os.fdopen(fd, 'wb')
+        tmpfile.write(struct.pack(_HEADER_FORMAT, CFG_CITATION_GRAPH_MAGIC,
+                                  _normalize_version(version),
+                                  nb_slots, len(targets)))
+        offsets.tofile(tmpfile)
+        targets.tofile(tmpfile)
+        tmpfile.close()
+        os.chmod(tmppath, 0644)
+        os.rename(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
+def read_citation_graph_version(path):
+    """Return version stored in citation graph file PATH, or None if
+    the file does not exist or is not a citation graph."""
+    try:
+        header = open(path, 'rb').read(_HEADER_SIZE)
+    except IOError:
+        return None
+    if len(header) != _HEADER_SIZE:
+        return None
+    magic, version, dummy_nb_slots, dummy_nb_edges = struct.unpack(_HEADER_FORMAT, header)
+    if magic != CFG_CITATION_GRAPH_MAGIC:
+        return None
+    return version
+
+class CitationGraph(object):
+    """
+    Read-only, memory-mapped citation dictionary.  Offers the subset of
+    the dictionary interface used by the citation searcher (get,
+    has_key, in, [], keys, len), returning lists of recids.
+    """
+    def __init__(self, path):
+        graph_file = open(path, 'rb')
+        try:
+            size = os.fstat(graph_file.fileno()).st_size
+            if size < _HEADER_SIZE:
+                raise InvenioCitationGraphError("%s is not a citation graph" % path)
+            self.mm = mmap.mmap(graph_file.fileno(), size, access=mmap.ACCESS_READ)
+        finally:
+            graph_file.close()
+        magic, version, self.nb_slots, self.nb_edges = \
+               struct.unpack(_HEADER_FORMAT, self.mm[:_HEADER_SIZE])
+        if magic != CFG_CITATION_GRAPH_MAGIC or \
+               size != _HEADER_SIZE + 4 * (self.nb_slots + 1 + self.nb_edges):
+            raise InvenioCitationGraphError("%s is not a citation graph" % path)
+        self.path = path
+        self.version = version
+        self.offsets_start = _HEADER_SIZE
+        self.targets_start = _HEADER_SIZE + 4 * (self.nb_slots + 1)
+        self._keys_intbitset = None
+
+    def _get_bounds(self, recid):
+        """Return (start, end) positions of the neighbours of RECID."""
+        if recid < 0 or recid >= self.nb_slots:
+            return 0, 0
+        return struct.unpack('=II', self.mm[self.offsets_start + 4 * recid:
+                                             self.offsets_start + 4 * recid + 8])
+
+    def get_degree(self, recid):
+        """Return number of neighbours of RECID."""
+        start, end = self._get_bounds(recid)
+        return end - start
+
+    def get(self, recid, default=None):
+        """Return list of neighbours of RECID, or DEFAULT if none."""
+        try:
+            start, end = self._get_bounds(recid)
+        except TypeError:
+            return default
+        if start == end:
+            return default
+        neighbours = array(_UINT32)
+        neighbours.fromstring(self.mm[self.targets_start + 4 * start:
+                                      self.targets_start + 4 * end])
+        return neighbours.tolist()
+
+    def __getitem__(self, recid):
+        neighbours = self.get(recid)
+        if neighbours is None:
+            raise KeyError(recid)
+        return neighbours
+
+    def has_key(self, recid):
+        """Does RECID have any neighbour?"""
+        try:
+            return self.get_degree(recid) > 0
+        except TypeError:
+            return False
+
+    __contains__ = has_key
+
+    def get_degrees(self):
+        """
+        Return the number of neighbours of every recid, as a numpy
+        array indexed by recid if numpy is available, as an array
+        otherwise.
+        """
+        if CFG_NUMPY_IMPORTABLE:
+            offsets = numpy.frombuffer(self.mm, dtype=numpy.uint32,
+                                       count=self.nb_slots + 1,
+                                       offset=self.offsets_start)
+            return numpy.diff(offsets)
+        offsets = array(_UINT32)
+        offsets.fromstring(self.mm[self.offsets_start:self.targets_start])
+        return array(_UINT32, [offsets[i + 1] - offsets[i]
+                               for i in xrange(self.nb_slots)])
+
+    def get_recids_by_degree(self, min_degree=1, max_degree=None):
+        """Return intbitset of recids having between MIN_DEGREE and
+        MAX_DEGREE (inclusive, None for no limit) neighbours."""
+        degrees = self.get_degrees()
+        if CFG_NUMPY_IMPORTABLE:
+            mask = degrees >= min_degree
+            if max_degree is not None:
+                mask &= degrees <= max_degree
+            return intbitset(numpy.nonzero(mask)[0].tolist())
+        return intbitset([recid for recid, degree in enumerate(degrees)
+                          if degree >= min_degree and
+                          (max_degree is None or degree <= max_degree)])
+
+    def keys_intbitset(self):
+        """Return intbitset of recids having neighbours."""
+        if self._keys_intbitset is None:
+            self._keys_intbitset = self.get_recids_by_degree(1)
+        return self._keys_intbitset
+
+    def keys(self):
+        """Return list of recids having neighbours."""
+        return self.keys_intbitset().tolist()
+
+    def __len__(self):
+        return len(self.keys_intbitset())
+
+    def __nonzero__(self):
+        return self.nb_edges > 0
+
+    def iteritems(self):
+        """Iterate over (recid, neighbours) pairs."""
+        for recid in self.keys_intbitset():
+            yield recid, self.get(recid)
+
+def open_citation_graph(name, version, dict_loader):
+    """
+    Return CitationGraph of dictionary NAME at VERSION.  If the graph
+    file does not exist or is older, it is (re)built from the
+    dictionary returned by DICT_LOADER().  Only one process of the host
+    rebuilds the file at a time, the others wait for it and then map
+    the same file.
+    """
+    path = get_citation_graph_path(name)
+    version = _normalize_version(version)
+    if read_citation_graph_version(path) != version:
+        if not os.path.isdir(CFG_CITATION_GRAPH_DIR):
+            try:
+                os.makedirs(CFG_CITATION_GRAPH_DIR)
+            except OSError:
+                if not os.path.isdir(CFG_CITATION_GRAPH_DIR):
+                    raise
+        lock_file = open(path + '.lock', 'a')
+        try:
+            if CFG_FCNTL_IMPORTABLE:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            # another process may have built it while we were waiting:
+            if read_citation_graph_version(path) != version:
+                write_citation_graph(path, dict_loader(), version)
+        finally:
+            if CFG_FCNTL_IMPORTABLE:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+    return CitationGraph(path)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for the memory-mapped citation graphs."""
+
+__revision__ = "$Id$"
+
+import os
+import shutil
+import tempfile
+
+from invenio.testutils import InvenioTestCase
+
+from invenio.intbitset import intbitset
+from invenio import bibrank_citation_graph
+from invenio.bibrank_citation_graph import CitationGraph, \
+     InvenioCitationGraphError, write_citation_graph, \
+     read_citation_graph_version, open_citation_graph
+from invenio.testutils import make_test_suite, run_test_suite
+
+CITATIONDICT = {1: [2, 3, 5], 3: [5], 4: [], 7: [1, 2]}
+
+class TestCitationGraph(InvenioTestCase):
+    """Test writing and reading citation graphs."""
+
+    def setUp(self):
+        """Create temporary graph directory."""
+        self.dirname = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirname, 'citationdict.graph')
+
+    def tearDown(self):
+        """Remove temporary graph directory."""
+        shutil.rmtree(self.dirname)
+
+    def test_lookups(self):
+        """bibrank citation graph - dictionary-like lookups"""
+        write_citation_graph(self.path, CITATIONDICT, '2013-01-01 00:00:00')
+        graph = CitationGraph(self.path)
+        self.assertEqual(graph.get(1), [2, 3, 5])
+        self.assertEqual(graph[7], [1, 2])
+        self.assertEqual(graph.get(4, []), [])
+        self.assertEqual(graph.get(100, []), [])
+        self.assertEqual(graph.get(-1), None)
+        self.assertRaises(KeyError, graph.__getitem__, 2)
+        self.assert_(graph.has_key(3))
+        self.failIf(4 in graph)
+        self.assertEqual(graph.keys(), [1, 3, 7])
+        self.assertEqual(len(graph), 3)
+        self.assertEqual(graph.get_degree(1), 3)
+        self.assertEqual(graph.version, '2013-01-01 00:00:00')
+
+    def test_degree_queries(self):
+        """bibrank citation graph - records by number of neighbours"""
+        write_citation_graph(self.path, CITATIONDICT, '2013-01-01 00:00:00')
+        graph = CitationGraph(self.path)
+        self.assertEqual(graph.get_recids_by_degree(2), intbitset([1, 7]))
+        self.assertEqual(graph.get_recids_by_degree(1, 2), intbitset([3, 7]))
+        self.assertEqual(graph.keys_intbitset(), intbitset([1, 3, 7]))
+
+    def test_empty_graph(self):
+        """bibrank citation graph - empty dictionary"""
+        write_citation_graph(self.path, {}, '2013-01-01 00:00:00')
+        graph = CitationGraph(self.path)
+        self.failIf(graph)
+        self.assertEqual(graph.get(1, []), [])
+        self.assertEqual(graph.keys(), [])
+
+    def test_corrupted_file(self):
+        """bibrank citation graph - corrupted file detection"""
+        open(self.path, 'wb').write('not a citation graph at all, really not')
+        self.assertEqual(read_citation_graph_version(self.path), None)
+        self.assertRaises(InvenioCitationGraphError, CitationGraph, self.path)
+
+    def test_open_rebuilds_stale_graphs(self):
+        """bibrank citation graph - stale graphs are rebuilt"""
+        saved_dir = bibrank_citation_graph.CFG_CITATION_GRAPH_DIR
+        bibrank_citation_graph.CFG_CITATION_GRAPH_DIR = self.dirname
+        loads = []
+        def loader():
+            loads.append(1)
+            return CITATIONDICT
+        try:
+            graph = open_citation_graph('citationdict', '2013-01-01 00:00:00', loader)
+            self.assertEqual(graph.get(3), [5])
+            open_citation_graph('citationdict', '2013-01-01 00:00:00', loader)
+            self.assertEqual(len(loads), 1)
+            open_citation_graph('citationdict', '2013-01-02 00:00:00', loader)
+            self.assertEqual(len(loads), 2)
+        finally:
+            bibrank_citation_graph.CFG_CITATION_GRAPH_DIR = saved_dir
+
+TEST_SUITE = make_test_suite(TestCitationGraph,)
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE)
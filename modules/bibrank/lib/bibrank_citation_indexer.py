@@ -33,6 +33,7 @@ from invenio.bibindex_tokenizers.BibIndexJournalTokenizer import \
     CFG_JOURNAL_PUBINFO_STANDARD_FORM, \
     CFG_JOURNAL_PUBINFO_STANDARD_FORM_REGEXP_CHECK
 from invenio.search_engine import search_pattern, search_unit
+from invenio.search_engine_date_index import get_recids_modified_between
 from invenio.search_engine_utils import get_fieldvalues
 from invenio.bibformat_utils import parse_tag
 from invenio.bibknowledge import get_kb_mappings
@@ -41,6 +42,8 @@ from invenio.bibtask import write_message, task_get_option, \
                      task_get_task_param
 from invenio.errorlib import register_exception
 from invenio.bibindex_engine_utils import get_field_tags
+from invenio.bibrank_citation_graph import write_citation_graph, \
+     get_citation_graph_path
 
 
 INTBITSET_OF_DELETED_RECORDS = search_unit(p='DELETED', f='980', m='a')
@@ -246,12 +249,9 @@ def get_modified_recs(bibrank_method_lastupdate, indexes_lastupdate):
     execution of bibrank method and the latest journal/report index updates.
     The result is expected to have ascending id order.
     """
-    query = """SELECT id FROM bibrec
-               WHERE modification_date >= %s
-               AND modification_date < %s
-               ORDER BY id ASC"""
-    records = run_sql(query, (bibrank_method_lastupdate, indexes_lastupdate))
-    return [r[0] for r in records]
+    return list(get_recids_modified_between(bibrank_method_lastupdate,
+                                            indexes_lastupdate,
+                                            until_exclusive=True))
 
 
 def last_updated_result(rank_method_code):
@@ -903,6 +903,13 @@ def insert_into_cit_db(dic, name):
     # check that this column really exists
     run_sql("""REPLACE INTO rnkCITATIONDATA(object_name, object_value,
                last_updated) VALUES (%s, %s, %s)""", (name, s, ndate))
+    # also publish it as memory-mapped graph for the searchers of this
+    # host; other hosts rebuild it from the database on first use
+    try:
+        write_citation_graph(get_citation_graph_path(name), dic, ndate)
+    except (IOError, OSError), err:
+        write_message("could not write citation graph %s: %s" % (name, err),
+                      stream=sys.stderr)
 
 
 def get_cit_dict(name):
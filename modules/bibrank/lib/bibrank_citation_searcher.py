@@ -25,20 +25,22 @@ from invenio.dbquery import run_sql, get_table_update_time, OperationalError, \
         deserialize_via_marshal
 from invenio.intbitset import intbitset
 from invenio.data_cacher import DataCacher
+from invenio.config import CFG_WEBSEARCH_CACHE_CHECK_INTERVAL, \
+     CFG_BIBRANK_CITATION_GRAPH_MMAP
+from invenio.bibrank_citation_graph import open_citation_graph, \
+     InvenioCitationGraphError
 
 class CitationDictsDataCacher(DataCacher):
     """
     Cache holding all citation dictionaries (citationdict,
     reversedict, selfcitdict, selfcitedbydict).
+
+    Only the dictionaries updated since the last refresh are reloaded,
+    and refreshing happens in the background, so that clients keep
+    being served the previous dictionaries meanwhile.
     """
     def __init__(self):
-        def cache_filler():
-            alldicts = {}
-            try:
-                res = run_sql("SELECT object_name,object_value FROM rnkCITATIONDATA")
-            except OperationalError:
-                # database problems, return empty cache
-                return {}
+        def load_dicts(alldicts, res):
             for row in res:
                 object_name = row[0]
                 object_value = row[1]
@@ -53,6 +55,24 @@ class CitationDictsDataCacher(DataCacher):
                     alldicts['citationdict_keys'] = object_value_dict.keys()
                     alldicts['citationdict_keys_intbitset'] = intbitset(object_value_dict.keys())
             return alldicts
+
+        def cache_filler():
+            try:
+                res = run_sql("SELECT object_name,object_value FROM rnkCITATIONDATA")
+            except OperationalError:
+                # database problems, return empty cache
+                return {}
+            return load_dicts({}, res)
+
+        def delta_filler(cache, timestamp):
+            try:
+                res = run_sql("""SELECT object_name,object_value FROM rnkCITATIONDATA
+                                 WHERE last_updated>=%s""", (timestamp,))
+            except OperationalError:
+                # database problems, keep the current cache
+                return cache
+            return load_dicts(dict(cache), res)
+
         def timestamp_verifier():
             res = run_sql("""SELECT DATE_FORMAT(last_updated, '%Y-%m-%d %H:%i:%s')
                              FROM rnkMETHOD WHERE name='citation'""")
@@ -61,7 +81,70 @@ class CitationDictsDataCacher(DataCacher):
             else:
                 return '0000-00-00 00:00:00'
 
-        DataCacher.__init__(self, cache_filler, timestamp_verifier)
+        DataCacher.__init__(self, cache_filler, timestamp_verifier,
+                            delta_filler=delta_filler,
+                            check_interval=CFG_WEBSEARCH_CACHE_CHECK_INTERVAL,
+                            background_refresh=True)
+
+class CitationGraphsDataCacher(DataCacher):
+    """
+    Cache holding all citation dictionaries as memory-mapped
+    CitationGraph objects (see bibrank_citation_graph), shared by all
+    the processes of the host.  Only the version of each dictionary is
+    read from the database; graph files that are missing or older than
+    the database are rebuilt from rnkCITATIONDATA.  Dictionaries whose
+    graph cannot be opened are loaded as plain dictionaries instead.
+    """
+    def __init__(self):
+        def load_dict(object_name):
+            res = run_sql("""SELECT object_value FROM rnkCITATIONDATA
+                             WHERE object_name=%s""", (object_name,))
+            if res and res[0][0]:
+                try:
+                    return deserialize_via_marshal(res[0][0])
+                except:
+                    pass
+            return {}
+
+        def load_graphs(graphs):
+            try:
+                res = run_sql("""SELECT object_name,
+                                 DATE_FORMAT(last_updated, '%Y-%m-%d %H:%i:%s')
+                                 FROM rnkCITATIONDATA""")
+            except OperationalError:
+                # database problems, keep the current cache
+                return graphs
+            alldicts = {}
+            for object_name, version in res:
+                graph = graphs.get(object_name)
+                if getattr(graph, 'version', None) == version:
+                    alldicts[object_name] = graph
+                    continue
+                try:
+                    alldicts[object_name] = open_citation_graph(object_name, version,
+                                            lambda name=object_name: load_dict(name))
+                except (IOError, OSError, InvenioCitationGraphError):
+                    alldicts[object_name] = load_dict(object_name)
+            return alldicts
+
+        def cache_filler():
+            return load_graphs({})
+
+        def delta_filler(cache, dummy_timestamp):
+            return load_graphs(cache)
+
+        def timestamp_verifier():
+            res = run_sql("""SELECT DATE_FORMAT(last_updated, '%Y-%m-%d %H:%i:%s')
+                             FROM rnkMETHOD WHERE name='citation'""")
+            if res:
+                return res[0][0]
+            else:
+                return '0000-00-00 00:00:00'
+
+        DataCacher.__init__(self, cache_filler, timestamp_verifier,
+                            delta_filler=delta_filler,
+                            check_interval=CFG_WEBSEARCH_CACHE_CHECK_INTERVAL,
+                            background_refresh=True)
 
 CACHE_CITATION_DICTS = None
 
@@ -75,14 +158,29 @@ def get_citation_dict(dictname):
             be citationdict, reversedict, selfcitdict, selfcitedbydict.
     @type dictname: string
     @return: a citation dictionary. The structure of the dictionary is
-            { recid -> [list of recids] }.
+            { recid -> [list of recids] }.  When
+            CFG_BIBRANK_CITATION_GRAPH_MMAP is set, this is a read-only
+            CitationGraph offering the same lookup interface.
     @rtype: dictionary
     """
     global CACHE_CITATION_DICTS
     if CACHE_CITATION_DICTS is None:
-        CACHE_CITATION_DICTS = CitationDictsDataCacher()
+        if CFG_BIBRANK_CITATION_GRAPH_MMAP:
+            CACHE_CITATION_DICTS = CitationGraphsDataCacher()
+        else:
+            CACHE_CITATION_DICTS = CitationDictsDataCacher()
     else:
         CACHE_CITATION_DICTS.recreate_cache_if_needed()
+    if dictname in ('citationdict_keys', 'citationdict_keys_intbitset') and \
+           dictname not in CACHE_CITATION_DICTS.cache:
+        citationdict = CACHE_CITATION_DICTS.cache.get('citationdict', {})
+        if hasattr(citationdict, 'keys_intbitset'):
+            keys = citationdict.keys_intbitset()
+        else:
+            keys = intbitset(citationdict.keys())
+        if dictname == 'citationdict_keys':
+            return keys.tolist()
+        return keys
     return CACHE_CITATION_DICTS.cache.get(dictname, {})
 
 def get_refers_to(recordid):
@@ -106,14 +204,27 @@ def get_cited_by_count(recordid):
     cache_cited_by_dictionary = get_citation_dict("citationdict")
     return len(cache_cited_by_dictionary.get(recordid, []))
 
+def _get_records_cited_between(first, last=None):
+    """Return an intbitset of record IDs that are cited between FIRST
+       (at least 1) and LAST (inclusive, None for no limit) times.
+    """
+    cache_cited_by_dictionary = get_citation_dict("citationdict")
+    if hasattr(cache_cited_by_dictionary, 'get_recids_by_degree'):
+        # memory-mapped graph: the numbers of cites are readily available
+        return cache_cited_by_dictionary.get_recids_by_degree(first, last)
+    matches = intbitset([])
+    for k in get_citation_dict("citationdict_keys"):
+        numcites = len(cache_cited_by_dictionary[k])
+        if numcites >= first and (last is None or numcites <= last):
+            matches.add(k)
+    return matches
+
 def get_records_with_num_cites(numstr, allrecs = intbitset([])):
     """Return an intbitset of record IDs that are cited X times,
        X defined in numstr.
        Warning: numstr is string and may not be numeric! It can
        be 10,0->100 etc
     """
-    cache_cited_by_dictionary = get_citation_dict("citationdict")
-    cache_cited_by_dictionary_keys = get_citation_dict("citationdict_keys")
     cache_cited_by_dictionary_keys_intbitset = get_citation_dict("citationdict_keys_intbitset")
     matches = intbitset([])
     #once again, check that the parameter is a string
@@ -130,11 +241,7 @@ def get_records_with_num_cites(numstr, allrecs = intbitset([])):
         if num == 0:
             #we return recids that are not in keys
             return allrecs - cache_cited_by_dictionary_keys_intbitset
-        for k in cache_cited_by_dictionary_keys:
-            li = cache_cited_by_dictionary[k]
-            if len(li) == num:
-                matches.add(k)
-        return matches
+        return _get_records_cited_between(num, num)
 
     #try to get 1->10 or such
     firstsec = re.findall("(\d+)->(\d+)", numstr)
@@ -150,20 +257,14 @@ def get_records_with_num_cites(numstr, allrecs = intbitset([])):
             #start with those that have no cites..
             matches = allrecs - cache_cited_by_dictionary_keys_intbitset
         if (first <= sec):
-            for k in cache_cited_by_dictionary_keys:
-                li = cache_cited_by_dictionary[k]
-                if len(li) >= first:
-                    if len(li) <= sec:
-                        matches.add(k)
+            if sec > 0:
+                matches |= _get_records_cited_between(max(first, 1), sec)
             return matches
 
     firstsec = re.findall("(\d+)\+", numstr)
     if firstsec:
-        first = firstsec[0]
-        for k in cache_cited_by_dictionary_keys:
-            li = cache_cited_by_dictionary[k]
-            if len(li) > int(first):
-                matches.add(k)
+        first = int(firstsec[0])
+        matches = _get_records_cited_between(first + 1)
     return matches
 
 def get_cited_by_list(recordlist):
@@ -183,15 +284,15 @@ def get_refersto_hitset(ahitset):
     refersto:author:ellis feature.
     """
     cache_cited_by_dictionary = get_citation_dict("citationdict")
-    out = intbitset()
+    recids = []
     if ahitset:
         try:
             for recid in ahitset:
-                out = out | intbitset(cache_cited_by_dictionary.get(recid, []))
+                recids.extend(cache_cited_by_dictionary.get(recid, []))
         except OverflowError:
             # ignore attempt to iterate over infinite ahitset
             pass
-    return out
+    return intbitset(recids)
 
 def get_citedby_hitset(ahitset):
     """
@@ -199,15 +300,15 @@ def get_citedby_hitset(ahitset):
     ahitset.  Useful for search engine's citedby:author:ellis feature.
     """
     cache_cited_by_dictionary = get_citation_dict("reversedict")
-    out = intbitset()
+    recids = []
     if ahitset:
         try:
             for recid in ahitset:
-                out = out | intbitset(cache_cited_by_dictionary.get(recid, []))
+                recids.extend(cache_cited_by_dictionary.get(recid, []))
         except OverflowError:
             # ignore attempt to iterate over infinite ahitset
             pass
-    return out
+    return intbitset(recids)
 
 def get_cited_by_weight(recordlist):
     """Return a tuple of ([recid,number_of_citing_records],...) for all the
@@ -26,8 +26,10 @@ Note: Does not access the database, the input is MARCXML only."""
 
 ### IMPORT INTERESTING MODULES AND XML PARSERS
 
+import marshal
 import re
 import sys
+from array import array
 from cStringIO import StringIO
 
 if sys.hexversion < 0x2040000:
@@ -38,6 +40,7 @@ if sys.hexversion < 0x2040000:
 from invenio.bibrecord_config import CFG_MARC21_DTD, \
     CFG_BIBRECORD_WARNING_MSGS, CFG_BIBRECORD_DEFAULT_VERBOSE_LEVEL, \
     CFG_BIBRECORD_DEFAULT_CORRECT, CFG_BIBRECORD_PARSERS_AVAILABLE, \
+    CFG_BIBRECORD_STREAM_BLOCK_SIZE, \
     InvenioBibRecordParserError, InvenioBibRecordFieldError
 from invenio.config import CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG
 from invenio.textutils import encode_for_xml
@@ -116,6 +119,51 @@ def create_records(marcxml, verbose=CFG_BIBRECORD_DEFAULT_VERBOSE_LEVEL,
     return [create_record(record_xml, verbose=verbose, correct=correct,
             parser=parser, keep_singletons=keep_singletons) for record_xml in record_xmls]
 
+def iter_record_xmls(source, block_size=CFG_BIBRECORD_STREAM_BLOCK_SIZE):
+    """Yields the MARCXML of each record of SOURCE (a path or a file-like
+    object), i.e. the same strings create_records() would parse, while
+    reading SOURCE by blocks of BLOCK_SIZE bytes."""
+    regex = re.compile('<record.*?>.*?</record>', re.DOTALL)
+    if hasattr(source, 'read'):
+        stream = source
+    else:
+        stream = open(source)
+    try:
+        buf = ''
+        while True:
+            block = stream.read(block_size)
+            buf += block
+            if block and buf.find('</record>',
+                    max(0, len(buf) - len(block) - len('</record>') + 1)) == -1:
+                # no record can have been completed by this block
+                continue
+            end = 0
+            for match in regex.finditer(buf):
+                yield match.group(0)
+                end = match.end()
+            if not block:
+                break
+            # Keep only what may still be (the beginning of) a record:
+            start = buf.find('<record', end)
+            if start == -1:
+                buf = buf[max(end, len(buf) - len('<record') + 1):]
+            else:
+                buf = buf[start:]
+    finally:
+        if stream is not source:
+            stream.close()
+
+def iter_records(source, verbose=CFG_BIBRECORD_DEFAULT_VERBOSE_LEVEL,
+    correct=CFG_BIBRECORD_DEFAULT_CORRECT, parser='',
+    keep_singletons=CFG_BIBRECORD_KEEP_SINGLETONS):
+    """Yields the records of the MARCXML of SOURCE (a path or a file-like
+    object) one at a time, as tuples (record, status_code, list_of_errors)
+    like create_records() returns, without ever holding the whole file
+    nor all the records in memory."""
+    for record_xml in iter_record_xmls(source):
+        yield create_record(record_xml, verbose=verbose, correct=correct,
+                            parser=parser, keep_singletons=keep_singletons)
+
 def create_record(marcxml, verbose=CFG_BIBRECORD_DEFAULT_VERBOSE_LEVEL,
     correct=CFG_BIBRECORD_DEFAULT_CORRECT, parser='',
     sort_fields_by_indicators=False,
@@ -306,6 +354,9 @@ def record_get_field_instances(rec, tag="", ind1=" ", ind2=" "):
         out = []
         ind1, ind2 = _wash_indicators(ind1, ind2)
 
+        if isinstance(rec, CompactRecord) and rec._fields is None:
+            return rec._get_fields(tag, ind1, ind2)
+
         if '%' in tag:
             # Wildcard in tag. Check all possible
             for field_tag in rec:
@@ -841,6 +892,11 @@ def record_get_field_value(rec, tag, ind1=" ", ind2=" ", code=""):
     # functions or doing tests inside loops)
     ind1, ind2 = _wash_indicators(ind1, ind2)
 
+    if isinstance(rec, CompactRecord):
+        if rec._fields is None:
+            return rec._get_first_value(tag, ind1, ind2, code)
+        rec = rec._fields
+
     if '%' in tag:
         # Wild card in tag. Must find all corresponding fields
         if code == '':
@@ -928,6 +984,11 @@ def record_get_field_values(rec, tag, ind1=" ", ind2=" ", code="",
 
     ind1, ind2 = _wash_indicators(ind1, ind2)
 
+    if isinstance(rec, CompactRecord):
+        if rec._fields is None and not filter_subfield_code:
+            return rec._get_values(tag, ind1, ind2, code)
+        rec = rec._get_tag_fields(tag)
+
     if filter_subfield_code and filter_subfield_mode == "r":
         reg_exp = re.compile(filter_subfield_value)
 
@@ -1250,6 +1311,353 @@ def record_order_subfields(rec, tag=None):
 
 ### IMPLEMENTATION / INVISIBLE FUNCTIONS
 
+class CompactRecord(object):
+    """
+    Compact representation of a record structure.
+
+    The fields are kept in flat arrays and all their values in a single
+    string; the values are looked up through an index on (tag, ind1,
+    ind2, code) built the first time it is needed.  A CompactRecord
+    behaves like the record structure returned by create_record() and
+    can be given to all the record_* functions:
+    record_get_field_value(), record_get_field_values(),
+    record_get_field_instances() and record_has_field() read the
+    arrays, whereas any other access to the fields (e.g. rec[tag] or a
+    modification) converts the record once to the usual dictionary
+    structure, which is used from then on (see to_dict()).
+
+    Note that the field instances returned by record_get_field_instances()
+    on a record that has not been converted are copies.
+    """
+
+    __slots__ = ('_tags', '_tag_starts', '_ind1s', '_ind2s', '_positions',
+                 '_field_starts', '_codes', '_values', '_offsets',
+                 '_index', '_fields')
+
+    def __init__(self, rec=None):
+        """Creates the compact representation of record structure REC.
+
+        Raises TypeError or ValueError if REC cannot be represented
+        (e.g. non-integer field positions or unicode values)."""
+        tags = []
+        tag_starts = array('i', [0])
+        ind1s = []
+        ind2s = []
+        positions = array('i')
+        field_starts = array('i', [0])
+        codes = []
+        values = []
+        offsets = array('i', [0])
+        offset = 0
+        for tag in sorted((rec or {}).keys()):
+            tags.append(tag)
+            for field in rec[tag]:
+                ind1s.append(field[1])
+                ind2s.append(field[2])
+                positions.append(field[4])
+                codes.append('')
+                values.append(field[3])
+                offset += len(field[3])
+                offsets.append(offset)
+                for code, value in field[0]:
+                    codes.append(code)
+                    values.append(value)
+                    offset += len(value)
+                    offsets.append(offset)
+                field_starts.append(len(codes))
+            tag_starts.append(len(ind1s))
+        self._tags = tuple(tags)
+        self._tag_starts = tag_starts
+        self._ind1s = _compact_strings(ind1s)
+        self._ind2s = _compact_strings(ind2s)
+        self._positions = positions
+        self._field_starts = field_starts
+        self._codes = _compact_strings(codes)
+        self._values = ''.join(values)
+        if not isinstance(self._values, str):
+            raise ValueError("record values must be byte strings")
+        self._offsets = offsets
+        self._index = None
+        self._fields = None
+
+    def get_structure(self):
+        """Returns the record as a tuple of strings that marshal can
+        serialize and load much faster than the dictionary structure,
+        see from_structure()."""
+        if self._fields is not None:
+            return CompactRecord(self._fields).get_structure()
+        return (_COMPACT_STRUCTURE_SIGNATURE, self._tags,
+                self._tag_starts.tostring(), self._ind1s, self._ind2s,
+                self._positions.tostring(), self._field_starts.tostring(),
+                self._codes, self._values, self._offsets.tostring())
+
+    def from_structure(cls, structure):
+        """Creates the CompactRecord of STRUCTURE, as returned by
+        get_structure().  Raises ValueError if STRUCTURE is not valid."""
+        if not isinstance(structure, tuple) or len(structure) != 10 or \
+               structure[0] != _COMPACT_STRUCTURE_SIGNATURE:
+            raise ValueError("not a compact record structure")
+        rec = cls.__new__(cls)
+        (dummy, rec._tags, tag_starts, rec._ind1s, rec._ind2s, positions,
+         field_starts, rec._codes, rec._values, offsets) = structure
+        rec._tag_starts = array('i')
+        rec._tag_starts.fromstring(tag_starts)
+        rec._positions = array('i')
+        rec._positions.fromstring(positions)
+        rec._field_starts = array('i')
+        rec._field_starts.fromstring(field_starts)
+        rec._offsets = array('i')
+        rec._offsets.fromstring(offsets)
+        rec._index = None
+        rec._fields = None
+        return rec
+    from_structure = classmethod(from_structure)
+
+    def to_dict(self):
+        """Converts the record to the dictionary record structure, which
+        is used from then on, and returns it."""
+        if self._fields is None:
+            self._fields = self._build_dict()
+            self._tags = self._tag_starts = self._ind1s = self._ind2s = \
+                self._positions = self._field_starts = self._codes = \
+                self._values = self._offsets = self._index = None
+        return self._fields
+
+    def _as_dict(self):
+        """Returns the dictionary record structure of the record,
+        without converting it."""
+        if self._fields is not None:
+            return self._fields
+        return self._build_dict()
+
+    def _build_dict(self):
+        """Returns a new dictionary record structure of the record."""
+        fields = {}
+        tag_starts = self._tag_starts
+        for i, tag in enumerate(self._tags):
+            fields[tag] = [self._get_field(field) for field in
+                           xrange(tag_starts[i], tag_starts[i + 1])]
+        return fields
+
+    def _get_value(self, piece):
+        """Returns the value of PIECE (a field or subfield value)."""
+        return self._values[self._offsets[piece]:self._offsets[piece + 1]]
+
+    def _get_field(self, field):
+        """Returns the field tuple of FIELD."""
+        start = self._field_starts[field]
+        subfields = [(self._codes[piece], self._get_value(piece)) for piece
+                     in xrange(start + 1, self._field_starts[field + 1])]
+        return (subfields, self._ind1s[field], self._ind2s[field],
+                self._get_value(start), self._positions[field])
+
+    def _get_index(self):
+        """Returns the index of the record, mapping (tag, ind1, ind2) to
+        the list of the matching fields and (tag, ind1, ind2, code) to
+        the pair of lists of the matching pieces and of their values,
+        where code '' stands for the non-empty field values and code
+        '%' for all the subfields."""
+        if self._index is None:
+            index = {}
+            tag_starts = self._tag_starts
+            field_starts = self._field_starts
+            codes = self._codes
+            for i, tag in enumerate(self._tags):
+                for field in xrange(tag_starts[i], tag_starts[i + 1]):
+                    key = (tag, self._ind1s[field], self._ind2s[field])
+                    index.setdefault(key, []).append(field)
+                    start = field_starts[field]
+                    value = self._get_value(start)
+                    if value:
+                        pieces, values = index.setdefault(key + ('',), ([], []))
+                        pieces.append(start)
+                        values.append(value)
+                    for piece in xrange(start + 1, field_starts[field + 1]):
+                        value = self._get_value(piece)
+                        for code in (codes[piece], '%'):
+                            pieces, values = index.setdefault(key + (code,), ([], []))
+                            pieces.append(piece)
+                            values.append(value)
+            self._index = index
+        return self._index
+
+    def _find(self, tag, ind1, ind2, code=None):
+        """Returns the items of the index matching (TAG, IND1, IND2), or
+        (TAG, IND1, IND2, CODE) if CODE is given, where TAG, IND1 and
+        IND2 can contain wildcard %.  The results of the lookups with
+        wildcards are kept in the index too."""
+        index = self._get_index()
+        if '%' not in tag and ind1 != '%' and ind2 != '%':
+            if code is None:
+                return [index.get((tag, ind1, ind2), [])]
+            return [index.get((tag, ind1, ind2, code), ((), ()))]
+        query = (tag, ind1, ind2, code, '%')
+        items = index.get(query)
+        if items is None:
+            key_length = code is None and 3 or 4
+            items = [item for key, item in index.items()
+                     if len(key) == key_length and \
+                        (code is None or key[3] == code) and \
+                        ind1 in ('%', key[1]) and ind2 in ('%', key[2]) and \
+                        _tag_matches_pattern(key[0], tag)]
+            index[query] = items
+        return items
+
+    def _get_fields(self, tag, ind1, ind2):
+        """See record_get_field_instances()."""
+        fields = []
+        for item in self._find(tag, ind1, ind2):
+            fields.extend(item)
+        fields.sort()
+        return [self._get_field(field) for field in fields]
+
+    def _get_values(self, tag, ind1, ind2, code):
+        """See record_get_field_values()."""
+        if self._index is not None and '%' not in tag and \
+               ind1 != '%' and ind2 != '%':
+            # shortcut for the most frequent lookups
+            item = self._index.get((tag, ind1, ind2, code))
+            if item is None:
+                return []
+            return list(item[1])
+        items = self._find(tag, ind1, ind2, code)
+        if len(items) == 1:
+            return list(items[0][1])
+        pairs = []
+        for pieces, values in items:
+            pairs.extend(zip(pieces, values))
+        pairs.sort()
+        return [value for dummy, value in pairs]
+
+    def _get_first_value(self, tag, ind1, ind2, code):
+        """See record_get_field_value()."""
+        if self._index is not None and '%' not in tag and \
+               ind1 != '%' and ind2 != '%':
+            item = self._index.get((tag, ind1, ind2, code))
+            if item is None:
+                return ""
+            return item[1][0]
+        items = self._find(tag, ind1, ind2, code)
+        first = None
+        for pieces, values in items:
+            if pieces and (first is None or pieces[0] < first[0]):
+                first = (pieces[0], values[0])
+        if first is None:
+            return ""
+        return first[1]
+
+    def _get_tag_fields(self, tag):
+        """Returns a record structure with the fields of the tags
+        matching TAG (wildcard % allowed)."""
+        if self._fields is not None:
+            return self._fields
+        out = {}
+        tag_starts = self._tag_starts
+        for i, field_tag in enumerate(self._tags):
+            if _tag_matches_pattern(field_tag, tag):
+                out[field_tag] = [self._get_field(field) for field in
+                                  xrange(tag_starts[i], tag_starts[i + 1])]
+        return out
+
+    def keys(self):
+        """Returns the tags of the record."""
+        if self._fields is not None:
+            return self._fields.keys()
+        return list(self._tags)
+
+    def has_key(self, tag):
+        """Returns True if the record has fields of TAG."""
+        return tag in self
+
+    def __contains__(self, tag):
+        if self._fields is not None:
+            return tag in self._fields
+        return tag in self._tags
+
+    def __len__(self):
+        if self._fields is not None:
+            return len(self._fields)
+        return len(self._tags)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, tag):
+        return self.to_dict()[tag]
+
+    def __setitem__(self, tag, fields):
+        self.to_dict()[tag] = fields
+
+    def __delitem__(self, tag):
+        del self.to_dict()[tag]
+
+    def __getattr__(self, name):
+        # the other methods of dictionaries (get, items, setdefault...)
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.to_dict(), name)
+
+    def __eq__(self, other):
+        if isinstance(other, CompactRecord):
+            other = other._as_dict()
+        return self._as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._as_dict())
+
+    def __deepcopy__(self, memo):
+        if self._fields is None:
+            return self._build_dict()
+        from copy import deepcopy
+        return deepcopy(self._fields, memo)
+
+    def __reduce__(self):
+        return (CompactRecord, (self._as_dict(),))
+
+_COMPACT_STRUCTURE_SIGNATURE = 'bibrecord-compact-1-%s%d' % \
+                               (sys.byteorder[0], array('i').itemsize)
+
+def _compact_strings(strings):
+    """Returns the list STRINGS as a string if its items are single
+    characters (indexing it gives the same items), as a tuple otherwise."""
+    for string in strings:
+        if len(string) != 1 or not isinstance(string, str):
+            return tuple(strings)
+    return ''.join(strings)
+
+def serialize_record_structure(rec, compact=False):
+    """Returns the marshal string of the record structure REC, in the
+    binary form of CompactRecord if COMPACT is True and the record can
+    be represented so.  See deserialize_record_structure()."""
+    if compact:
+        try:
+            if not isinstance(rec, CompactRecord):
+                rec = CompactRecord(rec)
+            return marshal.dumps(rec.get_structure())
+        except (TypeError, ValueError, OverflowError):
+            pass
+    if isinstance(rec, CompactRecord):
+        rec = rec.to_dict()
+    return marshal.dumps(rec)
+
+def deserialize_record_structure(astring, compact=False):
+    """Returns the record structure of the marshal string ASTRING, as
+    returned by serialize_record_structure(): a CompactRecord if
+    COMPACT is True and the record was serialized in binary form, else
+    the dictionary record structure."""
+    structure = marshal.loads(astring)
+    if isinstance(structure, tuple):
+        rec = CompactRecord.from_structure(structure)
+        if not compact:
+            return rec.to_dict()
+        return rec
+    return structure
+
 def _compare_fields(field1, field2, strict=True):
     """
     Compares 2 fields. If strict is True, then the order of the
@@ -51,6 +51,9 @@ CFG_BIBRECORD_DEFAULT_CORRECT = 0
 # XML parsers available:
 CFG_BIBRECORD_PARSERS_AVAILABLE = ['pyrxp', 'lxml', '4suite', 'minidom']
 
+# size (in bytes) of the blocks in which iter_records() reads MARCXML files:
+CFG_BIBRECORD_STREAM_BLOCK_SIZE = 1024 * 1024
+
 # Exceptions
 class InvenioBibRecordParserError(Exception):
     """A generic parsing exception for all available parsers."""
@@ -21,6 +21,8 @@
 The BibRecord test suite.
 """
 
+from cStringIO import StringIO
+
 from invenio.testutils import InvenioTestCase
 
 from invenio.config import CFG_TMPDIR, \
@@ -61,6 +63,7 @@ class BibRecordSuccessTest(InvenioTestCase):
         f = open(CFG_TMPDIR + '/demobibdata.xml', 'r')
         xmltext = f.read()
         f.close()
+        self.xmltext = xmltext
         self.recs = [rec[0] for rec in bibrecord.create_records(xmltext)]
 
     def test_records_created(self):
@@ -112,6 +115,21 @@ class BibRecordSuccessTest(InvenioTestCase):
             ret.append(rec)
         self.assertEqual(fields, cr, "\n%s\n!=\n%s" % (fields, cr))
 
+    def test_iter_records(self):
+        """ bibrecord - demo file parsed as a stream """
+        recs = [rec[0] for rec in bibrecord.iter_records(CFG_TMPDIR + '/demobibdata.xml')]
+        self.assertEqual(self.recs, recs)
+
+    def test_iter_record_xmls_small_blocks(self):
+        """ bibrecord - demo file read by blocks smaller than a record """
+        for block_size in (7, 4096):
+            record_xmls = list(bibrecord.iter_record_xmls(StringIO(self.xmltext),
+                                                          block_size))
+            self.assertEqual(141, len(record_xmls))
+            self.assertEqual(self.recs,
+                             [bibrecord.create_record(record_xml)[0]
+                              for record_xml in record_xmls])
+
     def test_create_record_with_collection_tag(self):
         """ bibrecord - create_record() for single record in collection"""
         xmltext = """
@@ -1645,6 +1663,102 @@ class BibRecordExtractIdentifiersTest(InvenioTestCase):
                          'oai:atlantis:1')
 
 
+class BibRecordCompactRecordTest(InvenioTestCase):
+    """ bibrecord - compact record structure """
+
+    def setUp(self):
+        """Initialize stuff"""
+        xml_example_record = """
+        <record>
+        <controlfield tag="001">33</controlfield>
+        <datafield tag="041" ind1=" " ind2=" ">
+        <subfield code="a">eng</subfield>
+        </datafield>
+        <datafield tag="100" ind1=" " ind2=" ">
+        <subfield code="a">Doe1, John</subfield>
+        </datafield>
+        <datafield tag="100" ind1=" " ind2=" ">
+        <subfield code="a">Doe2, John</subfield>
+        <subfield code="b">editor</subfield>
+        </datafield>
+        <datafield tag="245" ind1=" " ind2="1">
+        <subfield code="a">On the foo and bar1</subfield>
+        </datafield>
+        <datafield tag="245" ind1=" " ind2="2">
+        <subfield code="a">On the foo and bar2</subfield>
+        </datafield>
+        <datafield tag="700" ind1=" " ind2=" ">
+        <subfield code="a">Doe3, John</subfield>
+        <subfield code="u">CERN</subfield>
+        </datafield>
+        <datafield tag="999" ind1="C" ind2="5">
+        <subfield code="m">Reference 1</subfield>
+        <subfield code="s">Phys. Rev. Lett. 80 (1998) 1582</subfield>
+        </datafield>
+        <datafield tag="999" ind1="C" ind2="5">
+        <subfield code="m">Reference 2</subfield>
+        </datafield>
+        </record>
+        """
+        self.rec = bibrecord.create_record(xml_example_record, 1, 1)[0]
+        self.compact_rec = bibrecord.CompactRecord(self.rec)
+
+    def test_equality(self):
+        """bibrecord - compact record equals its record structure"""
+        self.assertEqual(self.compact_rec, self.rec)
+        self.assertEqual(len(self.compact_rec), len(self.rec))
+        self.assertEqual(sorted(self.compact_rec.keys()), sorted(self.rec.keys()))
+        self.assert_('245' in self.compact_rec)
+        self.failIf('246' in self.compact_rec)
+
+    def test_field_lookups(self):
+        """bibrecord - looking up fields of a compact record"""
+        for tag, ind1, ind2, code in (('001', '', '', ''),
+                                      ('100', '', '', 'a'),
+                                      ('100', '%', '%', '%'),
+                                      ('245', '', '%', 'a'),
+                                      ('245', '', '2', 'a'),
+                                      ('999', 'C', '5', '%'),
+                                      ('999', 'C', '5', 's'),
+                                      ('9%%', '%', '%', 'm'),
+                                      ('%%%', '%', '%', 'a'),
+                                      ('888', '', '', 'a')):
+            values = bibrecord.record_get_field_values(self.rec, tag, ind1, ind2, code)
+            self.assertEqual(sorted(bibrecord.record_get_field_values(self.compact_rec, tag, ind1, ind2, code)),
+                             sorted(values))
+            if '%' in tag:
+                # the first of the fields of several tags is not defined
+                self.assert_(bibrecord.record_get_field_value(self.compact_rec, tag, ind1, ind2, code) in values)
+            else:
+                self.assertEqual(bibrecord.record_get_field_value(self.compact_rec, tag, ind1, ind2, code),
+                                 bibrecord.record_get_field_value(self.rec, tag, ind1, ind2, code))
+            self.assertEqual(sorted(bibrecord.record_get_field_instances(self.compact_rec, tag, ind1, ind2)),
+                             sorted(bibrecord.record_get_field_instances(self.rec, tag, ind1, ind2)))
+        self.assertEqual(bibrecord.record_get_field_values(self.compact_rec, '100', '', '', 'a',
+                                                           filter_subfield_code='b',
+                                                           filter_subfield_value='editor'),
+                         ['Doe2, John'])
+
+    def test_modification(self):
+        """bibrecord - modifying a compact record"""
+        bibrecord.record_add_field(self.compact_rec, '980', subfields=[('a', 'ARTICLE')])
+        bibrecord.record_add_field(self.rec, '980', subfields=[('a', 'ARTICLE')])
+        self.assertEqual(self.compact_rec, self.rec)
+        self.assertEqual(bibrecord.record_get_field_value(self.compact_rec, '980', '', '', 'a'),
+                         'ARTICLE')
+
+    def test_serialization(self):
+        """bibrecord - serializing record structures"""
+        for compact in (False, True):
+            value = bibrecord.serialize_record_structure(self.rec, compact)
+            self.assertEqual(bibrecord.deserialize_record_structure(value), self.rec)
+            rec = bibrecord.deserialize_record_structure(value, compact=True)
+            self.assertEqual(isinstance(rec, bibrecord.CompactRecord), compact)
+            self.assertEqual(rec, self.rec)
+        self.assertEqual(bibrecord.deserialize_record_structure(
+            bibrecord.serialize_record_structure(self.compact_rec, True), True),
+                         self.rec)
+
 TEST_SUITE = make_test_suite(
     BibRecordSuccessTest,
     BibRecordParsersTest,
@@ -1669,6 +1783,7 @@ TEST_SUITE = make_test_suite(
     BibRecordSingletonTest,
     BibRecordNumCharRefTest,
     BibRecordExtractIdentifiersTest,
+    BibRecordCompactRecordTest,
     )
 
 if __name__ == '__main__':
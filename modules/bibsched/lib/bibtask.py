@@ -60,7 +60,7 @@ import random
 
 from socket import gethostname
 
-from invenio.dbquery import run_sql, _db_login
+from invenio.dbquery import run_sql, _db_login, forget_all_connections
 from invenio.access_control_engine import acc_authorize_action
 from invenio.config import CFG_PREFIX, CFG_BINDIR, CFG_LOGDIR, \
     CFG_BIBSCHED_PROCESS_USER, CFG_TMPDIR, CFG_SITE_SUPPORT_EMAIL
@@ -753,6 +753,17 @@ def task_sleep_now_if_required(can_stop_too=False):
                 task_update_status("STOPPED")
                 sys.exit(0)
 
+def task_init_worker_process():
+    """Initializer of the worker processes forked by a task, e.g. via
+    multiprocessing.Pool(processes, task_init_worker_process).  Only
+    the task process itself has to react to the signals of BibSched
+    and to update the task status, and the database connections
+    inherited from it must not be used, nor closed, by the workers."""
+    for sig in (signal.SIGTERM, signal.SIGQUIT, signal.SIGINT,
+                signal.SIGTSTP, signal.SIGABRT):
+        signal.signal(sig, signal.SIG_DFL)
+    forget_all_connections()
+
 def authenticate(user, authorization_action, authorization_msg=""):
     """Authenticate the user against the user database.
     Check for its password, if it exists.
@@ -45,6 +45,7 @@ from invenio.config import CFG_OAI_ID_FIELD, \
      CFG_BIBUPLOAD_STRONG_TAGS, \
      CFG_BIBUPLOAD_CONTROLLED_PROVENANCE_TAGS, \
      CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE, \
+     CFG_BIBUPLOAD_SERIALIZE_COMPACT_RECORD_STRUCTURE, \
      CFG_BIBUPLOAD_DELETE_FORMATS, \
      CFG_SITE_URL, CFG_SITE_SECURE_URL, CFG_SITE_RECORD, \
      CFG_OAI_PROVENANCE_ALTERED_SUBFIELD, \
@@ -56,10 +57,17 @@ from invenio.bibupload_config import CFG_BIBUPLOAD_CONTROLFIELD_TAGS, \
     CFG_BIBUPLOAD_SPECIAL_TAGS, \
     CFG_BIBUPLOAD_DELETE_CODE, \
     CFG_BIBUPLOAD_DELETE_VALUE, \
-    CFG_BIBUPLOAD_OPT_MODES
+    CFG_BIBUPLOAD_OPT_MODES, \
+    CFG_BIBUPLOAD_BIBXXX_QUERY_MAX_BYTES, \
+    CFG_BIBUPLOAD_PIPELINE_BATCH_SIZE
 from invenio.dbquery import run_sql, \
+                            run_sql_many, \
                             Error
+from invenio.bibrecord_config import CFG_BIBRECORD_STREAM_BLOCK_SIZE
 from invenio.bibrecord import create_records, \
+                              create_record, \
+                              iter_records, \
+                              serialize_record_structure, \
                               record_add_field, \
                               record_delete_field, \
                               record_xml_output, \
@@ -86,7 +94,8 @@ from invenio.urlutils import make_user_agent_string
 from invenio.config import CFG_BIBDOCFILE_FILEDIR
 from invenio.bibtask import task_init, write_message, \
     task_set_option, task_get_option, task_get_task_param, task_update_status, \
-    task_update_progress, task_sleep_now_if_required, fix_argv_paths
+    task_update_progress, task_sleep_now_if_required, fix_argv_paths, \
+    task_init_worker_process
 from invenio.bibdocfile import BibRecDocs, file_strip_ext, normalize_format, \
     get_docname_from_url, check_valid_url, download_url, \
     KEEP_OLD_VALUE, decompose_bibdocfile_url, InvenioBibDocFileError, \
@@ -539,7 +548,7 @@ def bibupload(record, opt_mode=None, opt_notimechange=0, oai_rec_id="", pretend=
                 write_message(msg, verbose=1, stream=sys.stderr)
                 return (1, int(rec_id), msg)
             if CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE:
-                error = update_bibfmt_format(rec_id, marshal.dumps(record), 'recstruct', modification_date, pretend=pretend)
+                error = update_bibfmt_format(rec_id, serialize_record_structure(record, CFG_BIBUPLOAD_SERIALIZE_COMPACT_RECORD_STRUCTURE), 'recstruct', modification_date, pretend=pretend)
                 if error == 1:
                     msg = "   Failed: error during update_bibfmt_format 'recstruct'"
                     write_message(msg, verbose=1, stream=sys.stderr)
@@ -775,23 +784,33 @@ def print_out_bibupload_statistics():
 
 def open_marc_file(path):
     """Open a file and return the data"""
+    marc_file = open_marc_stream(path)
     try:
-        # open the file containing the marc document
-        marc_file = open(path, 'r')
         marc = marc_file.read()
         marc_file.close()
     except IOError, erro:
-        write_message("Error: %s" % erro, verbose=1, stream=sys.stderr)
-        write_message("Exiting.", sys.stderr)
-        if erro.errno == 2:
-            # No such file or directory
-            # Not scary
-            task_update_status("CERROR")
-        else:
-            task_update_status("ERROR")
-        sys.exit(1)
+        _exit_on_marc_file_error(erro)
     return marc
 
+def open_marc_stream(path):
+    """Open the file containing the marc document and return it"""
+    try:
+        return open(path, 'r')
+    except IOError, erro:
+        _exit_on_marc_file_error(erro)
+
+def _exit_on_marc_file_error(erro):
+    """Report IOError ERRO on the marc document and exit"""
+    write_message("Error: %s" % erro, verbose=1, stream=sys.stderr)
+    write_message("Exiting.", sys.stderr)
+    if erro.errno == 2:
+        # No such file or directory
+        # Not scary
+        task_update_status("CERROR")
+    else:
+        task_update_status("ERROR")
+    sys.exit(1)
+
 def xml_marc_to_records(xml_marc):
     """create the records"""
     # Creation of the records from the xml Marc in argument
@@ -811,6 +830,146 @@ def xml_marc_to_records(xml_marc):
         recs = map((lambda x:x[0]), recs)
         return recs
 
+def xml_marc_file_to_records(path):
+    """
+    Create the records of the MARCXML file PATH, like
+    xml_marc_to_records(open_marc_file(PATH)), but one at a time while
+    the file is being read (see bibrecord.iter_records()), so that big
+    files are uploaded without holding all their records in memory.
+
+    @return: an iterator over the records, to be consumed by
+        bibupload_records()
+    """
+    stat['nb_records_to_upload'] = _count_marc_file_records(path)
+    if not stat['nb_records_to_upload']:
+        write_message("Error: Cannot parse MARCXML file.", verbose=1, stream=sys.stderr)
+        write_message("Exiting.", sys.stderr)
+        task_update_status("ERROR")
+        sys.exit(1)
+    return _iter_marc_file_records(path)
+
+def _count_marc_file_records(path):
+    """Return the number of records of the MARCXML file PATH, read by
+    blocks."""
+    marc_file = open_marc_stream(path)
+    nb_records = 0
+    tail = ''
+    try:
+        while True:
+            block = marc_file.read(CFG_BIBRECORD_STREAM_BLOCK_SIZE)
+            if not block:
+                break
+            nb_records += (tail + block).count('</record>')
+            tail = block[-len('</record>') + 1:]
+    finally:
+        marc_file.close()
+    return nb_records
+
+def _iter_marc_file_records(path):
+    """Yield the records of the MARCXML file PATH, exiting like
+    xml_marc_to_records() if the first one cannot be parsed."""
+    first = True
+    for record, dummy_status, errors in iter_records(open_marc_stream(path), 1, 1):
+        if first and record is None:
+            write_message("Error: MARCXML file has wrong format: %s" % errors,
+                          verbose=1, stream=sys.stderr)
+            write_message("Exiting.", sys.stderr)
+            task_update_status("CERROR")
+            sys.exit(1)
+        first = False
+        yield record
+
+def _create_record_in_worker(record_xml):
+    """Create the record of RECORD_XML, in a worker process of the
+    --parallel pipeline mode.
+    @return: tuple (create_record() result, time taken)"""
+    t1 = time.time()
+    return (create_record(record_xml, 1, 1), time.time() - t1)
+
+def xml_marc_to_records_in_parallel(xml_marc, parallel,
+                                    batch_size=CFG_BIBUPLOAD_PIPELINE_BATCH_SIZE):
+    """
+    Create the records of XML_MARC, like xml_marc_to_records(), in
+    PARALLEL worker processes, and look up the record IDs of their
+    identifiers by batches of BATCH_SIZE records.
+
+    @return: an iterator over the records, in order, to be consumed by
+        bibupload_records()
+    """
+    record_xmls = re.compile('<record.*?>.*?</record>', re.DOTALL).findall(xml_marc)
+    if not record_xmls:
+        write_message("Error: Cannot parse MARCXML file.", verbose=1, stream=sys.stderr)
+        write_message("Exiting.", sys.stderr)
+        task_update_status("ERROR")
+        sys.exit(1)
+    stat['nb_records_to_upload'] = len(record_xmls)
+    return _iter_records_in_parallel(record_xmls, parallel, batch_size)
+
+def _iter_records_in_parallel(record_xmls, parallel, batch_size):
+    """
+    Pipeline of the --parallel mode: the records are created by a pool
+    of PARALLEL processes, their identifiers are looked up by batches,
+    and they are yielded in order to the consumer (bibupload_records()),
+    which is the single writer to the database.  The throughput of each
+    stage (parse, resolve, write) is reported after each batch.
+    """
+    from multiprocessing import Pool
+    # stage -> [number of records, time taken]
+    stats = {'parse': [0, 0.0], 'resolve': [0, 0.0], 'write': [0, 0.0]}
+
+    def report_stats():
+        """Report the throughput of the stages."""
+        message = []
+        for stage in ('parse', 'resolve', 'write'):
+            nb_records, elapsed = stats[stage]
+            message.append("%s: %d records (%.1f rec/s%s)" % \
+                           (stage, nb_records, nb_records / max(elapsed, 0.001),
+                            stage == 'parse' and " per process" or ""))
+        write_message("Pipeline " + ", ".join(message), verbose=2)
+
+    pool = Pool(parallel, task_init_worker_process)
+    done = False
+    try:
+        created_records = pool.imap(_create_record_in_worker, record_xmls,
+                                    max(1, min(50, len(record_xmls) / (4 * parallel))))
+        first = True
+        while True:
+            batch = []
+            for (record, dummy_status, errors), elapsed in created_records:
+                if first and record is None:
+                    write_message("Error: MARCXML file has wrong format: %s" % errors,
+                                  verbose=1, stream=sys.stderr)
+                    write_message("Exiting.", sys.stderr)
+                    task_update_status("CERROR")
+                    sys.exit(1)
+                first = False
+                batch.append(record)
+                stats['parse'][0] += 1
+                stats['parse'][1] += elapsed
+                if len(batch) >= batch_size:
+                    break
+            if not batch:
+                break
+            t1 = time.time()
+            prefetch_record_ids(batch)
+            stats['resolve'][0] += len(batch)
+            stats['resolve'][1] += time.time() - t1
+            for record in batch:
+                t1 = time.time()
+                yield record
+                stats['write'][0] += 1
+                stats['write'][1] += time.time() - t1
+            report_stats()
+        done = True
+    finally:
+        if done:
+            pool.close()
+            pool.join()
+        else:
+            pool.terminate()
+        clear_prefetched_record_ids()
+    write_message("   -Pipeline: DONE", verbose=2)
+
 def find_record_format(rec_id, bibformat):
     """Look whether record REC_ID is formatted in FORMAT,
        i.e. whether FORMAT exists in the bibfmt table for this record.
@@ -843,6 +1002,9 @@ def find_record_from_sysno(sysno):
     Try to find record in the database from the external SYSNO number.
     Return record ID if found, None otherwise.
     """
+    recids = get_prefetched_record_ids(CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG, sysno)
+    if recids is not None:
+        return recids and list(recids)[0] or None
     bibxxx = 'bib'+CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG[0:2]+'x'
     bibrec_bibxxx = 'bibrec_' + bibxxx
     res = run_sql("""SELECT bb.id_bibrec FROM %(bibrec_bibxxx)s AS bb,
@@ -865,12 +1027,14 @@ def find_records_from_extoaiid(extoaiid, extoaisrc=None):
     bibxxx = 'bib'+CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG[0:2]+'x'
     bibrec_bibxxx = 'bibrec_' + bibxxx
     write_message('   Looking for extoaiid="%s" with extoaisrc="%s"' % (extoaiid, extoaisrc), verbose=9)
-    id_bibrecs = intbitset(run_sql("""SELECT bb.id_bibrec FROM %(bibrec_bibxxx)s AS bb,
-        %(bibxxx)s AS b WHERE b.tag=%%s AND b.value=%%s
-        AND bb.id_bibxxx=b.id""" % \
-                    {'bibxxx': bibxxx,
-                    'bibrec_bibxxx': bibrec_bibxxx},
-                    (CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG, extoaiid,)))
+    id_bibrecs = get_prefetched_record_ids(CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG, extoaiid)
+    if id_bibrecs is None:
+        id_bibrecs = intbitset(run_sql("""SELECT bb.id_bibrec FROM %(bibrec_bibxxx)s AS bb,
+            %(bibxxx)s AS b WHERE b.tag=%%s AND b.value=%%s
+            AND bb.id_bibxxx=b.id""" % \
+                        {'bibxxx': bibxxx,
+                        'bibrec_bibxxx': bibrec_bibxxx},
+                        (CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG, extoaiid,)))
     write_message('   Partially found %s for extoaiid="%s"' % (id_bibrecs, extoaiid), verbose=9)
     ret = intbitset()
     for id_bibrec in id_bibrecs:
@@ -900,6 +1064,9 @@ def find_record_from_oaiid(oaiid):
     Try to find record in the database from the OAI ID number and OAI SRC.
     Return record ID if found, None otherwise.
     """
+    recids = get_prefetched_record_ids(CFG_OAI_ID_FIELD, oaiid)
+    if recids is not None:
+        return recids and list(recids)[0] or None
     bibxxx = 'bib'+CFG_OAI_ID_FIELD[0:2]+'x'
     bibrec_bibxxx = 'bibrec_' + bibxxx
     res = run_sql("""SELECT bb.id_bibrec FROM %(bibrec_bibxxx)s AS bb,
@@ -941,6 +1108,113 @@ def find_record_from_doi(doi):
             return res[0][0]
     return None
 
+## Record IDs of the identifiers of the records being uploaded, looked
+## up in advance by prefetch_record_ids() in the --parallel pipeline
+## mode: {(identifier tag, collation key of value): intbitset of recids}
+_prefetched_record_ids = None
+
+def _get_identifier_tags():
+    """Return the tags of the identifiers whose record IDs can be
+    prefetched by prefetch_record_ids()."""
+    return [tag for tag in (CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG,
+                            CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG,
+                            CFG_OAI_ID_FIELD) if len(tag) == 6]
+
+def _get_identifier_values(record, tag):
+    """Return the values of the identifier TAG (e.g. '035__a') of
+    RECORD."""
+    return record_get_field_values(record,
+                                   tag[0:3],
+                                   tag[3:4] != "_" and tag[3:4] or "",
+                                   tag[4:5] != "_" and tag[4:5] or "",
+                                   tag[5:6])
+
+def _get_identifier_collation_key(value):
+    """
+    Return the key under which VALUE is found by the b.value=%s
+    conditions of the find_record_from_*() queries, i.e. VALUE ignoring
+    case and trailing spaces, or None for non-ASCII values, whose
+    matching depends on the collation of the database.
+    """
+    try:
+        value.decode('ascii')
+    except (UnicodeError, AttributeError):
+        return None
+    return value.lower().rstrip(' ')
+
+def prefetch_record_ids(records):
+    """
+    Look up with one query per identifier tag the record IDs of the
+    external SYSNO, external OAI ID and OAI ID identifiers of RECORDS,
+    so that the find_record_from_*() functions do not query the
+    database for them until forget_prefetched_record_ids() is called
+    for the record they belong to.
+    """
+    global _prefetched_record_ids
+    _prefetched_record_ids = {}
+    for tag in _get_identifier_tags():
+        values = {}
+        for record in records:
+            if record:
+                for value in _get_identifier_values(record, tag):
+                    key = _get_identifier_collation_key(value)
+                    if key is not None:
+                        values[key] = value
+        if not values:
+            continue
+        bibxxx = 'bib' + tag[0:2] + 'x'
+        res = run_sql("""SELECT b.value, bb.id_bibrec FROM %(bibrec_bibxxx)s AS bb,
+            %(bibxxx)s AS b WHERE b.tag=%%s AND b.value IN (%(values)s)
+            AND bb.id_bibxxx=b.id""" % \
+                      {'bibxxx': bibxxx,
+                       'bibrec_bibxxx': 'bibrec_' + bibxxx,
+                       'values': ', '.join(['%s'] * len(values))},
+                      tuple([tag] + values.values()))
+        found = {}
+        for key in values:
+            found[key] = intbitset()
+        for value, id_bibrec in res:
+            key = _get_identifier_collation_key(value)
+            if key not in found:
+                # matched by the database collation in a way we cannot
+                # tell: let these identifiers be looked up one by one
+                found = {}
+                break
+            found[key].add(id_bibrec)
+        for key, recids in found.items():
+            _prefetched_record_ids[(tag, key)] = recids
+
+def get_prefetched_record_ids(tag, value):
+    """Return the prefetched record IDs having VALUE in identifier TAG,
+    or None if they have not been prefetched."""
+    if _prefetched_record_ids is None:
+        return None
+    key = _get_identifier_collation_key(value)
+    recids = _prefetched_record_ids.get((tag, key))
+    if recids is None:
+        return None
+    return intbitset(recids)
+
+def forget_prefetched_record_ids(record, rec_id=None):
+    """Forget the prefetched record IDs of the identifiers of RECORD, and
+    of any identifier pointing to REC_ID, as uploading RECORD may have
+    changed them."""
+    if not _prefetched_record_ids:
+        return
+    if rec_id is not None and rec_id > 0:
+        for key, recids in _prefetched_record_ids.items():
+            if rec_id in recids:
+                del _prefetched_record_ids[key]
+    if record:
+        for tag in _get_identifier_tags():
+            for value in _get_identifier_values(record, tag):
+                _prefetched_record_ids.pop((tag, _get_identifier_collation_key(value)), None)
+
+def clear_prefetched_record_ids():
+    """Stop using prefetched record IDs."""
+    global _prefetched_record_ids
+    _prefetched_record_ids = None
+
 def extract_tag_from_record(record, tag_number):
     """ Extract the tag_number for record."""
     # first step verify if the record is not already in the database
@@ -1288,6 +1562,96 @@ def insert_record_bibrec_bibxxx(table_name, id_bibxxx,
         return 1
     return res
 
+def _split_tag_values(tag_values):
+    """Split the list of (tag, value) pairs TAG_VALUES into chunks of
+    at most CFG_BIBUPLOAD_BIBXXX_QUERY_MAX_BYTES bytes."""
+    chunk = []
+    size = 0
+    for tag, value in tag_values:
+        if chunk and size + len(tag) + len(value) > CFG_BIBUPLOAD_BIBXXX_QUERY_MAX_BYTES:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append((tag, value))
+        size += len(tag) + len(value)
+    if chunk:
+        yield chunk
+
+def get_bibxxx_ids(table_name, tag_values):
+    """
+    Return the ids of the (tag, value) pairs TAG_VALUES found in the
+    bibxxx table TABLE_NAME, as a dictionary {(tag, value): id}.
+
+    Like insert_record_bibxxx(), the values are compared in Python for
+    binary equality, as MySQL may match them regardless of case.
+    """
+    ids = {}
+    for chunk in _split_tag_values(tag_values):
+        wanted = dict.fromkeys(chunk)
+        query = """SELECT id,tag,value FROM %s WHERE """ % table_name
+        query += " OR ".join(["(tag=%s AND value=%s)"] * len(chunk))
+        params = []
+        for tag, value in chunk:
+            params.extend((tag, value))
+        for row_id, row_tag, row_value in run_sql(query, tuple(params)):
+            if (row_tag, row_value) in wanted and (row_tag, row_value) not in ids:
+                ids[(row_tag, row_value)] = row_id
+    return ids
+
+def insert_record_bibxxx_many(rows, pretend=False):
+    """
+    Insert the given (id_bibrec, tag, value, field_number) rows into
+    the bibxxx and bibrec_bibxxx tables.
+
+    This is the bulk equivalent of calling insert_record_bibxxx() and
+    insert_record_bibrec_bibxxx() for each row: for each bibxxx table,
+    the existing (tag, value) pairs are looked up together, the
+    missing ones are inserted with a multi-row INSERT and looked up
+    again, and the bibrec_bibxxx links are inserted with a multi-row
+    INSERT.  The rows may belong to several records.
+
+    @param rows: list of (id_bibrec, tag, value, field_number) tuples
+    @param pretend: if True, do not write to the database
+    @return: the number of rows that could not be inserted
+    """
+    tables = {}
+    for row in rows:
+        tables.setdefault('bib' + row[1][0:2] + 'x', []).append(row)
+    failed = 0
+    for table_name, table_rows in tables.items():
+        # distinct (tag, value) pairs, in order:
+        tag_values = []
+        seen = {}
+        for dummy_id_bibrec, tag, value, dummy_field_number in table_rows:
+            if (tag, value) not in seen:
+                seen[(tag, value)] = None
+                tag_values.append((tag, value))
+        ids = get_bibxxx_ids(table_name, tag_values)
+        missing = [tag_value for tag_value in tag_values if tag_value not in ids]
+        if missing:
+            write_message("   inserting %s new values into %s" % (len(missing), table_name), verbose=9)
+            if pretend:
+                for tag_value in missing:
+                    ids[tag_value] = 1
+            else:
+                for chunk in _split_tag_values(missing):
+                    run_sql_many("""INSERT INTO %s (tag, value) VALUES (%%s, %%s)""" % table_name,
+                                 chunk)
+                ids.update(get_bibxxx_ids(table_name, missing))
+        links = []
+        for id_bibrec, tag, value, field_number in table_rows:
+            id_bibxxx = ids.get((tag, value))
+            if id_bibxxx is None:
+                write_message("   Failed: during insert_record_bibxxx of the tag %s with the value %s" % (tag, value),
+                              verbose=1, stream=sys.stderr)
+                failed += 1
+            else:
+                links.append((id_bibrec, id_bibxxx, field_number))
+        if links and not pretend:
+            run_sql_many("""INSERT INTO bibrec_%s (id_bibrec, id_bibxxx, field_number) VALUES (%%s, %%s, %%s)""" % table_name,
+                         links)
+    return failed
+
 def synchronize_8564(rec_id, record, record_had_FFT, pretend=False):
     """
     Synchronize 8564_ tags and BibDocFile tables.
@@ -2345,6 +2709,8 @@ def update_database_with_metadata(record, rec_id, oai_rec_id="oai", affected_tag
     else:
         tmp_record = record
 
+    # (id_bibrec, tag, value, field_number) rows to insert:
+    bibxxx_rows = []
     for tag in tmp_record.keys():
         # check if tag is not a special one:
         if tag not in CFG_BIBUPLOAD_SPECIAL_TAGS:
@@ -2379,15 +2745,7 @@ def update_database_with_metadata(record, rec_id, oai_rec_id="oai", affected_tag
 
                     # update the tables
                     write_message("   insertion of the tag "+full_tag+" with the value "+value, verbose=9)
-                    # insert the tag and value into into bibxxx
-                    (table_name, bibxxx_row_id) = insert_record_bibxxx(full_tag, value, pretend=pretend)
-                    #print 'tname, bibrow', table_name, bibxxx_row_id;
-                    if table_name is None or bibxxx_row_id is None:
-                        write_message("   Failed: during insert_record_bibxxx", verbose=1, stream=sys.stderr)
-                    # connect bibxxx and bibrec with the table bibrec_bibxxx
-                    res = insert_record_bibrec_bibxxx(table_name, bibxxx_row_id, datafield_number, rec_id, pretend=pretend)
-                    if res is None:
-                        write_message("   Failed: during insert_record_bibrec_bibxxx", verbose=1, stream=sys.stderr)
+                    bibxxx_rows.append((rec_id, full_tag, value, datafield_number))
                 else:
                     # get the tag and value from the content of each subfield
                     for subfield in subfield_list:
@@ -2398,19 +2756,15 @@ def update_database_with_metadata(record, rec_id, oai_rec_id="oai", affected_tag
                         full_tag = ''.join(tag_list)
                         # update the tables
                         write_message("   insertion of the tag "+full_tag+" with the value "+value, verbose=9)
-                        # insert the tag and value into into bibxxx
-                        (table_name, bibxxx_row_id) = insert_record_bibxxx(full_tag, value, pretend=pretend)
-                        if table_name is None or bibxxx_row_id is None:
-                            write_message("   Failed: during insert_record_bibxxx", verbose=1, stream=sys.stderr)
-                        # connect bibxxx and bibrec with the table bibrec_bibxxx
-                        res = insert_record_bibrec_bibxxx(table_name, bibxxx_row_id, datafield_number, rec_id, pretend=pretend)
-                        if res is None:
-                            write_message("   Failed: during insert_record_bibrec_bibxxx", verbose=1, stream=sys.stderr)
+                        bibxxx_rows.append((rec_id, full_tag, value, datafield_number))
                         # remove the subtag from the list
                         tag_list.pop()
                 tag_list.pop()
                 tag_list.pop()
             tag_list.pop()
+    # insert the tags and values into bibxxx and connect them to
+    # bibrec with the tables bibrec_bibxxx
+    insert_record_bibxxx_many(bibxxx_rows, pretend=pretend)
     write_message("   -Update the database with metadata: DONE", verbose=2)
 
     log_record_uploading(oai_rec_id, task_get_task_param('task_id', 0), rec_id, 'P', pretend=pretend)
@@ -2614,6 +2968,8 @@ Examples:
   --callback-url\tSend via a POST request a JSON-serialized answer (see admin guide), in
 \t\t\torder to provide a feedback to an external service about the outcome of the operation.
   --nonce\t\twhen used together with --callback add the nonce value in the JSON message.
+  --parallel=N\t\tcreate the records from MARCXML with N processes, and look up their
+\t\t\tidentifiers by batches, while this process uploads them in order
   --special-treatment=MODE\tif "oracle" is specified, when used together with --callback_url,
 \t\t\tPOST an application/x-www-form-urlencoded request where the JSON message is encoded
 \t\t\tinside a form field called "results".
@@ -2635,6 +2991,7 @@ Examples:
                    "nonce=",
                    "special-treatment=",
                    "stage=",
+                   "parallel=",
                  ]),
             task_submit_elaborate_specific_parameter_fnc=task_submit_elaborate_specific_parameter,
             task_run_fnc=task_run_core)
@@ -2724,6 +3081,11 @@ def task_submit_elaborate_specific_parameter(key, value, opts, args): # pylint:
         else:
             print >> sys.stderr, """The specified value is not in the list of allowed special treatments codes: %s""" % CFG_BIBUPLOAD_ALLOWED_SPECIAL_TREATMENTS
             return False
+    elif key in ("--parallel", ):
+        task_set_option('parallel', int(value))
+        if task_get_option('parallel') < 1:
+            print >> sys.stderr, """The number of parallel processes should be at least 1."""
+            return False
     elif key in ("-S", "--stage"):
         print >> sys.stderr, """WARNING: the --stage parameter is deprecated and ignored."""
     else:
@@ -2818,7 +3180,13 @@ def bibupload_records(records, opt_mode=None, opt_notimechange=0,
         opt_mode = 'correct'
 
     record = None
+    # records may be an iterator: keep the ones with temporary
+    # identifiers for the second phase
+    uploaded_records = []
     for record in records:
+        if record and (extract_tag_from_record(record, 'BDR') is not None or
+                       extract_tag_from_record(record, 'BDM') is not None):
+            uploaded_records.append(record)
         record_id = record_extract_oai_id(record)
         task_sleep_now_if_required(can_stop_too=True)
         if opt_mode == "holdingpen":
@@ -2835,6 +3203,7 @@ def bibupload_records(records, opt_mode=None, opt_notimechange=0,
                 pretend = pretend,
                 tmp_ids = tmp_ids,
                 tmp_vers = tmp_vers)
+            forget_prefetched_record_ids(record, error[1])
             results.append(error)
             if error[0] == 1:
                 if record:
@@ -2874,7 +3243,7 @@ def bibupload_records(records, opt_mode=None, opt_notimechange=0,
     write_message("Identifiers table after processing: %s  versions: %s" % (str(tmp_ids), str(tmp_vers)))
     write_message("Uploading BDR and BDM fields")
     if opt_mode != "holdingpen":
-        for record in records:
+        for record in uploaded_records:
             record_id = retrieve_rec_id(record, opt_mode, pretend=pretend, post_phase = True)
             bibupload_post_phase(record,
                                  rec_id = record_id,
@@ -2895,8 +3264,12 @@ def task_run_core():
     if task_get_option('file_path') is not None:
         write_message("start preocessing", verbose=3)
         task_update_progress("Reading XML input")
-        recs = xml_marc_to_records(open_marc_file(task_get_option('file_path')))
-        stat['nb_records_to_upload'] = len(recs)
+        if task_get_option('parallel', 1) > 1:
+            write_message("Creating records with %d processes" % task_get_option('parallel'))
+            recs = xml_marc_to_records_in_parallel(open_marc_file(task_get_option('file_path')),
+                                                   task_get_option('parallel'))
+        else:
+            recs = xml_marc_file_to_records(task_get_option('file_path'))
         write_message("   -Open XML marc: DONE", verbose=2)
         task_sleep_now_if_required(can_stop_too=True)
         write_message("Entering records loop", verbose=3)
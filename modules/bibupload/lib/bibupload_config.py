@@ -34,3 +34,11 @@ CFG_BIBUPLOAD_DELETE_VALUE = "__DELETE_FIELDS__"
 
 CFG_BIBUPLOAD_OPT_MODES = ['insert', 'replace', 'replace_or_insert', 'reference',
         'correct', 'append', 'holdingpen', 'delete']
+
+## maximum size (in bytes) of the values looked up in, or inserted
+## into, a bibxxx table by one query of the bulk metadata writer
+CFG_BIBUPLOAD_BIBXXX_QUERY_MAX_BYTES = 512 * 1024
+
+## number of records whose identifiers are looked up together by the
+## --parallel pipeline mode
+CFG_BIBUPLOAD_PIPELINE_BATCH_SIZE = 500
@@ -3459,6 +3459,34 @@ class BibUploadUpperLowerCaseTest(GenericBibUploadTest):
         self.assertEqual(compare_hmbuffers(remove_tag_001_from_hmbuffer(recid2_inserted_hm),
                                           self.testrec2_hm), '')
 
+    def test_record_with_repeated_values(self):
+        """bibupload - inserting MARCXML record with repeated and upper/lower case values"""
+        testrec_xm = """
+        <record>
+        <controlfield tag="003">SzGeCERN</controlfield>
+         <datafield tag="700" ind1=" " ind2=" ">
+          <subfield code="a">Test, John</subfield>
+         </datafield>
+         <datafield tag="700" ind1=" " ind2=" ">
+          <subfield code="a">TEST, JOHN</subfield>
+         </datafield>
+         <datafield tag="700" ind1=" " ind2=" ">
+          <subfield code="a">Test, John</subfield>
+         </datafield>
+        </record>
+        """
+        recs = bibupload.xml_marc_to_records(testrec_xm)
+        dummyerr, recid, _ = bibupload.bibupload_records(recs, opt_mode='insert')[0]
+        self.check_record_consistency(recid)
+        res = run_sql("""SELECT b.value, bb.field_number FROM bib70x AS b, bibrec_bib70x AS bb
+                          WHERE bb.id_bibxxx=b.id AND bb.id_bibrec=%s AND b.tag='700__a'
+                          ORDER BY bb.field_number""", (recid,))
+        self.assertEqual([row[0] for row in res], ['Test, John', 'TEST, JOHN', 'Test, John'])
+        self.assertEqual(len(dict.fromkeys([row[1] for row in res])), 3)
+        res = run_sql("""SELECT DISTINCT bb.id_bibxxx FROM bib70x AS b, bibrec_bib70x AS bb
+                          WHERE bb.id_bibxxx=b.id AND bb.id_bibrec=%s AND b.tag='700__a'""", (recid,))
+        self.assertEqual(len(res), 2)
+
 class BibUploadControlledProvenanceTest(GenericBibUploadTest):
     """Testing treatment of tags under controlled provenance in the correct mode."""
 
@@ -3667,6 +3695,49 @@ class BibUploadStrongTagsTest(GenericBibUploadTest):
         self.assertEqual(compare_xmbuffers(replaced_xm, self.testrec1_replaced_xm), '')
         self.assertEqual(compare_hmbuffers(replaced_hm, self.testrec1_replaced_hm), '')
 
+class BibUploadPipelineTest(GenericBibUploadTest):
+    """
+    Testing the --parallel pipeline mode.
+    """
+
+    def setUp(self):
+        """Initialize the MARCXML test records."""
+        GenericBibUploadTest.setUp(self)
+        self.testrecs_xm = """
+        <collection>
+        <record>
+         <datafield tag="035" ind1=" " ind2=" ">
+          <subfield code="a">oai:pipeline.test:1</subfield>
+         </datafield>
+         <datafield tag="245" ind1=" " ind2=" ">
+          <subfield code="a">%(title)s one</subfield>
+         </datafield>
+        </record>
+        <record>
+         <datafield tag="035" ind1=" " ind2=" ">
+          <subfield code="a">oai:pipeline.test:2</subfield>
+         </datafield>
+         <datafield tag="245" ind1=" " ind2=" ">
+          <subfield code="a">%(title)s two</subfield>
+         </datafield>
+        </record>
+        </collection>
+        """
+
+    def test_pipeline_insert_and_replace(self):
+        """bibupload - pipeline mode inserting then replacing records by OAI ID"""
+        recs = bibupload.xml_marc_to_records_in_parallel(self.testrecs_xm % {'title': 'Pipeline'}, 2)
+        results = bibupload.bibupload_records(recs, opt_mode='insert')
+        self.assertEqual([error for error, dummy_recid, dummy_msg in results], [0, 0])
+        recids = [recid for dummy_error, recid, dummy_msg in results]
+        for recid in recids:
+            self.check_record_consistency(recid)
+        recs = bibupload.xml_marc_to_records_in_parallel(self.testrecs_xm % {'title': 'Replaced'}, 2)
+        results = bibupload.bibupload_records(recs, opt_mode='replace_or_insert')
+        self.assertEqual([recid for dummy_error, recid, dummy_msg in results], recids)
+        self.failUnless('Replaced two' in print_record(recids[1], 'hm'))
+        self.assertEqual(bibupload.get_prefetched_record_ids('035__a', 'oai:pipeline.test:1'), None)
+
 class BibUploadPretendTest(GenericBibUploadTest):
     """
     Testing bibupload --pretend correctness.
@@ -5964,6 +6035,7 @@ TEST_SUITE = make_test_suite(BibUploadNoUselessHistoryTest,
                              BibUploadStrongTagsTest,
                              BibUploadFFTModeTest,
                              BibUploadPretendTest,
+                             BibUploadPipelineTest,
                              BibUploadCallbackURLTest,
                              BibUploadMoreInfoTest,
                              BibUploadBibRelationsTest,
@@ -23,6 +23,7 @@ rarely change.
 """
 
 from invenio.dbquery import run_sql, get_table_update_time
+import threading
 import time
 
 class InvenioDataCacherError(Exception):
@@ -38,11 +39,36 @@ class DataCacher:
     The .timestamp and .cache objects are exposed to clients.  Most
     use cases use a dict internal structure for .cache, but some use
     lists.
+
+    Besides rebuilding the whole cache when the timestamp verifier
+    reports a change, the cacher can optionally:
+
+        - update the cache incrementally by means of a delta filler
+          that loads only what was modified since the last update;
+
+        - throttle the timestamp verifications, so that the database
+          is not asked for table update times on every call;
+
+        - refresh the cache in a background thread, so that clients
+          keep being served the old snapshot while the new one is
+          being built.
     """
-    def __init__(self, cache_filler, timestamp_verifier):
+    def __init__(self, cache_filler, timestamp_verifier, delta_filler=None,
+                 check_interval=0, background_refresh=False):
         """ @param cache_filler: a function that fills the cache dictionary.
             @param timestamp_verifier: a function that returns a timestamp for
                    checking if something has changed after cache creation.
+            @param delta_filler: an optional function that, given the
+                   current cache and the timestamp of its last update,
+                   returns the updated cache by loading only the
+                   changes that happened after that timestamp.  It may
+                   return None to request a complete rebuild.
+            @param check_interval: minimum number of seconds between two
+                   calls of the timestamp verifier (0 to verify on
+                   every call).
+            @param background_refresh: whether to refresh an existing
+                   cache in a background thread instead of blocking the
+                   caller.
         """
         self.timestamp = 0 # WARNING: may be exposed to clients
         self.cache = {} # WARNING: may be exposed to clients; lazy
@@ -53,6 +79,13 @@ class DataCacher:
         if not callable(timestamp_verifier):
             raise InvenioDataCacherError, "timestamp_verifier is not callable"
         self.timestamp_verifier = timestamp_verifier
+        if delta_filler is not None and not callable(delta_filler):
+            raise InvenioDataCacherError, "delta_filler is not callable"
+        self.delta_filler = delta_filler
+        self.check_interval = check_interval
+        self.background_refresh = background_refresh
+        self.last_check = 0
+        self.refresh_lock = threading.Lock()
         self.is_ok_p = True
         self.create_cache()
 
@@ -60,25 +93,79 @@ class DataCacher:
         """Clear the cache rebuilding it."""
         self.create_cache()
 
+    def _get_current_timestamp(self):
+        """Return current time in the timestamp format."""
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+
     def create_cache(self):
         """
         Create and populate cache by calling cache filler.  Called on
         startup and used later during runtime as needed by clients.
         """
+        # Take the timestamp before filling the cache, so that changes
+        # happening while we are filling it are not missed.
+        timestamp = self._get_current_timestamp()
+
         # We empty the cache first to force freeing of the variable
         # this is useful when it is really big like our citations dictionary
         self.cache = None
 
         self.cache = self.cache_filler()
-        self.timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        self.timestamp = timestamp
+
+    def update_cache(self):
+        """
+        Bring the cache up to date, incrementally via the delta filler
+        if there is one, or by rebuilding it otherwise.  The new cache
+        replaces the old one at once, so that concurrent clients see
+        either the old or the new snapshot.
+        """
+        timestamp = self._get_current_timestamp()
+        cache = None
+        if self.delta_filler is not None and self.cache is not None:
+            cache = self.delta_filler(self.cache, self.timestamp)
+        if cache is None:
+            if not self.background_refresh:
+                # free memory before rebuilding, as create_cache() does
+                self.cache = None
+            cache = self.cache_filler()
+        self.cache = cache
+        self.timestamp = timestamp
+
+    def _update_cache_and_release_lock(self):
+        """Update the cache and release the refresh lock."""
+        try:
+            self.update_cache()
+        finally:
+            self.refresh_lock.release()
 
     def recreate_cache_if_needed(self):
         """
         Recreate cache if needed, by verifying the cache timestamp
         against the timestamp verifier function.
         """
-        if self.timestamp_verifier() > self.timestamp:
-            self.create_cache()
+        if self.check_interval:
+            now = time.time()
+            if now - self.last_check < self.check_interval:
+                return
+            self.last_check = now
+        timestamp = self.timestamp
+        if self.timestamp_verifier() > timestamp:
+            if self.background_refresh and self.cache is not None:
+                if not self.refresh_lock.acquire(False):
+                    # somebody else is already refreshing the cache;
+                    # serve the current snapshot meanwhile
+                    return
+                refresher = threading.Thread(target=self._update_cache_and_release_lock)
+                refresher.setDaemon(True)
+                refresher.start()
+            else:
+                self.refresh_lock.acquire()
+                if self.timestamp != timestamp:
+                    # somebody else has refreshed the cache meanwhile
+                    self.refresh_lock.release()
+                    return
+                self._update_cache_and_release_lock()
 
 class SQLDataCacher(DataCacher):
     """
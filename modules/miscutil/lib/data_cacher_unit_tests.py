@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for the data cacher."""
+
+__revision__ = "$Id$"
+
+import threading
+
+from invenio.testutils import InvenioTestCase
+
+from invenio.data_cacher import DataCacher
+from invenio.testutils import make_test_suite, run_test_suite
+
+class DataCacherTest(InvenioTestCase):
+    """Test full, incremental and background cache updates."""
+
+    def setUp(self):
+        """Prepare fake data source."""
+        self.data = {'a': 1, 'b': 2}
+        self.modified = []
+        self.updated = '0000-00-00 00:00:00'
+        self.nb_fills = 0
+        self.nb_verifications = 0
+
+    def cache_filler(self):
+        """Load everything."""
+        self.nb_fills += 1
+        return dict(self.data)
+
+    def delta_filler(self, cache, dummy_timestamp):
+        """Load only modified keys."""
+        cache = dict(cache)
+        for key in self.modified:
+            cache[key] = self.data[key]
+        return cache
+
+    def timestamp_verifier(self):
+        """Return time of last modification."""
+        self.nb_verifications += 1
+        return self.updated
+
+    def modify(self, key, value):
+        """Modify fake data source."""
+        self.data[key] = value
+        self.modified.append(key)
+        self.updated = '9999-12-31 23:59:59'
+
+    def test_full_rebuild(self):
+        """data cacher - full rebuild"""
+        cacher = DataCacher(self.cache_filler, self.timestamp_verifier)
+        self.modify('a', 10)
+        cacher.recreate_cache_if_needed()
+        self.assertEqual(cacher.cache, {'a': 10, 'b': 2})
+        self.assertEqual(self.nb_fills, 2)
+
+    def test_delta_update(self):
+        """data cacher - incremental update"""
+        cacher = DataCacher(self.cache_filler, self.timestamp_verifier,
+                            delta_filler=self.delta_filler)
+        old_cache = cacher.cache
+        self.modify('b', 20)
+        cacher.recreate_cache_if_needed()
+        self.assertEqual(cacher.cache, {'a': 1, 'b': 20})
+        self.assertEqual(self.nb_fills, 1)
+        self.assertEqual(old_cache, {'a': 1, 'b': 2})
+
+    def test_check_interval(self):
+        """data cacher - throttled timestamp verification"""
+        cacher = DataCacher(self.cache_filler, self.timestamp_verifier,
+                            check_interval=3600)
+        for dummy in range(5):
+            cacher.recreate_cache_if_needed()
+        self.assertEqual(self.nb_verifications, 1)
+
+    def test_background_refresh(self):
+        """data cacher - background refresh"""
+        cacher = DataCacher(self.cache_filler, self.timestamp_verifier,
+                            background_refresh=True)
+        self.modify('a', 10)
+        cacher.recreate_cache_if_needed()
+        for thread in threading.enumerate():
+            if thread is not threading.currentThread() and thread.isDaemon():
+                thread.join()
+        self.assertEqual(cacher.cache, {'a': 10, 'b': 2})
+
+TEST_SUITE = make_test_suite(DataCacherTest)
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE)
@@ -40,13 +40,17 @@ import time
 import marshal
 import re
 import atexit
-import os
+import threading
 
 from zlib import compress, decompress
 from thread import get_ident
+from invenio import dbquery_profiler
 from invenio.config import CFG_ACCESS_CONTROL_LEVEL_SITE, \
     CFG_MISCUTIL_SQL_USE_SQLALCHEMY, \
-    CFG_MISCUTIL_SQL_RUN_SQL_MANY_LIMIT
+    CFG_MISCUTIL_SQL_RUN_SQL_MANY_LIMIT, \
+    CFG_MISCUTIL_SQL_POOL_SIZE, \
+    CFG_MISCUTIL_SQL_POOL_IDLE_TIMEOUT, \
+    CFG_MISCUTIL_SQL_POOL_PING_INTERVAL
 
 if CFG_MISCUTIL_SQL_USE_SQLALCHEMY:
     try:
@@ -83,16 +87,248 @@ except ImportError:
     CFG_DATABASE_PASS = 'my123p$ss'
     CFG_DATABASE_SLAVE = ''
 
+## how many seconds does a thread wait for a free connection when the
+## connection pool is exhausted?
+CFG_MISCUTIL_SQL_POOL_WAIT_TIMEOUT = 30
+
+## connections inherited from the parent process after a fork: they
+## must stay referenced, since deallocating them would close the
+## sessions of the parent process
+_ORPHANED_CONNECTIONS = []
+
+class DatabaseConnectionPool:
+    """
+    Bounded pool of MySQL connections to one database host.
+
+    Connections are thread-affine: once a thread gets a connection, it
+    keeps using it (so that LOCK TABLES, temporary tables and
+    LAST_INSERT_ID() work as expected) until it releases it via
+    release_connection(), closes it via close_connection(), or dies.
+    Released connections and connections of dead threads go back to
+    the pool of idle connections, so that they can be reused by other
+    threads.  Connections unused for more than
+    CFG_MISCUTIL_SQL_POOL_PING_INTERVAL seconds are pinged before
+    being used again, and idle connections are closed after
+    CFG_MISCUTIL_SQL_POOL_IDLE_TIMEOUT seconds.  At most
+    CFG_MISCUTIL_SQL_POOL_SIZE connections are opened per host and
+    per process.
+    """
+    def __init__(self, dbhost, max_size=CFG_MISCUTIL_SQL_POOL_SIZE,
+                 idle_timeout=CFG_MISCUTIL_SQL_POOL_IDLE_TIMEOUT,
+                 ping_interval=CFG_MISCUTIL_SQL_POOL_PING_INTERVAL):
+        self.dbhost = dbhost
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        ## we use a reentrant lock, since bibtask signal handlers may
+        ## relogin while the main thread is inside the pool:
+        self.lock = threading.RLock()
+        self.available = threading.Condition(self.lock)
+        self._reset()
+
+    def _reset(self):
+        """Forget about all connections, e.g. after a fork."""
+        if hasattr(self, 'in_use'):
+            _ORPHANED_CONNECTIONS.extend(self.get_connections())
+        self.pid = os.getpid()
+        self.in_use = {} # thread ident -> connection
+        self.last_used = {} # id(connection) -> time of last use
+        self.idle = [] # list of idle connections, most recent last
+        self.stats = {'created': 0,
+                      'reused': 0,
+                      'pinged': 0,
+                      'ping_failures': 0,
+                      'closed_idle': 0,
+                      'reclaimed': 0,
+                      'waits': 0}
+
+    def _connect(self):
+        """Open new connection to the database host."""
+        connection = connect(host=self.dbhost,
+                             port=int(CFG_DATABASE_PORT),
+                             db=CFG_DATABASE_NAME,
+                             user=CFG_DATABASE_USER,
+                             passwd=CFG_DATABASE_PASS,
+                             use_unicode=False, charset='utf8')
+        connection.autocommit(True)
+        self.stats['created'] += 1
+        return connection
+
+    def _close(self, connection):
+        """Close CONNECTION, ignoring errors."""
+        self.last_used.pop(id(connection), None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _is_alive(self, connection):
+        """Ping CONNECTION and tell whether it is still usable."""
+        self.stats['pinged'] += 1
+        try:
+            connection.ping()
+            return True
+        except (OperationalError, InterfaceError):
+            self.stats['ping_failures'] += 1
+            return False
+
+    def _reclaim_connections_of_dead_threads(self):
+        """Move connections owned by threads that are gone to idle pool."""
+        alive_threads = threading._active # pylint: disable=W0212
+        for thread_ident in self.in_use.keys():
+            if thread_ident not in alive_threads:
+                self.idle.append(self.in_use.pop(thread_ident))
+                self.stats['reclaimed'] += 1
+
+    def _get_idle_connection(self):
+        """Return a live idle connection or None."""
+        now = time.time()
+        while self.idle:
+            connection = self.idle.pop()
+            idle_time = now - self.last_used.get(id(connection), 0)
+            if idle_time > self.idle_timeout:
+                self._close(connection)
+                self.stats['closed_idle'] += 1
+            elif idle_time <= self.ping_interval or self._is_alive(connection):
+                self.stats['reused'] += 1
+                return connection
+            else:
+                self._close(connection)
+        return None
+
+    def get_connection(self, force_new=False):
+        """
+        Return connection for the current thread.  If FORCE_NEW is
+        set, always open a new one, replacing the current one.
+        """
+        if self.pid != os.getpid():
+            ## we have been forked: the connections belong to the
+            ## parent process and must not be closed nor used here
+            self._reset()
+        thread_ident = get_ident()
+        connection = self.in_use.get(thread_ident)
+        if connection is not None and not force_new:
+            now = time.time()
+            if now - self.last_used.get(id(connection), now) > self.ping_interval \
+                   and not self._is_alive(connection):
+                connection = self._connect()
+                self.in_use[thread_ident] = connection
+            self.last_used[id(connection)] = now
+            return connection
+        self.lock.acquire()
+        try:
+            if connection is not None:
+                ## do not close the old connection: it may still be
+                ## referenced by a run_sql() call interrupted by a
+                ## signal handler that is asking for a new one
+                del self.in_use[thread_ident]
+                self.last_used.pop(id(connection), None)
+                connection = self._connect()
+            else:
+                ## make sure the current thread is known to the
+                ## threading module, so that we can detect its death
+                threading.currentThread()
+                self._reclaim_connections_of_dead_threads()
+                connection = self._get_idle_connection()
+                deadline = time.time() + CFG_MISCUTIL_SQL_POOL_WAIT_TIMEOUT
+                while connection is None and self.max_size and \
+                          len(self.in_use) >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise OperationalError("Connection pool for %s is exhausted (%d connections in use)" % \
+                                               (self.dbhost, len(self.in_use)))
+                    self.stats['waits'] += 1
+                    self.available.wait(remaining)
+                    self._reclaim_connections_of_dead_threads()
+                    connection = self._get_idle_connection()
+                if connection is None:
+                    connection = self._connect()
+            self.in_use[thread_ident] = connection
+            self.last_used[id(connection)] = time.time()
+            return connection
+        finally:
+            self.lock.release()
+
+    def revalidate_connection(self):
+        """
+        Return connection for the current thread after having checked
+        that it is still alive; reconnect only if it is not.  Useful
+        after an OperationalError in order not to reconnect needlessly.
+        """
+        connection = self.in_use.get(get_ident())
+        if connection is not None and self.pid == os.getpid() and \
+               self._is_alive(connection):
+            self.last_used[id(connection)] = time.time()
+            return connection
+        return self.get_connection(force_new=connection is not None)
+
+    def release_connection(self):
+        """Give the connection of the current thread back to the pool."""
+        self.lock.acquire()
+        try:
+            connection = self.in_use.pop(get_ident(), None)
+            if connection is not None:
+                self.last_used[id(connection)] = time.time()
+                self.idle.append(connection)
+                self.available.notify()
+        finally:
+            self.lock.release()
+
+    def close_connection(self):
+        """Close the connection of the current thread."""
+        self.lock.acquire()
+        try:
+            connection = self.in_use.pop(get_ident(), None)
+            if connection is not None:
+                try:
+                    connection.cursor().execute("UNLOCK TABLES")
+                except Exception:
+                    pass
+                self._close(connection)
+                self.available.notify()
+        finally:
+            self.lock.release()
+
+    def get_connections(self):
+        """Return list of all the connections, in use or idle."""
+        return self.in_use.values() + self.idle
+
+    def get_stats(self):
+        """Return dictionary of pool statistics."""
+        stats = dict(self.stats)
+        stats['in_use'] = len(self.in_use)
+        stats['idle'] = len(self.idle)
+        stats['max_size'] = self.max_size
+        return stats
+
+_DB_POOLS = {}
+_DB_POOLS[CFG_DATABASE_HOST] = DatabaseConnectionPool(CFG_DATABASE_HOST)
+if CFG_DATABASE_SLAVE:
+    _DB_POOLS[CFG_DATABASE_SLAVE] = DatabaseConnectionPool(CFG_DATABASE_SLAVE)
+
+def _get_db_pool(dbhost):
+    """Return connection pool for DBHOST, creating it if needed."""
+    try:
+        return _DB_POOLS[dbhost]
+    except KeyError:
+        return _DB_POOLS.setdefault(dbhost, DatabaseConnectionPool(dbhost))
 
-_DB_CONN = {}
-_DB_CONN[CFG_DATABASE_HOST] = {}
-_DB_CONN[CFG_DATABASE_SLAVE] = {}
+def get_connection_pool_stats():
+    """
+    Return statistics of the database connection pools of this
+    process, as a dictionary of host -> dictionary with number of
+    connections in use, idle, created, reused, pinged, etc.
+    """
+    stats = {}
+    for dbhost, db_pool in _DB_POOLS.items():
+        stats[dbhost] = db_pool.get_stats()
+    return stats
 
 def unlock_all():
-    for dbhost in _DB_CONN.keys():
-        for db in _DB_CONN[dbhost].values():
+    for db_pool in _DB_POOLS.values():
+        for db in db_pool.get_connections():
             try:
-                cur = db.cur()
+                cur = db.cursor()
                 cur.execute("UNLOCK TABLES")
             except:
                 pass
@@ -106,7 +342,8 @@ class InvenioDbQueryWildcardLimitError(Exception):
         self.res = res
 
 def _db_login(dbhost=CFG_DATABASE_HOST, relogin=0):
-    """Login to the database."""
+    """Login to the database.  If RELOGIN is set, a new connection
+    is opened even if the current thread already has one."""
 
     ## Note: we are using "use_unicode=False", because we want to
     ## receive strings from MySQL as Python UTF-8 binary string
@@ -124,50 +361,58 @@ def _db_login(dbhost=CFG_DATABASE_HOST, relogin=0):
                        db=CFG_DATABASE_NAME, user=CFG_DATABASE_USER,
                        passwd=CFG_DATABASE_PASS,
                        use_unicode=False, charset='utf8')
-    else:
-        thread_ident = (os.getpid(), get_ident())
-    if relogin:
-        connection = _DB_CONN[dbhost][thread_ident] = connect(host=dbhost,
-                                         port=int(CFG_DATABASE_PORT),
-                                         db=CFG_DATABASE_NAME,
-                                         user=CFG_DATABASE_USER,
-                                         passwd=CFG_DATABASE_PASS,
-                                         use_unicode=False, charset='utf8')
-        connection.autocommit(True)
-        return connection
-    else:
-        if _DB_CONN[dbhost].has_key(thread_ident):
-            return _DB_CONN[dbhost][thread_ident]
-        else:
-            connection = _DB_CONN[dbhost][thread_ident] = connect(host=dbhost,
-                                             port=int(CFG_DATABASE_PORT),
-                                             db=CFG_DATABASE_NAME,
-                                             user=CFG_DATABASE_USER,
-                                             passwd=CFG_DATABASE_PASS,
-                                             use_unicode=False, charset='utf8')
-            connection.autocommit(True)
-            return connection
+    return _get_db_pool(dbhost).get_connection(force_new=relogin)
+
+def _db_relogin_if_needed(dbhost=CFG_DATABASE_HOST):
+    """Return connection to DBHOST after an error, reconnecting only
+    if the current connection does not answer to ping."""
+    if CFG_MISCUTIL_SQL_USE_SQLALCHEMY:
+        return _db_login(dbhost, relogin=1)
+    return _get_db_pool(dbhost).revalidate_connection()
 
 def _db_logout(dbhost=CFG_DATABASE_HOST):
-    """Close a connection."""
-    try:
-        del _DB_CONN[dbhost][(os.getpid(), get_ident())]
-    except KeyError:
-        pass
+    """Give the connection back to the pool."""
+    if not CFG_MISCUTIL_SQL_USE_SQLALCHEMY:
+        _get_db_pool(dbhost).release_connection()
+
+def release_connection(dbhost=CFG_DATABASE_HOST):
+    """
+    Give the connection of the current thread back to the pool, so
+    that it can be reused by other threads.  Useful at the end of a
+    web request or of a short-lived thread.
+    """
+    _db_logout(dbhost)
+
+def release_all_connections():
+    """
+    Give the connections of the current thread to all database hosts
+    back to their pools.
+    """
+    if not CFG_MISCUTIL_SQL_USE_SQLALCHEMY:
+        for db_pool in _DB_POOLS.values():
+            db_pool.release_connection()
+
+def forget_all_connections():
+    """
+    Forget about the connections of this process without closing
+    them, e.g. in a forked worker process, where they belong to the
+    parent process.  New connections are opened when needed.
+    """
+    if not CFG_MISCUTIL_SQL_USE_SQLALCHEMY:
+        for db_pool in _DB_POOLS.values():
+            db_pool.lock.acquire()
+            try:
+                db_pool._reset() # pylint: disable=W0212
+            finally:
+                db_pool.lock.release()
 
 def close_connection(dbhost=CFG_DATABASE_HOST):
     """
     Enforce the closing of a connection
     Highly relevant in multi-processing and multi-threaded modules
     """
-    try:
-        db = _DB_CONN[dbhost][(os.getpid(), get_ident())]
-        cur = db.cursor()
-        cur.execute("UNLOCK TABLES")
-        db.close()
-        del _DB_CONN[dbhost][(os.getpid(), get_ident())]
-    except KeyError:
-        pass
+    if not CFG_MISCUTIL_SQL_USE_SQLALCHEMY:
+        _get_db_pool(dbhost).close_connection()
 
 def run_sql(sql, param=None, n=0, with_desc=False, with_dict=False, run_on_slave=False):
     """Run SQL on the server with PARAM and return result.
@@ -209,6 +454,7 @@ def run_sql(sql, param=None, n=0, with_desc=False, with_dict=False, run_on_slave
         dbhost = CFG_DATABASE_SLAVE
 
     ### log_sql_query(dbhost, sql, param) ### UNCOMMENT ONLY IF you REALLY want to log all queries
+    query_start_time = time.time()
     try:
         db = _db_login(dbhost)
         cur = db.cursor()
@@ -216,9 +462,9 @@ def run_sql(sql, param=None, n=0, with_desc=False, with_dict=False, run_on_slave
         rc = cur.execute(sql, param)
         gc.enable()
     except (OperationalError, InterfaceError): # unexpected disconnect, bad malloc error, etc
-        # FIXME: now reconnect is always forced, we may perhaps want to ping() first?
+        # reconnect only if the connection does not answer to ping:
         try:
-            db = _db_login(dbhost, relogin=1)
+            db = _db_relogin_if_needed(dbhost)
             cur = db.cursor()
             gc.disable()
             rc = cur.execute(sql, param)
@@ -231,6 +477,8 @@ def run_sql(sql, param=None, n=0, with_desc=False, with_dict=False, run_on_slave
             recset = cur.fetchmany(n)
         else:
             recset = cur.fetchall()
+        if dbquery_profiler.sql_profiler_active:
+            dbquery_profiler.record_query(sql, time.time() - query_start_time, len(recset))
 
         if with_dict: # return list of dictionaries
             # let's extract column names
@@ -248,6 +496,8 @@ def run_sql(sql, param=None, n=0, with_desc=False, with_dict=False, run_on_slave
             else:
                 return recset
     else:
+        if dbquery_profiler.sql_profiler_active:
+            dbquery_profiler.record_query(sql, time.time() - query_start_time, rc or 0)
         if string.upper(string.split(sql)[0]) == "INSERT":
             rc = cur.lastrowid
         return rc
@@ -273,6 +523,7 @@ def run_sql_many(query, params, limit=CFG_MISCUTIL_SQL_RUN_SQL_MANY_LIMIT, run_o
     r = None
     while i < len(params):
         ## make partial query safely (mimicking procedure from run_sql())
+        query_start_time = time.time()
         try:
             db = _db_login(dbhost)
             cur = db.cursor()
@@ -281,13 +532,15 @@ def run_sql_many(query, params, limit=CFG_MISCUTIL_SQL_RUN_SQL_MANY_LIMIT, run_o
             gc.enable()
         except (OperationalError, InterfaceError):
             try:
-                db = _db_login(dbhost, relogin=1)
+                db = _db_relogin_if_needed(dbhost)
                 cur = db.cursor()
                 gc.disable()
                 rc = cur.executemany(query, params[i:i + limit])
                 gc.enable()
             except (OperationalError, InterfaceError):
                 raise
+        if dbquery_profiler.sql_profiler_active:
+            dbquery_profiler.record_query(query, time.time() - query_start_time, rc or 0)
         ## collect its result:
         if r is None:
             r = rc
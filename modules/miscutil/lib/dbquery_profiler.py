@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Invenio SQL query profiler.
+
+Opt-in instrumentation of run_sql() and run_sql_many().  When enabled
+(either globally via CFG_MISCUTIL_SQL_PROFILER, or for the current
+request only via start_request_profile()), every query is recorded
+with its duration and number of rows, grouped by its normalized
+fingerprint (literals replaced by `?'), so that N+1 query patterns
+stand out.  Two views are provided:
+
+    - the per-request profile, see start_request_profile(),
+      stop_request_profile() and format_query_profile();
+
+    - the aggregated statistics of the current process, see
+      get_slow_queries().
+
+Example:
+
+    >>> start_request_profile()
+    >>> ... run some code issuing SQL queries ...
+    >>> print format_query_profile(stop_request_profile())
+"""
+
+__revision__ = "$Id$"
+
+import re
+import threading
+import time
+
+from invenio.config import CFG_LOGDIR, \
+     CFG_MISCUTIL_SQL_PROFILER, \
+     CFG_MISCUTIL_SQL_PROFILER_LOG_THRESHOLD
+
+## maximum number of distinct fingerprints we keep aggregated
+## statistics for (the least used ones are dropped first):
+CFG_MISCUTIL_SQL_PROFILER_MAX_FINGERPRINTS = 1000
+
+## size of the profiler log file before it is rotated, and number of
+## rotated log files to keep:
+CFG_MISCUTIL_SQL_PROFILER_LOG_MAX_BYTES = 10 * 1024 * 1024
+CFG_MISCUTIL_SQL_PROFILER_LOG_BACKUP_COUNT = 5
+
+_RE_SQL_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_RE_SQL_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_RE_SQL_PLACEHOLDER = re.compile(r"%s|%\(\w+\)s")
+_RE_SQL_VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_RE_SQL_SPACES = re.compile(r"\s+")
+
+def get_query_fingerprint(sql):
+    """
+    Return normalized fingerprint of query SQL: literals and
+    placeholders are replaced by `?', lists of values are collapsed
+    and whitespace is normalized, so that e.g.
+
+        SELECT value FROM bib10x WHERE id IN (1, 2, 3)
+
+    and
+
+        SELECT value FROM bib10x WHERE id=%s
+
+    share fingerprints with all their siblings differing only by
+    values (respectively `... IN (?+)' and `... id=?').
+    """
+    sql = _RE_SQL_STRING.sub('?', sql)
+    sql = _RE_SQL_PLACEHOLDER.sub('?', sql)
+    sql = _RE_SQL_NUMBER.sub('?', sql)
+    sql = _RE_SQL_VALUE_LIST.sub('(?+)', sql)
+    return _RE_SQL_SPACES.sub(' ', sql).strip()
+
+class QueryProfile:
+    """
+    Statistics about a set of queries, grouped by fingerprint.
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.nb_queries = 0
+        self.nb_rows = 0
+        self.total_time = 0.0
+        ## fingerprint -> [count, total time, max time, rows]
+        self.fingerprints = {}
+
+    def add(self, fingerprint, duration, nb_rows):
+        """Record query of FINGERPRINT that took DURATION seconds and
+        returned or affected NB_ROWS rows."""
+        self.nb_queries += 1
+        self.nb_rows += nb_rows
+        self.total_time += duration
+        try:
+            stats = self.fingerprints[fingerprint]
+        except KeyError:
+            stats = self.fingerprints[fingerprint] = [0, 0.0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += duration
+        if duration > stats[2]:
+            stats[2] = duration
+        stats[3] += nb_rows
+
+    def get_top(self, n=10, sort_by='time'):
+        """
+        Return list of N tuples (fingerprint, count, total time, max
+        time, rows) sorted by decreasing total time (SORT_BY='time')
+        or number of executions (SORT_BY='count').
+        """
+        if sort_by == 'count':
+            key = lambda item: (item[1], item[2])
+        else:
+            key = lambda item: (item[2], item[1])
+        items = [(fingerprint, stats[0], stats[1], stats[2], stats[3])
+                 for fingerprint, stats in self.fingerprints.items()]
+        items.sort(key=key, reverse=True)
+        return items[:n]
+
+    def prune(self, max_fingerprints):
+        """Drop the least executed fingerprints beyond MAX_FINGERPRINTS."""
+        if len(self.fingerprints) > max_fingerprints:
+            for fingerprint, dummy_count, dummy_total, dummy_max, dummy_rows in \
+                    self.get_top(len(self.fingerprints), sort_by='count')[max_fingerprints:]:
+                del self.fingerprints[fingerprint]
+
+_PROFILER_LOCK = threading.Lock()
+_AGGREGATED_PROFILE = QueryProfile()
+_REQUEST_PROFILES = threading.local()
+
+## flag checked by dbquery on every query; True if either global
+## profiling is enabled or some thread is profiling its request:
+sql_profiler_active = CFG_MISCUTIL_SQL_PROFILER
+_NB_ACTIVE_REQUEST_PROFILES = [0]
+
+def _update_active_flag():
+    """Recompute sql_profiler_active."""
+    global sql_profiler_active
+    sql_profiler_active = bool(CFG_MISCUTIL_SQL_PROFILER or
+                               _NB_ACTIVE_REQUEST_PROFILES[0])
+
+def start_request_profile():
+    """
+    Start profiling the queries run by the current thread.  Queries
+    are recorded until stop_request_profile() is called.  Does
+    nothing if the current thread is already being profiled.
+    """
+    if getattr(_REQUEST_PROFILES, 'profile', None) is not None:
+        return
+    _REQUEST_PROFILES.profile = QueryProfile()
+    _PROFILER_LOCK.acquire()
+    try:
+        _NB_ACTIVE_REQUEST_PROFILES[0] += 1
+        _update_active_flag()
+    finally:
+        _PROFILER_LOCK.release()
+
+def get_request_profile():
+    """Return QueryProfile of the current thread, or None."""
+    return getattr(_REQUEST_PROFILES, 'profile', None)
+
+def stop_request_profile():
+    """
+    Stop profiling the queries run by the current thread and return
+    the collected QueryProfile (or None if it was not being profiled).
+    """
+    profile = getattr(_REQUEST_PROFILES, 'profile', None)
+    if profile is None:
+        return None
+    _REQUEST_PROFILES.profile = None
+    _PROFILER_LOCK.acquire()
+    try:
+        _NB_ACTIVE_REQUEST_PROFILES[0] -= 1
+        _update_active_flag()
+    finally:
+        _PROFILER_LOCK.release()
+    return profile
+
+def record_query(sql, duration, nb_rows):
+    """
+    Record execution of query SQL that took DURATION seconds and
+    returned or affected NB_ROWS rows.  Called by run_sql() and
+    run_sql_many() when sql_profiler_active is set.
+    """
+    fingerprint = get_query_fingerprint(sql)
+    profile = getattr(_REQUEST_PROFILES, 'profile', None)
+    if profile is not None:
+        profile.add(fingerprint, duration, nb_rows)
+    if CFG_MISCUTIL_SQL_PROFILER:
+        _PROFILER_LOCK.acquire()
+        try:
+            _AGGREGATED_PROFILE.add(fingerprint, duration, nb_rows)
+            if len(_AGGREGATED_PROFILE.fingerprints) > \
+                   2 * CFG_MISCUTIL_SQL_PROFILER_MAX_FINGERPRINTS:
+                _AGGREGATED_PROFILE.prune(CFG_MISCUTIL_SQL_PROFILER_MAX_FINGERPRINTS)
+        finally:
+            _PROFILER_LOCK.release()
+
+def get_slow_queries(n=20, sort_by='time'):
+    """
+    Return the N query fingerprints that took most time (or that were
+    run most often, if SORT_BY='count') in this process since the
+    aggregated statistics were last reset, as tuples (fingerprint,
+    count, total time, max time, rows).
+    """
+    _PROFILER_LOCK.acquire()
+    try:
+        return _AGGREGATED_PROFILE.get_top(n, sort_by)
+    finally:
+        _PROFILER_LOCK.release()
+
+def reset_slow_queries():
+    """Reset the aggregated statistics of this process."""
+    global _AGGREGATED_PROFILE
+    _PROFILER_LOCK.acquire()
+    try:
+        _AGGREGATED_PROFILE = QueryProfile()
+    finally:
+        _PROFILER_LOCK.release()
+
+def format_query_profile(profile, n=10, title="SQL query profile"):
+    """Return plain text report of QueryProfile PROFILE with its N
+    most expensive and N most frequent query fingerprints."""
+    out = "%s: %d queries, %d distinct, %d rows, %.3f s in SQL, %.3f s elapsed\n" % \
+          (title, profile.nb_queries, len(profile.fingerprints), profile.nb_rows,
+           profile.total_time, time.time() - profile.start_time)
+    for sort_by, header in (('time', 'most expensive'), ('count', 'most frequent')):
+        out += "  %s queries:\n" % header
+        out += "  %8s %10s %10s %8s  %s\n" % ('count', 'total(s)', 'max(s)', 'rows', 'query')
+        for fingerprint, count, total, maximum, rows in profile.get_top(n, sort_by):
+            out += "  %8d %10.4f %10.4f %8d  %s\n" % \
+                   (count, total, maximum, rows, fingerprint[:200])
+    return out
+
+_PROFILER_LOGGER = []
+
+def _get_profiler_logger():
+    """Return logger writing to the rotating profiler log file."""
+    if not _PROFILER_LOGGER:
+        import logging
+        import logging.handlers
+        logger = logging.getLogger('invenio.dbquery_profiler')
+        logger.propagate = False
+        handler = logging.handlers.RotatingFileHandler(
+            CFG_LOGDIR + '/dbquery_profiler.log',
+            maxBytes=CFG_MISCUTIL_SQL_PROFILER_LOG_MAX_BYTES,
+            backupCount=CFG_MISCUTIL_SQL_PROFILER_LOG_BACKUP_COUNT)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        _PROFILER_LOGGER.append(logger)
+    return _PROFILER_LOGGER[0]
+
+def log_query_profile(profile, context=''):
+    """
+    Write report of PROFILE to CFG_LOGDIR/dbquery_profiler.log if the
+    time it spent in SQL exceeds CFG_MISCUTIL_SQL_PROFILER_LOG_THRESHOLD
+    milliseconds.  CONTEXT (e.g. the request URI) is written along.
+    """
+    if profile is None or \
+           profile.total_time * 1000 < CFG_MISCUTIL_SQL_PROFILER_LOG_THRESHOLD:
+        return
+    try:
+        _get_profiler_logger().info(format_query_profile(profile, title=context or "SQL query profile"))
+    except (IOError, OSError):
+        pass
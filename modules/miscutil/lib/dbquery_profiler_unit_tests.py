@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for the SQL query profiler."""
+
+__revision__ = "$Id$"
+
+from invenio.testutils import InvenioTestCase
+
+from invenio import dbquery_profiler
+from invenio.testutils import make_test_suite, run_test_suite
+
+class QueryFingerprintTest(InvenioTestCase):
+    """Test normalization of SQL queries."""
+
+    def test_placeholders_and_literals(self):
+        """dbquery profiler - fingerprint of placeholders and literals"""
+        self.assertEqual(dbquery_profiler.get_query_fingerprint(
+            "SELECT value FROM bib10x WHERE id=%s AND tag='100__a'"),
+            "SELECT value FROM bib10x WHERE id=? AND tag=?")
+        self.assertEqual(dbquery_profiler.get_query_fingerprint(
+            "SELECT id FROM bibrec WHERE id=12"),
+            dbquery_profiler.get_query_fingerprint("SELECT id FROM bibrec WHERE id=%s"))
+
+    def test_value_lists_and_whitespace(self):
+        """dbquery profiler - fingerprint of value lists and whitespace"""
+        self.assertEqual(dbquery_profiler.get_query_fingerprint(
+            "SELECT id FROM bibrec\n    WHERE id IN (1, 2,3)"),
+            "SELECT id FROM bibrec WHERE id IN (?+)")
+
+    def test_table_names_are_kept(self):
+        """dbquery profiler - fingerprint keeps table names with digits"""
+        self.assertEqual(dbquery_profiler.get_query_fingerprint(
+            "SELECT hitlist FROM idxWORD01F WHERE term=%s"),
+            "SELECT hitlist FROM idxWORD01F WHERE term=?")
+
+class RequestProfileTest(InvenioTestCase):
+    """Test per-request query profiles."""
+
+    def test_request_profile(self):
+        """dbquery profiler - per-request profile"""
+        dbquery_profiler.start_request_profile()
+        self.assert_(dbquery_profiler.sql_profiler_active)
+        dbquery_profiler.record_query("SELECT id FROM bibrec WHERE id=1", 0.5, 1)
+        dbquery_profiler.record_query("SELECT id FROM bibrec WHERE id=2", 0.25, 1)
+        dbquery_profiler.record_query("SELECT * FROM collection", 0.1, 10)
+        profile = dbquery_profiler.stop_request_profile()
+        self.assertEqual(profile.nb_queries, 3)
+        self.assertEqual(profile.nb_rows, 12)
+        self.assertEqual(profile.get_top(1),
+                         [("SELECT id FROM bibrec WHERE id=?", 2, 0.75, 0.5, 2)])
+        self.assert_("SELECT * FROM collection" in
+                     dbquery_profiler.format_query_profile(profile))
+        self.assertEqual(dbquery_profiler.stop_request_profile(), None)
+
+    def test_prune(self):
+        """dbquery profiler - pruning of least used fingerprints"""
+        profile = dbquery_profiler.QueryProfile()
+        profile.add('a', 0.1, 0)
+        profile.add('a', 0.1, 0)
+        profile.add('b', 0.1, 0)
+        profile.prune(1)
+        self.assertEqual(profile.fingerprints.keys(), ['a'])
+
+TEST_SUITE = make_test_suite(QueryFingerprintTest, RequestProfileTest)
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE)
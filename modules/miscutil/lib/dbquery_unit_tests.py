@@ -21,6 +21,8 @@
 
 __revision__ = "$Id$"
 
+import threading
+
 from invenio.testutils import InvenioTestCase
 
 from invenio import dbquery
@@ -102,7 +104,69 @@ class WashTableColumnNameTest(InvenioTestCase):
         self.assertNotEqual(dbquery.real_escape_string(testcase_injection), testcase_injection)
 
 
-TEST_SUITE = make_test_suite(TableUpdateTimesTest, WashTableColumnNameTest)
+class ConnectionPoolTest(InvenioTestCase):
+    """Test database connection pooling."""
+
+    def _run_in_thread(self, pool, release=True):
+        """Get a connection from POOL in a new thread and return it."""
+        connections = []
+        def worker():
+            connections.append(pool.get_connection())
+            if release:
+                pool.release_connection()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        return connections[0]
+
+    def test_released_connection_is_reused(self):
+        """dbquery - released connection is reused by another thread"""
+        pool = dbquery.DatabaseConnectionPool(dbquery.CFG_DATABASE_HOST, max_size=1)
+        connection1 = self._run_in_thread(pool)
+        connection2 = self._run_in_thread(pool)
+        self.assert_(connection1 is connection2)
+        stats = pool.get_stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 1)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['in_use'], 0)
+
+    def test_connection_of_dead_thread_is_reclaimed(self):
+        """dbquery - connection of a finished thread is reclaimed"""
+        pool = dbquery.DatabaseConnectionPool(dbquery.CFG_DATABASE_HOST, max_size=1)
+        connection1 = self._run_in_thread(pool, release=False)
+        connection2 = self._run_in_thread(pool, release=False)
+        self.assert_(connection1 is connection2)
+        stats = pool.get_stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['in_use'], 1)
+
+    def test_thread_keeps_its_connection(self):
+        """dbquery - thread keeps using the same connection"""
+        pool = dbquery.DatabaseConnectionPool(dbquery.CFG_DATABASE_HOST)
+        self.assert_(pool.get_connection() is pool.get_connection())
+        connection = pool.get_connection()
+        self.assert_(pool.get_connection(force_new=True) is not connection)
+        pool.close_connection()
+        self.assertEqual(pool.get_stats()['in_use'], 0)
+
+    def test_fork_keeps_parent_connections(self):
+        """dbquery - connections of the parent process are kept after fork"""
+        pool = dbquery.DatabaseConnectionPool(dbquery.CFG_DATABASE_HOST)
+        connection = pool.get_connection()
+        pool.pid = -1 # pretend we have been forked
+        self.assert_(pool.get_connection() is not connection)
+        self.assert_(connection in dbquery._ORPHANED_CONNECTIONS)
+        pool.close_connection()
+
+    def test_pool_stats(self):
+        """dbquery - connection pool statistics"""
+        dbquery.run_sql("SELECT 1")
+        stats = dbquery.get_connection_pool_stats()
+        self.assert_(stats[dbquery.CFG_DATABASE_HOST]['in_use'] >= 1)
+
+TEST_SUITE = make_test_suite(TableUpdateTimesTest, WashTableColumnNameTest,
+                             ConnectionPoolTest)
 
 if __name__ == "__main__":
     run_test_suite(TEST_SUITE)
@@ -497,11 +497,15 @@ def cli_cmd_reset_recstruct_cache(conf):
     will adapt the database to either store or not store the recstruct
     format."""
     from invenio.intbitset import intbitset
-    from invenio.dbquery import run_sql, serialize_via_marshal
+    from zlib import compress, decompressobj
+    from invenio.dbquery import run_sql
     from invenio.search_engine import get_record
+    from invenio.bibrecord import serialize_record_structure
     from invenio.bibsched import server_pid, pidfile
     enable_recstruct_cache = conf.get("Invenio", "CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE")
     enable_recstruct_cache = enable_recstruct_cache in ('True', '1')
+    compact_recstruct_cache = conf.get("Invenio", "CFG_BIBUPLOAD_SERIALIZE_COMPACT_RECORD_STRUCTURE")
+    compact_recstruct_cache = compact_recstruct_cache in ('True', '1')
     pid = server_pid(ping_the_process=False)
     if pid:
         print >> sys.stderr, "ERROR: bibsched seems to run with pid %d, according to %s." % (pid, pidfile)
@@ -510,13 +514,19 @@ def cli_cmd_reset_recstruct_cache(conf):
     if enable_recstruct_cache:
         print ">>> Searching records which need recstruct cache resetting; this may take a while..."
         all_recids = intbitset(run_sql("SELECT id FROM bibrec"))
-        good_recids = intbitset(run_sql("SELECT bibrec.id FROM bibrec JOIN bibfmt ON bibrec.id = bibfmt.id_bibrec WHERE format='recstruct' AND modification_date < last_updated"))
+        good_recids = intbitset()
+        for recid, value in run_sql("SELECT bibrec.id, bibfmt.value FROM bibrec JOIN bibfmt ON bibrec.id = bibfmt.id_bibrec WHERE format='recstruct' AND modification_date < last_updated"):
+            # keep the records serialized in the wanted form only
+            # (marshalled tuple for the compact form, dictionary else):
+            if (decompressobj().decompress(value, 1) == '(') == compact_recstruct_cache:
+                good_recids.add(recid)
         recids = all_recids - good_recids
         print ">>> Generating recstruct cache..."
         tot = len(recids)
         count = 0
         for recid in recids:
-            value = serialize_via_marshal(get_record(recid))
+            value = compress(serialize_record_structure(get_record(recid),
+                                                        compact_recstruct_cache))
             run_sql("DELETE FROM bibfmt WHERE id_bibrec=%s AND format='recstruct'", (recid, ))
             run_sql("INSERT INTO bibfmt(id_bibrec, format, last_updated, value) VALUES(%s, 'recstruct', NOW(), %s)", (recid, value))
             count += 1
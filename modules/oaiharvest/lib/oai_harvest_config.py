@@ -30,6 +30,11 @@ CFG_OAI_POSSIBLE_POSTMODES = [\
          ["f", "filter (f)"], \
          ["u", "upload (u)"]]
 
+## CFG_OAI_HARVEST_PREFETCH_PAGES -- how many answers of an OAI
+## repository are fetched in advance while the current one is being
+## processed, when harvesting in pipelined mode
+CFG_OAI_HARVEST_PREFETCH_PAGES = 2
+
 # Exceptions: warnings
 class InvenioOAIHarvestWarning(Exception):
     """A generic warning for OAIHarvest."""
@@ -38,6 +38,8 @@ import shutil
 import tempfile
 import urlparse
 import random
+import threading
+import Queue
 
 from invenio.config import \
      CFG_BINDIR, \
@@ -58,6 +60,7 @@ from invenio.bibtask import \
      write_message, \
      task_init, \
      task_sleep_now_if_required, \
+     task_read_status, \
      task_update_progress, \
      task_low_level_submission
 from invenio.bibrecord import record_extract_oai_id, create_records, \
@@ -105,7 +108,6 @@ def task_run_core():
     """
     reposlist = []
     datelist = []
-    dateflag = 0
     filepath_prefix = "%s/oaiharvest_%s" % (CFG_TMPDIR, str(task_get_task_param("task_id")))
     ### go ahead: build up the reposlist
     if task_get_option("repository") is not None:
@@ -127,411 +129,27 @@ def task_run_core():
     if task_get_option("dates"):
         ### for each repos simply perform a from-until date harvesting...
         ### no need to update anything
-        dateflag = 1
         for element in task_get_option("dates"):
             datelist.append(element)
 
     error_happened_p = 0 # 0: no error, 1: "recoverable" error (don't stop queue), 2: error (admin intervention needed)
 
-    j = 0
-    for repos in reposlist:
-        j += 1
-        task_sleep_now_if_required()
-
-        # Extract values from database row (in exact order):
-        #  | id | baseurl | metadataprefix | arguments | comment
-        #  | bibconvertcfgfile | name   | lastrun | frequency
-        #  | postprocess | setspecs | bibfilterprogram
-        source_id = repos[0][0]
-        baseurl = str(repos[0][1])
-        metadataprefix = str(repos[0][2])
-        bibconvert_cfgfile = str(repos[0][5])
-        reponame = str(repos[0][6])
-        lastrun = repos[0][7]
-        frequency = repos[0][8]
-        postmode = repos[0][9]
-        setspecs = str(repos[0][10])
-        bibfilterprogram = str(repos[0][11])
-
-        write_message("running in postmode %s" % (postmode,))
-        downloaded_material_dict = {}
-        harvested_files_list = []
-        # Harvest phase
-        harvestpath = "%s_%d_%s_" % (filepath_prefix, j, time.strftime("%Y%m%d%H%M%S"))
-        if dateflag == 1:
-            task_update_progress("Harvesting %s from %s to %s (%i/%i)" % \
-                                 (reponame, \
-                                  str(datelist[0]),
-                                  str(datelist[1]),
-                                  j, \
-                                  len(reposlist)))
-            exit_code, file_list = oai_harvest_get(prefix=metadataprefix,
-                                                   baseurl=baseurl,
-                                                   harvestpath=harvestpath,
-                                                   fro=str(datelist[0]),
-                                                   until=str(datelist[1]),
-                                                   setspecs=setspecs)
-            if exit_code == 1 :
-                write_message("source %s was harvested from %s to %s" % \
-                              (reponame, str(datelist[0]), str(datelist[1])))
-                harvested_files_list = file_list
-            else:
-                write_message("an error occurred while harvesting from source %s for the dates chosen:\n%s\n" % \
-                              (reponame, file_list))
-                if error_happened_p < 1:
-                    error_happened_p = 1
-                continue
-
-        elif dateflag != 1 and lastrun is None and frequency != 0:
-            write_message("source %s was never harvested before - harvesting whole repository" % \
-                          (reponame,))
-            task_update_progress("Harvesting %s (%i/%i)" % \
-                                 (reponame,
-                                  j, \
-                                  len(reposlist)))
-            exit_code, file_list = oai_harvest_get(prefix=metadataprefix,
-                                                   baseurl=baseurl,
-                                                   harvestpath=harvestpath,
-                                                   setspecs=setspecs)
-            if exit_code == 1 :
-                update_lastrun(source_id)
-                harvested_files_list = file_list
-            else :
-                write_message("an error occurred while harvesting from source %s:\n%s\n" % \
-                              (reponame, file_list))
-                if error_happened_p < 1:
-                    error_happened_p = 1
-                continue
-
-        elif dateflag != 1 and frequency != 0:
-            ### check that update is actually needed,
-            ### i.e. lastrun+frequency>today
-            timenow = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-            lastrundate = re.sub(r'\.[0-9]+$', '',
-                str(lastrun)) # remove trailing .00
-            timeinsec = int(frequency) * 60 * 60
-            updatedue = add_timestamp_and_timelag(lastrundate, timeinsec)
-            proceed = compare_timestamps_with_tolerance(updatedue, timenow)
-            if proceed == 0 or proceed == -1 : #update needed!
-                write_message("source %s is going to be updated" % (reponame,))
-                fromdate = str(lastrun)
-                fromdate = fromdate.split()[0] # get rid of time of the day for the moment
-                task_update_progress("Harvesting %s (%i/%i)" % \
-                                     (reponame,
-                                     j, \
-                                     len(reposlist)))
-                exit_code, file_list = oai_harvest_get(prefix=metadataprefix,
-                                                       baseurl=baseurl,
-                                                       harvestpath=harvestpath,
-                                                       fro=fromdate,
-                                                       setspecs=setspecs)
-                if exit_code == 1 :
-                    update_lastrun(source_id)
-                    harvested_files_list = file_list
-                else :
-                    write_message("an error occurred while harvesting from source %s:\n%s\n" % \
-                                  (reponame, file_list))
-                    if error_happened_p < 1:
-                        error_happened_p = 1
-                    continue
-            else:
-                write_message("source %s does not need updating" % (reponame,))
-                continue
-
-        elif dateflag != 1 and frequency == 0:
-            write_message("source %s has frequency set to 'Never' so it will not be updated" % \
-                          (reponame,))
-            continue
-
-        # Harvesting done, now convert/extract/filter/upload as requested
-        if len(harvested_files_list) < 1:
-            write_message("No records harvested for %s" % (reponame,))
-            continue
-
-        # Retrieve all OAI IDs and set active list
-        harvested_identifier_list = collect_identifiers(harvested_files_list)
-        active_files_list = harvested_files_list
-        if len(active_files_list) != len(harvested_identifier_list):
-            # Harvested files and its identifiers are 'out of sync', abort harvest
-            write_message("Harvested files miss identifiers for %s" % (reponame,))
-            continue
-        write_message("post-harvest processes started")
-        # Convert phase
-        if 'c' in postmode:
-            updated_files_list = []
-            i = 0
-            write_message("conversion step started")
-            for active_file in active_files_list:
-                i += 1
-                task_sleep_now_if_required()
-                task_update_progress("Converting material harvested from %s (%i/%i)" % \
-                                     (reponame, \
-                                      i, \
-                                      len(active_files_list)))
-                updated_file = "%s.converted" % (active_file.split('.')[0],)
-                updated_files_list.append(updated_file)
-                (exitcode, err_msg) = call_bibconvert(config=bibconvert_cfgfile,
-                                                      harvestpath=active_file,
-                                                      convertpath=updated_file)
-                if exitcode == 0:
-                    write_message("harvested file %s was successfully converted" % \
-                                  (active_file,))
-                else:
-                    write_message("an error occurred while converting %s:\n%s" % \
-                                  (active_file, err_msg))
-                    error_happened_p = 2
-                    continue
-            # print stats:
-            for updated_file in updated_files_list:
-                write_message("File %s contains %i records." % \
-                              (updated_file,
-                               get_nb_records_in_file(updated_file)))
-            active_files_list = updated_files_list
-            write_message("conversion step ended")
-        # plotextract phase
-        if 'p' in postmode:
-            write_message("plotextraction step started")
-            # Download tarball for each harvested/converted record, then run plotextrator.
-            # Update converted xml files with generated xml or add it for upload
-            updated_files_list = []
-            i = 0
-            for active_file in active_files_list:
-                identifiers = harvested_identifier_list[i]
-                i += 1
-                task_sleep_now_if_required()
-                task_update_progress("Extracting plots from harvested material from %s (%i/%i)" % \
-                                     (reponame, i, len(active_files_list)))
-                updated_file = "%s.plotextracted" % (active_file.split('.')[0],)
-                updated_files_list.append(updated_file)
-                (exitcode, err_msg) = call_plotextractor(active_file,
-                                                         updated_file,
-                                                         identifiers,
-                                                         downloaded_material_dict,
-                                                         source_id)
-                if exitcode == 0:
-                    if err_msg != "":
-                        write_message("plots from %s was extracted, but with some errors:\n%s" % \
-                                  (active_file, err_msg))
-                    else:
-                        write_message("plots from %s was successfully extracted" % \
-                                      (active_file,))
-                else:
-                    write_message("an error occurred while extracting plots from %s:\n%s" % \
-                                  (active_file, err_msg))
-                    error_happened_p = 2
-                    continue
-            # print stats:
-            for updated_file in updated_files_list:
-                write_message("File %s contains %i records." % \
-                              (updated_file,
-                               get_nb_records_in_file(updated_file)))
-            active_files_list = updated_files_list
-            write_message("plotextraction step ended")
-        # refextract phase
-        if 'r' in postmode:
-            updated_files_list = []
-            i = 0
-            write_message("refextraction step started")
-            for active_file in active_files_list:
-                identifiers = harvested_identifier_list[i]
-                i += 1
-                task_sleep_now_if_required()
-                task_update_progress("Extracting references from material harvested from %s (%i/%i)" % \
-                                     (reponame, i, len(active_files_list)))
-                updated_file = "%s.refextracted" % (active_file.split('.')[0],)
-                updated_files_list.append(updated_file)
-                (exitcode, err_msg) = call_refextract(active_file,
-                                                      updated_file,
-                                                      identifiers,
-                                                      downloaded_material_dict,
-                                                      source_id)
-                if exitcode == 0:
-                    if err_msg != "":
-                        write_message("references from %s was extracted, but with some errors:\n%s" % \
-                                      (active_file, err_msg))
-                    else:
-                        write_message("references from %s was successfully extracted" % \
-                                      (active_file,))
-                else:
-                    write_message("an error occurred while extracting references from %s:\n%s" % \
-                                  (active_file, err_msg))
-                    error_happened_p = 2
-                    continue
-            # print stats:
-            for updated_file in updated_files_list:
-                write_message("File %s contains %i records." % \
-                              (updated_file,
-                               get_nb_records_in_file(updated_file)))
-            active_files_list = updated_files_list
-            write_message("refextraction step ended")
-        # authorlist phase
-        if 'a' in postmode:
-            write_message("authorlist extraction step started")
-            # Initialize BibCatalog connection as default user, if possible
-            if bibcatalog_system is not None:
-                bibcatalog_response = bibcatalog_system.check_system()
-            else:
-                bibcatalog_response = "No ticket system configured"
-            if bibcatalog_response != "":
-                write_message("BibCatalog error: %s\n" % (bibcatalog_response,))
-            updated_files_list = []
-            i = 0
-            for active_file in active_files_list:
-                identifiers = harvested_identifier_list[i]
-                i += 1
-                task_sleep_now_if_required()
-                task_update_progress("Extracting any authorlists from material harvested from %s (%i/%i)" % \
-                                     (reponame, i, len(active_files_list)))
-                updated_file = "%s.authextracted" % (active_file.split('.')[0],)
-                updated_files_list.append(updated_file)
-                (exitcode, err_msg) = call_authorlist_extract(active_file,
-                                                              updated_file,
-                                                              identifiers,
-                                                              downloaded_material_dict,
-                                                              source_id)
-                if exitcode == 0:
-                    if err_msg != "":
-                        write_message("authorlists from %s was extracted, but with some errors:\n%s" % \
-                                      (active_file, err_msg))
-                    else:
-                        write_message("any authorlists from %s was successfully extracted" % \
-                                      (active_file,))
-                else:
-                    write_message("an error occurred while extracting authorlists from %s:\n%s" % \
-                                  (active_file, err_msg))
-                    error_happened_p = 2
-                    continue
-            # print stats:
-            for updated_file in updated_files_list:
-                write_message("File %s contains %i records." % \
-                              (updated_file,
-                               get_nb_records_in_file(updated_file)))
-            active_files_list = updated_files_list
-            write_message("authorlist extraction step ended")
-        # fulltext phase
-        if 't' in postmode:
-            write_message("full-text attachment step started")
-            # Attaching fulltext
-            updated_files_list = []
-            i = 0
-            for active_file in active_files_list:
-                identifiers = harvested_identifier_list[i]
-                i += 1
-                task_sleep_now_if_required()
-                task_update_progress("Attaching fulltext to records harvested from %s (%i/%i)" % \
-                                     (reponame, i, len(active_files_list)))
-                updated_file = "%s.fulltext" % (active_file.split('.')[0],)
-                updated_files_list.append(updated_file)
-                (exitcode, err_msg) = call_fulltext(active_file,
-                                                    updated_file,
-                                                    identifiers,
-                                                    downloaded_material_dict,
-                                                    source_id)
-                if exitcode == 0:
-                    write_message("fulltext from %s was successfully attached" % \
-                                  (active_file,))
-                else:
-                    write_message("an error occurred while attaching fulltext to %s:\n%s" % \
-                                  (active_file, err_msg))
-                    error_happened_p = 2
-                    continue
-            # print stats:
-            for updated_file in updated_files_list:
-                write_message("File %s contains %i records." % \
-                              (updated_file,
-                               get_nb_records_in_file(updated_file)))
-            active_files_list = updated_files_list
-            write_message("full-text attachment step ended")
-        # Filter-phase
-        if 'f' in postmode:
-            write_message("filtering step started")
-            # first call bibfilter:
-            res = 0
-            i = 0
-            for active_file in active_files_list:
-                i += 1
-                task_sleep_now_if_required()
-                task_update_progress("Filtering material harvested from %s (%i/%i)" % \
-                                     (reponame, \
-                                      i, \
-                                      len(active_files_list)))
-                (exitcode, err_msg) = call_bibfilter(bibfilterprogram, active_file)
-
-                if exitcode == 0:
-                    write_message("%s was successfully bibfiltered" % \
-                                  (active_file,))
-                else:
-                    write_message("an error occurred while bibfiltering %s:\n%s" % \
-                                  (active_file, err_msg))
-                    error_happened_p = 2
-                    continue
-            # print stats:
-            for active_file in active_files_list:
-                write_message("File %s contains %i records." % \
-                    (active_file + ".insert.xml",
-                    get_nb_records_in_file(active_file + ".insert.xml")))
-                write_message("File %s contains %i records." % \
-                    (active_file + ".correct.xml",
-                    get_nb_records_in_file(active_file + ".correct.xml")))
-                write_message("File %s contains %i records." % \
-                    (active_file + ".append.xml",
-                    get_nb_records_in_file(active_file + ".append.xml")))
-                write_message("File %s contains %i records." % \
-                    (active_file + ".holdingpen.xml",
-                    get_nb_records_in_file(active_file + ".holdingpen.xml")))
-            write_message("filtering step ended")
-        # Upload files
-        if "u" in postmode:
-            write_message("upload step started")
-            if 'f' in postmode:
-                upload_modes = [('.insert.xml', '-i'),
-                                ('.correct.xml', '-c'),
-                                ('.append.xml', '-a'),
-                                ('.holdingpen.xml', '-o')]
-            else:
-                upload_modes = [('', '-ir')]
-
-            i = 0
-            last_upload_task_id = -1
-            # Get a random sequence ID that will allow for the tasks to be
-            # run in order, regardless if parallel task execution is activated
-            sequence_id = random.randrange(1, 4294967296)
-            for active_file in active_files_list:
-                task_sleep_now_if_required()
-                i += 1
-                task_update_progress("Uploading records harvested from %s (%i/%i)" % \
-                                    (reponame, \
-                                     i, \
-                                     len(active_files_list)))
-                for suffix, mode in upload_modes:
-                    upload_filename = active_file + suffix
-                    if get_nb_records_in_file(upload_filename) == 0:
-                        continue
-                    last_upload_task_id = call_bibupload(upload_filename, \
-                                                         [mode], \
-                                                         source_id, \
-                                                         sequence_id)
-                    if not last_upload_task_id:
-                        error_happened_p = 2
-                        write_message("an error occurred while uploading %s from %s" % \
-                                      (upload_filename, reponame))
-                        break
-                else:
-                    write_message("material harvested from source %s was successfully uploaded" % \
-                                  (reponame,))
-            if len(active_files_list) > 0:
-                write_message("nothing to upload")
-            write_message("upload step ended")
-
-            if CFG_INSPIRE_SITE:
-                # Launch BibIndex,Webcoll update task to show uploaded content quickly
-                bibindex_params = ['-w', 'reportnumber,collection', \
-                                   '-P', '6', \
-                                   '-I', str(sequence_id), \
-                                   '--post-process', 'bst_run_bibtask[taskname="webcoll", user="oaiharvest", P="6", c="HEP"]']
-                task_low_level_submission("bibindex", "oaiharvest", *tuple(bibindex_params))
-
-        write_message("post-harvest processes ended")
+    parallel = task_get_option("parallel") or 1
+    pipeline = task_get_option("pipeline")
+    if parallel > 1 and len(reposlist) > 1:
+        write_message("harvesting %i repositories at a time" % (parallel,))
+        error_happened_p = harvest_repositories_in_parallel(reposlist, datelist,
+                                                            filepath_prefix,
+                                                            parallel, pipeline)
+    else:
+        j = 0
+        for repos in reposlist:
+            j += 1
+            task_sleep_now_if_required()
+            error_happened_p = max(error_happened_p,
+                                   harvest_repository(repos, j, len(reposlist),
+                                                      datelist, filepath_prefix,
+                                                      pipeline))
 
     if error_happened_p:
         if CFG_OAI_FAILED_HARVESTING_STOP_QUEUE == 0 or \
@@ -555,6 +173,526 @@ def task_run_core():
     else:
         return True
 
+def harvest_repository(repos, j, nb_repos, datelist, filepath_prefix,
+                       pipeline=False, sleep_fnc=task_sleep_now_if_required):
+    """Harvest repository REPOS, the J-th of the NB_REPOS repositories
+    being harvested, from DATELIST[0] to DATELIST[1] if given or else
+    since its last run, then convert/extract/filter/upload the
+    harvested records as requested by its postmode.  If PIPELINE is
+    set, each harvested file is post-processed as soon as it has been
+    harvested, while the next ones are being fetched.  SLEEP_FNC is
+    called between the post-processing of two files.
+    Return 0 in case of success, 1 in case of "recoverable" error and 2
+    in case of error needing admin intervention.
+    """
+    # Extract values from database row (in exact order):
+    #  | id | baseurl | metadataprefix | arguments | comment
+    #  | bibconvertcfgfile | name   | lastrun | frequency
+    #  | postprocess | setspecs | bibfilterprogram
+    source_id = repos[0][0]
+    baseurl = str(repos[0][1])
+    metadataprefix = str(repos[0][2])
+    reponame = str(repos[0][6])
+    lastrun = repos[0][7]
+    frequency = repos[0][8]
+    postmode = repos[0][9]
+    setspecs = str(repos[0][10])
+
+    write_message("running in postmode %s" % (postmode,))
+    # Harvest phase
+    harvestpath = "%s_%d_%s_" % (filepath_prefix, j, time.strftime("%Y%m%d%H%M%S"))
+    fromdate = None
+    untildate = None
+    if datelist:
+        task_update_progress("Harvesting %s from %s to %s (%i/%i)" % \
+                             (reponame, \
+                              str(datelist[0]),
+                              str(datelist[1]),
+                              j, \
+                              nb_repos))
+        fromdate = str(datelist[0])
+        untildate = str(datelist[1])
+        error_message = "an error occurred while harvesting from source %s for the dates chosen:\n%s\n"
+    elif lastrun is None and frequency != 0:
+        write_message("source %s was never harvested before - harvesting whole repository" % \
+                      (reponame,))
+        task_update_progress("Harvesting %s (%i/%i)" % \
+                             (reponame,
+                              j, \
+                              nb_repos))
+        error_message = "an error occurred while harvesting from source %s:\n%s\n"
+    elif frequency != 0:
+        ### check that update is actually needed,
+        ### i.e. lastrun+frequency>today
+        timenow = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        lastrundate = re.sub(r'\.[0-9]+$', '',
+            str(lastrun)) # remove trailing .00
+        timeinsec = int(frequency) * 60 * 60
+        updatedue = add_timestamp_and_timelag(lastrundate, timeinsec)
+        proceed = compare_timestamps_with_tolerance(updatedue, timenow)
+        if proceed == 0 or proceed == -1 : #update needed!
+            write_message("source %s is going to be updated" % (reponame,))
+            fromdate = str(lastrun)
+            fromdate = fromdate.split()[0] # get rid of time of the day for the moment
+            task_update_progress("Harvesting %s (%i/%i)" % \
+                                 (reponame,
+                                 j, \
+                                 nb_repos))
+            error_message = "an error occurred while harvesting from source %s:\n%s\n"
+        else:
+            write_message("source %s does not need updating" % (reponame,))
+            return 0
+    else:
+        write_message("source %s has frequency set to 'Never' so it will not be updated" % \
+                      (reponame,))
+        return 0
+
+    downloaded_material_dict = {}
+    # Get a random sequence ID that will allow for the tasks to be
+    # run in order, regardless if parallel task execution is activated
+    sequence_id = random.randrange(1, 4294967296)
+    error_happened_p = 0
+    start_time = time.time()
+    harvesting_time = 0
+    harvested_files_list = []
+    if pipeline:
+        harvested_files = oai_harvest_iter(prefix=metadataprefix,
+                                           baseurl=baseurl,
+                                           harvestpath=harvestpath,
+                                           fro=fromdate,
+                                           until=untildate,
+                                           setspecs=setspecs)
+        while True:
+            waiting_time = time.time()
+            try:
+                harvested_file = harvested_files.next()
+            except StopIteration:
+                harvesting_time += time.time() - waiting_time
+                break
+            except (StandardError, oai_harvest_getter.InvenioOAIRequestError), e:
+                write_message(error_message % (reponame, e))
+                return max(error_happened_p, 1)
+            harvesting_time += time.time() - waiting_time
+            harvested_files_list.append(harvested_file)
+            error_happened_p = max(error_happened_p,
+                                   postprocess_harvested_files(repos, [harvested_file],
+                                                               downloaded_material_dict,
+                                                               sequence_id, sleep_fnc))
+    else:
+        exit_code, file_list = oai_harvest_get(prefix=metadataprefix,
+                                               baseurl=baseurl,
+                                               harvestpath=harvestpath,
+                                               fro=fromdate,
+                                               until=untildate,
+                                               setspecs=setspecs)
+        harvesting_time = time.time() - start_time
+        if exit_code != 1:
+            write_message(error_message % (reponame, file_list))
+            return 1
+        harvested_files_list = file_list
+    if datelist:
+        write_message("source %s was harvested from %s to %s" % \
+                      (reponame, str(datelist[0]), str(datelist[1])))
+    else:
+        update_lastrun(source_id)
+
+    # Harvesting done, now convert/extract/filter/upload as requested
+    if len(harvested_files_list) < 1:
+        write_message("No records harvested for %s" % (reponame,))
+        return error_happened_p
+    if not pipeline:
+        error_happened_p = postprocess_harvested_files(repos, harvested_files_list,
+                                                       downloaded_material_dict,
+                                                       sequence_id, sleep_fnc)
+
+    if "u" in postmode and CFG_INSPIRE_SITE:
+        # Launch BibIndex,Webcoll update task to show uploaded content quickly
+        bibindex_params = ['-w', 'reportnumber,collection', \
+                           '-P', '6', \
+                           '-I', str(sequence_id), \
+                           '--post-process', 'bst_run_bibtask[taskname="webcoll", user="oaiharvest", P="6", c="HEP"]']
+        task_low_level_submission("bibindex", "oaiharvest", *tuple(bibindex_params))
+
+    # print throughput stats:
+    nb_records = 0
+    for harvested_file in harvested_files_list:
+        nb_records += max(get_nb_records_in_file(harvested_file), 0)
+    total_time = time.time() - start_time
+    write_message("source %s: %i records in %i files harvested in %.1f s, "
+                  "harvested and processed in %.1f s (%.1f records/s)" % \
+                  (reponame, nb_records, len(harvested_files_list),
+                   harvesting_time, total_time,
+                   nb_records / max(total_time, 0.001)))
+    return error_happened_p
+
+def harvest_repositories_in_parallel(reposlist, datelist, filepath_prefix,
+                                     parallel, pipeline=False):
+    """Harvest the repositories of REPOSLIST, up to PARALLEL at a
+    time, see harvest_repository().  Return the highest error level.
+
+    Only the main thread can put the task to sleep, so the harvesting
+    threads wait at the points where they would have called
+    task_sleep_now_if_required() while SLEEP_REQUESTED is set, and the
+    main thread, polling the task status while it waits for them, sets
+    it and sleeps once they are all waiting there.
+    """
+    repos_queue = Queue.Queue()
+    j = 0
+    for repos in reposlist:
+        j += 1
+        repos_queue.put((j, repos))
+    error_levels = []
+    sleep_requested = threading.Event()
+    waiting = threading.Condition()
+    nb_waiting = [0]
+    def wait_while_sleep_requested():
+        """Wait until the main thread has slept, if it asked to."""
+        if not sleep_requested.isSet():
+            return
+        waiting.acquire()
+        try:
+            nb_waiting[0] += 1
+            waiting.notifyAll()
+            while sleep_requested.isSet():
+                waiting.wait()
+            nb_waiting[0] -= 1
+        finally:
+            waiting.release()
+    def harvest_repositories_from_queue():
+        """Harvest repositories until the queue is empty."""
+        while True:
+            wait_while_sleep_requested()
+            try:
+                j, repos = repos_queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                error_levels.append(harvest_repository(repos, j, len(reposlist),
+                                                       datelist, filepath_prefix,
+                                                       pipeline,
+                                                       wait_while_sleep_requested))
+            except Exception:
+                register_exception(alert_admin=True)
+                error_levels.append(2)
+    threads = []
+    for dummy in range(min(parallel, len(reposlist))):
+        thread = threading.Thread(target=harvest_repositories_from_queue)
+        thread.start()
+        threads.append(thread)
+    while threads:
+        # join with a timeout, so that the signals of BibSched are
+        # handled meanwhile
+        threads[0].join(1)
+        threads = [worker for worker in threads if worker.isAlive()]
+        if threads and task_read_status() in ('ABOUT TO SLEEP', 'ABOUT TO STOP'):
+            sleep_requested.set()
+            waiting.acquire()
+            try:
+                while nb_waiting[0] < len([worker for worker in threads
+                                           if worker.isAlive()]):
+                    waiting.wait(1)
+                try:
+                    task_sleep_now_if_required()
+                finally:
+                    sleep_requested.clear()
+                    waiting.notifyAll()
+            finally:
+                waiting.release()
+    return max([0] + error_levels)
+
+def postprocess_harvested_files(repos, harvested_files_list,
+                                downloaded_material_dict, sequence_id,
+                                sleep_fnc=task_sleep_now_if_required):
+    """Convert/extract/filter/upload the records of the files of
+    HARVESTED_FILES_LIST, harvested from repository REPOS, as requested
+    by its postmode.  DOWNLOADED_MATERIAL_DICT is the dict of identifier
+    -> dict mappings for the material downloaded from the repository so
+    far, SEQUENCE_ID the sequence of the upload tasks.  SLEEP_FNC is
+    called between the processing of two files.
+    Return 0 in case of success, 2 in case of error.
+    """
+    source_id = repos[0][0]
+    bibconvert_cfgfile = str(repos[0][5])
+    reponame = str(repos[0][6])
+    postmode = repos[0][9]
+    bibfilterprogram = str(repos[0][11])
+    error_happened_p = 0
+
+    # Retrieve all OAI IDs and set active list
+    harvested_identifier_list = collect_identifiers(harvested_files_list)
+    active_files_list = harvested_files_list
+    if len(active_files_list) != len(harvested_identifier_list):
+        # Harvested files and its identifiers are 'out of sync', abort harvest
+        write_message("Harvested files miss identifiers for %s" % (reponame,))
+        return 0
+    write_message("post-harvest processes started")
+    # Convert phase
+    if 'c' in postmode:
+        updated_files_list = []
+        i = 0
+        write_message("conversion step started")
+        for active_file in active_files_list:
+            i += 1
+            sleep_fnc()
+            task_update_progress("Converting material harvested from %s (%i/%i)" % \
+                                 (reponame, \
+                                  i, \
+                                  len(active_files_list)))
+            updated_file = "%s.converted" % (active_file.split('.')[0],)
+            updated_files_list.append(updated_file)
+            (exitcode, err_msg) = call_bibconvert(config=bibconvert_cfgfile,
+                                                  harvestpath=active_file,
+                                                  convertpath=updated_file)
+            if exitcode == 0:
+                write_message("harvested file %s was successfully converted" % \
+                              (active_file,))
+            else:
+                write_message("an error occurred while converting %s:\n%s" % \
+                              (active_file, err_msg))
+                error_happened_p = 2
+                continue
+        # print stats:
+        for updated_file in updated_files_list:
+            write_message("File %s contains %i records." % \
+                          (updated_file,
+                           get_nb_records_in_file(updated_file)))
+        active_files_list = updated_files_list
+        write_message("conversion step ended")
+    # plotextract phase
+    if 'p' in postmode:
+        write_message("plotextraction step started")
+        # Download tarball for each harvested/converted record, then run plotextrator.
+        # Update converted xml files with generated xml or add it for upload
+        updated_files_list = []
+        i = 0
+        for active_file in active_files_list:
+            identifiers = harvested_identifier_list[i]
+            i += 1
+            sleep_fnc()
+            task_update_progress("Extracting plots from harvested material from %s (%i/%i)" % \
+                                 (reponame, i, len(active_files_list)))
+            updated_file = "%s.plotextracted" % (active_file.split('.')[0],)
+            updated_files_list.append(updated_file)
+            (exitcode, err_msg) = call_plotextractor(active_file,
+                                                     updated_file,
+                                                     identifiers,
+                                                     downloaded_material_dict,
+                                                     source_id)
+            if exitcode == 0:
+                if err_msg != "":
+                    write_message("plots from %s was extracted, but with some errors:\n%s" % \
+                              (active_file, err_msg))
+                else:
+                    write_message("plots from %s was successfully extracted" % \
+                                  (active_file,))
+            else:
+                write_message("an error occurred while extracting plots from %s:\n%s" % \
+                              (active_file, err_msg))
+                error_happened_p = 2
+                continue
+        # print stats:
+        for updated_file in updated_files_list:
+            write_message("File %s contains %i records." % \
+                          (updated_file,
+                           get_nb_records_in_file(updated_file)))
+        active_files_list = updated_files_list
+        write_message("plotextraction step ended")
+    # refextract phase
+    if 'r' in postmode:
+        updated_files_list = []
+        i = 0
+        write_message("refextraction step started")
+        for active_file in active_files_list:
+            identifiers = harvested_identifier_list[i]
+            i += 1
+            sleep_fnc()
+            task_update_progress("Extracting references from material harvested from %s (%i/%i)" % \
+                                 (reponame, i, len(active_files_list)))
+            updated_file = "%s.refextracted" % (active_file.split('.')[0],)
+            updated_files_list.append(updated_file)
+            (exitcode, err_msg) = call_refextract(active_file,
+                                                  updated_file,
+                                                  identifiers,
+                                                  downloaded_material_dict,
+                                                  source_id)
+            if exitcode == 0:
+                if err_msg != "":
+                    write_message("references from %s was extracted, but with some errors:\n%s" % \
+                                  (active_file, err_msg))
+                else:
+                    write_message("references from %s was successfully extracted" % \
+                                  (active_file,))
+            else:
+                write_message("an error occurred while extracting references from %s:\n%s" % \
+                              (active_file, err_msg))
+                error_happened_p = 2
+                continue
+        # print stats:
+        for updated_file in updated_files_list:
+            write_message("File %s contains %i records." % \
+                          (updated_file,
+                           get_nb_records_in_file(updated_file)))
+        active_files_list = updated_files_list
+        write_message("refextraction step ended")
+    # authorlist phase
+    if 'a' in postmode:
+        write_message("authorlist extraction step started")
+        # Initialize BibCatalog connection as default user, if possible
+        if bibcatalog_system is not None:
+            bibcatalog_response = bibcatalog_system.check_system()
+        else:
+            bibcatalog_response = "No ticket system configured"
+        if bibcatalog_response != "":
+            write_message("BibCatalog error: %s\n" % (bibcatalog_response,))
+        updated_files_list = []
+        i = 0
+        for active_file in active_files_list:
+            identifiers = harvested_identifier_list[i]
+            i += 1
+            sleep_fnc()
+            task_update_progress("Extracting any authorlists from material harvested from %s (%i/%i)" % \
+                                 (reponame, i, len(active_files_list)))
+            updated_file = "%s.authextracted" % (active_file.split('.')[0],)
+            updated_files_list.append(updated_file)
+            (exitcode, err_msg) = call_authorlist_extract(active_file,
+                                                          updated_file,
+                                                          identifiers,
+                                                          downloaded_material_dict,
+                                                          source_id)
+            if exitcode == 0:
+                if err_msg != "":
+                    write_message("authorlists from %s was extracted, but with some errors:\n%s" % \
+                                  (active_file, err_msg))
+                else:
+                    write_message("any authorlists from %s was successfully extracted" % \
+                                  (active_file,))
+            else:
+                write_message("an error occurred while extracting authorlists from %s:\n%s" % \
+                              (active_file, err_msg))
+                error_happened_p = 2
+                continue
+        # print stats:
+        for updated_file in updated_files_list:
+            write_message("File %s contains %i records." % \
+                          (updated_file,
+                           get_nb_records_in_file(updated_file)))
+        active_files_list = updated_files_list
+        write_message("authorlist extraction step ended")
+    # fulltext phase
+    if 't' in postmode:
+        write_message("full-text attachment step started")
+        # Attaching fulltext
+        updated_files_list = []
+        i = 0
+        for active_file in active_files_list:
+            identifiers = harvested_identifier_list[i]
+            i += 1
+            sleep_fnc()
+            task_update_progress("Attaching fulltext to records harvested from %s (%i/%i)" % \
+                                 (reponame, i, len(active_files_list)))
+            updated_file = "%s.fulltext" % (active_file.split('.')[0],)
+            updated_files_list.append(updated_file)
+            (exitcode, err_msg) = call_fulltext(active_file,
+                                                updated_file,
+                                                identifiers,
+                                                downloaded_material_dict,
+                                                source_id)
+            if exitcode == 0:
+                write_message("fulltext from %s was successfully attached" % \
+                              (active_file,))
+            else:
+                write_message("an error occurred while attaching fulltext to %s:\n%s" % \
+                              (active_file, err_msg))
+                error_happened_p = 2
+                continue
+        # print stats:
+        for updated_file in updated_files_list:
+            write_message("File %s contains %i records." % \
+                          (updated_file,
+                           get_nb_records_in_file(updated_file)))
+        active_files_list = updated_files_list
+        write_message("full-text attachment step ended")
+    # Filter-phase
+    if 'f' in postmode:
+        write_message("filtering step started")
+        # first call bibfilter:
+        res = 0
+        i = 0
+        for active_file in active_files_list:
+            i += 1
+            sleep_fnc()
+            task_update_progress("Filtering material harvested from %s (%i/%i)" % \
+                                 (reponame, \
+                                  i, \
+                                  len(active_files_list)))
+            (exitcode, err_msg) = call_bibfilter(bibfilterprogram, active_file)
+
+            if exitcode == 0:
+                write_message("%s was successfully bibfiltered" % \
+                              (active_file,))
+            else:
+                write_message("an error occurred while bibfiltering %s:\n%s" % \
+                              (active_file, err_msg))
+                error_happened_p = 2
+                continue
+        # print stats:
+        for active_file in active_files_list:
+            write_message("File %s contains %i records." % \
+                (active_file + ".insert.xml",
+                get_nb_records_in_file(active_file + ".insert.xml")))
+            write_message("File %s contains %i records." % \
+                (active_file + ".correct.xml",
+                get_nb_records_in_file(active_file + ".correct.xml")))
+            write_message("File %s contains %i records." % \
+                (active_file + ".append.xml",
+                get_nb_records_in_file(active_file + ".append.xml")))
+            write_message("File %s contains %i records." % \
+                (active_file + ".holdingpen.xml",
+                get_nb_records_in_file(active_file + ".holdingpen.xml")))
+        write_message("filtering step ended")
+    # Upload files
+    if "u" in postmode:
+        write_message("upload step started")
+        if 'f' in postmode:
+            upload_modes = [('.insert.xml', '-i'),
+                            ('.correct.xml', '-c'),
+                            ('.append.xml', '-a'),
+                            ('.holdingpen.xml', '-o')]
+        else:
+            upload_modes = [('', '-ir')]
+
+        i = 0
+        last_upload_task_id = -1
+        for active_file in active_files_list:
+            sleep_fnc()
+            i += 1
+            task_update_progress("Uploading records harvested from %s (%i/%i)" % \
+                                (reponame, \
+                                 i, \
+                                 len(active_files_list)))
+            for suffix, mode in upload_modes:
+                upload_filename = active_file + suffix
+                if get_nb_records_in_file(upload_filename) == 0:
+                    continue
+                last_upload_task_id = call_bibupload(upload_filename, \
+                                                     [mode], \
+                                                     source_id, \
+                                                     sequence_id)
+                if not last_upload_task_id:
+                    error_happened_p = 2
+                    write_message("an error occurred while uploading %s from %s" % \
+                                  (upload_filename, reponame))
+                    break
+            else:
+                write_message("material harvested from source %s was successfully uploaded" % \
+                              (reponame,))
+        if len(active_files_list) > 0:
+            write_message("nothing to upload")
+        write_message("upload step ended")
+
+    write_message("post-harvest processes ended")
+    return error_happened_p
+
 def collect_identifiers(harvested_file_list):
     """Collects all OAI PMH identifiers from each file in the list
     and adds them to a list of identifiers per file.
@@ -574,11 +712,14 @@ def collect_identifiers(harvested_file_list):
         result.append(REGEXP_OAI_ID.findall(data))
     return result
 
-def remove_duplicates(harvested_file_list):
+def remove_duplicates(harvested_file_list, harvested_identifiers=None):
     """
     Go through a list of harvested files and remove any duplicate records.
+    HARVESTED_IDENTIFIERS is the set of the OAI IDs of the records
+    already kept, e.g. in previously harvested files; it is updated.
     """
-    harvested_identifiers = []
+    if harvested_identifiers is None:
+        harvested_identifiers = set()
     for harvested_file in harvested_file_list:
         # Firstly, rename original file to temporary name
         try:
@@ -606,7 +747,7 @@ def remove_duplicates(harvested_file_list):
             oai_identifier = REGEXP_OAI_ID.search(record)
             if oai_identifier != None and oai_identifier.group(1) not in harvested_identifiers:
                 updated_harvested_file.write("<record>%s</record>\n" % (record,))
-                harvested_identifiers.append(oai_identifier.group(1))
+                harvested_identifiers.add(oai_identifier.group(1))
         updated_harvested_file.write("</ListRecords>\n</OAI-PMH>\n")
         updated_harvested_file.close()
 
@@ -643,20 +784,8 @@ def oai_harvest_get(prefix, baseurl, harvestpath,
     Retrieve OAI records from given repository, with given arguments
     """
     try:
-        (addressing_scheme, network_location, path, dummy1, \
-         dummy2, dummy3) = urlparse.urlparse(baseurl)
-        secure = (addressing_scheme == "https")
-
-        http_param_dict = {'verb': "ListRecords",
-                           'metadataPrefix': prefix}
-        if fro:
-            http_param_dict['from'] = fro
-        if until:
-            http_param_dict['until'] = until
-        sets = None
-        if setspecs:
-            sets = [oai_set.strip() for oai_set in setspecs.split(' ')]
-
+        network_location, path, secure, http_param_dict, sets = \
+            get_harvest_parameters(prefix, baseurl, fro, until, setspecs)
         harvested_files = oai_harvest_getter.harvest(network_location, path, http_param_dict, method, harvestpath,
                                    sets, secure, user, password, cert_file, key_file)
         remove_duplicates(harvested_files)
@@ -664,6 +793,46 @@ def oai_harvest_get(prefix, baseurl, harvestpath,
     except (StandardError, oai_harvest_getter.InvenioOAIRequestError), e:
         return (0, e)
 
+def oai_harvest_iter(prefix, baseurl, harvestpath,
+                     fro=None, until=None, setspecs=None,
+                     user=None, password=None, cert_file=None,
+                     key_file=None, method="POST"):
+    """
+    Like oai_harvest_get(), but yield the harvested files one by one,
+    as soon as they are harvested, while the next ones are being
+    fetched.  Errors are raised.
+    """
+    network_location, path, secure, http_param_dict, sets = \
+        get_harvest_parameters(prefix, baseurl, fro, until, setspecs)
+    harvested_identifiers = set()
+    for harvested_file in oai_harvest_getter.iter_harvested_files(network_location, path,
+                                                                  http_param_dict, method,
+                                                                  harvestpath, sets, secure,
+                                                                  user, password,
+                                                                  cert_file, key_file):
+        remove_duplicates([harvested_file], harvested_identifiers)
+        yield harvested_file
+
+def get_harvest_parameters(prefix, baseurl, fro=None, until=None, setspecs=None):
+    """
+    Return server, script, security flag, OAI parameters and sets to
+    harvest repository at BASEURL with given arguments.
+    """
+    (addressing_scheme, network_location, path, dummy1, \
+     dummy2, dummy3) = urlparse.urlparse(baseurl)
+    secure = (addressing_scheme == "https")
+
+    http_param_dict = {'verb': "ListRecords",
+                       'metadataPrefix': prefix}
+    if fro:
+        http_param_dict['from'] = fro
+    if until:
+        http_param_dict['until'] = until
+    sets = None
+    if setspecs:
+        sets = [oai_set.strip() for oai_set in setspecs.split(' ')]
+    return network_location, path, secure, http_param_dict, sets
+
 def call_bibconvert(config, harvestpath, convertpath):
     """ Call BibConvert to convert file given at 'harvestpath' with
     conversion template 'config', and save the result in file at
@@ -1548,6 +1717,8 @@ def main():
     # mode.
     task_set_option("repository", None)
     task_set_option("dates", None)
+    task_set_option("parallel", 1)
+    task_set_option("pipeline", False)
     task_init(authorization_action='runoaiharvest',
               authorization_msg="oaiharvest Task Submission",
               description="""
@@ -1578,6 +1749,9 @@ Automatic (periodical) harvesting mode:
    Harvest in 10 minutes from 'pubmed' repository records added/modified
    between 2005-05-05 and 2005-05-10:
      $ oaiharvest -r pubmed -d 2005-05-05:2005-05-10 -t 10m
+   Harvest all repositories, 4 at a time, processing harvested records
+   while the next ones are being downloaded:
+     $ oaiharvest --parallel=4 --pipeline
 """,
             help_specific_usage='Manual single-shot harvesting mode:\n'
               '  -o, --output         specify output file\n'
@@ -1595,9 +1769,11 @@ Automatic (periodical) harvesting mode:
               '  -w, --password       password (in case of password-protected harvesting)\n'
               'Automatic periodical harvesting mode:\n'
               '  -r, --repository="repo A"[,"repo B"] \t which repositories to harvest (default=all)\n'
-              '  -d, --dates=yyyy-mm-dd:yyyy-mm-dd \t reharvest given dates only\n',
+              '  -d, --dates=yyyy-mm-dd:yyyy-mm-dd \t reharvest given dates only\n'
+              '  --parallel=N \t\t\t\t harvest N repositories at a time (default=1)\n'
+              '  --pipeline \t\t\t\t process harvested records while the next ones are downloaded\n',
             version=__revision__,
-            specific_params=("r:d:", ["repository=", "dates=", ]),
+            specific_params=("r:d:", ["repository=", "dates=", "parallel=", "pipeline"]),
             task_submit_elaborate_specific_parameter_fnc=
                 task_submit_elaborate_specific_parameter,
             task_run_fnc=task_run_core)
@@ -1610,6 +1786,15 @@ def task_submit_elaborate_specific_parameter(key, value, opts, args):
         task_set_option('dates', get_dates(value))
         if value is not None and task_get_option("dates") is None:
             raise StandardError, "Date format not valid."
+    elif key in ("--parallel", ):
+        try:
+            task_set_option('parallel', int(value))
+        except ValueError:
+            raise StandardError, "Number of parallel harvests not valid."
+        if task_get_option('parallel') < 1:
+            raise StandardError, "Number of parallel harvests not valid."
+    elif key in ("--pipeline", ):
+        task_set_option('pipeline', True)
     else:
         return False
     return True
@@ -35,12 +35,15 @@ try:
     import base64
     import tempfile
     import os
+    import threading
+    import Queue
 except ImportError, e:
     print "Error: %s" % e
     sys.exit(1)
 
 try:
     from invenio.config import CFG_SITE_ADMIN_EMAIL, CFG_VERSION
+    from invenio.oai_harvest_config import CFG_OAI_HARVEST_PREFETCH_PAGES
 except ImportError, e:
     print "Error: %s" % e
     sys.exit(1)
@@ -76,9 +79,106 @@ def http_request_parameters(http_param_dict, method="POST"):
 
     return urllib.urlencode(http_param_dict)
 
+def iter_OAI_pages(server, script, http_param_dict, method="POST",
+                   secure=False, user=None, password=None,
+                   cert_file=None, key_file=None):
+    """Yield the successive answers of one OAI session (1 request,
+    which might lead to multiple answers because of resumption
+    tokens)."""
+    while True:
+        harvested_data = OAI_Request(server, script,
+                                     http_request_parameters(http_param_dict, method), method,
+                                     secure, user, password,
+                                     key_file=key_file, cert_file=cert_file)
+        yield harvested_data
+        rt_obj = re.search('<resumptionToken.*>(.+)</resumptionToken>',
+            harvested_data, re.DOTALL)
+        if rt_obj is not None and rt_obj != "":
+            http_param_dict = http_param_resume(http_param_dict, rt_obj.group(1))
+        else:
+            break
+
+def prefetch_pages(pages, pages_queue, stopped):
+    """Put the items of iterator PAGES into PAGES_QUEUE, as (True,
+    page) tuples, followed by None.  If the iteration fails, put
+    (False, exc_info) instead.  Give up if STOPPED gets set."""
+    def put(item):
+        while not stopped.isSet():
+            try:
+                pages_queue.put(item, True, 1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    try:
+        for page in pages:
+            if not put((True, page)):
+                return
+    except:
+        put((False, sys.exc_info()))
+        return
+    put(None)
+
+class PagePrefetcher(object):
+    """Iterator over the items of iterator PAGES, which are fetched by
+    a background thread up to SIZE items ahead, so that the next pages
+    of a harvest are downloaded while the current one is processed.
+    Exceptions are raised to the consumer when it reaches them."""
+
+    def __init__(self, pages, size=1):
+        self.pages_queue = Queue.Queue(size)
+        self.stopped = threading.Event()
+        self.finished = False
+        thread = threading.Thread(target=prefetch_pages,
+                                  args=(pages, self.pages_queue, self.stopped))
+        thread.setDaemon(True)
+        thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the next page."""
+        if self.finished:
+            raise StopIteration
+        item = self.pages_queue.get()
+        if item is None:
+            self.finished = True
+            raise StopIteration
+        ok, value = item
+        if not ok:
+            self.finished = True
+            raise value[0], value[1], value[2]
+        return value
+
+    def close(self):
+        """Stop fetching pages."""
+        self.finished = True
+        self.stopped.set()
+
+    def __del__(self):
+        self.close()
+
+def save_harvested_data(harvested_data, verb, output, i):
+    """Save HARVESTED_DATA into a new file whose path starts with
+    OUTPUT and ends with sequence number I, and return its path.  If
+    there are no records in the data, return None."""
+    output_path, output_name = os.path.split(output)
+    if harvested_data.lower().find('<'+verb.lower()) > -1:
+        output_fd, output_filename = tempfile.mkstemp(suffix="_%07d.harvested" % (i,), \
+                                                      prefix=output_name, dir=output_path)
+        os.write(output_fd, harvested_data)
+        os.close(output_fd)
+        return output_filename
+    else:
+        # No records in output? Do not create a file. Warn the user.
+        sys.stderr.write("\n<!--\n*** WARNING: NO RECORDS IN THE HARVESTED DATA: "
+                         +  "\n" + repr(harvested_data) + "\n***\n-->\n")
+        return None
+
 def OAI_Session(server, script, http_param_dict , method="POST", output="",
                 resume_request_nbr=0, secure=False, user=None, password=None,
-                cert_file=None, key_file=None):
+                cert_file=None, key_file=None, prefetch=0):
     """Handle one OAI session (1 request, which might lead
     to multiple answers because of resumption tokens)
 
@@ -86,6 +186,9 @@ def OAI_Session(server, script, http_param_dict , method="POST", output="",
     in corresponding filepath, with a unique number appended at the end.
     This number starts at 'resume_request_nbr'.
 
+    If prefetch is given, up to that many answers are fetched in
+    advance while the current one is saved.
+
     Returns a tuple containing an int corresponding to the last created 'resume_request_nbr' and
     a list of harvested files.
     """
@@ -94,41 +197,58 @@ def OAI_Session(server, script, http_param_dict , method="POST", output="",
     sys.stderr.write("%s - %s\n" % (server,
         http_request_parameters(http_param_dict)))
 
-    output_path, output_name = os.path.split(output)
     harvested_files = []
-    i = resume_request_nbr
-    while True:
-        harvested_data = OAI_Request(server, script,
-                                     http_request_parameters(http_param_dict, method), method,
-                                     secure, user, password, cert_file, key_file)
+    i = resume_request_nbr - 1
+    pages = iter_OAI_pages(server, script, http_param_dict, method,
+                           secure, user, password, cert_file, key_file)
+    if prefetch:
+        pages = PagePrefetcher(pages, prefetch)
+    for harvested_data in pages:
+        i = i + 1
         if output:
             # Write results to a file specified by 'output'
-            if harvested_data.lower().find('<'+http_param_dict['verb'].lower()) > -1:
-                output_fd, output_filename = tempfile.mkstemp(suffix="_%07d.harvested" % (i,), \
-                                                              prefix=output_name, dir=output_path)
-                os.write(output_fd, harvested_data)
-                os.close(output_fd)
+            output_filename = save_harvested_data(harvested_data,
+                                                  http_param_dict['verb'],
+                                                  output, i)
+            if output_filename:
                 harvested_files.append(output_filename)
-            else:
-                # No records in output? Do not create a file. Warn the user.
-                sys.stderr.write("\n<!--\n*** WARNING: NO RECORDS IN THE HARVESTED DATA: "
-                                 +  "\n" + repr(harvested_data) + "\n***\n-->\n")
         else:
             sys.stdout.write(harvested_data)
 
-        rt_obj = re.search('<resumptionToken.*>(.+)</resumptionToken>',
-            harvested_data, re.DOTALL)
-        if rt_obj is not None and rt_obj != "":
-            http_param_dict = http_param_resume(http_param_dict, rt_obj.group(1))
-            i = i + 1
-        else:
-            break
-
     return i, harvested_files
 
+def iter_harvested_files(server, script, http_param_dict, method="POST",
+                         output="", sets=None, secure=False, user=None,
+                         password=None, cert_file=None, key_file=None,
+                         prefetch=CFG_OAI_HARVEST_PREFETCH_PAGES):
+    """
+    Like harvest(), but yield the path of each harvested file as soon
+    as it is saved, while the following answers of the repository are
+    fetched in the background.  OUTPUT must be given.
+    """
+    i = 0
+    for set in sets or [None]:
+        if set is not None:
+            http_param_dict['set'] = set
+        sys.stderr.write("Starting the harvesting session at %s" %
+            time.strftime("%Y-%m-%d %H:%M:%S --> ", time.localtime()))
+        sys.stderr.write("%s - %s\n" % (server,
+            http_request_parameters(http_param_dict)))
+        pages = iter_OAI_pages(server, script, http_param_dict, method,
+                               secure, user, password, cert_file, key_file)
+        if prefetch:
+            pages = PagePrefetcher(pages, prefetch)
+        for harvested_data in pages:
+            output_filename = save_harvested_data(harvested_data,
+                                                  http_param_dict['verb'],
+                                                  output, i)
+            i = i + 1
+            if output_filename:
+                yield output_filename
+
 def harvest(server, script, http_param_dict , method="POST", output="",
             sets=None, secure=False, user=None, password=None,
-            cert_file=None, key_file=None):
+            cert_file=None, key_file=None, prefetch=0):
     """
     Handle multiple OAI sessions (multiple requests, which might lead to
     multiple answers).
@@ -186,6 +306,10 @@ http_param_dict - *dict* the URL parameters to send to the OAI script
                   key in case the server to harvest requires
                   certificate-based authentication
                   (If provided, 'key_file' must also be provided)
+
+       prefetch - *int* how many answers of the server to fetch in
+                  advance while the current one is saved (0 to
+                  disable)
     """
     if sets:
         resume_request_nbr = 0
@@ -194,7 +318,7 @@ http_param_dict - *dict* the URL parameters to send to the OAI script
             http_param_dict['set'] = set
             resume_request_nbr, harvested_files = OAI_Session(server, script, http_param_dict, method,
                             output, resume_request_nbr, secure, user, password,
-                            cert_file, key_file)
+                            cert_file, key_file, prefetch)
             resume_request_nbr += 1
             all_harvested_files.extend(harvested_files)
         return all_harvested_files
@@ -202,7 +326,7 @@ http_param_dict - *dict* the URL parameters to send to the OAI script
         dummy, harvested_files = OAI_Session(server, script, http_param_dict, method,
                     output, secure=secure, user=user,
                     password=password, cert_file=cert_file,
-                    key_file=key_file)
+                    key_file=key_file, prefetch=prefetch)
         return harvested_files
 
 def OAI_Request(server, script, params, method="POST", secure=False,
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for the OAI harvest getter, run against a local stand-in
+OAI repository."""
+
+__revision__ = "$Id$"
+
+import cgi
+import os
+import shutil
+import tempfile
+import threading
+import time
+import BaseHTTPServer
+
+from invenio.testutils import InvenioTestCase
+
+from invenio import oai_harvest_getter
+from invenio.testutils import make_test_suite, run_test_suite
+
+NB_PAGES = 4
+NB_RECORDS_PER_PAGE = 3
+
+def get_page(page):
+    """Return answer number PAGE of the stand-in repository."""
+    records = ''.join(['<record><header><identifier>oai:test:%i</identifier></header></record>' % \
+                       (page * NB_RECORDS_PER_PAGE + i) for i in range(NB_RECORDS_PER_PAGE)])
+    if page + 1 < NB_PAGES:
+        token = '<resumptionToken>page%i</resumptionToken>' % (page + 1)
+    else:
+        token = '<resumptionToken/>'
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<OAI-PMH><ListRecords>%s%s</ListRecords></OAI-PMH>\n' % \
+           (records, token)
+
+class StandInOAIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve NB_PAGES pages of records, following resumption tokens."""
+
+    def do_POST(self):
+        """Answer ListRecords requests."""
+        params = cgi.parse_qs(self.rfile.read(int(self.headers['Content-Length'])))
+        token = params.get('resumptionToken', ['page0'])[0]
+        self.server.requests.append((time.time(), token))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        data = get_page(int(token[4:]))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        """Be quiet."""
+        pass
+
+class TestHarvesting(InvenioTestCase):
+    """Test harvesting from a local stand-in OAI repository."""
+
+    def setUp(self):
+        """Start the repository and create temporary directory."""
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StandInOAIRequestHandler)
+        self.server.requests = []
+        self.server.delay = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.address = '127.0.0.1:%i' % self.server.server_address[1]
+        self.dirname = tempfile.mkdtemp()
+        self.http_proxy = os.environ.pop('http_proxy', None)
+
+    def tearDown(self):
+        """Stop the repository and remove temporary directory."""
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dirname)
+        if self.http_proxy is not None:
+            os.environ['http_proxy'] = self.http_proxy
+
+    def test_harvest(self):
+        """oaiharvest - harvesting with and without prefetching"""
+        for prefetch in (0, 2):
+            files = oai_harvest_getter.harvest(self.address, '/oai2d',
+                                               {'verb': 'ListRecords', 'metadataPrefix': 'marcxml'},
+                                               output=os.path.join(self.dirname, 'prefetch%i_' % prefetch),
+                                               prefetch=prefetch)
+            self.assertEqual([open(filename).read() for filename in files],
+                             [get_page(page) for page in range(NB_PAGES)])
+
+    def test_iter_harvested_files(self):
+        """oaiharvest - prefetching pages while files are processed"""
+        self.server.delay = 0.1
+        files = oai_harvest_getter.iter_harvested_files(self.address, '/oai2d',
+                                                        {'verb': 'ListRecords', 'metadataPrefix': 'marcxml'},
+                                                        output=os.path.join(self.dirname, 'pipeline_'),
+                                                        prefetch=1)
+        contents = []
+        for filename in files:
+            contents.append(open(filename).read())
+            time.sleep(0.3)
+            if len(contents) < NB_PAGES:
+                ## the next page was fetched in the meantime
+                self.assert_(len(self.server.requests) > len(contents))
+        self.assertEqual(contents, [get_page(page) for page in range(NB_PAGES)])
+
+    def test_prefetcher_errors(self):
+        """oaiharvest - errors raised while prefetching pages"""
+        def pages():
+            yield 'page0'
+            raise oai_harvest_getter.InvenioOAIRequestError('no more pages')
+        prefetcher = oai_harvest_getter.PagePrefetcher(pages())
+        self.assertEqual(prefetcher.next(), 'page0')
+        self.assertRaises(oai_harvest_getter.InvenioOAIRequestError, prefetcher.next)
+        self.assertRaises(StopIteration, prefetcher.next)
+
+TEST_SUITE = make_test_suite(TestHarvesting,)
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE)
@@ -26,3 +26,16 @@ CFG_OAI_REPOSITORY_MARCXML_SIZE = 1000
 ## Makefile.am and tabcreate.sql defaults for setSpec column in
 ## oaiREPOSITORY MySQL table.
 CFG_OAI_REPOSITORY_GLOBAL_SET_SPEC = "GLOBAL_SET"
+
+## Number of records of a ListRecords or ListIdentifiers response whose
+## identifiers, sets, datestamps and metadata are fetched together
+CFG_OAI_REPOSITORY_BATCH_SIZE = 100
+
+## Resumption tokens are grouped in directories of CFG_CACHEDIR/RTdata
+## by period of this many seconds, so that expired tokens are removed
+## directory by directory
+CFG_OAI_REPOSITORY_RT_BUCKET_SIZE = 3600
+
+## Number of harvests whose date-filtered list of records is kept in
+## memory between the requests of a harvester
+CFG_OAI_REPOSITORY_RT_CACHE_SIZE = 16
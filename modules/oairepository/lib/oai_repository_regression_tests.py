@@ -34,7 +34,7 @@ from invenio.config import CFG_SITE_URL, \
      CFG_OAI_ID_FIELD
 from invenio.dbquery import run_sql
 from invenio.intbitset import intbitset
-from invenio import oai_repository_server, search_engine
+from invenio import oai_repository_server, oai_repository_updater, search_engine
 from invenio.testutils import make_test_suite, run_test_suite, \
                               test_web_page_content, merge_error_messages
 
@@ -178,6 +178,14 @@ class TestSelectiveHarvesting(InvenioTestCase):
 
         self.assert_('badResumptionToken' in req.getvalue())
 
+    def test_batched_printing(self):
+        """oairepository - batched printing of records"""
+        recids = list(oai_repository_server.oai_get_recid_list())
+        for verb in ('ListRecords', 'ListIdentifiers'):
+            for prefix in ('marcxml', 'oai_dc'):
+                self.assertEqual([oai_repository_server.print_record(recid, prefix, verb) for recid in recids],
+                                 list(oai_repository_server.print_records(recids, prefix, verb)))
+
 class TestPerformance(InvenioTestCase):
     """Test performance of the repository """
 
@@ -214,11 +222,84 @@ Limit: %s seconds""" % (t, self.number_of_records * allowed_seconds_per_record_o
 %s seconds.
 Limit: %s seconds""" % (t, self.number_of_records * allowed_seconds_per_record_marcxml))
 
+class TestSetMembership(InvenioTestCase):
+    """Test the set membership computed by the updater."""
+
+    def test_set_definitions(self):
+        """oairepository - set definitions evaluated like searches"""
+        all_recids = intbitset(run_sql("SELECT id FROM bibrec"))
+        for set_spec in oai_repository_updater.all_set_specs():
+            expected = intbitset()
+            for set_def in oai_repository_updater.get_set_definitions(set_spec):
+                expected |= search_engine.perform_request_search(
+                    c=[coll.strip() for coll in set_def['c'].split(',')],
+                    p1=set_def['p1'], f1=set_def['f1'], m1=set_def['m1'], op1=set_def['op1'],
+                    p2=set_def['p2'], f2=set_def['f2'], m2=set_def['m2'], op2=set_def['op2'],
+                    p3=set_def['p3'], f3=set_def['f3'], m3=set_def['m3'],
+                    ap=0, of='intbitset')
+            self.assertEqual(oai_repository_updater.get_recids_for_set_spec(set_spec), expected)
+            self.assertEqual(oai_repository_updater.get_recids_for_set_spec(set_spec, all_recids), expected)
+
+    def test_unwashed_set_definitions(self):
+        """oairepository - set definitions washed like searches"""
+        set_id = run_sql("""INSERT INTO oaiREPOSITORY (setName, setSpec,
+                            setCollection, setDescription, setDefinition,
+                            setRecList, p1, f1, m1, p2, f2, m2, p3, f3, m3)
+                            VALUES ('Unwashed', 'test:unwashed', '', '',
+                            'c=;p1= Ellis ;f1=Author;m1=a;op1=o;p2=muon;f2= Title ;m2=a;op2=a;p3=;f3=;m3=;',
+                            NULL, '', '', '', '', '', '', '', '', '')""")
+        try:
+            expected = search_engine.perform_request_search(
+                c=[''], p1=' Ellis ', f1='Author', m1='a', op1='o',
+                p2='muon', f2=' Title ', m2='a', ap=0, of='intbitset')
+            self.failUnless(expected)
+            self.assertEqual(oai_repository_updater.get_recids_for_set_spec('test:unwashed'), expected)
+        finally:
+            run_sql("DELETE FROM oaiREPOSITORY WHERE id=%s", (set_id, ))
+
+    def test_indexes_last_updated(self):
+        """oairepository - update date of the indexes searched by sets"""
+        ## cern:experiment searches the reportnumber index and the
+        ## division field, which has no index
+        expected = run_sql("""SELECT DATE_FORMAT(last_updated, '%Y-%m-%d %H:%i:%s')
+                              FROM idxINDEX WHERE name='reportnumber'""")[0][0]
+        self.assertEqual(oai_repository_updater.get_set_indexes_last_updated(['cern:experiment']),
+                         expected)
+        self.assertEqual(oai_repository_updater.get_set_indexes_last_updated(['nonExistingSet']),
+                         None)
+
+    def test_incremental_update(self):
+        """oairepository - incremental update equal to full recompute"""
+        membership = oai_repository_updater.get_set_membership()
+        self.failUnless(membership['should'])
+        ## records 1-20 as if modified since the previous run, records
+        ## 41-60 as if they had entered their collections since then,
+        ## and a set as if its definitions had changed
+        modified = intbitset(range(1, 21))
+        moved = intbitset(range(41, 61))
+        previous = {'definitions': dict(membership['definitions']),
+                    'should': {},
+                    'current': {},
+                    'collections': {},
+                    'all_current': membership['all_current'] - modified,
+                    'with_oaiid': membership['with_oaiid'] - modified}
+        for set_spec, recids in membership['should'].iteritems():
+            previous['should'][set_spec] = recids - modified - moved
+        for set_spec, recids in membership['current'].iteritems():
+            previous['current'][set_spec] = recids - modified
+        for coll, recids in membership['collections'].iteritems():
+            previous['collections'][coll] = recids - moved
+        set_spec = membership['should'].keys()[0]
+        previous['definitions'][set_spec] = ''
+        previous['should'][set_spec] = intbitset()
+        self.assertEqual(oai_repository_updater.update_set_membership(previous, modified),
+                         membership)
 
 TEST_SUITE = make_test_suite(OAIRepositoryTouchSetTest,
                              OAIRepositoryWebPagesAvailabilityTest,
                              TestSelectiveHarvesting,
-                             TestPerformance)
+                             TestPerformance,
+                             TestSetMembership)
 
 if __name__ == "__main__":
     run_test_suite(TEST_SUITE, warn_user=True)
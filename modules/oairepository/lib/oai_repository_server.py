@@ -25,7 +25,10 @@ import re
 import time
 import datetime
 import tempfile
+import shutil
 import sys
+from array import array
+from bisect import bisect_right
 if sys.hexversion < 0x2050000:
     from glob import glob as iglob
 else:
@@ -59,12 +62,22 @@ from invenio.config import \
 
 from invenio.intbitset import intbitset
 from invenio.htmlutils import X, EscapedXMLString
-from invenio.dbquery import run_sql, wash_table_column_name
-from invenio.search_engine import record_exists, get_all_restricted_recids, get_all_field_values, search_unit_in_bibxxx, get_record
+from invenio.dbquery import run_sql, wash_table_column_name, get_table_update_time
+from invenio.search_engine import record_exists, get_all_restricted_recids, get_all_field_values, search_unit_in_bibxxx, get_record, \
+     records_exist, get_records, prefetch_records, clear_prefetched_records
+from invenio.search_engine_date_index import get_recids_modified_between
 from invenio.bibformat import format_record
 from invenio.bibrecord import record_get_field_instances
 from invenio.errorlib import register_exception
-from invenio.oai_repository_config import CFG_OAI_REPOSITORY_GLOBAL_SET_SPEC
+from invenio.oai_repository_config import CFG_OAI_REPOSITORY_GLOBAL_SET_SPEC, \
+     CFG_OAI_REPOSITORY_BATCH_SIZE, \
+     CFG_OAI_REPOSITORY_RT_BUCKET_SIZE, \
+     CFG_OAI_REPOSITORY_RT_CACHE_SIZE
+
+CFG_OAI_RT_DIR = os.path.join(CFG_CACHEDIR, 'RTdata')
+_UINT32 = 'I'
+if array(_UINT32).itemsize != 4:
+    _UINT32 = 'L'
 
 CFG_VERBS = {
     'GetRecord'          : ['identifier', 'metadataPrefix'],
@@ -163,6 +176,28 @@ def get_field(recid, field):
 
     return [row[0] for row in run_sql(query, (recid, field))]
 
+def get_fields(recids, field):
+    """
+    Gets dictionary {recid: list of field 'field'} for the records of
+    the list 'recids', with one query.
+    """
+
+    out = {}
+    for recid in recids:
+        out[recid] = []
+    if not recids:
+        return out
+
+    digit = field[0:2]
+
+    bibbx = "bib%sx" % digit
+    bibx  = "bibrec_bib%sx" % digit
+    query = "SELECT bibx.id_bibrec, bx.value FROM %s AS bx, %s AS bibx WHERE bibx.id_bibrec IN (%s) AND bx.id=bibx.id_bibxxx AND bx.tag=%%s" % (wash_table_column_name(bibbx), wash_table_column_name(bibx), ",".join(["%s"] * len(recids)))
+
+    for recid, value in run_sql(query, tuple(recids) + (field,)):
+        out[recid].append(value)
+    return out
+
 def utc_to_localtime(date):
     """
     Convert UTC to localtime
@@ -246,6 +281,20 @@ def get_modification_date(recid):
         out = localtime_to_utc(res[0][0])
     return out
 
+def get_modification_dates(recids):
+    """Returns dictionary {recid: date of last modification in UTC}
+    for the records of the list 'recids', with one query.
+    Records that do not exist are missing from the dictionary.
+    """
+    out = {}
+    if recids:
+        res = run_sql("SELECT id, DATE_FORMAT(modification_date,'%%Y-%%m-%%d %%H:%%i:%%s') FROM bibrec WHERE id IN (%s)" % \
+                      ",".join(["%s"] * len(recids)), tuple(recids))
+        for recid, modification_date in res:
+            if modification_date:
+                out[recid] = localtime_to_utc(modification_date)
+    return out
+
 def get_earliest_datestamp():
     """Get earliest datestamp in the database
     Return empty string if no records or earliest datestamp in UTC.
@@ -291,12 +340,14 @@ def normalize_date(date, dtime="T00:00:00Z"):
 
     return date
 
-def get_record_provenance(recid):
+def get_record_provenance(recid, record=None):
     """
     Return the provenance XML representation of a record, suitable to be put
-    in the about tag.
+    in the about tag.  RECORD may give the already loaded structure of
+    the record.
     """
-    record = get_record(recid)
+    if record is None:
+        record = get_record(recid)
     provenances = record_get_field_instances(record, CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG[:3], CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG[3], CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG[4])
     out = ""
     for provenance in provenances:
@@ -375,9 +426,68 @@ def print_record(recid, prefix='marcxml', verb='ListRecords', set_spec=None, set
 
     """
 
-    record_exists_result = record_exists(recid) == 1
+    return _print_record(recid, record_exists(recid) == 1, get_field, get_modification_date,
+                         prefix, verb, set_spec, set_last_updated)
+
+def print_records(recids, prefix='marcxml', verb='ListRecords', set_spec=None, set_last_updated=None):
+    """Yields records of the list 'recids' formatted according to
+    'prefix', as print_record() would do, but fetching the identifiers,
+    sets, datestamps, provenance and metadata of
+    CFG_OAI_REPOSITORY_BATCH_SIZE records at a time with a few bulk
+    queries, so that they can be streamed out.
+    """
+
+    recids = list(recids)
+    for i in range(0, len(recids), CFG_OAI_REPOSITORY_BATCH_SIZE):
+        batch = recids[i:i + CFG_OAI_REPOSITORY_BATCH_SIZE]
+        prefetched = []
+        out = []
+        try:
+            if verb == 'ListIdentifiers':
+                existence = records_exist(batch)
+            else:
+                prefetched = prefetch_records(batch, of=CFG_OAI_METADATA_FORMATS[prefix][0])
+                existence = dict([(recid, record_exists(recid)) for recid in batch])
+            fields = {CFG_OAI_SET_FIELD: get_fields(batch, CFG_OAI_SET_FIELD),
+                      CFG_OAI_ID_FIELD: get_fields(batch, CFG_OAI_ID_FIELD)}
+            dates = get_modification_dates(batch)
+            provenance_records = {}
+            if verb != 'ListIdentifiers':
+                ## only records having a provenance baseURL need to be loaded:
+                provenance_field = CFG_BIBUPLOAD_EXTERNAL_OAIID_TAG[:5] + CFG_OAI_PROVENANCE_BASEURL_SUBFIELD
+                provenance_recids = [recid for recid, values in get_fields(batch, provenance_field).iteritems()
+                                     if values and existence[recid] == 1]
+                provenance_records = get_records(provenance_recids, compact=True)
+            def get_batch_field(recid, field):
+                "Return field 'field' of record 'recid' of the batch."
+                return fields[field][recid]
+            def get_batch_modification_date(recid):
+                "Return modification date of record 'recid' of the batch."
+                return dates.get(recid, "")
+            def get_batch_record_provenance(recid):
+                "Return provenance of record 'recid' of the batch."
+                if recid in provenance_records:
+                    return get_record_provenance(recid, provenance_records[recid])
+                return ""
+            for recid in batch:
+                out.append(_print_record(recid, existence[recid] == 1, get_batch_field,
+                                         get_batch_modification_date, prefix, verb, set_spec,
+                                         set_last_updated, get_batch_record_provenance))
+        finally:
+            clear_prefetched_records(prefetched)
+        for record in out:
+            yield record
+
+def _print_record(recid, record_exists_result, field_getter, modification_date_getter,
+                  prefix, verb, set_spec, set_last_updated, record_provenance_getter=get_record_provenance):
+    """Prints record 'recid' as described in print_record(), reading
+    its fields with 'field_getter' (see get_field()), its modification
+    date with 'modification_date_getter' (see get_modification_date())
+    and its provenance with 'record_provenance_getter' (see
+    get_record_provenance())."""
+
     if record_exists_result:
-        sets = get_field(recid, CFG_OAI_SET_FIELD)
+        sets = field_getter(recid, CFG_OAI_SET_FIELD)
         if set_spec is not None and not set_spec in sets and not [set_ for set_ in sets if set_.startswith("%s:" % set_spec)]:
             ## the record is not in the requested set, and is not
             ## in any subset
@@ -391,7 +501,7 @@ def print_record(recid, prefix='marcxml', verb='ListRecords', set_spec=None, set
     if not record_exists_result and CFG_OAI_DELETED_POLICY not in ('persistent', 'transient'):
         return ""
 
-    idents = get_field(recid, CFG_OAI_ID_FIELD)
+    idents = field_getter(recid, CFG_OAI_ID_FIELD)
     if not idents:
         return ""
     ## FIXME: Move these checks in a bibtask
@@ -409,10 +519,10 @@ def print_record(recid, prefix='marcxml', verb='ListRecords', set_spec=None, set
     header_body = EscapedXMLString('')
     header_body += X.identifier()(ident)
     if set_last_updated:
-        header_body += X.datestamp()(max(get_modification_date(recid), set_last_updated))
+        header_body += X.datestamp()(max(modification_date_getter(recid), set_last_updated))
     else:
-        header_body += X.datestamp()(get_modification_date(recid))
-    for set_spec in get_field(recid, CFG_OAI_SET_FIELD):
+        header_body += X.datestamp()(modification_date_getter(recid))
+    for set_spec in field_getter(recid, CFG_OAI_SET_FIELD):
         if set_spec and set_spec != CFG_OAI_REPOSITORY_GLOBAL_SET_SPEC:
             # Print only if field not empty
             header_body += X.setSpec()(set_spec)
@@ -425,7 +535,7 @@ def print_record(recid, prefix='marcxml', verb='ListRecords', set_spec=None, set
         if record_exists_result:
             metadata_body = format_record(recid, CFG_OAI_METADATA_FORMATS[prefix][0])
             metadata = X.metadata(body=metadata_body)
-            provenance_body = get_record_provenance(recid)
+            provenance_body = record_provenance_getter(recid)
             if provenance_body:
                 provenance = X.about(body=provenance_body)
             else:
@@ -465,7 +575,6 @@ def oai_list_records_or_identifiers(req, argd):
 
     verb = argd['verb']
     resumption_token_was_specified = False
-
     # check if the resumption_token did not expire
     if argd.get('resumptionToken'):
         resumption_token_was_specified = True
@@ -473,46 +582,60 @@ def oai_list_records_or_identifiers(req, argd):
             cache = oai_cache_load(argd['resumptionToken'])
             last_recid = cache['last_recid']
             argd = cache['argd']
-            complete_list = cache['complete_list']
-            complete_list = filter_out_based_on_date_range(complete_list, argd.get('from', ''), argd.get('until', ''))
+            if 'harvest' in cache:
+                harvest = cache['harvest']
+                complete_list = None
+                recids = oai_get_harvest_recids(harvest, argd)
+            else:
+                ## resumption token of a previous version
+                harvest = None
+                complete_list = filter_out_based_on_date_range(intbitset(cache['complete_list']), argd.get('from', ''), argd.get('until', ''))
+                recids = array(_UINT32, complete_list.tolist())
         except Exception:
             register_exception(alert_admin=True)
             req.write(oai_error(argd, [("badResumptionToken", "ResumptionToken expired or invalid: %s" % argd['resumptionToken'])]))
             return
+        ## fast-forward the cursor to point after the last recid that was
+        ## disseminated successfully
+        cursor = bisect_right(recids, last_recid)
+        page = recids[cursor:cursor+CFG_OAI_LOAD].tolist()
+        complete_list_size = len(recids)
     else:
-        last_recid = 0
+        harvest = None
         complete_list = oai_get_recid_list(argd.get('set', ""), argd.get('from', ""), argd.get('until', ""))
 
         if not complete_list: # noRecordsMatch error
             req.write(oai_error(argd, [("noRecordsMatch", "no records correspond to the request")]))
             return
-
-    cursor = 0
-    for cursor, recid in enumerate(complete_list):
-        ## Let's fast-forward the cursor to point after the last recid that was
-        ## disseminated successfully
-        if recid > last_recid:
-            break
+        cursor = 0
+        page = complete_list[:CFG_OAI_LOAD].tolist()
+        complete_list_size = len(complete_list)
 
     set_last_updated = get_set_last_update(argd.get('set', ""))
 
     req.write(oai_header(argd, verb))
-    for recid in list(complete_list)[cursor:cursor+CFG_OAI_LOAD]:
-        req.write(print_record(recid, argd['metadataPrefix'], verb=verb, set_spec=argd.get('set'), set_last_updated=set_last_updated))
+    for record in print_records(page, argd['metadataPrefix'], verb=verb, set_spec=argd.get('set'), set_last_updated=set_last_updated):
+        req.write(record)
 
-    if list(complete_list)[cursor+CFG_OAI_LOAD:]:
+    if cursor + CFG_OAI_LOAD < complete_list_size:
         resumption_token = oai_generate_resumption_token(argd.get('set', ''))
+        if harvest is None:
+            ## the list of records is stored once for all the resumption
+            ## tokens of the harvest
+            harvest = oai_store_harvest_recids(resumption_token, complete_list)
+        else:
+            harvest = oai_link_harvest_recids(harvest, resumption_token)
         cache = {
             'argd': argd,
-            'last_recid': recid,
-            'complete_list': complete_list.fastdump(),
+            'last_recid': page[-1],
+            'harvest': harvest,
         }
         oai_cache_dump(resumption_token, cache)
         expdate = oai_get_response_date(CFG_OAI_EXPIRE)
-        req.write(X.resumptionToken(expirationDate=expdate, cursor=cursor, completeListSize=len(complete_list))(resumption_token))
+        req.write(X.resumptionToken(expirationDate=expdate, cursor=cursor, completeListSize=complete_list_size)(resumption_token))
     elif resumption_token_was_specified:
         ## Since a resumptionToken was used we shall put a last empty resumptionToken
-        req.write(X.resumptionToken(cursor=cursor, completeListSize=len(complete_list))(""))
+        req.write(X.resumptionToken(cursor=cursor, completeListSize=complete_list_size)(""))
     req.write(oai_footer(verb))
     oai_cache_gc()
 
@@ -677,12 +800,8 @@ def filter_out_based_on_date_range(recids, fromdate="", untildate="", set_spec=N
 
     recids = intbitset(recids) ## Let's clone :-)
 
-    if fromdate and untildate:
-        recids &= intbitset(run_sql("SELECT id FROM bibrec WHERE modification_date BETWEEN %s AND %s", (fromdate, untildate)))
-    elif fromdate:
-        recids &= intbitset(run_sql("SELECT id FROM bibrec WHERE modification_date >= %s", (fromdate, )))
-    elif untildate:
-        recids &= intbitset(run_sql("SELECT id FROM bibrec WHERE modification_date <= %s", (untildate, )))
+    if fromdate or untildate:
+        recids &= get_recids_modified_between(fromdate or None, untildate or None)
     return recids - get_all_restricted_recids()
 
 def oai_get_recid_list(set_spec="", fromdate="", untildate=""):
@@ -706,48 +825,141 @@ def oai_get_recid_list(set_spec="", fromdate="", untildate=""):
             ret -= search_unit_in_bibxxx(p='DUMMY', f='980__%', type='e')
     return filter_out_based_on_date_range(ret, fromdate, untildate, set_spec)
 
+def _get_rt_bucket(now=None):
+    """Returns the name of the directory of CFG_OAI_RT_DIR holding the
+    resumption tokens generated at time 'now'."""
+    if now is None:
+        now = time.time()
+    return str(int(now / CFG_OAI_REPOSITORY_RT_BUCKET_SIZE))
+
+def _get_rt_path(resumption_token, suffix=''):
+    """Returns the path of the file of the resumption token, checking
+    that it lies in CFG_OAI_RT_DIR."""
+    bucket, name = '', resumption_token
+    if '-' in resumption_token:
+        bucket, name = resumption_token.split('-', 1)
+        if not bucket.isdigit():
+            ## resumption token of a previous version
+            bucket, name = '', resumption_token
+    fullpath = os.path.join(CFG_OAI_RT_DIR, bucket, name + suffix)
+    if os.path.dirname(os.path.abspath(fullpath)) != os.path.abspath(os.path.join(CFG_OAI_RT_DIR, bucket)) or \
+           os.path.basename(fullpath) != name + suffix:
+        raise ValueError("Invalid path")
+    return fullpath
+
 def oai_generate_resumption_token(set_spec):
     """Generates unique ID for resumption token management."""
-    fd, name = tempfile.mkstemp(dir=os.path.join(CFG_CACHEDIR, 'RTdata'), prefix='%s___' % set_spec)
+    bucket = _get_rt_bucket()
+    dirname = os.path.join(CFG_OAI_RT_DIR, bucket)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    fd, name = tempfile.mkstemp(dir=dirname, prefix='%s___' % set_spec)
     os.close(fd)
-    return os.path.basename(name)
+    return '%s-%s' % (bucket, os.path.basename(name))
 
 def oai_delete_resumption_tokens_for_set(set_spec):
     """
     In case a set is modified by the admin interface, this will delete
     any resumption token that is now invalid.
     """
+    prefixes = ['']
     aset = set_spec
     while aset:
-        for name in iglob(os.path.join(CFG_CACHEDIR, 'RTdata', '%s___*' % set_spec)):
-            os.remove(name)
+        prefixes.append(aset)
+        if ':' not in aset:
+            break
         aset = aset.rsplit(":", 1)[0]
-    for name in iglob(os.path.join(CFG_CACHEDIR, 'RTdata', '___*')):
-        os.remove(name)
+    for prefix in prefixes:
+        for pattern in (os.path.join(CFG_OAI_RT_DIR, '*', '%s___*' % prefix),
+                        os.path.join(CFG_OAI_RT_DIR, '%s___*' % prefix)):
+            for name in iglob(pattern):
+                os.remove(name)
 
 def oai_cache_dump(resumption_token, cache):
     """
     Given a resumption_token and the cache, stores the cache.
     """
-    cPickle.dump(cache, open(os.path.join(CFG_CACHEDIR, 'RTdata', resumption_token), 'w'), -1)
+    cPickle.dump(cache, open(_get_rt_path(resumption_token), 'w'), -1)
 
 def oai_cache_load(resumption_token):
     """
     Restores the cache from the resumption_token.
     """
-    fullpath = os.path.join(CFG_CACHEDIR, 'RTdata', resumption_token)
-    if os.path.dirname(os.path.abspath(fullpath)) != os.path.abspath(os.path.join(CFG_CACHEDIR, 'RTdata')):
-        raise ValueError("Invalid path")
-    return cPickle.load(open(fullpath))
+    return cPickle.load(open(_get_rt_path(resumption_token)))
+
+def oai_store_harvest_recids(resumption_token, recids):
+    """
+    Stores the intbitset 'recids' of the records of the harvest
+    started with the resumption_token, and returns the harvest
+    identifier to be put in the cache of its resumption tokens.
+    """
+    recids_file = open(_get_rt_path(resumption_token, '.recids'), 'wb')
+    recids_file.write(recids.fastdump())
+    recids_file.close()
+    return resumption_token
+
+def oai_link_harvest_recids(harvest, resumption_token):
+    """
+    Makes the records of the 'harvest' available to the new
+    resumption_token, and returns the harvest identifier to be put in
+    its cache.  The records are shared with the previous resumption
+    tokens of the harvest, and copied (linked) only when the new
+    resumption token expires in a different bucket.
+    """
+    bucket = resumption_token.split('-', 1)[0]
+    if harvest.split('-', 1)[0] == bucket:
+        return harvest
+    new_harvest = '%s-%s' % (bucket, harvest.split('-', 1)[1])
+    path = _get_rt_path(harvest, '.recids')
+    new_path = _get_rt_path(new_harvest, '.recids')
+    if not os.path.exists(new_path):
+        try:
+            os.link(path, new_path)
+        except (OSError, AttributeError):
+            shutil.copyfile(path, new_path)
+    return new_harvest
+
+## date-filtered lists of records of the current harvests, in this process:
+_harvest_recids_cache = {}
+
+def oai_get_harvest_recids(harvest, argd):
+    """
+    Returns the sorted array of the records of the 'harvest' that
+    match the date range of 'argd' (see filter_out_based_on_date_range()).
+    The arrays are cached in memory as long as records are neither
+    modified nor restricted.
+    """
+    key = (harvest.split('-', 1)[-1], argd.get('from', ''), argd.get('until', ''))
+    generation = (get_table_update_time('bibrec'), get_table_update_time('collection'))
+    if key in _harvest_recids_cache:
+        recids_generation, recids = _harvest_recids_cache[key]
+        if recids_generation == generation:
+            return recids
+    dump = open(_get_rt_path(harvest, '.recids'), 'rb').read()
+    complete_list = filter_out_based_on_date_range(intbitset(dump), argd.get('from', ''), argd.get('until', ''))
+    recids = array(_UINT32, complete_list.tolist())
+    if len(_harvest_recids_cache) >= CFG_OAI_REPOSITORY_RT_CACHE_SIZE:
+        _harvest_recids_cache.clear()
+    _harvest_recids_cache[key] = (generation, recids)
+    return recids
 
 def oai_cache_gc():
     """
     OAI Cache Garbage Collector.
     """
-    for file_ in os.listdir(os.path.join(CFG_CACHEDIR, 'RTdata')):
-        filename = os.path.join(os.path.join(CFG_CACHEDIR, 'RTdata', file_))
+    now = time.time()
+    for file_ in os.listdir(CFG_OAI_RT_DIR):
+        filename = os.path.join(CFG_OAI_RT_DIR, file_)
+        if file_.isdigit():
+            # a bucket expires when its latest token does
+            if (int(file_) + 1) * CFG_OAI_REPOSITORY_RT_BUCKET_SIZE + CFG_OAI_EXPIRE < now:
+                shutil.rmtree(filename, True)
         # cache entry expires when not modified during a specified period of time
-        if ((time.time() - os.path.getmtime(filename)) > CFG_OAI_EXPIRE):
+        elif ((now - os.path.getmtime(filename)) > CFG_OAI_EXPIRE):
             try:
                 os.remove(filename)
             except OSError, e:
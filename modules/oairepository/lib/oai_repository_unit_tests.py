@@ -23,11 +23,16 @@
 __revision__ = "$Id$"
 
 from invenio.testutils import InvenioTestCase
+import os
 import re
+import shutil
+import tempfile
+import time
 
 from cStringIO import StringIO
 
-from invenio import oai_repository_server
+from invenio import oai_repository_server, oai_repository_updater
+from invenio.intbitset import intbitset
 from invenio.testutils import make_test_suite, run_test_suite
 
 class TestVerbs(InvenioTestCase):
@@ -80,8 +85,72 @@ class TestErrorCodes(InvenioTestCase):
 
         self.assertNotEqual([], [code for (code, dummy_text) in oai_repository_server.check_argd({'verb': 'ListRecords', 'resumptionToken': ''}) if code == 'badResumptionToken'])
 
+class TestResumptionTokens(InvenioTestCase):
+    """Test for the resumption token store."""
+
+    def setUp(self):
+        """Use a temporary resumption token directory."""
+        self.saved_rt_dir = oai_repository_server.CFG_OAI_RT_DIR
+        oai_repository_server.CFG_OAI_RT_DIR = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the temporary resumption token directory."""
+        shutil.rmtree(oai_repository_server.CFG_OAI_RT_DIR)
+        oai_repository_server.CFG_OAI_RT_DIR = self.saved_rt_dir
+
+    def test_store(self):
+        """oairepository - storing resumption tokens and harvested records"""
+        token = oai_repository_server.oai_generate_resumption_token('cern:theory')
+        cache = {'argd': {'verb': 'ListRecords'}, 'last_recid': 3}
+        oai_repository_server.oai_cache_dump(token, cache)
+        self.assertEqual(oai_repository_server.oai_cache_load(token), cache)
+        harvest = oai_repository_server.oai_store_harvest_recids(token, intbitset([1, 3, 5]))
+        next_token = oai_repository_server.oai_generate_resumption_token('cern:theory')
+        self.assertEqual(oai_repository_server.oai_link_harvest_recids(harvest, next_token), harvest)
+        self.assertRaises(ValueError, oai_repository_server.oai_cache_load, '1-../../etc/passwd')
+        oai_repository_server.oai_delete_resumption_tokens_for_set('cern:theory')
+        self.assertRaises(IOError, oai_repository_server.oai_cache_load, token)
+
+    def test_gc(self):
+        """oairepository - expiring resumption tokens by bucket"""
+        expired_bucket = oai_repository_server._get_rt_bucket(time.time() - oai_repository_server.CFG_OAI_EXPIRE - \
+                                                              2 * oai_repository_server.CFG_OAI_REPOSITORY_RT_BUCKET_SIZE)
+        os.mkdir(os.path.join(oai_repository_server.CFG_OAI_RT_DIR, expired_bucket))
+        token = oai_repository_server.oai_generate_resumption_token('')
+        oai_repository_server.oai_cache_gc()
+        self.assertEqual(os.listdir(oai_repository_server.CFG_OAI_RT_DIR), [token.split('-')[0]])
+
+class TestSetMembership(InvenioTestCase):
+    """Test for the set membership saved between updater runs."""
+
+    def setUp(self):
+        """Create temporary directory."""
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove temporary directory."""
+        shutil.rmtree(self.dirname)
+
+    def test_storage(self):
+        """oairepository - reading and writing set membership"""
+        path = os.path.join(self.dirname, 'set_membership')
+        self.assertEqual(oai_repository_updater.read_set_membership(path), None)
+        membership = {'definitions': {'cern:theory': "[([('c', 'Theses')], ['Theses'])]"},
+                      'should': {'cern:theory': intbitset([1, 2])},
+                      'current': {'cern:theory': intbitset([2, 3])},
+                      'collections': {'Theses': intbitset([1, 2, 4])},
+                      'all_current': intbitset([2, 3]),
+                      'with_oaiid': intbitset([1, 2, 3])}
+        oai_repository_updater.write_set_membership(membership, '2013-01-31 12:00:00', intbitset([1, 3]), path)
+        self.assertEqual(oai_repository_updater.read_set_membership(path),
+                         (membership, '2013-01-31 12:00:00', intbitset([1, 3])))
+        open(path, 'wb').write('not a set membership')
+        self.assertEqual(oai_repository_updater.read_set_membership(path), None)
+
 TEST_SUITE = make_test_suite(TestVerbs,
-                             TestErrorCodes)
+                             TestErrorCodes,
+                             TestResumptionTokens,
+                             TestSetMembership)
 
 if __name__ == "__main__":
     run_test_suite(TEST_SUITE)
@@ -26,6 +26,7 @@
 import os
 import sys
 import time
+import marshal
 
 if sys.hexversion < 0x2040000:
     # pylint: disable=W0622
@@ -36,6 +37,7 @@ from tempfile import mkstemp
 from pprint import pformat
 
 from invenio.config import \
+     CFG_CACHEDIR, \
      CFG_OAI_ID_FIELD, \
      CFG_OAI_ID_PREFIX, \
      CFG_OAI_SET_FIELD, \
@@ -43,8 +45,15 @@ from invenio.config import \
      CFG_SITE_NAME, \
      CFG_TMPDIR
 from invenio.oai_repository_config import CFG_OAI_REPOSITORY_MARCXML_SIZE, \
-     CFG_OAI_REPOSITORY_GLOBAL_SET_SPEC
-from invenio.search_engine import perform_request_search, get_record, search_unit_in_bibxxx
+     CFG_OAI_REPOSITORY_GLOBAL_SET_SPEC, \
+     CFG_OAI_REPOSITORY_BATCH_SIZE
+from invenio.oai_repository_server import get_fields
+from invenio.search_engine import get_record, search_unit_in_bibxxx, \
+     search_pattern_parenthesised, wash_colls, get_collection_reclist, \
+     wash_pattern, wash_field, get_index_id_from_field
+from invenio.search_engine_config import \
+     InvenioWebSearchUnknownCollectionError
+from invenio.search_engine_date_index import get_recids_modified_between
 from invenio.intbitset import intbitset
 from invenio.dbquery import run_sql
 from invenio.bibtask import \
@@ -61,6 +70,10 @@ from invenio.bibrecord import \
      record_add_field, \
      record_xml_output
 
+## where the membership of the records to the sets is kept between runs
+CFG_OAI_REPOSITORY_SET_MEMBERSHIP_PATH = os.path.join(CFG_CACHEDIR, 'oairepository', 'set_membership')
+CFG_OAI_REPOSITORY_SET_MEMBERSHIP_MAGIC = 'INVOAIS2'
+
 def get_set_definitions(set_spec):
     """
     Retrieve set definitions from oaiREPOSITORY table.
@@ -117,7 +130,19 @@ def all_set_specs():
 
     return [row[0] for row in res]
 
-def get_recids_for_set_spec(set_spec):
+def get_set_definition_collections(set_def):
+    """
+    Returns the list of the collections searched by the set definition
+    'set_def', as washed by the search engine (empty if one of them
+    does not exist).
+    """
+    try:
+        return wash_colls(CFG_SITE_NAME,
+                          [coll.strip() for coll in set_def['c'].split(',')])[2]
+    except InvenioWebSearchUnknownCollectionError:
+        return []
+
+def get_recids_for_set_spec(set_spec, recids=None, searches=None):
     """
     Returns the list (as intbitset) of recids belonging to 'set'
 
@@ -125,28 +150,55 @@ def get_recids_for_set_spec(set_spec):
 
       set_spec - *str* the set_spec for which we would like to get the
                  recids
+
+        recids - *intbitset* if given, only look up these records
+
+      searches - *dict* (p, f, m) -> intbitset of the patterns already
+                 searched, shared between calls
     """
-    recids = intbitset()
+    if searches is None:
+        searches = {}
+    def search(p, f, m):
+        """Return the records matching pattern P in field F."""
+        key = (p, f, m)
+        if key not in searches:
+            searches[key] = search_pattern_parenthesised(p=p, f=f, m=m, ap=0)
+        return searches[key]
+
+    recids_for_set = intbitset()
 
     for set_def in get_set_definitions(set_spec):
-        new_recids = perform_request_search(c=[coll.strip() \
-                                               for coll in set_def['c'].split(',')],
-                                            p1=set_def['p1'],
-                                            f1=set_def['f1'],
-                                            m1=set_def['m1'],
-                                            op1=set_def['op1'],
-                                            p2=set_def['p2'],
-                                            f2=set_def['f2'],
-                                            m2=set_def['m2'],
-                                            op2=set_def['op2'],
-                                            p3=set_def['p3'],
-                                            f3=set_def['f3'],
-                                            m3=set_def['m3'],
-                                            ap=0)
-
-        recids |= intbitset(new_recids)
-
-    return recids
+        # same evaluation as an advanced search in the collections
+        # of the definition, see perform_request_search(), but
+        # limited to the records of interest from the start
+        universe = intbitset()
+        for coll in get_set_definition_collections(set_def):
+            universe |= get_collection_reclist(coll)
+        if recids is not None:
+            universe &= recids
+        if not universe:
+            continue
+        # wash the patterns and fields like prs_wash_arguments() does
+        p1, p2, p3 = [wash_pattern(set_def[p]) for p in ('p1', 'p2', 'p3')]
+        f1, f2, f3 = [wash_field(set_def[f]) for f in ('f1', 'f2', 'f3')]
+        hits = search(p1, f1, set_def['m1'])
+        if not hits:
+            continue
+        new_recids = hits & universe
+        for p, f, m, op in ((p2, f2, set_def['m2'], set_def['op1']),
+                            (p3, f3, set_def['m3'], set_def['op2'])):
+            if not p:
+                continue
+            if op == 'o':
+                new_recids |= search(p, f, m) & universe
+            elif op == 'a' and new_recids:
+                new_recids &= search(p, f, m)
+            elif op == 'n' and new_recids:
+                new_recids -= search(p, f, m)
+
+        recids_for_set |= new_recids
+
+    return recids_for_set
 
 def get_set_name_for_set_spec(set_spec):
     """
@@ -283,6 +335,192 @@ def repository_size():
     """Read repository size"""
     return len(search_unit_in_bibxxx(p="*", f=CFG_OAI_SET_FIELD, type="e"))
 
+def get_set_definitions_signature(set_spec):
+    """
+    Returns a string that changes whenever the set definitions of
+    'set_spec', or the collections they search, change.
+    """
+    set_definitions = []
+    for params in get_set_definitions(set_spec):
+        items = params.items()
+        items.sort()
+        set_definitions.append((items, get_set_definition_collections(params)))
+    return repr(set_definitions)
+
+def get_set_collections(set_specs):
+    """
+    Returns the reclists of the collections searched by the set
+    definitions of 'set_specs', as a dictionary collection -> intbitset.
+    """
+    collections = {}
+    for set_spec in set_specs:
+        for set_def in get_set_definitions(set_spec):
+            for coll in get_set_definition_collections(set_def):
+                collections[coll] = intbitset(get_collection_reclist(coll))
+    return collections
+
+def get_set_indexes_last_updated(set_specs):
+    """
+    Returns the oldest update date (as 'YYYY-MM-DD HH:MM:SS') of the
+    indexes searched by the set definitions of 'set_specs', or None if
+    they search no index.  The records modified after this date might
+    not be indexed yet.
+    """
+    index_ids = {}
+    for set_spec in set_specs:
+        for set_def in get_set_definitions(set_spec):
+            for p, f in (('p1', 'f1'), ('p2', 'f2'), ('p3', 'f3')):
+                if wash_pattern(set_def[p]):
+                    index_id = get_index_id_from_field(wash_field(set_def[f]))
+                    if index_id:
+                        index_ids[index_id] = True
+    if not index_ids:
+        return None
+    query = "SELECT DATE_FORMAT(MIN(last_updated), '%%Y-%%m-%%d %%H:%%i:%%s') FROM idxINDEX WHERE id IN (%s)" % \
+            ','.join(['%s'] * len(index_ids))
+    return run_sql(query, tuple(index_ids.keys()))[0][0]
+
+def get_set_membership():
+    """
+    Returns the membership of all the records to the OAI sets, as a
+    dictionary with keys:
+
+       definitions - *dict* setSpec -> signature of its set definitions
+            should - *dict* setSpec -> intbitset of the records that
+                     should be in the set according to the settings
+           current - *dict* setSpec -> intbitset of the records that are
+                     currently in the set according to their metadata
+       collections - *dict* collection -> intbitset of the records of
+                     the collections searched by the set definitions
+       all_current - *intbitset* of the records currently in any set
+        with_oaiid - *intbitset* of the records having an OAI ID
+    """
+    membership = {'definitions': {}, 'should': {}, 'current': {}}
+    membership['with_oaiid'] = search_unit_in_bibxxx(p='*', f=CFG_OAI_ID_FIELD, type='e')
+    membership['all_current'] = search_unit_in_bibxxx(p='*', f=CFG_OAI_SET_FIELD, type='e')
+    searches = {}
+    for set_spec in all_set_specs():
+        if not set_spec:
+            set_spec = CFG_OAI_REPOSITORY_GLOBAL_SET_SPEC
+        membership['definitions'][set_spec] = get_set_definitions_signature(set_spec)
+        membership['should'][set_spec] = get_recids_for_set_spec(set_spec, searches=searches)
+        membership['current'][set_spec] = search_unit_in_bibxxx(p=set_spec, f=CFG_OAI_SET_FIELD, type='e')
+    membership['collections'] = get_set_collections(membership['definitions'].keys())
+    return membership
+
+def update_set_membership(membership, recids):
+    """
+    Returns the membership of all the records to the OAI sets (see
+    get_set_membership()), given their previous 'membership' and the
+    intbitset 'recids' of the records that might have changed since.
+    Only these records, and the records that entered or left the
+    collections searched by the set definitions, are looked up, except
+    in the sets whose definitions changed, which are computed from
+    scratch.
+    """
+    oai_ids = {}
+    oai_sets = {}
+    recids_list = list(recids)
+    for i in range(0, len(recids_list), CFG_OAI_REPOSITORY_BATCH_SIZE):
+        batch = recids_list[i:i + CFG_OAI_REPOSITORY_BATCH_SIZE]
+        oai_ids.update(get_fields(batch, CFG_OAI_ID_FIELD))
+        oai_sets.update(get_fields(batch, CFG_OAI_SET_FIELD))
+
+    updated_membership = {'definitions': {}, 'should': {}, 'current': {}}
+    updated_membership['with_oaiid'] = (membership['with_oaiid'] - recids) | \
+        intbitset([recid for recid, values in oai_ids.iteritems() if values])
+    updated_membership['all_current'] = (membership['all_current'] - recids) | \
+        intbitset([recid for recid, values in oai_sets.iteritems() if values])
+    set_specs = [set_spec or CFG_OAI_REPOSITORY_GLOBAL_SET_SPEC for set_spec in all_set_specs()]
+    updated_membership['collections'] = get_set_collections(set_specs)
+    # records can enter or leave a collection (e.g. when WebColl runs)
+    # without being modified
+    examined_recids = intbitset(recids)
+    for coll, reclist in updated_membership['collections'].iteritems():
+        if coll in membership['collections']:
+            examined_recids |= reclist ^ membership['collections'][coll]
+    searches = {}
+    for set_spec in set_specs:
+        signature = get_set_definitions_signature(set_spec)
+        updated_membership['definitions'][set_spec] = signature
+        if membership['definitions'].get(set_spec) == signature:
+            if examined_recids:
+                updated_membership['should'][set_spec] = (membership['should'][set_spec] - examined_recids) | \
+                    get_recids_for_set_spec(set_spec, examined_recids, searches)
+            else:
+                updated_membership['should'][set_spec] = membership['should'][set_spec]
+        else:
+            write_message("Set definitions of %s have changed" % set_spec, verbose=2)
+            updated_membership['should'][set_spec] = get_recids_for_set_spec(set_spec, searches=searches)
+        if set_spec in membership['current']:
+            updated_membership['current'][set_spec] = (membership['current'][set_spec] - recids) | \
+                intbitset([recid for recid, values in oai_sets.iteritems() if set_spec in values])
+        else:
+            updated_membership['current'][set_spec] = search_unit_in_bibxxx(p=set_spec, f=CFG_OAI_SET_FIELD, type='e')
+    return updated_membership
+
+def read_set_membership(path=CFG_OAI_REPOSITORY_SET_MEMBERSHIP_PATH):
+    """
+    Returns the set membership saved at 'path' by
+    write_set_membership(), together with the date of the run it was
+    computed in and the records to look up again, or None if there is
+    no valid saved membership.
+    """
+    try:
+        magic, last_run, pending, definitions, should, current, collections, \
+               all_current, with_oaiid = marshal.loads(open(path, 'rb').read())
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if magic != CFG_OAI_REPOSITORY_SET_MEMBERSHIP_MAGIC:
+        return None
+    membership = {'definitions': definitions,
+                  'should': {},
+                  'current': {},
+                  'collections': {},
+                  'all_current': intbitset(all_current),
+                  'with_oaiid': intbitset(with_oaiid)}
+    for set_spec, dump in should.iteritems():
+        membership['should'][set_spec] = intbitset(dump)
+    for set_spec, dump in current.iteritems():
+        membership['current'][set_spec] = intbitset(dump)
+    for coll, dump in collections.iteritems():
+        membership['collections'][coll] = intbitset(dump)
+    return membership, last_run, intbitset(pending)
+
+def write_set_membership(membership, last_run, pending, path=CFG_OAI_REPOSITORY_SET_MEMBERSHIP_PATH):
+    """
+    Saves set 'membership' computed in the run started at 'last_run'
+    (a date as 'YYYY-MM-DD HH:MM:SS'), together with the records
+    'pending' to look up again at the next run, at 'path'.
+    """
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    should = {}
+    for set_spec, recids in membership['should'].iteritems():
+        should[set_spec] = recids.fastdump()
+    current = {}
+    for set_spec, recids in membership['current'].iteritems():
+        current[set_spec] = recids.fastdump()
+    collections = {}
+    for coll, recids in membership['collections'].iteritems():
+        collections[coll] = recids.fastdump()
+    dump = marshal.dumps((CFG_OAI_REPOSITORY_SET_MEMBERSHIP_MAGIC,
+                          last_run, pending.fastdump(),
+                          membership['definitions'], should, current, collections,
+                          membership['all_current'].fastdump(),
+                          membership['with_oaiid'].fastdump()))
+    (fd, tmppath) = mkstemp(dir=dirname, prefix='tmp_')
+    try:
+        tmpfile = os.fdopen(fd, 'wb')
+        tmpfile.write(dump)
+        tmpfile.close()
+        os.rename(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
+
 ### MAIN ###
 def oairepositoryupdater_task():
     """Main business logic code of oai_archive"""
@@ -300,24 +538,35 @@ def oairepositoryupdater_task():
 
     task_update_progress("Fetching records to process")
 
-    recids_with_oaiid = search_unit_in_bibxxx(p='*', f=CFG_OAI_ID_FIELD, type='e')
+    start_date = run_sql("SELECT DATE_FORMAT(NOW(), '%Y-%m-%d %H:%i:%s')")[0][0]
+    previous_run = None
+    if task_get_option("incremental"):
+        previous_run = read_set_membership()
+        if previous_run is None:
+            write_message("No saved set membership, updating all the records")
+    if previous_run is None:
+        membership = get_set_membership()
+    else:
+        previous_membership, last_run, pending_recids = previous_run
+        modified_recids = get_recids_modified_between(last_run)
+        write_message("%s recids were modified since %s" % (len(modified_recids), last_run))
+        membership = update_set_membership(previous_membership,
+                                           modified_recids | pending_recids)
+
+    recids_with_oaiid = membership['with_oaiid']
     write_message("%s recids have an OAI ID" % len(recids_with_oaiid), verbose=2)
 
-    all_current_recids = search_unit_in_bibxxx(p='*', f=CFG_OAI_SET_FIELD, type='e')
+    all_current_recids = membership['all_current']
     no_more_exported_recids = intbitset(all_current_recids)
     write_message("%s recids are currently exported" % (len(all_current_recids)), verbose=2)
 
     all_affected_recids = intbitset()
     all_should_recids = intbitset()
-    recids_for_set = {}
-    for set_spec in all_set_specs():
-        if not set_spec:
-            set_spec = CFG_OAI_REPOSITORY_GLOBAL_SET_SPEC
-        should_recids = get_recids_for_set_spec(set_spec)
-        recids_for_set[set_spec] = should_recids
+    recids_for_set = membership['should']
+    for set_spec, should_recids in recids_for_set.iteritems():
         no_more_exported_recids -= should_recids
         all_should_recids |= should_recids
-        current_recids = search_unit_in_bibxxx(p=set_spec, f=CFG_OAI_SET_FIELD, type='e')
+        current_recids = membership['current'][set_spec]
         write_message("%s recids should be in %s. Currently %s are in %s" % (len(should_recids), set_spec, len(current_recids), set_spec), verbose=2)
         to_add = should_recids - current_recids
         write_message("%s recids should be added to %s" % (len(to_add), set_spec), verbose=2)
@@ -335,6 +584,18 @@ def oairepositoryupdater_task():
     all_affected_recids |= missing_oaiid | no_more_exported_recids
     write_message("%s recids should updated" % (len(all_affected_recids)), verbose=2)
 
+    ## The metadata of the updated records is only known once the
+    ## corrections are uploaded, and the records modified after the
+    ## last run of BibIndex were matched against stale indexes: look
+    ## them up again at the next run
+    pending_recids = intbitset(all_affected_recids)
+    indexed_until = get_set_indexes_last_updated(membership['definitions'].keys())
+    if indexed_until is not None and indexed_until < start_date:
+        not_indexed_recids = get_recids_modified_between(indexed_until)
+        write_message("%s recids were modified since the indexes were updated on %s" % (len(not_indexed_recids), indexed_until), verbose=2)
+        pending_recids |= not_indexed_recids
+    write_set_membership(membership, start_date, pending_recids)
+
     if not all_affected_recids:
         write_message("Nothing to do!")
         return True
@@ -485,6 +746,8 @@ field. Please revise your configuration for the variables
                 "   $ oairepositoryupdater \n"
                 " Expose records according to sets defined in OAI Repository admin interface and update them every day\n"
                 "   $ oairepositoryupdater -s24\n"
+                " Update every hour only the records modified since the previous run\n"
+                "   $ oairepositoryupdater --incremental -s1h\n"
                 " Print OAI repository status\n"
                 "   $ oairepositoryupdater -r\n"
                 " Print OAI repository detailed status\n"
@@ -494,12 +757,14 @@ field. Please revise your configuration for the variables
                 " -d --detailed-report\t\tOAI repository detailed status\n"
                 " -n --no-process\tDo no upload the modifications\n"
                 " --notimechange\tDo not update record modification_date\n"
+                " --incremental\tOnly look up the records modified since the previous run\n"
                 "NOTE: --notimechange should be used with care, basically only the first time a new set is added.",
             specific_params=("rdn", [
                 "report",
                 "detailed-report",
                 "no-process",
-                "notimechange"]),
+                "notimechange",
+                "incremental"]),
             task_submit_elaborate_specific_parameter_fnc=
                 task_submit_elaborate_specific_parameter,
             task_run_fnc=oairepositoryupdater_task)
@@ -514,6 +779,8 @@ def task_submit_elaborate_specific_parameter(key, _value, _opts, _args):
         task_set_option("no_upload", 1)
     elif key in ("--notimechange",):
         task_set_option("notimechange", 1)
+    elif key in ("--incremental",):
+        task_set_option("incremental", 1)
     else:
         return False
     return True
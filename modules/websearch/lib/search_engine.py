@@ -37,6 +37,7 @@ import urllib
 import urlparse
 import zlib
 import sys
+import threading
 
 try:
     ## import optional module:
@@ -61,6 +62,9 @@ from invenio.config import \
      CFG_WEBSEARCH_FIELDS_CONVERT, \
      CFG_WEBSEARCH_NB_RECORDS_TO_SORT, \
      CFG_WEBSEARCH_SEARCH_CACHE_SIZE, \
+     CFG_WEBSEARCH_SEARCH_CACHE_MAX_BYTES, \
+     CFG_WEBSEARCH_TERM_CACHE_SIZE, \
+     CFG_WEBSEARCH_CACHE_CHECK_INTERVAL, \
      CFG_WEBSEARCH_USE_MATHJAX_FOR_FORMATS, \
      CFG_WEBSEARCH_USE_ALEPH_SYSNOS, \
      CFG_WEBSEARCH_DEF_RECORDS_IN_GROUPS, \
@@ -74,6 +78,10 @@ from invenio.config import \
      CFG_SITE_NAME, \
      CFG_LOGDIR, \
      CFG_BIBFORMAT_HIDDEN_TAGS, \
+     CFG_BIBFORMAT_DISABLE_I18N_FOR_CACHED_FORMATS, \
+     CFG_WEBSEARCH_MAX_RECORDS_IN_GROUPS, \
+     CFG_BIBFORMAT_CACHE_SIZE, \
+     CFG_BIBFORMAT_CACHE_MAX_BYTES, \
      CFG_SITE_URL, \
      CFG_ACCESS_CONTROL_LEVEL_ACCOUNTS, \
      CFG_SOLR_URL, \
@@ -91,7 +99,8 @@ from invenio.search_engine_config import \
      CFG_WEBSEARCH_IDXPAIRS_FIELDS,\
      CFG_WEBSEARCH_IDXPAIRS_EXACT_SEARCH
 from invenio.search_engine_utils import get_fieldvalues, get_fieldvalues_alephseq_like
-from invenio.bibrecord import create_record, record_xml_output
+from invenio.bibrecord import create_record, record_xml_output, \
+     CompactRecord, deserialize_record_structure
 from invenio.bibrank_record_sorter import get_bibrank_methods, is_method_valid, rank_records as rank_records_bibrank
 from invenio.bibrank_downloads_similarity import register_page_view_event, calculate_reading_similarity_list
 from invenio.bibindex_engine_stemmer import stem
@@ -102,10 +111,20 @@ from invenio.bibindex_engine_washer import wash_index_term, lower_index_term, wa
 from invenio.bibindex_engine_config import CFG_BIBINDEX_SYNONYM_MATCH_TYPE
 from invenio.bibindex_engine_utils import get_idx_indexer
 from invenio.bibformat import format_record, format_records, get_output_format_content_type, create_excel
-from invenio.bibformat_config import CFG_BIBFORMAT_USE_OLD_BIBFORMAT
+from invenio.bibformat_config import CFG_BIBFORMAT_USE_OLD_BIBFORMAT, \
+     CFG_BIBFORMAT_BATCH_SIZE
+from invenio.bibformat_dblayer import get_preformatted_records
+from invenio.bibformat_cache import formatted_records_cache
 from invenio.bibrank_downloads_grapher import create_download_history_graph_and_box
 from invenio.bibknowledge import get_kbr_values
 from invenio.data_cacher import DataCacher
+from invenio.search_engine_cache import get_search_results_cache, \
+     get_records_generation, normalize_query_key, get_index_generation, \
+     term_hitlist_cache
+from invenio.search_engine_collection_index import CollectionMembershipIndex, \
+     read_collection_membership_index
+from invenio.search_engine_date_index import get_recids_modified_between, \
+     get_recids_created_between
 from invenio.websearch_external_collections import print_external_results_overview, perform_external_collection_search
 from invenio.access_control_admin import acc_get_action_id
 from invenio.access_control_config import VIEWRESTRCOLL, \
@@ -132,6 +151,8 @@ from invenio.bibrank_citation_grapher import create_citation_history_graph_and_b
 
 from invenio.dbquery import run_sql, run_sql_with_limit, wash_table_column_name, \
                             get_table_update_time
+from invenio.dbquery_profiler import start_request_profile, stop_request_profile, \
+                                     get_request_profile, format_query_profile, get_slow_queries
 from invenio.webuser import getUid, collect_user_info, session_param_set
 from invenio.webpage import pageheaderonly, pagefooteronly, create_error_box, write_warning
 from invenio.messages import gettext_set_language
@@ -222,7 +243,8 @@ class RestrictedCollectionDataCacher(DataCacher):
         def timestamp_verifier():
             return max(get_table_update_time('accROLE_accACTION_accARGUMENT'), get_table_update_time('accARGUMENT'))
 
-        DataCacher.__init__(self, cache_filler, timestamp_verifier)
+        DataCacher.__init__(self, cache_filler, timestamp_verifier,
+                            check_interval=CFG_WEBSEARCH_CACHE_CHECK_INTERVAL)
 
 def collection_restricted_p(collection, recreate_cache_if_needed=True):
     if recreate_cache_if_needed:
@@ -282,8 +304,8 @@ def get_restricted_collections_for_recid(recid, recreate_cache_if_needed=True):
     """
     if recreate_cache_if_needed:
         restricted_collection_cache.recreate_cache_if_needed()
-        collection_reclist_cache.recreate_cache_if_needed()
-    return [collection for collection in restricted_collection_cache.cache if recid in get_collection_reclist(collection, recreate_cache_if_needed=False)]
+    return [collection for collection in get_collection_membership_index(recreate_cache_if_needed).get_collections(recid)
+            if collection in restricted_collection_cache.cache]
 
 def is_user_owner_of_record(user_info, recid):
     """
@@ -476,21 +498,48 @@ class CollectionRecListDataCacher(DataCacher):
     to be used directly; use function get_collection_reclist() instead.
     """
     def __init__(self):
+        # checksums of collection reclists, used to invalidate only
+        # the reclists that have changed:
+        self.reclist_checksums = {}
+
+        def get_reclist_checksums():
+            checksums = {}
+            for name, checksum in run_sql("SELECT name, CRC32(reclist) FROM collection"):
+                checksums[name] = checksum
+            return checksums
+
         def cache_filler():
             ret = {}
             try:
-                res = run_sql("SELECT name FROM collection")
+                self.reclist_checksums = get_reclist_checksums()
             except Exception:
                 # database problems, return empty cache
                 return {}
-            for name in res:
-                ret[name[0]] = None # this will be filled later during runtime by calling get_collection_reclist(coll)
+            for name in self.reclist_checksums:
+                ret[name] = None # this will be filled later during runtime by calling get_collection_reclist(coll)
+            return ret
+
+        def delta_filler(cache, dummy_timestamp):
+            try:
+                checksums = get_reclist_checksums()
+            except Exception:
+                # database problems, keep the current cache
+                return cache
+            ret = {}
+            for name, checksum in checksums.items():
+                if self.reclist_checksums.get(name) == checksum:
+                    ret[name] = cache.get(name)
+                else:
+                    ret[name] = None # reclist changed, reload it lazily
+            self.reclist_checksums = checksums
             return ret
 
         def timestamp_verifier():
             return get_table_update_time('collection')
 
-        DataCacher.__init__(self, cache_filler, timestamp_verifier)
+        DataCacher.__init__(self, cache_filler, timestamp_verifier,
+                            delta_filler=delta_filler,
+                            check_interval=CFG_WEBSEARCH_CACHE_CHECK_INTERVAL)
 
 try:
     if not collection_reclist_cache.is_ok_p:
@@ -519,6 +568,33 @@ def get_collection_reclist(coll, recreate_cache_if_needed=True):
     # finally, return reclist:
     return collection_reclist_cache.cache[coll]
 
+_collection_membership_index = {'current': (None, None)}
+
+def get_collection_membership_index(recreate_cache_if_needed=True):
+    """
+    Return the CollectionMembershipIndex (recid -> collections) of the
+    current collection reclists.  The index is loaded from the file
+    maintained by WebColl and brought up to date with the reclists that
+    changed since, which are the only ones loaded from the database.
+    The returned index is never modified afterwards: updates are made
+    on a copy, published together with the checksums it matches by
+    one assignment, so that concurrent threads always see a
+    consistent index.
+    """
+    if recreate_cache_if_needed:
+        collection_reclist_cache.recreate_cache_if_needed()
+    checksums = collection_reclist_cache.reclist_checksums
+    index, index_checksums = _collection_membership_index['current']
+    if index is None or index_checksums is not checksums:
+        if index is None:
+            index = read_collection_membership_index() or CollectionMembershipIndex()
+        else:
+            index = index.copy()
+        index.synchronize(checksums,
+                          lambda coll: get_collection_reclist(coll, recreate_cache_if_needed=False))
+        _collection_membership_index['current'] = (index, checksums)
+    return index
+
 def get_available_output_formats(visible_only=False):
     """
     Return the list of available output formats.  When visible_only is
@@ -544,25 +620,11 @@ def get_available_output_formats(visible_only=False):
                        })
     return formats
 
-class SearchResultsCache(DataCacher):
-    """
-    Provides temporary lazy cache for Search Results.
-    Useful when users click on `next page'.
-    """
-    def __init__(self):
-        def cache_filler():
-            return {}
-        def timestamp_verifier():
-            return '1970-01-01 00:00:00' # lazy cache is always okay;
-                                         # its filling is governed by
-                                         # CFG_WEBSEARCH_SEARCH_CACHE_SIZE
-        DataCacher.__init__(self, cache_filler, timestamp_verifier)
-
 try:
-    if not search_results_cache.is_ok_p:
+    if not search_results_cache:
         raise Exception
 except Exception:
-    search_results_cache = SearchResultsCache()
+    search_results_cache = get_search_results_cache()
 
 class CollectionI18nNameDataCacher(DataCacher):
     """
@@ -2026,6 +2088,7 @@ def search_pattern(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, l
     if verbose and of.startswith("h"):
         t1 = os.times()[4]
     basic_search_units = create_basic_search_units(req, p, f, m, of)
+    prefetch_basic_search_units(basic_search_units)
     if verbose and of.startswith("h"):
         t2 = os.times()[4]
         write_warning("Search stage 1: basic search units are: %s" % cgi.escape(repr(basic_search_units)), req=req)
@@ -2221,6 +2284,11 @@ def search_pattern_parenthesised(req=None, p=None, f=None, m=None, ap=0, of="id"
         if verbose  and of.startswith("h"):
             write_warning("Search stage 1: search_pattern_parenthesised() searched %s." % repr(p), req=req)
             write_warning("Search stage 1: search_pattern_parenthesised() returned %s." % repr(parsing_result), req=req)
+        # fetch the exact terms of all the patterns at once:
+        all_basic_search_units = []
+        for index in xrange(0, len(parsing_result)-1, 2 ):
+            all_basic_search_units.extend(create_basic_search_units(None, parsing_result[index+1], f, m, 'id'))
+        prefetch_basic_search_units(all_basic_search_units)
          # go through every pattern
         # calculate hitset for it
         # combine pattern's hitset with the result using the corresponding operator
@@ -2456,8 +2524,9 @@ def search_unit_in_bibwords(word, f, m=None, decompress=zlib.decompress, wl=0):
                     res = excp.res
                     limit_reached = 1 # set the limit reached flag to true
         else:
-            res = run_sql("SELECT term,hitlist FROM %s WHERE term=%%s" % bibwordsX,
-                          (wash_index_term(word),))
+            word = wash_index_term(word)
+            # the hitset may come from the term hitlist cache, so copy it:
+            return intbitset(search_terms_in_bibwords(index_id, [word])[word])
     # fill the result set:
     for word, hitlist in res:
         hitset_bibwrd = intbitset(hitlist)
@@ -2474,6 +2543,127 @@ def search_unit_in_bibwords(word, f, m=None, decompress=zlib.decompress, wl=0):
     # okay, return result set:
     return set
 
+def get_bibwords_exact_term(word, f):
+    """
+    Return tuple (index_id, term) of the exact index term that
+    search_unit_in_bibwords() looks up when searching for WORD in
+    field F, or None if it would run a span or a wildcard query, or if
+    F has no word index.
+    """
+    f = f or 'anyfield'
+    word = string.replace(word, '*', '%')
+    if (f.endswith('count') and word.endswith('+')) or word.find('->') >= 0:
+        return None
+    index_id = get_index_id_from_field(f)
+    if not index_id:
+        return None
+    if f != 'journal':
+        word = re_word.sub('', word)
+    stemming_language = get_index_stemming_language(index_id)
+    if stemming_language:
+        word = lower_index_term(word)
+        word = stem(word, stemming_language)
+    if string.find(word, '%') >= 0:
+        return None
+    return index_id, wash_index_term(word)
+
+## how many terms do we look up in one SQL query?
+CFG_WEBSEARCH_TERM_BATCH_SIZE = 500
+
+def search_terms_in_bibwords(index_id, terms):
+    """
+    Return dictionary {term: hitset} with the hitsets of the exact
+    TERMS in the word index INDEX_ID.  See search_terms_in_index_table().
+    """
+    return search_terms_in_index_table("idxWORD%02dF" % index_id, index_id, terms)
+
+def search_terms_in_index_table(bibwordsX, index_id, terms):
+    """
+    Return dictionary {term: hitset} with the hitsets of TERMS in the
+    forward table BIBWORDSX (idxWORD, idxPHRASE or idxPAIR) of index
+    INDEX_ID, i.e. the union of the hitlists of all the rows whose term
+    is equal to a term under the database collation.  Terms are looked up in the term
+    hitlist cache first, the missing ones are fetched together with
+    `term IN (...)' queries and cached.  The returned hitsets may be
+    shared with the cache, so they must not be modified.
+    """
+    out = {}
+    if not terms:
+        return out
+    generation = None
+    if CFG_WEBSEARCH_TERM_CACHE_SIZE:
+        generation = get_index_generation(index_id)
+    missing_terms = []
+    for term in terms:
+        if out.has_key(term):
+            continue
+        hitset = None
+        if CFG_WEBSEARCH_TERM_CACHE_SIZE:
+            hitset = term_hitlist_cache.get((bibwordsX, term), generation)
+        if hitset is None:
+            missing_terms.append(term)
+            out[term] = None
+        else:
+            out[term] = hitset
+    for i in xrange(0, len(missing_terms), CFG_WEBSEARCH_TERM_BATCH_SIZE):
+        batch_terms = missing_terms[i:i+CFG_WEBSEARCH_TERM_BATCH_SIZE]
+        res = run_sql("SELECT term,hitlist FROM %s WHERE term IN (%s)" % \
+                      (bibwordsX, ','.join(['%s'] * len(batch_terms))),
+                      tuple(batch_terms))
+        # the database collation matches terms differing e.g. in case
+        # or accents, and idxPHRASE tables may hold several such rows:
+        # rows are grouped by their term without case and accents, and
+        # a term is attributed rows of its own group only if they all
+        # carry exactly that term, otherwise it is looked up alone
+        found = {}
+        variants = {}
+        for term, hitlist in res:
+            if found.has_key(term):
+                found[term] |= intbitset(hitlist)
+            else:
+                found[term] = intbitset(hitlist)
+                variants.setdefault(strip_accents(term).lower(), []).append(term)
+        batch_keys = dict([(strip_accents(term).lower(), term) for term in batch_terms])
+        batch_found_exactly = len([key for key in variants if batch_keys.has_key(key)]) == len(variants)
+        for term in batch_terms:
+            term_variants = variants.get(strip_accents(term).lower(), [])
+            if batch_found_exactly and term_variants == [term]:
+                hitset = found[term]
+            elif batch_found_exactly and not term_variants:
+                hitset = intbitset()
+            else:
+                hitset = intbitset()
+                for row in run_sql("SELECT hitlist FROM %s WHERE term=%%s" % bibwordsX,
+                                   (term,)):
+                    hitset |= intbitset(row[0])
+            out[term] = hitset
+            if CFG_WEBSEARCH_TERM_CACHE_SIZE:
+                term_hitlist_cache.set((bibwordsX, term), hitset, generation)
+    return out
+
+def prefetch_basic_search_units(basic_search_units):
+    """
+    Fetch at once, per word index, the hitlists of all the BASIC_SEARCH_UNITS
+    that are plain exact-term word searches, so that their subsequent
+    search_unit() calls are served from the term hitlist cache instead
+    of running one query per unit.
+    """
+    if not CFG_WEBSEARCH_TERM_CACHE_SIZE:
+        return
+    terms_by_index = {}
+    for dummy_bsu_o, bsu_p, bsu_f, bsu_m in basic_search_units:
+        if not bsu_p or bsu_m in ('a', 'r') or bsu_p.startswith('cited:') or \
+               (bsu_f and len(bsu_f) < 2) or \
+               bsu_f in ('fulltext', 'datecreated', 'datemodified',
+                         'refersto', 'rawref', 'citedby'):
+            continue
+        index_term = get_bibwords_exact_term(bsu_p, bsu_f)
+        if index_term:
+            terms_by_index.setdefault(index_term[0], []).append(index_term[1])
+    for index_id, terms in terms_by_index.items():
+        if len(terms) > 1:
+            search_terms_in_bibwords(index_id, terms)
+
 def search_unit_in_idxpairs(p, f, type, wl=0):
     """Searches for pair 'p' inside idxPAIR table for field 'f' and
     returns hitset of recIDs found."""
@@ -2547,11 +2737,26 @@ def search_unit_in_idxpairs(p, f, type, wl=0):
         for pair in pairs:
             queries_releated_vars.append(("= %s", (pair, ), False))
 
+    # fetch all the exact pairs at once, through the term hitlist cache:
+    exact_pairs_hitsets = search_terms_in_index_table(idxpair_table_washed, index_id,
+                                                      [query_var[1][0] for query_var in queries_releated_vars
+                                                       if query_var[0] == "= %s"])
     first_results = 1 # flag to know if it's the first set of results or not
     for query_var in queries_releated_vars:
         query_addons = query_var[0]
         query_params = query_var[1]
         use_query_limit = query_var[2]
+        if query_addons == "= %s":
+            hitset_idxpairs = exact_pairs_hitsets[query_params[0]]
+            if not hitset_idxpairs:
+                return intbitset()
+            if first_results:
+                # copy, since the hitset may be shared with the cache
+                result_set = intbitset(hitset_idxpairs)
+                first_results = 0
+            else:
+                result_set.intersection_update(hitset_idxpairs)
+            continue
         if use_query_limit:
             try:
                 res = run_sql_with_limit("SELECT term, hitlist FROM %s WHERE term %s" \
@@ -2605,13 +2810,12 @@ def search_unit_in_idxphrases(p, f, type, wl=0):
     limit_reached = 0 # flag for knowing if the query limit has been reached
     use_query_limit = False # flag for knowing if to limit the query results or not
     # deduce in which idxPHRASE table we will search:
-    idxphraseX = "idxPHRASE%02dF" % get_index_id_from_field("anyfield")
+    index_id = get_index_id_from_field("anyfield")
     if f:
         index_id = get_index_id_from_field(f)
-        if index_id:
-            idxphraseX = "idxPHRASE%02dF" % index_id
-        else:
+        if not index_id:
             return intbitset() # phrase index f does not exist
+    idxphraseX = "idxPHRASE%02dF" % index_id
     # detect query type (exact phrase, partial phrase, regexp):
     if type == 'r':
         query_addons = "REGEXP %s"
@@ -2648,7 +2852,8 @@ def search_unit_in_idxphrases(p, f, type, wl=0):
             res = excp.res
             limit_reached = 1 # set the limit reached flag to true
     else:
-        res = run_sql("SELECT term,hitlist FROM %s WHERE term %s" % (idxphraseX, query_addons), query_params)
+        # exact phrase: the hitset may come from the term hitlist cache, so copy it
+        return intbitset(search_terms_in_index_table(idxphraseX, index_id, query_params)[query_params[0]])
     # fill the result set:
     for word, hitlist in res:
         hitset_bibphrase = intbitset(hitlist)
@@ -2812,9 +3017,10 @@ def search_unit_in_bibrec(datetext1, datetext2, type='c'):
     if datetext1 == datetext2:
         res = run_sql("SELECT id FROM bibrec WHERE %s LIKE %%s" % (type,),
                       (datetext1 + '%',))
+    elif type == "modification_date":
+        return get_recids_modified_between(datetext1, datetext2)
     else:
-        res = run_sql("SELECT id FROM bibrec WHERE %s>=%%s AND %s<=%%s" % (type, type),
-                      (datetext1, datetext2))
+        return get_recids_created_between(datetext1, datetext2)
     for row in res:
         set += row[0]
     return set
@@ -2878,10 +3084,12 @@ def intersect_results_with_collrecs(req, hitset_in_any_collection, colls, ap=0,
     # calculate the list of recids (restricted or not) that the user has rights to access and we should display (only those)
     records_that_can_be_displayed = intbitset()
 
+    collection_membership_index = get_collection_membership_index()
+
     if not req or isinstance(req, cStringIO.OutputType): # called from CLI
         user_info = {}
+        results = collection_membership_index.intersect(hitset_in_any_collection, colls)
         for coll in colls:
-            results[coll] = hitset_in_any_collection & get_collection_reclist(coll)
             results_nbhits += len(results[coll])
         records_that_can_be_displayed = hitset_in_any_collection
         permitted_restricted_collections = []
@@ -2918,24 +3126,26 @@ def intersect_results_with_collrecs(req, hitset_in_any_collection, colls, ap=0,
 
         if policy == 'ANY':# the user needs to have access to at least one collection that restricts the records
             #we need this to be able to remove records that are both in a public and restricted collection
-            permitted_recids = intbitset()
-            notpermitted_recids = intbitset()
+            permitted_collections = []
+            notpermitted_collections = []
             for collection in restricted_collection_cache.cache:
                 if collection in permitted_restricted_collections:
-                    permitted_recids |= get_collection_reclist(collection)
+                    permitted_collections.append(collection)
                 else:
-                    notpermitted_recids |= get_collection_reclist(collection)
-            records_that_can_be_displayed = hitset_in_any_collection - (notpermitted_recids - permitted_recids)
+                    notpermitted_collections.append(collection)
+            records_that_can_be_displayed = hitset_in_any_collection - \
+                collection_membership_index.get_recids_in_any_of(notpermitted_collections,
+                                                                 none_of=permitted_collections)
 
         else:# the user needs to have access to all collections that restrict a records
-            notpermitted_recids = intbitset()
-            for collection in restricted_collection_cache.cache:
-                if collection not in permitted_restricted_collections:
-                    notpermitted_recids |= get_collection_reclist(collection)
-            records_that_can_be_displayed = hitset_in_any_collection - notpermitted_recids
+            notpermitted_collections = [collection for collection in restricted_collection_cache.cache
+                                        if collection not in permitted_restricted_collections]
+            records_that_can_be_displayed = hitset_in_any_collection - \
+                collection_membership_index.get_recids_in_any_of(notpermitted_collections)
 
+        results = collection_membership_index.intersect(records_that_can_be_displayed,
+                                                        colls_to_be_displayed)
         for coll in colls_to_be_displayed:
-            results[coll] = results.get(coll, intbitset()).union_update(records_that_can_be_displayed & get_collection_reclist(coll))
             results_nbhits += len(results[coll])
 
     if results_nbhits == 0:
@@ -3511,23 +3721,12 @@ def is_record_in_any_collection(recID, recreate_cache_if_needed=True):
     good, although not perfect, indicator to guess if webcoll has already run
     after this record has been entered into the system.
     """
-    if recreate_cache_if_needed:
-        collection_reclist_cache.recreate_cache_if_needed()
-    for name in collection_reclist_cache.cache.keys():
-        if recID in get_collection_reclist(name, recreate_cache_if_needed=False):
-            return True
-    return False
+    return get_collection_membership_index(recreate_cache_if_needed).is_record_in_any_collection(recID)
 
 def get_all_collections_of_a_record(recID, recreate_cache_if_needed=True):
     """Return all the collection names a record belongs to.
-    Note this function is O(n_collections)."""
-    ret = []
-    if recreate_cache_if_needed:
-        collection_reclist_cache.recreate_cache_if_needed()
-    for name in collection_reclist_cache.cache.keys():
-        if recID in get_collection_reclist(name, recreate_cache_if_needed=False):
-            ret.append(name)
-    return ret
+    Note this function is O(1), see get_collection_membership_index()."""
+    return list(get_collection_membership_index(recreate_cache_if_needed).get_collections(recID))
 
 def get_tag_name(tag_value, prolog="", epilog=""):
     """Return tag name from the known tag value, by looking up the 'tag' table.
@@ -3592,6 +3791,9 @@ def record_exists(recID):
        Return 0 if it doesn't exist.
        Return -1 if it exists but is marked as deleted.
     """
+    store = getattr(_prefetched_records, 'store', None)
+    if store is not None and recID in store['exists']:
+        return store['exists'][recID]
     out = 0
     res = run_sql("SELECT id FROM bibrec WHERE id=%s", (recID,), 1)
     if res:
@@ -3607,6 +3809,35 @@ def record_exists(recID):
             out = 1 # exists fine
     return out
 
+def records_exist(recIDs, modification_dates=None):
+    """Return dictionary {recID: status} telling, for every record of
+       the list RECIDS, whether it exists, with the same status values
+       as record_exists().  Records are checked in batches.  If the
+       dictionary MODIFICATION_DATES is given, the modification dates
+       ('YYYY-MM-DD HH:MM:SS') of the existing records are put in it.
+    """
+    out = {}
+    recIDs = list(recIDs)
+    for i in range(0, len(recIDs), CFG_BIBFORMAT_BATCH_SIZE):
+        batch = recIDs[i:i + CFG_BIBFORMAT_BATCH_SIZE]
+        for recID in batch:
+            out[recID] = 0
+        placeholders = ",".join(["%s"] * len(batch))
+        res = run_sql("SELECT id, DATE_FORMAT(modification_date, '%%%%Y-%%%%m-%%%%d %%%%H:%%%%i:%%%%s') FROM bibrec WHERE id IN (%s)" % \
+                      placeholders, tuple(batch))
+        for recID, modification_date in res:
+            out[recID] = 1
+            if modification_dates is not None:
+                modification_dates[recID] = modification_date
+        # now check whether they aren't marked as deleted:
+        res = run_sql("""SELECT bb.id_bibrec, b.value FROM bib98x AS b, bibrec_bib98x AS bb
+                         WHERE bb.id_bibrec IN (%s) AND b.id=bb.id_bibxxx
+                         AND b.tag LIKE '980__%%%%'""" % placeholders, tuple(batch))
+        for recID, value in res:
+            if value == "DELETED" or (CFG_CERN_SITE and value == "DUMMY"):
+                out[recID] = -1
+    return out
+
 def record_empty(recID):
     """
     Is this record empty, e.g. has only 001, waiting for integration?
@@ -4183,6 +4414,48 @@ def print_records(req, recIDs, jrec=1, rg=CFG_WEBSEARCH_DEF_RECORDS_IN_GROUPS, f
                   decompress=zlib.decompress, search_pattern='', print_records_prologue_p=True,
                   print_records_epilogue_p=True, verbose=0, tab='', sf='', so='d', sp='',
                   rm='', em=''):
+    """
+    Prints list of records 'recIDs' formatted according to 'format' in
+    groups of 'rg' starting from 'jrec' (see _print_records()).
+
+    The records of the page are loaded beforehand with a few queries
+    instead of several queries per record, unless there are too many
+    of them to be kept in memory.
+    """
+    prefetched = []
+    if req is not None and len(recIDs) and format != 'excel' and \
+           (em == "" or EM_REPOSITORY["body"] in em):
+        nb_found = len(recIDs)
+        if rg == -9999:
+            nb_to_print = nb_found
+        else:
+            nb_to_print = abs(rg)
+        if nb_to_print <= CFG_WEBSEARCH_MAX_RECORDS_IN_GROUPS:
+            # same page boundaries as _print_records():
+            first = max(jrec, 1)
+            if first > nb_found:
+                first = max(nb_found - nb_to_print + 1, 1)
+            irec_max = min(nb_found - first, nb_found - 1)
+            irec_min = max(nb_found - first - nb_to_print, -1)
+            recIDs_to_prefetch = [recIDs[x] for x in range(irec_max, irec_min, -1)]
+            if ot:
+                prefetched = prefetch_records(recIDs_to_prefetch)
+            else:
+                prefetched = prefetch_records(recIDs_to_prefetch, format, ln)
+    try:
+        return _print_records(req, recIDs, jrec, rg, format, ot, ln,
+                              relevances, relevances_prologue, relevances_epilogue,
+                              decompress, search_pattern, print_records_prologue_p,
+                              print_records_epilogue_p, verbose, tab, sf, so, sp,
+                              rm, em)
+    finally:
+        clear_prefetched_records(prefetched)
+
+def _print_records(req, recIDs, jrec=1, rg=CFG_WEBSEARCH_DEF_RECORDS_IN_GROUPS, format='hb', ot='', ln=CFG_SITE_LANG,
+                   relevances=[], relevances_prologue="(", relevances_epilogue="%%)",
+                   decompress=zlib.decompress, search_pattern='', print_records_prologue_p=True,
+                   print_records_epilogue_p=True, verbose=0, tab='', sf='', so='d', sp='',
+                   rm='', em=''):
 
     """
     Prints list of records 'recIDs' formatted according to 'format' in
@@ -4625,18 +4898,126 @@ def print_records_epilogue(req, format):
         epilogue = websearch_templates.tmpl_xml_default_epilogue()
     req.write(epilogue)
 
-def get_record(recid):
-    """Directly the record object corresponding to the recid."""
+def get_record(recid, compact=False):
+    """Directly the record object corresponding to the recid.
+
+    If COMPACT is True, the record may be returned as a
+    bibrecord.CompactRecord (if it was serialized so, see
+    CFG_BIBUPLOAD_SERIALIZE_COMPACT_RECORD_STRUCTURE), which is
+    faster to look up when only reading it."""
+    store = getattr(_prefetched_records, 'store', None)
+    if store is not None and recid in store['records']:
+        # prefetched records are handed out only once, as callers may
+        # modify them:
+        record = store['records'].pop(recid)
+        if not compact and isinstance(record, CompactRecord):
+            record = record.to_dict()
+        return record
     if CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE:
         value = run_sql("SELECT value FROM bibfmt WHERE id_bibrec=%s AND FORMAT='recstruct'",  (recid, ))
         if value:
             try:
-                return deserialize_via_marshal(value[0][0])
+                return deserialize_record_structure(zlib.decompress(value[0][0]), compact)
             except:
                 ### In case of corruption, let's rebuild it!
                 pass
     return create_record(print_record(recid, 'xm'))[0]
 
+def get_records(recIDs, compact=False):
+    """Return dictionary {recID: record object} of the list of records
+    RECIDS, reading their serialized structures in batches.  See
+    get_record() for COMPACT."""
+    out = {}
+    recIDs = list(recIDs)
+    if CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE:
+        for i in range(0, len(recIDs), CFG_BIBFORMAT_BATCH_SIZE):
+            batch = recIDs[i:i + CFG_BIBFORMAT_BATCH_SIZE]
+            res = run_sql("SELECT id_bibrec, value FROM bibfmt WHERE id_bibrec IN (%s) AND format='recstruct'" % \
+                          ",".join(["%s"] * len(batch)), tuple(batch))
+            for recid, value in res:
+                try:
+                    out[recid] = deserialize_record_structure(zlib.decompress(value), compact)
+                except:
+                    ### In case of corruption, get_record() will rebuild it
+                    pass
+    for recid in recIDs:
+        if recid not in out:
+            out[recid] = get_record(recid, compact)
+    return out
+
+## records prefetched by prefetch_records() for the current thread:
+_prefetched_records = threading.local()
+
+def prefetch_records(recIDs, of=None, ln=CFG_SITE_LANG):
+    """
+    Load in memory, with a few batched queries, what formatting the
+    list of records RECIDS in output format OF and language LN needs:
+    their existence status, their modification date, their
+    preformatted OF output, and the structure of the existing records
+    that are not preformatted.  The following record_exists(),
+    get_record() and format_record() calls of the current thread are
+    then served from memory.
+
+    Return the list of records that were prefetched (records already
+    prefetched are skipped), to be passed to clear_prefetched_records()
+    once done.
+    """
+    store = getattr(_prefetched_records, 'store', None)
+    if store is None:
+        store = _prefetched_records.store = {'exists': {}, 'records': {}, 'preformatted': {},
+                                             'modification_dates': {}}
+    recIDs = [recID for recID in recIDs if recID not in store['exists']]
+    if not recIDs:
+        return []
+    existence = records_exist(recIDs, store['modification_dates'])
+    store['exists'].update(existence)
+    recIDs_to_load = [recID for recID in recIDs if existence[recID] == 1]
+    if of and (ln == CFG_SITE_LANG or \
+               of.lower() == 'xm' or \
+               CFG_BIBFORMAT_USE_OLD_BIBFORMAT or \
+               of.lower() in CFG_BIBFORMAT_DISABLE_I18N_FOR_CACHED_FORMATS):
+        preformatted = get_preformatted_records(recIDs_to_load, of)
+        for recID in recIDs:
+            if existence[recID] != -1:
+                store['preformatted'][(recID, of)] = preformatted.get(recID)
+        recIDs_to_load = [recID for recID in recIDs_to_load if recID not in preformatted]
+    store['records'].update(get_records(recIDs_to_load, compact=True))
+    return recIDs
+
+def get_prefetched_preformatted_record(recID, of):
+    """Return preformatted output OF of record RECID as prefetched by
+    prefetch_records(), or None if it has no such output.  Raise
+    KeyError if it was not prefetched."""
+    store = getattr(_prefetched_records, 'store', None)
+    if store is None:
+        raise KeyError((recID, of))
+    return store['preformatted'][(recID, of)]
+
+def get_prefetched_modification_date(recID):
+    """Return modification date of record RECID as prefetched by
+    prefetch_records(), or None if it does not exist.  Raise KeyError
+    if it was not prefetched."""
+    store = getattr(_prefetched_records, 'store', None)
+    if store is None or recID not in store['exists']:
+        raise KeyError(recID)
+    return store['modification_dates'].get(recID)
+
+def clear_prefetched_records(recIDs):
+    """Forget records RECIDS prefetched by prefetch_records()."""
+    store = getattr(_prefetched_records, 'store', None)
+    if store is None:
+        return
+    recIDs = set(recIDs)
+    for recID in recIDs:
+        store['exists'].pop(recID, None)
+        store['records'].pop(recID, None)
+        store['modification_dates'].pop(recID, None)
+    for key in store['preformatted'].keys():
+        if key[0] in recIDs:
+            del store['preformatted'][key]
+    if not store['exists']:
+        _prefetched_records.store = None
+
 def print_record(recID, format='hb', ot='', ln=CFG_SITE_LANG, decompress=zlib.decompress,
                  search_pattern=None, user_info=None, verbose=0, sf='', so='d', sp='', rm=''):
     """
@@ -5285,7 +5666,21 @@ def perform_request_search(req=None, cc=CFG_SITE_NAME, c=None, p="", f="", rg=CF
                                 d1y=d1y, d1m=d1m, d1d=d1d, d2=d2, d2y=d2y, d2m=d2m, d2d=d2d, dt=dt, verbose=verbose, ap=ap, ln=ln, ec=ec,
                                 tab=tab, wl=wl, em=em)
 
-    return prs_perform_search(kwargs=kwargs, **kwargs)
+    # with verbose=9, report the SQL queries run by this search:
+    sql_profile_p = kwargs['verbose'] >= 9 and kwargs['of'].startswith("h") and req
+    sql_profile_started_here_p = False
+    if sql_profile_p and get_request_profile() is None:
+        start_request_profile()
+        sql_profile_started_here_p = True
+    try:
+        return prs_perform_search(kwargs=kwargs, **kwargs)
+    finally:
+        if sql_profile_p:
+            if sql_profile_started_here_p:
+                sql_profile = stop_request_profile()
+            else:
+                sql_profile = get_request_profile()
+            write_warning("<pre>%s</pre>" % encode_for_xml(format_query_profile(sql_profile)), req=req)
 
 
 def prs_perform_search(kwargs=None, **dummy):
@@ -5838,11 +6233,14 @@ def prs_advanced_search(results_in_any_collection, kwargs=None, req=None, of=Non
 def prs_simple_search(results_in_any_collection, kwargs=None, req=None, of=None, cc=None, ln=None, p=None, f=None,
                     p1=None, p2=None, p3=None, ec=None, verbose=None, selected_external_collections_infos=None,
                     only_hosted_colls_actual_or_potential_results_p=None, query_representation_in_cache=None,
-                    ap=None, hosted_colls_actual_or_potential_results_p=None, wl=None, em=None,
+                    records_generation=None, ap=None, hosted_colls_actual_or_potential_results_p=None, wl=None, em=None,
                     **dummy):
-    if search_results_cache.cache.has_key(query_representation_in_cache):
-        # query is not in the cache already, so reuse it:
-        results_in_any_collection.union_update(search_results_cache.cache[query_representation_in_cache])
+    cached_results = None
+    if CFG_WEBSEARCH_SEARCH_CACHE_SIZE and query_representation_in_cache is not None:
+        cached_results = search_results_cache.get(query_representation_in_cache, records_generation)
+    if cached_results is not None:
+        # query is in the cache already, so reuse it:
+        results_in_any_collection.union_update(cached_results)
         if verbose and of.startswith("h"):
             write_warning("Search stage 0: query found in cache, reusing cached results.", req=req)
     else:
@@ -5885,11 +6283,12 @@ def prs_intersect_results_with_collrecs(results_final, results_in_any_collection
         return page_end(req, of, ln, em)
 
 
-def prs_store_results_in_cache(query_representation_in_cache, results_in_any_collection, req=None, verbose=None, of=None, **dummy):
-    if CFG_WEBSEARCH_SEARCH_CACHE_SIZE and not search_results_cache.cache.has_key(query_representation_in_cache):
-        if len(search_results_cache.cache) > CFG_WEBSEARCH_SEARCH_CACHE_SIZE:
-            search_results_cache.clear()
-        search_results_cache.cache[query_representation_in_cache] = results_in_any_collection
+def prs_store_results_in_cache(results_in_any_collection, query_representation_in_cache=None, records_generation=None,
+                               req=None, verbose=None, of=None, **dummy):
+    if CFG_WEBSEARCH_SEARCH_CACHE_SIZE and query_representation_in_cache is not None and \
+           not search_results_cache.has_key(query_representation_in_cache, records_generation):
+        # note: the cache backend takes care of evicting old entries
+        search_results_cache.set(query_representation_in_cache, results_in_any_collection, records_generation)
         if verbose and of.startswith("h"):
             write_warning(req, "Search stage 3: storing query results in cache.", req=req)
 
@@ -6215,7 +6614,16 @@ def prs_search_common(kwargs=None, req=None, of=None, cc=None, ln=None, uid=None
                     dt=None, jrec=None, ec=None, action=None, colls_to_search=None, wash_colls_debug=None,
                     verbose=None, wl=None, em=None, **dummy):
 
-    query_representation_in_cache = repr((p, f, colls_to_search, wl))
+    if aas == 1 or (p1 or p2 or p3):
+        # the cache key only describes simple searches, so do not
+        # cache advanced search results:
+        kwargs['query_representation_in_cache'] = None
+    else:
+        kwargs['query_representation_in_cache'] = normalize_query_key(p, f, colls_to_search, wl)
+    if CFG_WEBSEARCH_SEARCH_CACHE_SIZE:
+        # remember records generation before searching, so that
+        # results are never cached as fresher than they are:
+        kwargs['records_generation'] = get_records_generation()
     page_start(req, of, cc, aas, ln, uid, p=create_page_title_search_pattern_info(p, p1, p2, p3), em=em)
 
     if of.startswith("h") and verbose and wash_colls_debug:
@@ -6300,7 +6708,7 @@ def prs_search_common(kwargs=None, req=None, of=None, cc=None, ln=None, uid=None
         return None
 
     # store this search query results into search results cache if needed:
-    prs_store_results_in_cache(query_representation_in_cache, results_in_any_collection, **kwargs)
+    prs_store_results_in_cache(results_in_any_collection, **kwargs)
 
     # search stage 4 and 5: intersection with collection universe and sorting/limiting
     try:
@@ -6447,6 +6855,9 @@ def perform_request_cache(req, action="show"):
     # clear cache if requested:
     if action == "clear":
         search_results_cache.clear()
+        term_hitlist_cache.clear()
+        if formatted_records_cache is not None:
+            formatted_records_cache.clear()
     req.write(out)
     # show collection reclist cache:
     out = "<h3>Collection reclist cache</h3>"
@@ -6461,15 +6872,55 @@ def perform_request_cache(req, action="show"):
     req.write(out)
     # show search results cache:
     out = "<h3>Search Cache</h3>"
-    out += "- search cache usage: %d queries cached (max. ~%d)" % \
-           (len(search_results_cache.cache), CFG_WEBSEARCH_SEARCH_CACHE_SIZE)
-    if len(search_results_cache.cache):
+    search_cache_stats = search_results_cache.get_stats()
+    out += "- search cache backend: %s" % search_results_cache.__class__.__name__
+    out += "<br />- search cache usage: %d queries cached (max. ~%d), %d bytes (max. ~%d)" % \
+           (search_cache_stats['entries'], CFG_WEBSEARCH_SEARCH_CACHE_SIZE,
+            search_cache_stats['bytes'], CFG_WEBSEARCH_SEARCH_CACHE_MAX_BYTES)
+    out += "<br />- search cache hits/misses in this process: %d/%d" % \
+           (search_cache_stats['hits'], search_cache_stats['misses'])
+    if search_cache_stats['entries']:
         out += "<br />- search cache contents:"
         out += "<blockquote>"
-        for query, hitset in search_results_cache.cache.items():
+        for query, hitset in search_results_cache.items():
             out += "<br />%s ... %s" % (query, hitset)
         out += """<p><a href="%s/search/cache?action=clear">clear search results cache</a>""" % CFG_SITE_URL
         out += "</blockquote>"
+    term_cache_stats = term_hitlist_cache.get_stats()
+    out += "<br />- term hitlist cache usage: %d terms cached (max. ~%d), %d pinned, %d bytes" % \
+           (term_cache_stats['entries'], CFG_WEBSEARCH_TERM_CACHE_SIZE,
+            term_cache_stats['pinned'], term_cache_stats['bytes'])
+    out += "<br />- term hitlist cache hits/misses in this process: %d/%d" % \
+           (term_cache_stats['hits'], term_cache_stats['misses'])
+    req.write(out)
+    # show formatted records cache:
+    out = "<h3>Formatted records cache</h3>"
+    if formatted_records_cache is None:
+        out += "- disabled (see CFG_BIBFORMAT_CACHE_BACKEND)"
+    else:
+        format_cache_stats = formatted_records_cache.get_stats()
+        out += "- formatted records cache backend: %s" % formatted_records_cache.__class__.__name__
+        out += "<br />- formatted records cache usage: %d outputs cached (max. ~%d), %d bytes (max. ~%d)" % \
+               (format_cache_stats['entries'], CFG_BIBFORMAT_CACHE_SIZE,
+                format_cache_stats['bytes'], CFG_BIBFORMAT_CACHE_MAX_BYTES)
+        lookups = format_cache_stats['hits'] + format_cache_stats['misses']
+        hit_rate = 0.0
+        if lookups:
+            hit_rate = 100.0 * format_cache_stats['hits'] / lookups
+        out += "<br />- formatted records cache hits/misses in this process: %d/%d (hit rate %.1f%%)" % \
+               (format_cache_stats['hits'], format_cache_stats['misses'], hit_rate)
+    req.write(out)
+    # show SQL queries that took most time in this process:
+    out = "<h3>SQL query profiler</h3>"
+    slow_queries = get_slow_queries()
+    if slow_queries:
+        out += "<pre>%8s %10s %10s %8s  %s\n" % ('count', 'total(s)', 'max(s)', 'rows', 'query')
+        for fingerprint, count, total, maximum, rows in slow_queries:
+            out += "%8d %10.4f %10.4f %8d  %s\n" % (count, total, maximum, rows,
+                                                   encode_for_xml(fingerprint[:200]))
+        out += "</pre>"
+    else:
+        out += "- no statistics available (see CFG_MISCUTIL_SQL_PROFILER)"
     req.write(out)
     # show field i18nname cache:
     out = "<h3>Field I18N names cache</h3>"
@@ -0,0 +1,524 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Invenio Search Engine results cache.
+
+Caches the hitsets found by search_pattern_parenthesised() for a given
+normalized query, so that `next page' clicks and popular queries do
+not recompute them.  Two backends are provided:
+
+    - MemorySearchResultsCache: in-process LRU cache bounded both in
+      number of queries and in bytes;
+
+    - DiskSearchResultsCache: local store of serialized hitsets in
+      CFG_CACHEDIR shared by all the processes of the same host
+      (e.g. by all mod_wsgi workers).
+
+Every entry remembers the records `generation' (i.e. the latest
+modification date of any record) at which it was computed; an entry
+whose generation differs from the current one is considered stale.
+Use get_search_results_cache() to obtain the backend configured via
+CFG_WEBSEARCH_SEARCH_CACHE_BACKEND.
+
+The module also provides the term hitlist cache, holding the decoded
+hitlists of individual word, phrase and pair index terms; its entries
+are versioned by the last_updated date of their index, see
+get_index_generation(), and the most frequently looked up terms are
+pinned in it, see TermHitlistCache.
+"""
+
+__revision__ = "$Id$"
+
+import heapq
+import marshal
+import os
+import tempfile
+import threading
+import time
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from invenio.config import \
+     CFG_CACHEDIR, \
+     CFG_WEBSEARCH_SEARCH_CACHE_BACKEND, \
+     CFG_WEBSEARCH_SEARCH_CACHE_MAX_BYTES, \
+     CFG_WEBSEARCH_SEARCH_CACHE_SIZE, \
+     CFG_WEBSEARCH_TERM_CACHE_SIZE, \
+     CFG_WEBSEARCH_TERM_CACHE_MAX_BYTES, \
+     CFG_WEBSEARCH_TERM_CACHE_PINNED
+from invenio.dbquery import run_sql
+from invenio.intbitset import intbitset
+
+## how often (in seconds) do we ask the database for the latest
+## record modification date?
+CFG_WEBSEARCH_SEARCH_CACHE_GENERATION_CHECK_INTERVAL = 5
+
+## how many stores do we allow before garbage collecting the disk
+## store?
+CFG_WEBSEARCH_SEARCH_CACHE_DISK_GC_FREQUENCY = 50
+
+def normalize_query_key(p, f, colls_to_search, wl):
+    """
+    Return normalized cache key for a query defined by pattern P,
+    field F, list of collections COLLS_TO_SEARCH and wildcard limit
+    WL.  Queries differing only in whitespace or in the order of
+    collections share the same key.
+    """
+    p = ' '.join(p.split())
+    colls = list(colls_to_search or [])
+    colls.sort()
+    return repr((p, f, colls, wl))
+
+_RECORDS_GENERATION = {'value': None, 'checked': 0}
+
+def get_records_generation(force=False):
+    """
+    Return current records generation, i.e. the latest modification
+    date of any record.  The value is cached in-process and refreshed
+    at most every CFG_WEBSEARCH_SEARCH_CACHE_GENERATION_CHECK_INTERVAL
+    seconds, unless FORCE is set.
+    """
+    now = time.time()
+    if force or _RECORDS_GENERATION['value'] is None or \
+       now - _RECORDS_GENERATION['checked'] > \
+       CFG_WEBSEARCH_SEARCH_CACHE_GENERATION_CHECK_INTERVAL:
+        res = run_sql("SELECT MAX(modification_date) FROM bibrec")
+        if res and res[0][0]:
+            _RECORDS_GENERATION['value'] = str(res[0][0])
+        else:
+            _RECORDS_GENERATION['value'] = ''
+        _RECORDS_GENERATION['checked'] = now
+    return _RECORDS_GENERATION['value']
+
+_INDEX_GENERATIONS = {'value': None, 'checked': 0}
+
+def get_index_generation(index_id, force=False):
+    """
+    Return current generation of index INDEX_ID, i.e. the date when
+    bibindex last updated it.  The values are cached in-process and
+    refreshed at most every
+    CFG_WEBSEARCH_SEARCH_CACHE_GENERATION_CHECK_INTERVAL seconds,
+    unless FORCE is set.
+    """
+    now = time.time()
+    if force or _INDEX_GENERATIONS['value'] is None or \
+       now - _INDEX_GENERATIONS['checked'] > \
+       CFG_WEBSEARCH_SEARCH_CACHE_GENERATION_CHECK_INTERVAL:
+        generations = {}
+        for an_index_id, last_updated in run_sql("SELECT id, last_updated FROM idxINDEX"):
+            generations[an_index_id] = str(last_updated)
+        _INDEX_GENERATIONS['value'] = generations
+        _INDEX_GENERATIONS['checked'] = now
+    return _INDEX_GENERATIONS['value'].get(index_id, '')
+
+def get_hitset_size(hitset):
+    """Return approximate size in bytes of HITSET in memory."""
+    return (hitset.get_allocated() + 1) * hitset.get_wordbytsize()
+
+class SearchResultsCacheBase(object):
+    """
+    Interface of search results cache backends.  Keys are normalized
+    query representations (see normalize_query_key()), values are
+    intbitset hitsets.
+    """
+    def __init__(self, max_entries=0, max_bytes=0):
+        """
+        @param max_entries: maximum number of cached queries (0 for
+            no limit)
+        @param max_bytes: maximum number of bytes taken by cached
+            hitsets (0 for no limit)
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation=None):
+        """
+        Return hitset cached for KEY or None if it is not cached or
+        if it was computed for a records generation different from
+        GENERATION.
+        """
+        raise NotImplementedError
+
+    def set(self, key, hitset, generation=None):
+        """Cache HITSET for KEY computed at records GENERATION."""
+        raise NotImplementedError
+
+    def has_key(self, key, generation=None):
+        """Is there a fresh cached hitset for KEY?  Does not alter
+        hit/miss statistics."""
+        hits, misses = self.hits, self.misses
+        found = self.get(key, generation) is not None
+        self.hits, self.misses = hits, misses
+        return found
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        raise NotImplementedError
+
+    def items(self):
+        """Return list of (key, hitset) tuples of cached queries."""
+        raise NotImplementedError
+
+    def get_stats(self):
+        """
+        Return dictionary with cache statistics: number of entries,
+        number of bytes, hits and misses.
+        """
+        raise NotImplementedError
+
+    def _count(self, hitset):
+        """Update hit/miss counters according to HITSET lookup result."""
+        if hitset is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return hitset
+
+class MemorySearchResultsCache(SearchResultsCacheBase):
+    """
+    In-process least-recently-used search results cache with byte
+    size accounting.  It is shared by the threads of the process, so
+    the entries and their accounting are only touched under a lock.
+    """
+    def __init__(self, max_entries=0, max_bytes=0):
+        SearchResultsCacheBase.__init__(self, max_entries, max_bytes)
+        self.lock = threading.RLock()
+        self.cache = {} # key -> (hitset, size, generation)
+        self.last_used = {} # key -> tick
+        self.tick = 0
+        self.nbytes = 0
+
+    def get(self, key, generation=None):
+        self.lock.acquire()
+        try:
+            try:
+                hitset, dummy_size, entry_generation = self.cache[key]
+            except KeyError:
+                return self._count(None)
+            if generation is not None and entry_generation != generation:
+                self._remove(key)
+                return self._count(None)
+            self.tick += 1
+            self.last_used[key] = self.tick
+            return self._count(hitset)
+        finally:
+            self.lock.release()
+
+    def set(self, key, hitset, generation=None):
+        size = self._get_size(hitset)
+        self.lock.acquire()
+        try:
+            if key in self.cache:
+                self._remove(key)
+            if self.max_bytes and size > self.max_bytes:
+                # would evict everything else without being useful
+                return
+            self.tick += 1
+            self.cache[key] = (hitset, size, generation)
+            self.last_used[key] = self.tick
+            self.nbytes += size
+            self._evict()
+        finally:
+            self.lock.release()
+
+    def _get_size(self, hitset):
+        """Return size in bytes accounted for HITSET."""
+        return get_hitset_size(hitset)
+
+    def _remove(self, key):
+        """Remove KEY from the cache, updating byte accounting."""
+        dummy_hitset, size, dummy_generation = self.cache.pop(key)
+        del self.last_used[key]
+        self.nbytes -= size
+
+    def _evict(self):
+        """Evict least recently used entries until limits are met."""
+        while self.cache and \
+              ((self.max_entries and len(self.cache) > self.max_entries) or
+               (self.max_bytes and self.nbytes > self.max_bytes)):
+            lru_key = min(self.last_used, key=self.last_used.get)
+            self._remove(lru_key)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.cache = {}
+            self.last_used = {}
+            self.nbytes = 0
+        finally:
+            self.lock.release()
+
+    def items(self):
+        self.lock.acquire()
+        try:
+            return [(key, value[0]) for key, value in self.cache.items()]
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        self.lock.acquire()
+        try:
+            return {'entries': len(self.cache),
+                    'bytes': self.nbytes,
+                    'hits': self.hits,
+                    'misses': self.misses}
+        finally:
+            self.lock.release()
+
+class DiskSearchResultsCache(SearchResultsCacheBase):
+    """
+    Search results cache storing serialized hitsets in a local
+    directory, so that they are shared by all processes running on
+    the same host.  Files are written atomically (write to a temporary
+    file and rename), hence readers never see partial entries.  Put
+    the directory on tmpfs to keep it memory-backed.
+    """
+    def __init__(self, dirname, max_entries=0, max_bytes=0):
+        SearchResultsCacheBase.__init__(self, max_entries, max_bytes)
+        self.dirname = dirname
+        self.stores_since_gc = 0
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # maybe created concurrently by another process
+                if not os.path.isdir(dirname):
+                    raise
+
+    def _get_path(self, key):
+        """Return path of the file holding KEY."""
+        return os.path.join(self.dirname, md5(key).hexdigest())
+
+    def _read(self, path):
+        """Return (key, generation, hitset dump) stored in PATH."""
+        return marshal.loads(open(path, 'rb').read())
+
+    def _dump(self, hitset):
+        """Return string representation of HITSET to store."""
+        return hitset.fastdump()
+
+    def _load(self, dump):
+        """Return hitset stored as DUMP, raise ValueError if corrupted."""
+        return intbitset(dump)
+
+    def get(self, key, generation=None):
+        path = self._get_path(key)
+        try:
+            entry_key, entry_generation, dump = self._read(path)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return self._count(None)
+        if entry_key != key:
+            # md5 collision, extremely unlikely
+            return self._count(None)
+        if generation is not None and entry_generation != generation:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return self._count(None)
+        try:
+            hitset = self._load(dump)
+        except ValueError:
+            return self._count(None)
+        return self._count(hitset)
+
+    def set(self, key, hitset, generation=None):
+        data = marshal.dumps((key, generation, self._dump(hitset)))
+        if self.max_bytes and len(data) > self.max_bytes:
+            return
+        fd, tmppath = tempfile.mkstemp(dir=self.dirname, prefix='tmp_')
+        try:
+            os.write(fd, data)
+            os.close(fd)
+            os.rename(tmppath, self._get_path(key))
+        except OSError:
+            try:
+                os.remove(tmppath)
+            except OSError:
+                pass
+            return
+        self.stores_since_gc += 1
+        if self.stores_since_gc >= CFG_WEBSEARCH_SEARCH_CACHE_DISK_GC_FREQUENCY:
+            self.gc()
+
+    def _list_entries(self):
+        """Return list of (mtime, size, path) of the stored entries."""
+        entries = []
+        for filename in os.listdir(self.dirname):
+            if filename.startswith('tmp_'):
+                continue
+            path = os.path.join(self.dirname, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def gc(self):
+        """Remove the oldest entries until limits are met."""
+        self.stores_since_gc = 0
+        if not self.max_entries and not self.max_bytes:
+            return
+        entries = self._list_entries()
+        entries.sort()
+        nbytes = sum([size for dummy_mtime, size, dummy_path in entries])
+        nentries = len(entries)
+        for dummy_mtime, size, path in entries:
+            if not ((self.max_entries and nentries > self.max_entries) or
+                    (self.max_bytes and nbytes > self.max_bytes)):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            nentries -= 1
+            nbytes -= size
+
+    def clear(self):
+        for dummy_mtime, dummy_size, path in self._list_entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def items(self):
+        out = []
+        for dummy_mtime, dummy_size, path in self._list_entries():
+            try:
+                key, dummy_generation, dump = self._read(path)
+                out.append((key, self._load(dump)))
+            except (IOError, OSError, EOFError, ValueError, TypeError):
+                continue
+        return out
+
+    def get_stats(self):
+        entries = self._list_entries()
+        return {'entries': len(entries),
+                'bytes': sum([size for dummy_mtime, size, dummy_path in entries]),
+                'hits': self.hits,
+                'misses': self.misses}
+
+class TermHitlistCache(MemorySearchResultsCache):
+    """
+    In-process cache of index term hitlists.  Like its parent, it is
+    bounded in number of entries and in bytes and evicts the least
+    recently used entries first, except that the PINNED_SIZE terms
+    that were looked up most often are kept as long as the byte limit
+    allows it, since a few very frequent terms with huge hitlists
+    dominate the traffic.  Lookup counts are halved whenever the total
+    exceeds a threshold, so that pinning follows changes in popularity.
+    """
+    def __init__(self, max_entries=0, max_bytes=0, pinned_size=0):
+        MemorySearchResultsCache.__init__(self, max_entries, max_bytes)
+        self.pinned_size = pinned_size
+        self.lookups = {} # key -> number of lookups
+        self.nb_lookups = 0
+
+    def get(self, key, generation=None):
+        self.lock.acquire()
+        try:
+            self.lookups[key] = self.lookups.get(key, 0) + 1
+            self.nb_lookups += 1
+            if self.nb_lookups > 100 * (self.max_entries or 1000):
+                self._decay_lookups()
+            return MemorySearchResultsCache.get(self, key, generation)
+        finally:
+            self.lock.release()
+
+    def _decay_lookups(self):
+        """Halve lookup counts, forgetting keys that drop to zero."""
+        for key, count in self.lookups.items():
+            if count > 1:
+                self.lookups[key] = count / 2
+            else:
+                del self.lookups[key]
+        self.nb_lookups = sum(self.lookups.values())
+
+    def get_pinned_keys(self):
+        """Return dictionary whose keys are the currently pinned keys."""
+        if not self.pinned_size:
+            return {}
+        pinned = {}
+        self.lock.acquire()
+        try:
+            for dummy_count, key in heapq.nlargest(self.pinned_size,
+                                                   [(self.lookups.get(key, 0), key)
+                                                    for key in self.cache]):
+                pinned[key] = 1
+        finally:
+            self.lock.release()
+        return pinned
+
+    def _evict(self):
+        if not self.cache or \
+           not ((self.max_entries and len(self.cache) > self.max_entries) or
+                (self.max_bytes and self.nbytes > self.max_bytes)):
+            return
+        pinned = self.get_pinned_keys()
+        while self.cache and \
+              ((self.max_entries and len(self.cache) > self.max_entries) or
+               (self.max_bytes and self.nbytes > self.max_bytes)):
+            candidates = [key for key in self.last_used if not pinned.has_key(key)]
+            if not candidates:
+                # pinned terms alone exceed the limits
+                candidates = self.last_used.keys()
+            lru_key = min(candidates, key=self.last_used.get)
+            self._remove(lru_key)
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            MemorySearchResultsCache.clear(self)
+            self.lookups = {}
+            self.nb_lookups = 0
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        self.lock.acquire()
+        try:
+            stats = MemorySearchResultsCache.get_stats(self)
+            stats['pinned'] = len(self.get_pinned_keys())
+            return stats
+        finally:
+            self.lock.release()
+
+def get_search_results_cache():
+    """
+    Return search results cache backend as configured by
+    CFG_WEBSEARCH_SEARCH_CACHE_BACKEND ('memory' or 'disk').
+    """
+    if CFG_WEBSEARCH_SEARCH_CACHE_BACKEND == 'disk':
+        return DiskSearchResultsCache(os.path.join(CFG_CACHEDIR, 'search_results'),
+                                      CFG_WEBSEARCH_SEARCH_CACHE_SIZE,
+                                      CFG_WEBSEARCH_SEARCH_CACHE_MAX_BYTES)
+    return MemorySearchResultsCache(CFG_WEBSEARCH_SEARCH_CACHE_SIZE,
+                                    CFG_WEBSEARCH_SEARCH_CACHE_MAX_BYTES)
+
+## term hitlist cache, keyed by (index table name, term):
+term_hitlist_cache = TermHitlistCache(CFG_WEBSEARCH_TERM_CACHE_SIZE,
+                                      CFG_WEBSEARCH_TERM_CACHE_MAX_BYTES,
+                                      CFG_WEBSEARCH_TERM_CACHE_PINNED)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for the search engine results cache."""
+
+__revision__ = \
+    "$Id$"
+
+import shutil
+import tempfile
+import threading
+
+from invenio.testutils import InvenioTestCase
+
+from invenio.intbitset import intbitset
+from invenio.search_engine_cache import MemorySearchResultsCache, \
+     DiskSearchResultsCache, TermHitlistCache, normalize_query_key, \
+     get_hitset_size
+from invenio.testutils import make_test_suite, run_test_suite
+
+class TestNormalizeQueryKey(InvenioTestCase):
+    """Test normalization of cache keys."""
+
+    def test_whitespace_and_collection_order(self):
+        """search engine cache - key normalization"""
+        self.assertEqual(normalize_query_key('ellis  muon ', 'title', ['B', 'A'], 0),
+                         normalize_query_key('ellis muon', 'title', ['A', 'B'], 0))
+        self.assertNotEqual(normalize_query_key('ellis', 'title', ['A'], 0),
+                            normalize_query_key('ellis', 'author', ['A'], 0))
+
+class TestMemorySearchResultsCache(InvenioTestCase):
+    """Test in-process LRU search results cache."""
+
+    def test_get_set(self):
+        """search engine cache - memory get and set"""
+        cache = MemorySearchResultsCache()
+        cache.set('q', intbitset([1, 2, 3]), 'g1')
+        self.assertEqual(cache.get('q', 'g1'), intbitset([1, 2, 3]))
+        self.assertEqual(cache.get('other', 'g1'), None)
+        self.assertEqual(cache.get_stats()['hits'], 1)
+        self.assertEqual(cache.get_stats()['misses'], 1)
+
+    def test_generation_invalidation(self):
+        """search engine cache - memory stale generation"""
+        cache = MemorySearchResultsCache()
+        cache.set('q', intbitset([1, 2, 3]), 'g1')
+        self.assertEqual(cache.get('q', 'g2'), None)
+        self.assertEqual(cache.get_stats()['entries'], 0)
+
+    def test_lru_eviction_by_entries(self):
+        """search engine cache - memory LRU eviction by number of entries"""
+        cache = MemorySearchResultsCache(max_entries=2)
+        cache.set('a', intbitset([1]))
+        cache.set('b', intbitset([2]))
+        cache.get('a')
+        cache.set('c', intbitset([3]))
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), intbitset([1]))
+        self.assertEqual(cache.get('c'), intbitset([3]))
+
+    def test_eviction_by_bytes(self):
+        """search engine cache - memory eviction by size in bytes"""
+        hitset = intbitset(range(10000))
+        cache = MemorySearchResultsCache(max_bytes=get_hitset_size(hitset) * 2)
+        cache.set('a', hitset)
+        cache.set('b', intbitset(hitset))
+        cache.set('c', intbitset(hitset))
+        stats = cache.get_stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assert_(stats['bytes'] <= get_hitset_size(hitset) * 2)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_concurrent_access(self):
+        """search engine cache - memory cache shared by threads"""
+        hitset = intbitset(range(100))
+        cache = MemorySearchResultsCache(max_entries=5)
+        errors = []
+        def worker(offset):
+            try:
+                for i in range(2000):
+                    key = str((i + offset) % 20)
+                    cache.set(key, hitset, i % 3)
+                    cache.get(key, (i + 1) % 3)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        stats = cache.get_stats()
+        self.assert_(stats['entries'] <= 5)
+        self.assertEqual(stats['bytes'], stats['entries'] * get_hitset_size(hitset))
+
+class TestDiskSearchResultsCache(InvenioTestCase):
+    """Test search results cache shared via local disk."""
+
+    def setUp(self):
+        """Create temporary cache directory."""
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove temporary cache directory."""
+        shutil.rmtree(self.dirname)
+
+    def test_shared_between_instances(self):
+        """search engine cache - disk entries are seen by other instances"""
+        DiskSearchResultsCache(self.dirname).set('q', intbitset([5, 7]), 'g1')
+        cache = DiskSearchResultsCache(self.dirname)
+        self.assertEqual(cache.get('q', 'g1'), intbitset([5, 7]))
+        self.assertEqual(cache.get('q', 'g2'), None)
+        self.assertEqual(cache.get('q', 'g1'), None)
+
+    def test_gc(self):
+        """search engine cache - disk garbage collection"""
+        cache = DiskSearchResultsCache(self.dirname, max_entries=3)
+        for i in range(5):
+            cache.set('q%d' % i, intbitset([i]))
+        cache.gc()
+        self.assertEqual(cache.get_stats()['entries'], 3)
+        cache.clear()
+        self.assertEqual(cache.get_stats()['entries'], 0)
+
+class TestTermHitlistCache(InvenioTestCase):
+    """Test term hitlist cache with pinning of frequent terms."""
+
+    def test_frequent_terms_are_pinned(self):
+        """search engine cache - frequent terms survive LRU eviction"""
+        cache = TermHitlistCache(max_entries=2, pinned_size=1)
+        cache.set('the', intbitset([1, 2, 3]), 'g1')
+        for dummy in range(5):
+            cache.get('the', 'g1')
+        cache.set('muon', intbitset([4]), 'g1')
+        cache.get('muon', 'g1')
+        cache.set('higgs', intbitset([5]), 'g1')
+        self.assertEqual(cache.get('the', 'g1'), intbitset([1, 2, 3]))
+        self.assertEqual(cache.get('muon', 'g1'), None)
+        self.assertEqual(cache.get_stats()['pinned'], 1)
+
+    def test_pinned_terms_are_invalidated(self):
+        """search engine cache - pinned terms of updated index are dropped"""
+        cache = TermHitlistCache(max_entries=2, pinned_size=1)
+        cache.set('the', intbitset([1, 2, 3]), 'g1')
+        cache.get('the', 'g1')
+        self.assertEqual(cache.get('the', 'g2'), None)
+        self.assertEqual(cache.get_stats()['entries'], 0)
+
+    def test_concurrent_access(self):
+        """search engine cache - term cache shared by threads"""
+        cache = TermHitlistCache(max_entries=3, pinned_size=1)
+        errors = []
+        def worker(offset):
+            try:
+                for i in range(2000):
+                    key = str((i * offset) % 10)
+                    if cache.get(key, 'g1') is None:
+                        cache.set(key, intbitset([i]), 'g1')
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assert_(cache.get_stats()['entries'] <= 3)
+
+TEST_SUITE = make_test_suite(TestNormalizeQueryKey,
+                             TestMemorySearchResultsCache,
+                             TestDiskSearchResultsCache,
+                             TestTermHitlistCache)
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE)
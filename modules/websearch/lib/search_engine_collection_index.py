@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Record -> collections membership index.
+
+Complements the per-collection reclists of the collection table with
+the reverse mapping.  Every collection is given a bit, and the set of
+collections a record belongs to is its `signature', a bit mask.  The
+index keeps:
+
+    - an array of signature ids indexed by recid, so that the
+      collections of a record are found in O(1);
+
+    - the partition of the records by signature, as one intbitset per
+      signature, so that the records belonging to any combination of
+      collections, or the intersections of a hitset with many
+      collections, are computed with one pass over the (few) distinct
+      signatures instead of one pass per collection.
+
+The index remembers the CRC32 checksum of the reclist of every
+collection it was built from (the same as the one computed by the
+database), so that it can be updated incrementally with the reclists
+that changed only.  WebColl maintains it on disk in
+CFG_COLLECTION_MEMBERSHIP_INDEX_PATH after each reclist update, and
+the search engine loads it from there.
+"""
+
+__revision__ = "$Id$"
+
+import marshal
+import os
+import tempfile
+import zlib
+from array import array
+
+from invenio.config import CFG_CACHEDIR
+from invenio.intbitset import intbitset
+
+CFG_COLLECTION_MEMBERSHIP_INDEX_PATH = os.path.join(CFG_CACHEDIR,
+                                                    'collection_membership.index')
+CFG_COLLECTION_MEMBERSHIP_INDEX_MAGIC = 'INVCOLM1'
+
+def get_reclist_checksum(reclist):
+    """Return the checksum of intbitset RECLIST, as computed by
+    CRC32(reclist) in the collection table."""
+    return zlib.crc32(reclist.fastdump()) & 0xffffffffL
+
+class CollectionMembershipIndex(object):
+    """
+    Index of the collections records belong to.  Collections are
+    identified by their names; records that are in no collection have
+    the empty signature 0, which is not stored in the partition.
+    """
+    def __init__(self):
+        self.checksums = {}
+        self._bits = {}
+        self._free_bits = []
+        self._masks = [0]
+        self._mask_ids = {0: 0}
+        self._mask_names = {0: ()}
+        self._recid_mask_ids = array('H')
+        self._parts = {}
+
+    def _get_mask(self, names):
+        """Return bit mask of collections NAMES."""
+        mask = 0
+        for name in names:
+            mask |= self._bits.get(name, 0)
+        return mask
+
+    def _get_mask_id(self, mask):
+        """Return id of signature MASK, registering it if needed."""
+        mask_id = self._mask_ids.get(mask)
+        if mask_id is None:
+            mask_id = len(self._masks)
+            if mask_id > 0xffff and self._recid_mask_ids.typecode == 'H':
+                self._recid_mask_ids = array('I', self._recid_mask_ids)
+            self._masks.append(mask)
+            self._mask_ids[mask] = mask_id
+        return mask_id
+
+    def get_collection_names(self):
+        """Return list of the names of the indexed collections."""
+        return self._bits.keys()
+
+    def get_recid_mask(self, recid):
+        """Return signature of record RECID."""
+        recid = int(recid)
+        if 0 <= recid < len(self._recid_mask_ids):
+            return self._masks[self._recid_mask_ids[recid]]
+        return 0
+
+    def get_collections(self, recid):
+        """Return tuple of the names of the collections RECID belongs to."""
+        mask = self.get_recid_mask(recid)
+        names = self._mask_names.get(mask)
+        if names is None:
+            names = [name for name, bit in self._bits.iteritems() if mask & bit]
+            names.sort()
+            names = self._mask_names[mask] = tuple(names)
+        return names
+
+    def is_record_in_any_collection(self, recid):
+        """Return True if RECID belongs to at least one collection."""
+        return self.get_recid_mask(recid) != 0
+
+    def is_record_in_collection(self, recid, name):
+        """Return True if RECID belongs to collection NAME."""
+        return bool(self.get_recid_mask(recid) & self._bits.get(name, 0))
+
+    def get_reclist(self, name):
+        """Return intbitset of the records of collection NAME."""
+        return self.get_recids_in_any_of((name,))
+
+    def get_recids_in_any_of(self, names, none_of=()):
+        """
+        Return intbitset of the records belonging to at least one of
+        the collections NAMES but to none of the collections NONE_OF.
+        """
+        mask = self._get_mask(names)
+        excluded_mask = self._get_mask(none_of)
+        ret = intbitset()
+        if mask:
+            for part_mask, part in self._parts.iteritems():
+                if part_mask & mask and not part_mask & excluded_mask:
+                    ret |= part
+        return ret
+
+    def intersect(self, hitset, names):
+        """
+        Return dictionary {name: hitset & reclist of collection name}
+        for every collection of NAMES, computed with one intersection
+        per signature rather than per collection.
+        """
+        bits = [(name, self._bits.get(name, 0)) for name in names]
+        ret = {}
+        for name, dummy_bit in bits:
+            ret[name] = intbitset()
+        mask = self._get_mask(names)
+        if mask and hitset:
+            for part_mask, part in self._parts.iteritems():
+                if not part_mask & mask:
+                    continue
+                hits = hitset & part
+                if not hits:
+                    continue
+                for name, bit in bits:
+                    if part_mask & bit:
+                        ret[name] |= hits
+        return ret
+
+    def update(self, reclists, checksums=None):
+        """
+        Update the index with RECLISTS, dictionary {collection name:
+        intbitset or None if the collection was deleted}.  CHECKSUMS
+        ({collection name: checksum}) may give the precomputed
+        checksums of the reclists.  Only the records whose
+        membership changed are touched.
+        """
+        if checksums is None:
+            checksums = {}
+        parts = dict(self._parts)
+        touched = intbitset()
+        for name, reclist in reclists.items():
+            if reclist is None:
+                reclist = intbitset()
+            bit = self._bits.get(name)
+            if bit is None:
+                if not reclist:
+                    continue
+                if self._free_bits:
+                    bit = self._free_bits.pop()
+                else:
+                    bit = 1L << len(self._bits)
+                    if bit < 0x7fffffff:
+                        bit = int(bit)
+                self._bits[name] = bit
+                self._mask_names = {0: ()}
+                old_reclist = intbitset()
+            else:
+                old_reclist = intbitset()
+                for part_mask, part in parts.iteritems():
+                    if part_mask & bit:
+                        old_reclist |= part
+            added = reclist - old_reclist
+            removed = old_reclist - reclist
+            if added or removed:
+                touched |= added
+                touched |= removed
+                new_parts = {}
+                for part_mask, part in parts.iteritems():
+                    if part_mask & bit:
+                        moved, moved_mask = part & removed, part_mask & ~bit
+                    else:
+                        moved, moved_mask = part & added, part_mask | bit
+                        added -= moved
+                    if moved:
+                        part = part - moved
+                        if moved_mask:
+                            new_parts[moved_mask] = new_parts.get(moved_mask, intbitset()) | moved
+                    if part:
+                        new_parts[part_mask] = new_parts.get(part_mask, intbitset()) | part
+                if added:
+                    # records that were in no collection yet:
+                    new_parts[bit] = new_parts.get(bit, intbitset()) | added
+                parts = new_parts
+            if reclist:
+                if name in checksums:
+                    self.checksums[name] = checksums[name]
+                else:
+                    self.checksums[name] = get_reclist_checksum(reclist)
+            elif name in self._bits:
+                del self._bits[name]
+                self._free_bits.append(bit)
+                self._mask_names = {0: ()}
+                if name in self.checksums:
+                    del self.checksums[name]
+        if not touched:
+            return
+        recid_mask_ids = self._recid_mask_ids
+        if touched[-1] >= len(recid_mask_ids):
+            recid_mask_ids.extend([0] * (touched[-1] + 1 - len(recid_mask_ids)))
+        untouched = intbitset(touched)
+        for part_mask, part in parts.iteritems():
+            hits = part & touched
+            if hits:
+                mask_id = self._get_mask_id(part_mask)
+                recid_mask_ids = self._recid_mask_ids
+                for recid in hits:
+                    recid_mask_ids[recid] = mask_id
+                untouched -= hits
+        recid_mask_ids = self._recid_mask_ids
+        for recid in untouched:
+            recid_mask_ids[recid] = 0
+        self._parts = parts
+        if len(self._masks) > 4 * len(parts) + 256:
+            self._renumber_masks()
+
+    def _renumber_masks(self):
+        """Forget the signatures no record has anymore."""
+        masks = [0]
+        recid_mask_ids = array('H', [0]) * len(self._recid_mask_ids)
+        if len(self._parts) >= 0xffff:
+            recid_mask_ids = array('I', recid_mask_ids)
+        for part_mask, part in self._parts.iteritems():
+            mask_id = len(masks)
+            masks.append(part_mask)
+            for recid in part:
+                recid_mask_ids[recid] = mask_id
+        self._mask_ids = dict([(mask, index) for index, mask in enumerate(masks)])
+        self._masks = masks
+        self._recid_mask_ids = recid_mask_ids
+
+    def synchronize(self, checksums, reclist_loader):
+        """
+        Bring the index up to date with the collections of CHECKSUMS
+        ({collection name: current reclist checksum}), loading the
+        reclists that changed with RECLIST_LOADER(name).  Return the
+        number of updated collections.
+        """
+        reclists = {}
+        for name in self._bits.keys():
+            if name not in checksums:
+                reclists[name] = None
+        for name, checksum in checksums.iteritems():
+            if name not in self.checksums or self.checksums[name] != checksum:
+                reclists[name] = reclist_loader(name)
+        self.update(reclists, dict([(name, checksums[name]) for name in reclists
+                                    if name in checksums]))
+        # empty collections have no bit, but are up to date too:
+        for name, checksum in checksums.iteritems():
+            if name not in self.checksums:
+                self.checksums[name] = checksum
+        return len(reclists)
+
+    def copy(self):
+        """Return a copy of the index that can be updated without
+        changing this one.  The record sets of the partition are
+        shared, since update() replaces them rather than modifying
+        them."""
+        index = CollectionMembershipIndex()
+        index.checksums = dict(self.checksums)
+        index._bits = dict(self._bits)
+        index._free_bits = list(self._free_bits)
+        index._masks = list(self._masks)
+        index._mask_ids = dict(self._mask_ids)
+        index._mask_names = dict(self._mask_names)
+        index._recid_mask_ids = array(self._recid_mask_ids.typecode, self._recid_mask_ids)
+        index._parts = dict(self._parts)
+        return index
+
+    def dumps(self):
+        """Return the index serialized as a string."""
+        return marshal.dumps((CFG_COLLECTION_MEMBERSHIP_INDEX_MAGIC,
+                              self._bits, self.checksums,
+                              self._recid_mask_ids.typecode,
+                              self._recid_mask_ids.tostring(),
+                              self._masks,
+                              [(part_mask, part.fastdump()) for part_mask, part in self._parts.iteritems()]))
+
+    def loads(self, dump):
+        """Return index deserialized from DUMP, as returned by dumps()."""
+        try:
+            magic, bits, checksums, typecode, recid_mask_ids, masks, parts = marshal.loads(dump)
+        except (EOFError, ValueError, TypeError):
+            raise ValueError("corrupted collection membership index")
+        if magic != CFG_COLLECTION_MEMBERSHIP_INDEX_MAGIC:
+            raise ValueError("corrupted collection membership index")
+        index = CollectionMembershipIndex()
+        index._bits = bits
+        index.checksums = checksums
+        index._recid_mask_ids = array(typecode)
+        index._recid_mask_ids.fromstring(recid_mask_ids)
+        index._masks = masks
+        index._mask_ids = dict([(mask, mask_id) for mask_id, mask in enumerate(masks)])
+        all_bits = 0
+        for bit in bits.values():
+            all_bits |= bit
+        index._free_bits = []
+        bit = 1
+        while bit <= all_bits:
+            if not bit & all_bits:
+                index._free_bits.append(bit)
+            bit <<= 1
+        index._parts = dict([(part_mask, intbitset(part)) for part_mask, part in parts])
+        return index
+    loads = classmethod(loads)
+
+def read_collection_membership_index(path=None):
+    """Return CollectionMembershipIndex stored in PATH (by default
+    CFG_COLLECTION_MEMBERSHIP_INDEX_PATH), or None if the file does not
+    exist or is corrupted."""
+    if path is None:
+        path = CFG_COLLECTION_MEMBERSHIP_INDEX_PATH
+    try:
+        dump = open(path, 'rb').read()
+    except IOError:
+        return None
+    try:
+        return CollectionMembershipIndex.loads(dump)
+    except ValueError:
+        return None
+
+def write_collection_membership_index(index, path=None):
+    """Store CollectionMembershipIndex INDEX into PATH (by default
+    CFG_COLLECTION_MEMBERSHIP_INDEX_PATH).  The file is replaced
+    atomically."""
+    if path is None:
+        path = CFG_COLLECTION_MEMBERSHIP_INDEX_PATH
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    fd, tmppath = tempfile.mkstemp(dir=dirname, prefix='tmp_')
+    try:
+        tmpfile = os.fdopen(fd, 'wb')
+        tmpfile.write(index.dumps())
+        tmpfile.close()
+        os.chmod(tmppath, 0644)
+        os.rename(tmppath, path)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
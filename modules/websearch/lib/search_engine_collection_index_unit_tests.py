@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for the record -> collections membership index."""
+
+__revision__ = "$Id$"
+
+import os
+import shutil
+import tempfile
+
+from invenio.testutils import InvenioTestCase
+
+from invenio.intbitset import intbitset
+from invenio.search_engine_collection_index import CollectionMembershipIndex, \
+     get_reclist_checksum, read_collection_membership_index, \
+     write_collection_membership_index
+from invenio.testutils import make_test_suite, run_test_suite
+
+RECLISTS = {'Articles': intbitset([1, 2, 3, 4]),
+            'Preprints': intbitset([3, 4, 5]),
+            'Theses': intbitset([6]),
+            'Atlantis Institute of Fictive Science': intbitset([1, 2, 3, 4, 5, 6])}
+
+class TestCollectionMembershipIndex(InvenioTestCase):
+    """Test building, updating and storing membership indexes."""
+
+    def setUp(self):
+        """Create index of RECLISTS and temporary directory."""
+        self.index = CollectionMembershipIndex()
+        self.index.update(RECLISTS)
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove temporary directory."""
+        shutil.rmtree(self.dirname)
+
+    def test_lookups(self):
+        """collection index - collections of records"""
+        self.assertEqual(self.index.get_collections(3),
+                         ('Articles', 'Atlantis Institute of Fictive Science', 'Preprints'))
+        self.assertEqual(self.index.get_collections(6),
+                         ('Atlantis Institute of Fictive Science', 'Theses'))
+        self.assertEqual(self.index.get_collections(7), ())
+        self.assertEqual(self.index.get_collections(100), ())
+        self.assert_(self.index.is_record_in_any_collection(5))
+        self.failIf(self.index.is_record_in_any_collection(0))
+        self.assert_(self.index.is_record_in_collection(5, 'Preprints'))
+        self.failIf(self.index.is_record_in_collection(5, 'Articles'))
+        for name, reclist in RECLISTS.items():
+            self.assertEqual(self.index.get_reclist(name), reclist)
+
+    def test_set_operations(self):
+        """collection index - intersections and unions of collections"""
+        hitset = intbitset([2, 3, 5, 7])
+        results = self.index.intersect(hitset, ['Articles', 'Preprints', 'Books'])
+        self.assertEqual(results, {'Articles': intbitset([2, 3]),
+                                   'Preprints': intbitset([3, 5]),
+                                   'Books': intbitset()})
+        self.assertEqual(self.index.get_recids_in_any_of(['Preprints', 'Theses']),
+                         intbitset([3, 4, 5, 6]))
+        self.assertEqual(self.index.get_recids_in_any_of(['Preprints'], none_of=['Articles']),
+                         intbitset([5]))
+
+    def test_incremental_update(self):
+        """collection index - incremental updates"""
+        self.index.update({'Theses': intbitset([1, 7]),
+                           'Preprints': None,
+                           'Books': intbitset([8])})
+        self.assertEqual(self.index.get_collections(6),
+                         ('Atlantis Institute of Fictive Science',))
+        self.assertEqual(self.index.get_collections(7), ('Theses',))
+        self.assertEqual(self.index.get_collections(8), ('Books',))
+        self.assertEqual(self.index.get_reclist('Preprints'), intbitset())
+        self.failIf('Preprints' in self.index.get_collection_names())
+
+    def test_synchronize(self):
+        """collection index - synchronization with reclist checksums"""
+        checksums = dict([(name, get_reclist_checksum(reclist))
+                          for name, reclist in RECLISTS.items()])
+        loads = []
+        def loader(name):
+            loads.append(name)
+            return intbitset([9])
+        self.assertEqual(self.index.synchronize(checksums, loader), 0)
+        checksums['Theses'] = get_reclist_checksum(intbitset([9]))
+        self.assertEqual(self.index.synchronize(checksums, loader), 1)
+        self.assertEqual(loads, ['Theses'])
+        self.assertEqual(self.index.get_collections(9), ('Theses',))
+
+    def test_copy(self):
+        """collection index - updating a copy leaves the original alone"""
+        index = self.index.copy()
+        checksums = dict(self.index.checksums)
+        checksums['Theses'] = get_reclist_checksum(intbitset([3, 9]))
+        index.synchronize(checksums, lambda name: intbitset([3, 9]))
+        self.assertEqual(index.get_collections(9), ('Theses',))
+        self.assertEqual(index.get_reclist('Theses'), intbitset([3, 9]))
+        self.assertEqual(self.index.get_collections(9), ())
+        self.assertEqual(self.index.get_collections(3),
+                         ('Articles', 'Atlantis Institute of Fictive Science', 'Preprints'))
+        for name, reclist in RECLISTS.items():
+            self.assertEqual(self.index.get_reclist(name), reclist)
+        self.assertEqual(self.index.checksums['Theses'], get_reclist_checksum(RECLISTS['Theses']))
+
+    def test_storage(self):
+        """collection index - reading and writing index files"""
+        path = os.path.join(self.dirname, 'collection_membership.index')
+        self.assertEqual(read_collection_membership_index(path), None)
+        write_collection_membership_index(self.index, path)
+        index = read_collection_membership_index(path)
+        self.assertEqual(index.get_collections(3), self.index.get_collections(3))
+        self.assertEqual(index.checksums, self.index.checksums)
+        open(path, 'wb').write('not an index')
+        self.assertEqual(read_collection_membership_index(path), None)
+
+TEST_SUITE = make_test_suite(TestCollectionMembershipIndex,)
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE)
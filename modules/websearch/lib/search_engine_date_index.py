@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Record dates index.
+
+Keeps, for the modification_date and the creation_date columns of the
+bibrec table, one intbitset of records per day.  The records created
+or modified between two dates are then the union of the bitsets of
+the days in between, plus small range queries for the first and the
+last day when they are not entirely covered, instead of a range scan
+over the whole bibrec table.
+
+Only the days before a horizon, CFG_RECORD_DATES_INDEX_OVERLAP days
+ago, are indexed, since bibupload stamps every record it updates with
+the local time of that update: the last days keep receiving records
+while tasks run, and a record indexed under an older day moves to the
+current one as soon as it is modified again.  The dates of the records
+of the last days are therefore read from the database at every query,
+which the date keys of bibrec make cheap, and the records found there
+are removed from the older days they were indexed under.  The horizon
+moves forward once a day, by indexing only the records of the days it
+passes over.  The indexes are shared by the processes of the host
+through files in CFG_RECORD_DATES_INDEX_DIR, and rebuilt from scratch
+every CFG_RECORD_DATES_INDEX_MAX_AGE seconds in order to forget the
+records removed from bibrec.
+
+Use get_recids_modified_between() and get_recids_created_between().
+"""
+
+__revision__ = "$Id$"
+
+import marshal
+import os
+import re
+import tempfile
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+from invenio.config import CFG_CACHEDIR
+from invenio.dbquery import run_sql
+from invenio.intbitset import intbitset
+
+CFG_RECORD_DATES_INDEX_DIR = os.path.join(CFG_CACHEDIR, 'record_dates')
+CFG_RECORD_DATES_INDEX_MAGIC = 'INVDATE1'
+## for how many days are dates read from the database rather than from
+## the index?
+CFG_RECORD_DATES_INDEX_OVERLAP = 1
+## how often (in seconds) are indexes rebuilt from scratch?
+CFG_RECORD_DATES_INDEX_MAX_AGE = 86400
+
+_RE_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}( \d{2}:\d{2}:\d{2})?$')
+_EARLIEST_DATE = '0000-00-00 00:00:00'
+_MIDNIGHT = ' 00:00:00'
+
+def _normalize_date(date):
+    """Return DATE (string or datetime) as 'YYYY-MM-DD HH:MM:SS', the
+    way MySQL compares it with a datetime column.  Raise ValueError if
+    it does not look like a date."""
+    date = str(date)[:19]
+    if not _RE_DATE.match(date):
+        raise ValueError("invalid date %s" % repr(date))
+    if len(date) == 10:
+        date += _MIDNIGHT
+    return date
+
+def _add_seconds(date, seconds):
+    """Return normalized DATE shifted by SECONDS."""
+    date = datetime(*time.strptime(date, '%Y-%m-%d %H:%M:%S')[:6])
+    return (date + timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+class RecordDatesIndex(object):
+    """Per-day index of the records by the date of column FIELD of the
+    bibrec table."""
+
+    def __init__(self, field):
+        assert field in ('modification_date', 'creation_date')
+        self.field = field
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget all the indexed records."""
+        self.days = {}
+        self.sorted_days = []
+        self.horizon = _EARLIEST_DATE
+        self.built = time.time()
+
+    def get_path(self):
+        """Return path of the file of the index."""
+        return os.path.join(CFG_RECORD_DATES_INDEX_DIR, '%s.index' % self.field)
+
+    def load(self):
+        """Read the index from its file.  Return False if the file
+        does not exist or is corrupted."""
+        try:
+            magic, field, horizon, built, days = marshal.loads(open(self.get_path(), 'rb').read())
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        if magic != CFG_RECORD_DATES_INDEX_MAGIC or field != self.field:
+            return False
+        self.days = dict([(day, intbitset(dump)) for day, dump in days])
+        self.sorted_days = self.days.keys()
+        self.sorted_days.sort()
+        self.horizon = horizon
+        self.built = built
+        return True
+
+    def save(self):
+        """Write the index into its file, atomically."""
+        if not os.path.isdir(CFG_RECORD_DATES_INDEX_DIR):
+            try:
+                os.makedirs(CFG_RECORD_DATES_INDEX_DIR)
+            except OSError:
+                if not os.path.isdir(CFG_RECORD_DATES_INDEX_DIR):
+                    raise
+        dump = marshal.dumps((CFG_RECORD_DATES_INDEX_MAGIC, self.field,
+                              self.horizon, self.built,
+                              [(day, recids.fastdump()) for day, recids in self.days.iteritems()]))
+        fd, tmppath = tempfile.mkstemp(dir=CFG_RECORD_DATES_INDEX_DIR, prefix='tmp_')
+        try:
+            tmpfile = os.fdopen(fd, 'wb')
+            tmpfile.write(dump)
+            tmpfile.close()
+            os.chmod(tmppath, 0644)
+            os.rename(tmppath, self.get_path())
+        except:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+    def move_horizon(self, horizon):
+        """Index the records dated between the current horizon and the
+        new HORIZON, and remove from the index the records dated after
+        the current horizon."""
+        res = run_sql("SELECT id, DATE_FORMAT(%s, '%%%%Y-%%%%m-%%%%d') FROM bibrec WHERE %s>=%%s" % \
+                      (self.field, self.field), (self.horizon,))
+        moved = intbitset([row[0] for row in res])
+        for day in self.sorted_days:
+            if self.days[day] & moved:
+                self.days[day] -= moved
+        new_day = horizon[:10]
+        for recid, day in res:
+            if day < new_day:
+                self.days.setdefault(day, intbitset()).add(recid)
+        for day in self.days.keys():
+            if not self.days[day]:
+                del self.days[day]
+        sorted_days = self.days.keys()
+        sorted_days.sort()
+        self.sorted_days = sorted_days
+        self.horizon = horizon
+
+    def refresh(self):
+        """Load or rebuild the index if needed, and move its horizon
+        to CFG_RECORD_DATES_INDEX_OVERLAP days ago."""
+        if time.time() - self.built > CFG_RECORD_DATES_INDEX_MAX_AGE:
+            if not self.load() or time.time() - self.built > CFG_RECORD_DATES_INDEX_MAX_AGE:
+                self.reset()
+        horizon = (datetime.now() - timedelta(days=CFG_RECORD_DATES_INDEX_OVERLAP)).strftime('%Y-%m-%d') + _MIDNIGHT
+        if horizon > self.horizon:
+            self.move_horizon(horizon)
+            try:
+                self.save()
+            except (IOError, OSError):
+                # the index is still valid in memory
+                pass
+
+    def _get_recids_by_query(self, fromdate, untildate):
+        """Return records dated from FROMDATE, inclusive, until
+        UNTILDATE, exclusive, by querying the database."""
+        return intbitset(run_sql("SELECT id FROM bibrec WHERE %s>=%%s AND %s<%%s" % \
+                                 (self.field, self.field), (fromdate, untildate)))
+
+    def get_recids(self, fromdate=None, untildate=None, until_exclusive=False):
+        """
+        Return intbitset of the records whose date is between FROMDATE
+        and UNTILDATE, inclusive, unless UNTIL_EXCLUSIVE is set.  None
+        means no bound.  Dates are compared as MySQL does, i.e.
+        '2013-01-31' stands for '2013-01-31 00:00:00'.  Raise
+        ValueError if the dates cannot be understood.
+        """
+        if fromdate is None:
+            fromdate = _EARLIEST_DATE
+        else:
+            fromdate = _normalize_date(fromdate)
+        if untildate is not None:
+            untildate = _normalize_date(untildate)
+            if not until_exclusive:
+                ## dates have a resolution of one second
+                untildate = _add_seconds(untildate, 1)
+        self.lock.acquire()
+        try:
+            self.refresh()
+            horizon = self.horizon
+            ## recent records are looked up in the database
+            recent = run_sql("SELECT id, DATE_FORMAT(%s, '%%%%Y-%%%%m-%%%%d %%%%H:%%%%i:%%%%s') FROM bibrec WHERE %s>=%%s" % \
+                             (self.field, self.field), (horizon,))
+            ret = intbitset([recid for recid, date in recent
+                             if date >= fromdate and (untildate is None or date < untildate)])
+            if fromdate >= horizon:
+                return ret
+            if untildate is None or untildate > horizon:
+                untildate = horizon
+            if untildate <= fromdate:
+                return ret
+            if fromdate[:10] == untildate[:10]:
+                return ret | self._get_recids_by_query(fromdate, untildate)
+            ## whole days come from the index, the others from the
+            ## database
+            if fromdate.endswith(_MIDNIGHT):
+                first_day = bisect_left(self.sorted_days, fromdate[:10])
+            else:
+                first_day = bisect_right(self.sorted_days, fromdate[:10])
+                ret |= self._get_recids_by_query(fromdate, _add_seconds(fromdate[:10] + _MIDNIGHT, 86400))
+            last_day = bisect_left(self.sorted_days, untildate[:10])
+            indexed = intbitset()
+            for day in self.sorted_days[first_day:last_day]:
+                indexed |= self.days[day]
+            ret |= indexed - intbitset([row[0] for row in recent])
+            if not untildate.endswith(_MIDNIGHT):
+                ret |= self._get_recids_by_query(untildate[:10] + _MIDNIGHT, untildate)
+            return ret
+        finally:
+            self.lock.release()
+
+_record_dates_indexes = {}
+
+def get_record_dates_index(field):
+    """Return RecordDatesIndex of FIELD, 'modification_date' or
+    'creation_date'."""
+    index = _record_dates_indexes.get(field)
+    if index is None:
+        index = RecordDatesIndex(field)
+        index.built = 0 # load it from its file at first use
+        _record_dates_indexes[field] = index
+    return index
+
+def _get_recids_between(field, fromdate, untildate, until_exclusive):
+    """Return records whose FIELD date is in the given range, using
+    the index if the dates can be understood by it."""
+    try:
+        return get_record_dates_index(field).get_recids(fromdate, untildate, until_exclusive)
+    except ValueError:
+        ## let the database interpret the dates
+        query = "SELECT id FROM bibrec WHERE 1=1"
+        params = []
+        if fromdate is not None:
+            query += " AND %s>=%%s" % field
+            params.append(fromdate)
+        if untildate is not None:
+            if until_exclusive:
+                query += " AND %s<%%s" % field
+            else:
+                query += " AND %s<=%%s" % field
+            params.append(untildate)
+        return intbitset(run_sql(query, tuple(params)))
+
+def get_recids_modified_between(fromdate=None, untildate=None, until_exclusive=False):
+    """Return intbitset of the records modified between FROMDATE and
+    UNTILDATE (see RecordDatesIndex.get_recids())."""
+    return _get_recids_between('modification_date', fromdate, untildate, until_exclusive)
+
+def get_recids_created_between(fromdate=None, untildate=None, until_exclusive=False):
+    """Return intbitset of the records created between FROMDATE and
+    UNTILDATE (see RecordDatesIndex.get_recids())."""
+    return _get_recids_between('creation_date', fromdate, untildate, until_exclusive)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2013 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Regression tests for the record dates index."""
+
+__revision__ = "$Id$"
+
+import shutil
+import tempfile
+
+from invenio.testutils import InvenioTestCase
+
+from invenio.dbquery import run_sql
+from invenio.intbitset import intbitset
+from invenio import search_engine_date_index
+from invenio.search_engine_date_index import RecordDatesIndex, \
+     get_recids_modified_between, get_recids_created_between
+from invenio.testutils import make_test_suite, run_test_suite
+
+class TestRecordDatesIndex(InvenioTestCase):
+    """Compare the index with range queries on the bibrec table."""
+
+    def setUp(self):
+        """Use a temporary directory for the index files."""
+        self.dirname = tempfile.mkdtemp()
+        self.old_dirname = search_engine_date_index.CFG_RECORD_DATES_INDEX_DIR
+        self.old_overlap = search_engine_date_index.CFG_RECORD_DATES_INDEX_OVERLAP
+        search_engine_date_index.CFG_RECORD_DATES_INDEX_DIR = self.dirname
+
+    def tearDown(self):
+        """Restore the configuration."""
+        search_engine_date_index.CFG_RECORD_DATES_INDEX_DIR = self.old_dirname
+        search_engine_date_index.CFG_RECORD_DATES_INDEX_OVERLAP = self.old_overlap
+        shutil.rmtree(self.dirname)
+
+    def _check_ranges(self, field):
+        """Check various ranges of dates of FIELD."""
+        index = RecordDatesIndex(field)
+        dates = [str(row[0]) for row in run_sql("SELECT DISTINCT %s FROM bibrec ORDER BY %s" % (field, field))]
+        bounds = [None, '1970-01-01', '2100-01-01'] + dates[:3] + dates[-3:] + \
+                 [date[:10] for date in dates[-3:]]
+        for fromdate in bounds:
+            for untildate in bounds:
+                for until_exclusive in (False, True):
+                    query = "SELECT id FROM bibrec WHERE 1=1"
+                    params = []
+                    if fromdate is not None:
+                        query += " AND %s>=%%s" % field
+                        params.append(fromdate)
+                    if untildate is not None:
+                        query += " AND %s%s%%s" % (field, until_exclusive and '<' or '<=')
+                        params.append(untildate)
+                    self.assertEqual(index.get_recids(fromdate, untildate, until_exclusive),
+                                     intbitset(run_sql(query, tuple(params))),
+                                     "%s from %s until %s" % (field, fromdate, untildate))
+
+    def test_recent_dates(self):
+        """date index - dates read from the database"""
+        search_engine_date_index.CFG_RECORD_DATES_INDEX_OVERLAP = 100000
+        self._check_ranges('modification_date')
+        self._check_ranges('creation_date')
+
+    def test_indexed_dates(self):
+        """date index - dates read from the index"""
+        search_engine_date_index.CFG_RECORD_DATES_INDEX_OVERLAP = -1
+        self._check_ranges('modification_date')
+        self._check_ranges('creation_date')
+
+    def test_storage(self):
+        """date index - reading and writing index files"""
+        search_engine_date_index.CFG_RECORD_DATES_INDEX_OVERLAP = -1
+        index = RecordDatesIndex('creation_date')
+        index.refresh()
+        loaded = RecordDatesIndex('creation_date')
+        self.assert_(loaded.load())
+        self.assertEqual(loaded.horizon, index.horizon)
+        self.assertEqual(loaded.days, index.days)
+        self.failIf(RecordDatesIndex('modification_date').load())
+
+    def test_invalid_dates(self):
+        """date index - dates not understood by the index"""
+        self.assertRaises(ValueError, RecordDatesIndex('creation_date').get_recids, '2013')
+        self.assertEqual(get_recids_created_between('1970'),
+                         intbitset(run_sql("SELECT id FROM bibrec WHERE creation_date>='1970'")))
+        self.assertEqual(get_recids_modified_between(untildate='2100'),
+                         intbitset(run_sql("SELECT id FROM bibrec WHERE modification_date<='2100'")))
+
+TEST_SUITE = make_test_suite(TestRecordDatesIndex,)
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE, warn_user=True)
@@ -4699,6 +4699,85 @@ class WebSearchGetRecordTests(InvenioTestCase):
         self.assertEqual(get_record(self.recid), {'001': [([], ' ', ' ', str(self.recid), 1)]})
 
 
+class WebSearchPrefetchRecordsTest(InvenioTestCase):
+    """Test loading records of result pages in batches."""
+
+    def test_records_exist(self):
+        """websearch - batched record existence checks"""
+        from invenio.search_engine import record_exists, records_exist
+        recids = range(1, 110) + [-1, 1000000]
+        existence = records_exist(recids)
+        for recid in recids:
+            self.assertEqual(existence[recid], record_exists(recid))
+
+    def test_prefetched_modification_dates(self):
+        """websearch - formatted record generations of prefetched records"""
+        from invenio.search_engine import prefetch_records, clear_prefetched_records
+        from invenio.bibformat_cache import get_formatted_record_generation
+        recids = [1, 10, 77, 1000000]
+        generations = [get_formatted_record_generation(recid) for recid in recids]
+        prefetched = prefetch_records(recids)
+        try:
+            self.assertEqual([get_formatted_record_generation(recid) for recid in recids],
+                             generations)
+        finally:
+            clear_prefetched_records(prefetched)
+
+    def test_get_records(self):
+        """websearch - batched record structure loading"""
+        from invenio.search_engine import get_record, get_records
+        records = get_records([1, 10, 77])
+        for recid in (1, 10, 77):
+            self.assertEqual(records[recid], get_record(recid))
+
+    def test_prefetched_formatting(self):
+        """websearch - formatting prefetched records"""
+        from invenio.search_engine import print_record, prefetch_records, \
+             clear_prefetched_records
+        recids = [1, 8, 10, 77, 1000000]
+        expected = [print_record(recid, 'hb') for recid in recids] + \
+                   [print_record(recid, 'xm') for recid in recids]
+        prefetched = prefetch_records(recids, 'hb')
+        try:
+            self.assertEqual(prefetched, recids)
+            got = [print_record(recid, 'hb') for recid in recids] + \
+                  [print_record(recid, 'xm') for recid in recids]
+        finally:
+            clear_prefetched_records(prefetched)
+        self.assertEqual(got, expected)
+
+
+class WebSearchPhraseTermVariantsTest(InvenioTestCase):
+    """Test phrase terms stored in several rows differing in case."""
+
+    def setUp(self):
+        """Add two case variants of a phrase to the author index."""
+        from invenio.search_engine import term_hitlist_cache
+        run_sql("INSERT INTO idxPHRASE04F (term, hitlist) VALUES (%s, %s)",
+                ('Testvariant, Z', intbitset([1]).fastdump()))
+        run_sql("INSERT INTO idxPHRASE04F (term, hitlist) VALUES (%s, %s)",
+                ('testvariant, z', intbitset([2]).fastdump()))
+        term_hitlist_cache.clear()
+
+    def tearDown(self):
+        """Remove the case variants."""
+        from invenio.search_engine import term_hitlist_cache
+        # the collation matches both variants
+        run_sql("DELETE FROM idxPHRASE04F WHERE term=%s", ('testvariant, z',))
+        term_hitlist_cache.clear()
+
+    def test_phrase_term_variants(self):
+        """websearch - union of the phrase rows of case variants"""
+        from invenio.search_engine import search_terms_in_index_table
+        for dummy in range(2):
+            hitsets = search_terms_in_index_table('idxPHRASE04F', 4,
+                                                  ['Testvariant, Z', 'Ellis, J'])
+            self.assertEqual(hitsets['Testvariant, Z'], intbitset([1, 2]))
+            self.assertEqual(search_terms_in_index_table('idxPHRASE04F', 4,
+                                                         ['testvariant, z']),
+                             {'testvariant, z': intbitset([1, 2])})
+
+
 class WebSearchExactTitleIndexTest(InvenioTestCase):
     """Checks if exact title index works correctly """
 
@@ -4814,6 +4893,8 @@ TEST_SUITE = make_test_suite(WebSearchWebPagesAvailabilityTest,
                              WebSearchFiletypeQueryTest,
                              WebSearchPerformRequestSearchRefactoringTest,
                              WebSearchGetRecordTests,
+                             WebSearchPrefetchRecordsTest,
+                             WebSearchPhraseTermVariantsTest,
                              WebSearchExactTitleIndexTest,
                              WebSearchCJKTokenizedSearchTest,
                              WebSearchItemCountQueryTest,
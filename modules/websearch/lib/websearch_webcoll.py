@@ -49,6 +49,8 @@ from invenio.dateutils import convert_datestruct_to_dategui, strftime
 from invenio.bibformat import format_record
 from invenio.shellutils import mymkdir
 from invenio.intbitset import intbitset
+from invenio.search_engine_collection_index import CollectionMembershipIndex, \
+     read_collection_membership_index, write_collection_membership_index
 from invenio.websearch_external_collections import \
      external_collection_load_states, \
      dico_collection_external_searches, \
@@ -1108,6 +1110,37 @@ def task_submit_check_options():
             return False
     return True
 
+def update_collection_membership_index(colls):
+    """
+    Bring the record -> collections index file up to date with the
+    reclists stored in the collection table, using the freshly
+    calculated reclists of COLLS and reading from the database only
+    the other reclists that changed since the last update.
+    """
+    index = read_collection_membership_index() or CollectionMembershipIndex()
+    reclists = {}
+    for coll in colls:
+        reclists[coll.name] = coll.reclist
+    def get_reclist(name):
+        "Return the current reclist of collection NAME."
+        if name in reclists:
+            return reclists[name]
+        res = run_sql("SELECT reclist FROM collection WHERE name=%s", (name,))
+        if res and res[0][0]:
+            return intbitset(res[0][0])
+        return intbitset()
+    checksums = {}
+    for name, checksum in run_sql("SELECT name, CRC32(reclist) FROM collection"):
+        checksums[name] = checksum
+    nb_updated = index.synchronize(checksums, get_reclist)
+    if nb_updated:
+        try:
+            write_collection_membership_index(index)
+        except (IOError, OSError), e:
+            write_message("Cannot write collection membership index: %s" % e, stream=sys.stderr)
+            return
+    write_message("Collection membership index: %d collections updated." % nb_updated, verbose=3)
+
 def task_run_core():
     """ Reimplement to add the body of the task."""
 ##
@@ -1170,6 +1203,7 @@ def task_run_core():
                 coll.update_reclist()
                 task_update_progress("Part 1/2: done %d/%d" % (i, len(colls)))
                 task_sleep_now_if_required(can_stop_too=True)
+            update_collection_membership_index(colls)
         # thirdly, update collection webpage cache:
         if task_get_option("part", 2) == 2:
             i = 0
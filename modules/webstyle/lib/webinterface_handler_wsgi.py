@@ -46,8 +46,12 @@ from invenio.webinterface_handler_config import \
     HTTP_NOT_FOUND, HTTP_INTERNAL_SERVER_ERROR
 from invenio.config import CFG_WEBDIR, CFG_SITE_LANG, \
     CFG_WEBSTYLE_HTTP_STATUS_ALERT_LIST, CFG_DEVEL_SITE, CFG_SITE_URL, \
-    CFG_SITE_SECURE_URL, CFG_WEBSTYLE_REVERSE_PROXY_IPS
+    CFG_SITE_SECURE_URL, CFG_WEBSTYLE_REVERSE_PROXY_IPS, \
+    CFG_MISCUTIL_SQL_PROFILER
 from invenio.errorlib import register_exception, get_pretty_traceback
+from invenio.dbquery import release_all_connections
+from invenio.dbquery_profiler import start_request_profile, \
+    stop_request_profile, log_query_profile
 
 ## Static files are usually handled directly by the webserver (e.g. Apache)
 ## However in case WSGI is required to handle static files too (such
@@ -471,6 +475,8 @@ def application(environ, start_response):
     ## Needed for mod_wsgi, see: <http://code.google.com/p/modwsgi/wiki/ApplicationIssues>
     req = SimulatedModPythonRequest(environ, start_response)
     #print 'Starting mod_python simulation'
+    if CFG_MISCUTIL_SQL_PROFILER:
+        start_request_profile()
     try:
         try:
             if (CFG_FULL_HTTPS or (CFG_HAS_HTTPS_SUPPORT and get_session(req).need_https)) and not req.is_https():
@@ -566,6 +572,13 @@ def application(environ, start_response):
         for (callback, data) in req.get_cleanups():
             callback(data)
 
+        ## give database connections back to the pool, so that they
+        ## can be reused by other threads:
+        release_all_connections()
+
+        if CFG_MISCUTIL_SQL_PROFILER:
+            log_query_profile(stop_request_profile(), context=req.unparsed_uri)
+
         ## as suggested in
         ## <http://www.python.org/doc/2.3.5/lib/module-gc.html>
         gc.enable()